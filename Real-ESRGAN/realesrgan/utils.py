@@ -1,15 +1,19 @@
 import cv2
+import logging
 import math
 import numpy as np
 import os
 import queue
 import threading
 import torch
+from contextlib import nullcontext
 from basicsr.utils.download_util import load_file_from_url
 from torch.nn import functional as F
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+logger = logging.getLogger(__name__)
+
 
 class RealESRGANer():
     """A helper class for upsampling images with RealESRGAN.
@@ -114,11 +118,19 @@ class RealESRGANer():
         # model inference
         self.output = self.model(self.img)
 
-    def tile_process(self):
+    def tile_process(self, progress_callback=None, cancel=None, trace=None):
         """It will first crop input images to tiles, and then process each tile.
         Finally, all the processed tiles are merged into one images.
 
         Modified from: https://github.com/ata4/esrgan-launcher
+
+        Args:
+            progress_callback (callable): Called as ``progress_callback(done, total)`` after each tile.
+                Default: None.
+            cancel (object): Cancellation token; ``cancel.check()`` is called before each tile and
+                raises to stop. Default: None.
+            trace (callable): Called as ``trace('tile', **attributes)`` for a context manager around
+                each tile's inference. Default: None.
         """
         batch, channel, height, width = self.img.shape
         output_height = height * self.scale
@@ -133,6 +145,8 @@ class RealESRGANer():
         # loop over all tiles
         for y in range(tiles_y):
             for x in range(tiles_x):
+                if cancel is not None:
+                    cancel.check()
                 # extract tile from input image
                 ofs_x = x * self.tile_size
                 ofs_y = y * self.tile_size
@@ -156,11 +170,14 @@ class RealESRGANer():
 
                 # upscale tile
                 try:
-                    with torch.no_grad():
+                    with torch.no_grad(), tile_span(trace, tile_idx, x, y, input_tile):
                         output_tile = self.model(input_tile)
                 except RuntimeError as error:
-                    print('Error', error)
-                print(f'\tTile {tile_idx}/{tiles_x * tiles_y}')
+                    logger.error(f'Error {error}')
+                # Tagged so a log setup can sample the per-tile lines
+                logger.debug('Tile %d/%d', tile_idx, tiles_x * tiles_y, extra={'event': 'tile'})
+                if progress_callback is not None:
+                    progress_callback(tile_idx, tiles_x * tiles_y)
 
                 # output tile area on total image
                 output_start_x = input_start_x * self.scale
@@ -190,14 +207,53 @@ class RealESRGANer():
             self.output = self.output[:, :, 0:h - self.pre_pad * self.scale, 0:w - self.pre_pad * self.scale]
         return self.output
 
+    def _run(self, progress_callback=None, cancel=None, trace=None):
+        if cancel is not None:
+            cancel.check()
+        if self.tile_size > 0:
+            self.tile_process(progress_callback, cancel, trace)
+        else:
+            with tile_span(trace, 1, 0, 0, self.img):
+                self.process()
+            if progress_callback is not None:
+                progress_callback(1, 1)
+
     @torch.no_grad()
-    def enhance(self, img, outscale=None, alpha_upsampler='realesrgan'):
+    def enhance(self, img, outscale=None, alpha_upsampler='realesrgan', progress_callback=None, cancel=None,
+                trace=None):
+        """Upsample an image.
+
+        Args:
+            img (ndarray): BGR, BGRA or gray image, 8-bit or 16-bit.
+            outscale (float): Final scale of the output. Default: None, the network scale.
+            alpha_upsampler (str): 'realesrgan' runs the alpha channel through the network as a
+                second pass; anything else resizes it. Default: 'realesrgan'.
+            progress_callback (callable): Called as ``progress_callback(done, total)`` as each pass
+                progresses (once per tile when tiling). Default: None.
+            cancel (object): Cancellation token checked before each pass and tile; whatever its
+                ``check()`` raises stops the upsampling and frees the intermediate tensors.
+                Default: None.
+            trace (callable): Called as ``trace(name, **attributes)`` for a context manager timing
+                each step: 'pre_process', 'pass' (per network pass) and 'tile' within it,
+                'post_process' and 'resize'. Use it to plug in tracing spans. Default: None.
+        """
+        try:
+            return self._enhance(img, outscale, alpha_upsampler, progress_callback, cancel, trace)
+        except BaseException:
+            # Drop the padded input and partial output now rather than at the next image
+            self.img = self.output = None
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            raise
+
+    def _enhance(self, img, outscale, alpha_upsampler, progress_callback, cancel, trace):
+        step = trace or (lambda name, **attributes: nullcontext())
         h_input, w_input = img.shape[0:2]
         # img: numpy
         img = img.astype(np.float32)
         if np.max(img) > 256:  # 16-bit image
             max_range = 65535
-            print('\tInput is a 16-bit image')
+            logger.debug('Input is a 16-bit image')
         else:
             max_range = 255
         img = img / max_range
@@ -216,13 +272,13 @@ class RealESRGANer():
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
         # ------------------- process image (without the alpha channel) ------------------- #
-        self.pre_process(img)
-        if self.tile_size > 0:
-            self.tile_process()
-        else:
-            self.process()
-        output_img = self.post_process()
-        output_img = output_img.data.squeeze().float().cpu().clamp_(0, 1).numpy()
+        with step('pre_process', mode=img_mode):
+            self.pre_process(img)
+        with step('pass', channels='rgb'):
+            self._run(progress_callback, cancel, trace)
+        with step('post_process'):
+            output_img = self.post_process()
+            output_img = output_img.data.squeeze().float().cpu().clamp_(0, 1).numpy()
         output_img = np.transpose(output_img[[2, 1, 0], :, :], (1, 2, 0))
         if img_mode == 'L':
             output_img = cv2.cvtColor(output_img, cv2.COLOR_BGR2GRAY)
@@ -231,10 +287,8 @@ class RealESRGANer():
         if img_mode == 'RGBA':
             if alpha_upsampler == 'realesrgan':
                 self.pre_process(alpha)
-                if self.tile_size > 0:
-                    self.tile_process()
-                else:
-                    self.process()
+                with step('pass', channels='alpha'):
+                    self._run(progress_callback, cancel, trace)
                 output_alpha = self.post_process()
                 output_alpha = output_alpha.data.squeeze().float().cpu().clamp_(0, 1).numpy()
                 output_alpha = np.transpose(output_alpha[[2, 1, 0], :, :], (1, 2, 0))
@@ -254,15 +308,23 @@ class RealESRGANer():
             output = (output_img * 255.0).round().astype(np.uint8)
 
         if outscale is not None and outscale != float(self.scale):
-            output = cv2.resize(
-                output, (
-                    int(w_input * outscale),
-                    int(h_input * outscale),
-                ), interpolation=cv2.INTER_LANCZOS4)
+            with step('resize', outscale=outscale):
+                output = cv2.resize(
+                    output, (
+                        int(w_input * outscale),
+                        int(h_input * outscale),
+                    ), interpolation=cv2.INTER_LANCZOS4)
 
         return output, img_mode
 
 
+def tile_span(trace, index, x, y, tile):
+    """Context manager around the inference of one tile (or of the whole image untiled)"""
+    if trace is None:
+        return nullcontext()
+    return trace('tile', index=index, x=x, y=y, width=tile.shape[-1], height=tile.shape[-2])
+
+
 class PrefetchReader(threading.Thread):
     """Prefetch images.
 
@@ -310,4 +372,4 @@ class IOConsumer(threading.Thread):
             output = msg['output']
             save_path = msg['save_path']
             cv2.imwrite(save_path, output)
-        print(f'IO worker {self.qid} is done.')
+        logger.info(f'IO worker {self.qid} is done.')
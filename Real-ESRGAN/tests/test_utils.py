@@ -1,6 +1,8 @@
 import numpy as np
+import torch
 from basicsr.archs.rrdbnet_arch import RRDBNet
 
+from realesrgan.archs.srvgg_arch import SRVGGNetCompact
 from realesrgan.utils import RealESRGANer
 
 
@@ -85,3 +87,30 @@ def test_realesrganer():
     result = restorer.enhance(img, outscale=2, alpha_upsampler=None)
     assert result[0].shape == (8, 8, 4)
     assert result[1] == 'RGBA'
+
+
+def test_realesrganer_progress_callback(tmp_path):
+    model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=8, num_conv=2, upscale=4, act_type='prelu')
+    model_path = str(tmp_path / 'srvgg.pth')
+    torch.save({'params': model.state_dict()}, model_path)
+    restorer = RealESRGANer(scale=4, model_path=model_path, model=model, tile=8, tile_pad=2, pre_pad=0)
+
+    # ------------------ one call per tile ---------------- #
+    calls = []
+    img = np.random.random((12, 20, 3)).astype(np.float32)
+    result = restorer.enhance(img, progress_callback=lambda done, total: calls.append((done, total)))
+    assert result[0].shape == (48, 80, 3)
+    assert calls == [(i, 6) for i in range(1, 7)]
+
+    # ------------------ the alpha channel is a second pass ---------------- #
+    calls = []
+    img = np.random.random((8, 8, 4)).astype(np.float32)
+    restorer.enhance(img, progress_callback=lambda done, total: calls.append((done, total)))
+    assert calls == [(1, 1), (1, 1)]
+
+    # ------------------ without tiling ---------------- #
+    calls = []
+    restorer.tile_size = 0
+    img = np.random.random((8, 8, 3)).astype(np.float32)
+    restorer.enhance(img, progress_callback=lambda done, total: calls.append((done, total)))
+    assert calls == [(1, 1)]
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Cost- and memory-aware admission control for the Real-ESRGAN API
+Each request's compute cost and peak memory are estimated from the image header
+before the image is decoded. Requests are admitted while they fit the global
+budgets, queued in arrival order while they do not, and rejected with a computed
+Retry-After when the queue is full or the wait runs out.
+"""
+
+import os
+import math
+import time
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from model_config import MODEL_CONFIG
+
+# Compute admitted at once, in RealESRGAN_x4plus input megapixels
+ADMISSION_COST_BUDGET = float(os.getenv('ADMISSION_COST_BUDGET', 2.0))
+# Memory for request buffers: the 4G container minus the model budget and the processes themselves
+ADMISSION_MEMORY_BUDGET = int(os.getenv('ADMISSION_MEMORY_BUDGET_MB', 1536)) * 1024 * 1024
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 20))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', 16))
+# Tile size used for working-memory estimates (CPU default of inference.build_upsampler)
+ADMISSION_TILE = int(os.getenv('ADMISSION_TILE', 256))
+
+BUSY = 'busy'
+TOO_LARGE = 'too_large'
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is not admitted.
+
+    ``reason`` is 'busy' (retry after ``retry_after`` seconds) or 'too_large'
+    (the request alone would exceed the memory budget).
+    """
+
+    def __init__(self, reason, retry_after=None):
+        super().__init__(f'Request rejected: {reason}')
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def estimate_cost(width, height, model_name):
+    """Compute cost of an image: input megapixels times the model's relative cost.
+
+    The model cost already reflects its network scale; ``outscale`` only adds a resize.
+    """
+    return width * height / 1e6 * MODEL_CONFIG[model_name]['cost']
+
+
+def estimate_peak_memory(width, height, channels, model_name, outscale=None, tile=ADMISSION_TILE, bit_depth=8):
+    """Upper bound of the bytes a request holds at its peak, across HTTP worker and model server.
+
+    ``bit_depth`` is bits per sample: 16-bit images decode, come out of the network and
+    encode at two bytes per sample.
+    """
+    config = MODEL_CONFIG[model_name]
+    scale = config['scale']
+    outscale = outscale or scale
+    sample = max(1, bit_depth // 8)
+    input_px = width * height
+    network_px = input_px * scale * scale
+    output_px = int(input_px * outscale * outscale)
+
+    memory = input_px * channels * sample  # decoded upload
+    memory += input_px * channels * 4 * 2  # float32 copy and input tensor
+    memory += network_px * 3 * 4 * 2  # output tensor and its float32 array
+    memory += network_px * channels * sample  # integer network output
+    memory += output_px * channels * sample * 2  # outscale resize and encoded PNG (at most raw size)
+    memory += output_px * channels * sample * 4 // 3  # base64 of the PNG
+    tile_px = min(input_px, tile * tile) if tile else input_px
+    memory += tile_px * config['activation_bytes']
+    return int(memory)
+
+
+class AdmissionController:
+    """Admit requests against global compute and memory budgets.
+
+    Waiting requests are admitted in arrival order. One request is always allowed
+    to run on its own, whatever its cost, unless its memory alone exceeds the budget.
+
+    Args:
+        cost_budget (float): Cost admitted at once (see estimate_cost).
+        memory_budget (int): Bytes of request memory admitted at once.
+        max_wait (float): Seconds a request may wait in the queue before it is rejected.
+        max_queue (int): Waiting requests beyond which new ones are rejected at once.
+    """
+
+    def __init__(self, cost_budget=ADMISSION_COST_BUDGET, memory_budget=ADMISSION_MEMORY_BUDGET,
+                 max_wait=ADMISSION_MAX_WAIT, max_queue=ADMISSION_MAX_QUEUE):
+        self.cost_budget = cost_budget
+        self.memory_budget = memory_budget
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.cost_in_use = 0.0
+        self.memory_in_use = 0
+        self._active = {}  # ticket -> (cost, memory, admitted at, predicted seconds)
+        self._queue = deque()  # (ticket, cost, memory, predicted seconds) in arrival order
+        self._tickets = itertools.count(1)
+        self._rate = None  # cost completed per second by one request, moving average
+        self._cond = threading.Condition()
+        self.stats = {'admitted': 0, 'queued': 0, 'rejected': 0, 'too_large': 0}
+
+    def _fits(self, cost, memory):
+        if not self._active:
+            return True
+        return self.cost_in_use + cost <= self.cost_budget and self.memory_in_use + memory <= self.memory_budget
+
+    def retry_after(self, cost=0.0):
+        """Seconds until a request of ``cost`` would likely be admitted.
+
+        With predicted run times for every request ahead, the time until they have
+        finished; otherwise the backlog over the budget at the measured rate.
+        """
+        now = time.monotonic()
+        ahead = [(seconds, now - started) for _, _, started, seconds in self._active.values()]
+        ahead += [(seconds, 0.0) for _, _, _, seconds in self._queue]
+        if ahead and all(seconds is not None for seconds, _ in ahead):
+            wait = sum(max(0.0, seconds - elapsed) for seconds, elapsed in ahead) / max(1, len(self._active))
+            return max(1, min(300, math.ceil(wait)))
+        backlog = self.cost_in_use + sum(queued_cost for _, queued_cost, _, _ in self._queue) + cost
+        if self._rate is None:
+            return int(min(self.max_wait, 60)) or 1
+        throughput = self._rate * max(1, len(self._active))
+        return max(1, min(300, math.ceil((backlog - self.cost_budget) / throughput)))
+
+    def admit(self, cost, memory, timeout=None, seconds=None):
+        """Wait until the request fits the budgets. Returns a ticket for release().
+
+        ``seconds`` is the request's predicted run time, if known, for Retry-After.
+        """
+        timeout = self.max_wait if timeout is None else timeout
+        with self._cond:
+            if memory > self.memory_budget:
+                self.stats['too_large'] += 1
+                raise AdmissionRejected(TOO_LARGE)
+
+            ticket = next(self._tickets)
+            if self._queue or not self._fits(cost, memory):
+                if len(self._queue) >= self.max_queue or timeout <= 0:
+                    self.stats['rejected'] += 1
+                    raise AdmissionRejected(BUSY, self.retry_after(cost))
+                entry = (ticket, cost, memory, seconds)
+                self._queue.append(entry)
+                self.stats['queued'] += 1
+                deadline = time.monotonic() + timeout
+                while self._queue[0] is not entry or not self._fits(cost, memory):
+                    if memory > self.memory_budget:
+                        # The budget was lowered while it waited (see set_memory_budget)
+                        self._queue.remove(entry)
+                        self.stats['too_large'] += 1
+                        self._cond.notify_all()
+                        raise AdmissionRejected(TOO_LARGE)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._queue.remove(entry)
+                        self.stats['rejected'] += 1
+                        self._cond.notify_all()
+                        raise AdmissionRejected(BUSY, self.retry_after(cost))
+                    self._cond.wait(remaining)
+                self._queue.popleft()
+                # The next waiter may fit as well
+                self._cond.notify_all()
+
+            self._active[ticket] = (cost, memory, time.monotonic(), seconds)
+            self.cost_in_use += cost
+            self.memory_in_use += memory
+            self.stats['admitted'] += 1
+            return ticket
+
+    def set_memory_budget(self, memory_budget):
+        """Change the memory budget. Requests admitted already keep running; below the
+        new budget's use, no more are admitted until enough of them have finished."""
+        with self._cond:
+            self.memory_budget = memory_budget
+            self._cond.notify_all()
+
+    def release(self, ticket):
+        """Return a request's share of the budgets"""
+        with self._cond:
+            admitted = self._active.pop(ticket, None)
+            if admitted is None:
+                return
+            cost, memory, started, _ = admitted
+            self.cost_in_use -= cost
+            self.memory_in_use -= memory
+            elapsed = time.monotonic() - started
+            if cost > 0 and elapsed > 0:
+                rate = cost / elapsed
+                self._rate = rate if self._rate is None else 0.8 * self._rate + 0.2 * rate
+            self._cond.notify_all()
+
+    def queued_cost(self):
+        """Cost of the requests waiting for admission"""
+        with self._cond:
+            return sum(cost for _, cost, _, _ in self._queue)
+
+    def queued_seconds(self, seconds_per_cost=None):
+        """Predicted run time of the requests waiting for admission; those without a
+        prediction count as their cost at ``seconds_per_cost`` (None if that is unknown)"""
+        with self._cond:
+            total = 0.0
+            for _, cost, _, seconds in self._queue:
+                if seconds is None:
+                    if seconds_per_cost is None:
+                        return None
+                    seconds = cost * seconds_per_cost
+                total += seconds
+            return total
+
+    def snapshot(self):
+        """Admission state for health and metrics endpoints"""
+        with self._cond:
+            return {
+                'cost_budget': self.cost_budget,
+                'cost_in_use': round(self.cost_in_use, 3),
+                'memory_budget_mb': round(self.memory_budget / (1024 * 1024), 1),
+                'memory_in_use_mb': round(self.memory_in_use / (1024 * 1024), 1),
+                'active': len(self._active),
+                'queued': len(self._queue),
+                'stats': dict(self.stats)
+            }
+
+
+@contextmanager
+def admitted(backend, cost, memory, timeout=None, timer=None, cancel=None, work=None):
+    """Hold an admission ticket of an inference backend for the duration of the block.
+
+    The wait for admission is recorded as the 'admission' stage of ``timer``. With a
+    ``cancel`` token the wait ends by its deadline, raising Cancelled rather than
+    AdmissionRejected when that is why it ended. ``work`` (see latency_model.work_of)
+    lets the backend predict the request's run time.
+    """
+    started = time.perf_counter()
+    if cancel is not None:
+        cancel.check()
+        timeout = cancel.timeout(ADMISSION_MAX_WAIT if timeout is None else timeout)
+    try:
+        ticket = backend.admit(cost, memory, timeout=timeout, work=work)
+    except AdmissionRejected:
+        if cancel is not None:
+            cancel.check()
+        raise
+    if timer is not None:
+        timer.record('admission', started)
+    try:
+        yield ticket
+    finally:
+        backend.release_admission(ticket)
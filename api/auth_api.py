@@ -15,18 +15,13 @@ from dotenv import load_dotenv
 import logging
 import re
 
+import logs
+
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('auth_api.log'),
-        logging.StreamHandler()
-    ]
-)
+# Configure logging: written from a background thread, as JSON lines unless LOG_FORMAT=text
+logs.configure('auth_api.log')
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Batch enhancement for the Real-ESRGAN API
+Items are read lazily from the upload (many files or one zip archive), enhanced a few
+at a time and streamed back as they finish, so memory is bounded by the pipeline
+window rather than the batch size
+"""
+
+import io
+import os
+import json
+import zipfile
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import tracing
+from cancellation import DISCONNECTED
+from image_io import bytes_to_base64
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 200))
+# Items in flight at once: while one runs on the model the next is decoded and the
+# previous encoded, so the model is never idle on per-image CPU work
+BATCH_WINDOW = int(os.getenv('BATCH_WINDOW', 2))
+
+ARCHIVE_EXTENSIONS = {'zip'}
+
+
+class BatchItem:
+    """One image of a batch: its raw bytes, or why it could not be read"""
+
+    def __init__(self, index, filename, data=None, error=None):
+        self.index = index
+        self.filename = filename
+        self.data = data
+        self.error = error
+
+    def entry(self, **fields):
+        """Manifest entry for this item"""
+        return {'index': self.index, 'filename': self.filename, **fields}
+
+
+def _extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+def is_archive(filename):
+    return _extension(filename) in ARCHIVE_EXTENSIONS
+
+
+def _read_limited(stream, max_size):
+    """Read at most ``max_size`` bytes; None if the stream holds more"""
+    data = stream.read(max_size + 1)
+    return None if len(data) > max_size else data
+
+
+def _checked_item(index, filename, stream, size, allowed_extensions, max_size):
+    if _extension(filename) not in allowed_extensions:
+        return BatchItem(index, filename, error='Invalid file type')
+    # Uploads rejected while the request was parsed (uploads.IngestStream) kept no data
+    rejection = getattr(stream, 'rejection', None)
+    if rejection is not None:
+        return BatchItem(index, filename, error=rejection[0])
+    if size is not None and size > max_size:
+        return BatchItem(index, filename, error=f'File too large. Maximum size is {max_size // (1024 * 1024)}MB')
+    data = _read_limited(stream, max_size)
+    if data is None:
+        return BatchItem(index, filename, error=f'File too large. Maximum size is {max_size // (1024 * 1024)}MB')
+    if not data:
+        return BatchItem(index, filename, error='Empty file')
+    return BatchItem(index, filename, data)
+
+
+def detach_stream(file):
+    """Take ownership of an uploaded file's stream.
+
+    Request teardown closes request.files, which can happen before a streamed
+    response has read them; the caller closes the returned stream instead.
+    """
+    stream = file.stream
+    file.stream = io.BytesIO()
+    return stream
+
+
+def archive_members(archive):
+    """Image candidates of a zip archive, skipping directories and macOS metadata"""
+    return [info for info in archive.infolist()
+            if not info.is_dir() and not os.path.basename(info.filename).startswith('.')
+            and '__MACOSX/' not in info.filename]
+
+
+def iter_archive(archive, allowed_extensions, max_size):
+    """Yield the images of an open zip archive one at a time, closing it at the end"""
+    stream = archive.fp
+    try:
+        for index, info in enumerate(archive_members(archive)):
+            # file_size comes from the archive header; the read limit guards against lying headers
+            try:
+                with archive.open(info) as member:
+                    yield _checked_item(index, info.filename, member, info.file_size, allowed_extensions, max_size)
+            except (zipfile.BadZipFile, RuntimeError, NotImplementedError) as e:
+                # Corrupt, encrypted or unsupported-compression member
+                yield BatchItem(index, info.filename, error=f'Could not read archive member: {e}')
+    finally:
+        archive.close()
+        stream.close()
+
+
+def iter_uploads(uploads, allowed_extensions, max_size):
+    """Yield uploaded files, given as (filename, detached stream) pairs, one at a time"""
+    for index, (filename, stream) in enumerate(uploads):
+        try:
+            yield _checked_item(index, filename, stream, None, allowed_extensions, max_size)
+        finally:
+            stream.close()
+
+
+def _run(item, process):
+    with tracing.span('batch_item', index=item.index, filename=item.filename) as span:
+        try:
+            payload, fields = process(item)
+            entry = item.entry(success=True, **fields)
+        except Exception as e:
+            logger.warning(f"Batch item {item.index} ({item.filename}) failed: {e}")
+            span.fail(e)
+            payload, entry = None, item.entry(success=False, error=str(e))
+    item.data = None
+    return entry, payload
+
+
+def run_pipelined(items, process, window=BATCH_WINDOW, cancel=None):
+    """Run ``process(item)`` over items with at most ``window`` in flight.
+
+    ``process`` returns ``(payload_bytes, entry_fields)``. Yields ``(entry, payload)``
+    in completion order; failed items have ``success: False`` and no payload. If the
+    consumer stops early (the client went away), ``cancel`` is cancelled so the items
+    in flight stop too instead of holding up the shutdown of the pool. Items run in the
+    caller's context, so they are traced as part of its request.
+    """
+    items = iter(items)
+    exhausted = False
+    pending = set()
+    with ThreadPoolExecutor(max_workers=window, thread_name_prefix='batch') as pool:
+        try:
+            while pending or not exhausted:
+                while not exhausted and len(pending) < window:
+                    item = next(items, None)
+                    if item is None:
+                        exhausted = True
+                    elif item.error:
+                        yield item.entry(success=False, error=item.error), None
+                    else:
+                        pending.add(pool.submit(contextvars.copy_context().run, _run, item, process))
+                if not pending:
+                    continue
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        except GeneratorExit:
+            if cancel is not None:
+                cancel.cancel(DISCONNECTED)
+            raise
+
+
+class _StreamSink:
+    """Write-only file object that hands out what was written since the last drain"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(results, manifest_name='results.ndjson'):
+    """Stream results as a zip archive, ending with a manifest of every item.
+
+    Entries are stored uncompressed: PNG data does not compress further.
+    """
+    sink = _StreamSink()
+    manifest = []
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for entry, payload in results:
+            if payload is not None:
+                archive.writestr(entry['output'], payload)
+            manifest.append(entry)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+        archive.writestr(manifest_name, ''.join(json.dumps(entry) + '\n' for entry in manifest))
+    yield sink.drain()
+
+
+def stream_ndjson(results):
+    """Stream results as newline-delimited JSON, one line per item"""
+    for entry, payload in results:
+        if payload is not None:
+            entry = dict(entry, enhanced_image=bytes_to_base64(payload))
+        yield json.dumps(entry) + '\n'
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Benchmark result encoding: time against size for each output format
+Typical outputs are made by upscaling the Real-ESRGAN sample inputs (bicubic, so no
+model weights are needed). Run from the repository root:
+
+    python api/benchmarks/encode_formats.py --scale 4 --repeat 3
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+import statistics
+from concurrent.futures import wait
+
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_io import ENCODE_WORKERS, OutputFormat, encode_async  # noqa: E402
+
+DEFAULT_INPUTS = os.path.join(os.path.dirname(__file__), '..', '..', 'Real-ESRGAN', 'inputs', '*')
+
+CONFIGS = [
+    ('png (cv2 default)', OutputFormat('png', compression=None)),
+    ('png level 1', OutputFormat('png', compression=1)),
+    ('png level 3', OutputFormat('png', compression=3)),
+    ('png level 6', OutputFormat('png', compression=6)),
+    ('png level 9', OutputFormat('png', compression=9)),
+    ('webp lossless', OutputFormat('webp', lossless=True)),
+    ('webp q90', OutputFormat('webp', quality=90)),
+    ('webp q75', OutputFormat('webp', quality=75)),
+    ('jpeg q95', OutputFormat('jpeg', quality=95)),
+    ('jpeg q85', OutputFormat('jpeg', quality=85)),
+]
+
+
+def load_outputs(pattern, scale, max_side):
+    outputs = []
+    for path in sorted(glob.glob(pattern)):
+        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if img is None:
+            continue
+        # Keep outputs to a typical size: inputs larger than max_side / scale are shrunk first
+        factor = min(1.0, max_side / scale / max(img.shape[:2]))
+        if factor < 1.0:
+            img = cv2.resize(img, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+        outputs.append((os.path.basename(path), cv2.resize(img, None, fx=scale, fy=scale,
+                                                           interpolation=cv2.INTER_CUBIC)))
+    return outputs
+
+
+def bench(output_format, images, repeat):
+    times, sizes = [], []
+    for _, img in images:
+        runs = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            data = output_format.encode(img)
+            runs.append(time.perf_counter() - started)
+        times.append(statistics.median(runs))
+        sizes.append(len(data))
+    return times, sizes
+
+
+def bench_pool(output_format, images, repeat):
+    """Wall time to encode every image ``repeat`` times on the shared encode pool"""
+    started = time.perf_counter()
+    wait([encode_async(img, output_format) for _ in range(repeat) for _, img in images])
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--inputs', default=DEFAULT_INPUTS, help='Glob of input images')
+    parser.add_argument('--scale', type=float, default=4, help='Upscale factor of the simulated outputs')
+    parser.add_argument('--max-side', type=int, default=2048, help='Longest side of an output')
+    parser.add_argument('--repeat', type=int, default=3, help='Encodes per image (median is reported)')
+    parser.add_argument('--pool', action='store_true', help='Also time the encode pool against one thread')
+    args = parser.parse_args()
+
+    images = load_outputs(args.inputs, args.scale, args.max_side)
+    if not images:
+        sys.exit(f'No images match {args.inputs}')
+    megapixels = sum(img.shape[0] * img.shape[1] for _, img in images) / 1e6
+    raw = sum(img.nbytes for _, img in images)
+    print(f'{len(images)} outputs, {megapixels:.1f} MP, {raw / 1e6:.1f} MB raw')
+    print(f'{"format":<20}{"ms/image":>10}{"MP/s":>8}{"size MB":>10}{"ratio":>8}')
+
+    for name, output_format in CONFIGS:
+        times, sizes = bench(output_format, images, args.repeat)
+        total = sum(times)
+        print(f'{name:<20}{total / len(images) * 1000:>10.1f}{megapixels / total:>8.1f}'
+              f'{sum(sizes) / 1e6:>10.2f}{sum(sizes) / raw:>8.3f}')
+
+    if args.pool:
+        output_format = OutputFormat('png')
+        serial = sum(sum(bench(output_format, images, 1)[0]) for _ in range(args.repeat))
+        pooled = bench_pool(output_format, images, args.repeat)
+        print(f'png on {ENCODE_WORKERS} encode threads: {serial:.2f}s serial, {pooled:.2f}s pooled '
+              f'({serial / pooled:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,566 @@
+#!/usr/bin/env python3
+"""
+Load generator for the enhancement API: throughput, tail latency, errors and RSS
+Synthesizes photo-like images from a size distribution and drives /api/enhance and the
+model endpoints, either in this process through the Flask test client (no server or
+Redis needed) or against a running server. Results are written as JSON so runs can be
+compared across commits. Run from the repository root:
+
+    python api/benchmarks/loadtest.py run --duration 60 --concurrency 4 --sizes 128x128=3,512x384=1
+    python api/benchmarks/loadtest.py run --url http://localhost:8080 --rate 2 --duration 120
+    python api/benchmarks/loadtest.py compare loadtest-results/a.json loadtest-results/b.json
+
+Closed-loop mode (--concurrency) keeps N requests in flight. Open-loop mode (--rate)
+sends Poisson arrivals regardless of how fast the server answers, and measures latency
+from each request's scheduled start, so a stalled server shows up in the tail instead
+of slowing the generator down. Start servers under test with RATELIMIT_ENABLED=false.
+"""
+
+import os
+import io
+import re
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import threading
+import subprocess
+import http.client
+from datetime import datetime
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import psutil
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_OUTPUT_DIR = 'loadtest-results'
+ENDPOINTS = ('enhance', 'models', 'health', 'ready', 'switch-model')
+# Gauges scraped from /metrics (see metrics.InferenceCollector)
+RSS_METRICS = {
+    'http': 'hdess_http_resident_memory_bytes',
+    'inference': 'hdess_inference_resident_memory_bytes'
+}
+
+
+def parse_weights(spec, parse=str):
+    """Parse ``a=3,b=1`` (weights default to 1) into [(parse(a), 3.0), (parse(b), 1.0)]"""
+    weights = []
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, weight = part.partition('=')
+        weights.append((parse(name), float(weight or 1)))
+    if not weights or any(weight < 0 for _, weight in weights) or not sum(weight for _, weight in weights):
+        raise argparse.ArgumentTypeError(f'Invalid weights: {spec}')
+    return weights
+
+
+def parse_size(text):
+    match = re.fullmatch(r'(\d+)x(\d+)', text)
+    if not match:
+        raise argparse.ArgumentTypeError(f'Sizes are WIDTHxHEIGHT, got {text}')
+    return int(match.group(1)), int(match.group(2))
+
+
+def parse_endpoint(text):
+    if text not in ENDPOINTS:
+        raise argparse.ArgumentTypeError(f'Unknown endpoint {text}; choose from {", ".join(ENDPOINTS)}')
+    return text
+
+
+def synthesize(width, height, rng, fmt='png'):
+    """Encode a photo-like test image: smooth gradients, texture and sensor noise.
+
+    Pure noise would not compress and flat colour compresses far too well; this
+    lands in between, like real uploads.
+    """
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = []
+    for _ in range(3):
+        wave = np.sin(x / rng.uniform(8, 96) + rng.uniform(0, 6)) * np.cos(y / rng.uniform(8, 96) + rng.uniform(0, 6))
+        ramp = (x / max(width, 1) * rng.uniform(-1, 1) + y / max(height, 1) * rng.uniform(-1, 1))
+        channels.append(wave * 60 + ramp * 50)
+    img = np.stack(channels, axis=-1) + 128 + rng.normal(0, 8, (height, width, 3))
+    img = np.clip(img, 0, 255).astype(np.uint8)
+    params = [cv2.IMWRITE_JPEG_QUALITY, 90] if fmt == 'jpeg' else []
+    return cv2.imencode('.jpg' if fmt == 'jpeg' else '.png', img, params)[1].tobytes()
+
+
+class ImagePool:
+    """Pre-encoded test images, ``per_size`` distinct ones for every size and format.
+
+    Identical images in flight at once are coalesced by the server (single-flight),
+    so use enough distinct images for the concurrency under test.
+    """
+
+    def __init__(self, sizes, formats, per_size, seed):
+        rng = np.random.default_rng(seed)
+        self.images = {}
+        for size, _ in sizes:
+            for fmt, _ in formats:
+                self.images[size, fmt] = [synthesize(*size, rng, fmt) for _ in range(per_size)]
+        self.sizes = sizes
+        self.formats = formats
+
+    def pick(self, rng):
+        size = rng.choices([size for size, _ in self.sizes], [weight for _, weight in self.sizes])[0]
+        fmt = rng.choices([fmt for fmt, _ in self.formats], [weight for _, weight in self.formats])[0]
+        return size, fmt, rng.choice(self.images[size, fmt])
+
+
+class Workload:
+    """Draws the next request from the endpoint mix"""
+
+    def __init__(self, mix, pool, form, model):
+        self.mix = mix
+        self.pool = pool
+        self.form = form
+        self.model = model
+
+    def next_request(self, rng):
+        """(endpoint, method, path, form fields, files, JSON body)"""
+        endpoint = rng.choices([name for name, _ in self.mix], [weight for _, weight in self.mix])[0]
+        if endpoint == 'enhance':
+            (width, height), fmt, data = self.pool.pick(rng)
+            filename = f'load_{width}x{height}.{"jpg" if fmt == "jpeg" else "png"}'
+            return endpoint, 'POST', '/api/enhance', self.form, {'image': (filename, data)}, None
+        if endpoint == 'switch-model':
+            return endpoint, 'POST', '/api/switch-model', None, None, {'model': self.model}
+        return endpoint, 'GET', f'/api/{endpoint}', None, None, None
+
+
+class LocalTarget:
+    """The Flask app in this process, driven through its test client (no sockets, Redis optional)"""
+
+    name = 'local'
+
+    def __init__(self, app=None):
+        if app is None:
+            sys.path.insert(0, API_DIR)
+            import realesrgan_api
+            realesrgan_api.limiter.enabled = False
+            realesrgan_api.inference.start()
+            app = realesrgan_api.app
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, form=None, files=None, json_body=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        data = dict(form or {})
+        for field, (filename, content) in (files or {}).items():
+            data[field] = (io.BytesIO(content), filename)
+        response = client.open(path, method=method, data=data if files or form else None, json=json_body,
+                               content_type='multipart/form-data' if files else None)
+        return response.status_code, response.get_data()
+
+    def own_rss(self):
+        # The app runs in this process (and inference too, unless it uses a model server)
+        return {'http': psutil.Process().memory_info().rss}
+
+
+class HttpTarget:
+    """A running server, over one keep-alive connection per thread"""
+
+    def __init__(self, url, timeout=600):
+        parts = urlsplit(url)
+        self.name = url
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, method, path, form=None, files=None, json_body=None):
+        headers = {}
+        body = None
+        if files or form:
+            boundary = f'loadtest{random.getrandbits(64):016x}'
+            body = _multipart(boundary, form or {}, files or {})
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        elif json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            connection = getattr(self._local, 'connection', None)
+            if connection is None:
+                connection = self._local.connection = self.connection_class(self.host, self.port,
+                                                                            timeout=self.timeout)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError, socket.timeout):
+                # The server closed the kept-alive connection; retry once on a new one
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+    def own_rss(self):
+        return {}
+
+
+def _multipart(boundary, form, files):
+    parts = []
+    for name, value in form.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts)
+
+
+def scrape_rss(target):
+    """Resident memory of the server's HTTP and inference processes from /metrics, or {}"""
+    try:
+        status, body = target.request('GET', '/metrics')
+    except (OSError, http.client.HTTPException):
+        return {}
+    if status != 200:
+        # prometheus_client is not installed on the server
+        return target.own_rss()
+    rss = {}
+    for line in body.decode(errors='replace').splitlines():
+        for name, metric in RSS_METRICS.items():
+            if line.startswith(metric + ' '):
+                rss[name] = float(line.split()[1])
+    return rss
+
+
+class RssSampler(threading.Thread):
+    """Scrape the server's RSS every ``interval`` seconds while the load runs"""
+
+    def __init__(self, target, interval):
+        super().__init__(name='rss-sampler', daemon=True)
+        self.target = target
+        self.interval = interval
+        self.samples = []
+        self._stop_event = threading.Event()
+        self._origin = time.monotonic()
+
+    def run(self):
+        while True:
+            rss = scrape_rss(self.target)
+            if rss:
+                self.samples.append(dict(rss, t=round(time.monotonic() - self._origin, 2)))
+            if self._stop_event.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def summary(self):
+        result = {}
+        for name in RSS_METRICS:
+            values = [sample[name] for sample in self.samples if name in sample]
+            if values:
+                result[name] = {'start_mb': values[0] / 2 ** 20, 'peak_mb': max(values) / 2 ** 20,
+                                'end_mb': values[-1] / 2 ** 20}
+        return {name: {key: round(value, 1) for key, value in stats.items()} for name, stats in result.items()}
+
+
+class Recorder:
+    """Thread-safe log of finished requests: (endpoint, start, latency_s, status, fields)"""
+
+    def __init__(self):
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, start, latency, status, fields):
+        with self._lock:
+            self.samples.append((endpoint, start, latency, status, fields))
+
+
+def execute(target, workload, rng, recorder, clock, scheduled=None):
+    """Send one request; latency counts from ``scheduled`` (open loop) or from now"""
+    endpoint, method, path, form, files, json_body = workload.next_request(rng)
+    start = clock() if scheduled is None else scheduled
+    fields = {}
+    try:
+        status, body = target.request(method, path, form, files, json_body)
+        if endpoint == 'enhance' and status == 200:
+            response = json.loads(body)
+            fields = {'coalesced': bool(response.get('coalesced')),
+                      'tier': (response.get('tier') or {}).get('name')}
+    except Exception as e:
+        status, fields = 0, {'error': f'{type(e).__name__}: {e}'}
+    recorder.add(endpoint, start, clock() - start, status, fields)
+
+
+def run_closed_loop(target, workload, concurrency, duration, max_requests, seed, think=0.0):
+    """``concurrency`` workers, each sending its next request as soon as the last one finishes"""
+    recorder = Recorder()
+    started = time.monotonic()
+    clock = lambda: time.monotonic() - started
+    sent = iter(range(max_requests)) if max_requests else None
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        while clock() < duration:
+            if sent is not None:
+                with lock:
+                    if next(sent, None) is None:
+                        return
+            execute(target, workload, rng, recorder, clock)
+            if think:
+                time.sleep(rng.expovariate(1 / think))
+
+    threads = [threading.Thread(target=worker, args=(index,), daemon=True) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.samples, clock()
+
+
+def run_open_loop(target, workload, rate, duration, max_requests, seed, max_in_flight=256):
+    """Poisson arrivals at ``rate`` per second, independent of how fast requests finish"""
+    recorder = Recorder()
+    started = time.monotonic()
+    clock = lambda: time.monotonic() - started
+    rng = random.Random(seed)
+    arrival, count = 0.0, 0
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='load') as pool:
+        while True:
+            arrival += rng.expovariate(rate)
+            if arrival >= duration or (max_requests and count >= max_requests):
+                break
+            delay = arrival - clock()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(execute, target, workload, random.Random(rng.random()), recorder, clock, arrival)
+            count += 1
+    return recorder.samples, clock()
+
+
+def percentile(sorted_values, q):
+    """Linearly interpolated percentile (0-100) of already sorted values"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+def summarize(samples, elapsed, warmup=0.0):
+    """Per-endpoint and overall throughput, latency of successful requests and errors.
+
+    Requests started during the first ``warmup`` seconds are left out.
+    """
+    samples = [sample for sample in samples if sample[1] >= warmup]
+    window = max(elapsed - warmup, 1e-9)
+    groups = {'all': samples}
+    for sample in samples:
+        groups.setdefault(sample[0], []).append(sample)
+
+    summary = {}
+    for name, group in groups.items():
+        ok = sorted(latency * 1000 for _, _, latency, status, _ in group if 200 <= status < 300)
+        statuses = {}
+        for _, _, _, status, _ in group:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        errors = len(group) - len(ok)
+        stats = {
+            'requests': len(group),
+            'ok': len(ok),
+            'errors': errors,
+            'error_rate': round(errors / len(group), 4) if group else 0.0,
+            'throughput_rps': round(len(group) / window, 3),
+            'ok_rps': round(len(ok) / window, 3),
+            'latency_ms': {
+                'p50': percentile(ok, 50), 'p95': percentile(ok, 95), 'p99': percentile(ok, 99),
+                'mean': sum(ok) / len(ok) if ok else None, 'max': ok[-1] if ok else None
+            },
+            'statuses': statuses
+        }
+        stats['latency_ms'] = {key: None if value is None else round(value, 1)
+                               for key, value in stats['latency_ms'].items()}
+        fields = [sample[4] for sample in group]
+        if any('tier' in field for field in fields):
+            tiers = {}
+            for field in fields:
+                if field.get('tier'):
+                    tiers[field['tier']] = tiers.get(field['tier'], 0) + 1
+            stats['tiers'] = tiers
+            stats['coalesced'] = sum(1 for field in fields if field.get('coalesced'))
+        transport_errors = sorted({field['error'] for field in fields if 'error' in field})
+        if transport_errors:
+            stats['transport_errors'] = transport_errors[:10]
+        summary[name] = stats
+    return summary
+
+
+def git_commit():
+    """Commit and dirty flag of the working tree, for comparing runs across commits"""
+    try:
+        sha = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                             cwd=API_DIR).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                                    text=True, cwd=API_DIR).stdout.strip())
+        return {'sha': sha, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'sha': None, 'dirty': None}
+
+
+def wait_ready(target, timeout):
+    """Wait for /api/ready so model loading is not measured; returns whether it became ready"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if target.request('GET', '/api/ready')[0] == 200:
+                return True
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(1)
+    return False
+
+
+def print_summary(result):
+    print(f"{result['target']} @ {(result['commit']['sha'] or 'unknown')[:10]}"
+          f"{' (dirty)' if result['commit']['dirty'] else ''}: {result['elapsed_s']:.1f}s")
+    print(f'{"endpoint":<14}{"reqs":>7}{"rps":>8}{"err%":>7}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for name, stats in result['results'].items():
+        latency = stats['latency_ms']
+        cells = [f'{latency[key]:>10.1f}' if latency[key] is not None else f'{"-":>10}' for key in ('p50', 'p95', 'p99')]
+        print(f'{name:<14}{stats["requests"]:>7}{stats["throughput_rps"]:>8.2f}{stats["error_rate"] * 100:>7.1f}'
+              + ''.join(cells))
+    for name, stats in result['rss'].items():
+        print(f'{name} RSS: {stats["start_mb"]:.0f} MB -> peak {stats["peak_mb"]:.0f} MB, end {stats["end_mb"]:.0f} MB')
+
+
+def run(args):
+    target = HttpTarget(args.url) if args.url else LocalTarget()
+    if args.wait_ready and not wait_ready(target, args.wait_ready):
+        sys.exit('Server did not become ready; pass --wait-ready 0 to skip waiting')
+
+    pool = ImagePool(args.sizes, args.formats, args.images_per_size, args.seed)
+    form = {'model': args.model} if args.model else {}
+    if args.scale:
+        form['scale'] = str(args.scale)
+    if args.output_format:
+        form['format'] = args.output_format
+    workload = Workload(args.mix, pool, form, args.model or 'realesr-general-x4v3')
+
+    sampler = RssSampler(target, args.sample_interval)
+    sampler.start()
+    started_at = datetime.now().isoformat()
+    if args.rate:
+        samples, elapsed = run_open_loop(target, workload, args.rate, args.duration, args.requests, args.seed,
+                                         args.max_in_flight)
+    else:
+        samples, elapsed = run_closed_loop(target, workload, args.concurrency, args.duration, args.requests,
+                                           args.seed, args.think)
+    sampler.stop()
+
+    config = {key: value for key, value in vars(args).items() if key not in ('func', 'output')}
+    config['sizes'] = [[f'{width}x{height}', weight] for (width, height), weight in args.sizes]
+    result = {
+        'version': 1,
+        'started_at': started_at,
+        'commit': git_commit(),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'target': target.name,
+        'mode': 'open' if args.rate else 'closed',
+        'config': config,
+        'elapsed_s': round(elapsed, 2),
+        'results': summarize(samples, elapsed, args.warmup),
+        'rss': sampler.summary(),
+        'rss_samples': sampler.samples
+    }
+    print_summary(result)
+
+    output = args.output
+    if output is None:
+        os.makedirs(DEFAULT_OUTPUT_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(DEFAULT_OUTPUT_DIR, f'{stamp}-{(result["commit"]["sha"] or "nogit")[:8]}.json')
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'Results written to {output}')
+
+
+def _change(before, after):
+    if before is None or after is None:
+        return ''
+    if before == 0:
+        return '' if after == 0 else '   new'
+    return f'{(after - before) / before * 100:>+7.1f}%'
+
+
+def compare(args):
+    """Print the changes between two result files, endpoint by endpoint"""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    for label, result in (('baseline', baseline), ('candidate', candidate)):
+        print(f"{label}: {result['commit']['sha'] and result['commit']['sha'][:10]} {result['started_at']} "
+              f"({result['mode']} loop, {result['target']})")
+    rows = [('rps', lambda stats: stats['throughput_rps']), ('error rate', lambda stats: stats['error_rate'])]
+    rows += [(key, lambda stats, key=key: stats['latency_ms'][key]) for key in ('p50', 'p95', 'p99')]
+    for name in candidate['results']:
+        if name not in baseline['results']:
+            continue
+        print(f'\n{name}')
+        for label, read in rows:
+            before, after = read(baseline['results'][name]), read(candidate['results'][name])
+            print(f'  {label:<12}{before if before is not None else "-":>12}{after if after is not None else "-":>12}'
+                  f'{_change(before, after):>10}')
+    shared = [name for name in candidate['rss'] if name in baseline['rss']]
+    if shared:
+        print('\npeak RSS MB')
+    for name in shared:
+        before, after = baseline['rss'][name]['peak_mb'], candidate['rss'][name]['peak_mb']
+        print(f'  {name:<12}{before:>12}{after:>12}{_change(before, after):>10}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('run', help='Generate load and record the results')
+    load.add_argument('--url', help='Server to test, e.g. http://localhost:8080 (default: the app in this process)')
+    loop = load.add_mutually_exclusive_group()
+    loop.add_argument('--concurrency', type=int, default=4, help='Closed loop: requests kept in flight')
+    loop.add_argument('--rate', type=float, help='Open loop: mean arrivals per second (Poisson)')
+    load.add_argument('--duration', type=float, default=60, help='Seconds to generate load for')
+    load.add_argument('--requests', type=int, default=0, help='Stop after this many requests (0: no limit)')
+    load.add_argument('--warmup', type=float, default=0, help='Leave requests started in the first N seconds out')
+    load.add_argument('--think', type=float, default=0, help='Closed loop: mean pause between requests (s)')
+    load.add_argument('--max-in-flight', type=int, default=256, help='Open loop: concurrent request limit')
+    load.add_argument('--mix', type=lambda spec: parse_weights(spec, parse_endpoint), default='enhance',
+                      help=f'Weighted endpoint mix, e.g. enhance=9,models=1 ({", ".join(ENDPOINTS)})')
+    load.add_argument('--sizes', type=lambda spec: parse_weights(spec, parse_size), default='256x256',
+                      help='Weighted input sizes, e.g. 128x128=3,1024x768=1')
+    load.add_argument('--formats', type=lambda spec: parse_weights(spec, str), default='png',
+                      help='Weighted input formats: png, jpeg')
+    load.add_argument('--images-per-size', type=int, default=8, help='Distinct images per size and format')
+    load.add_argument('--model', help='Model for /api/enhance (default: the server default)')
+    load.add_argument('--scale', type=float, help='Outscale for /api/enhance')
+    load.add_argument('--output-format', help='Output format for /api/enhance: png, jpeg, webp')
+    load.add_argument('--seed', type=int, default=0, help='Seed of the images and the request sequence')
+    load.add_argument('--sample-interval', type=float, default=1.0, help='Seconds between RSS samples')
+    load.add_argument('--wait-ready', type=float, default=600, help='Seconds to wait for /api/ready (0: skip)')
+    load.add_argument('--output', help=f'Result file (default: {DEFAULT_OUTPUT_DIR}/<time>-<commit>.json)')
+    load.set_defaults(func=run)
+
+    diff = commands.add_parser('compare', help='Compare two result files')
+    diff.add_argument('baseline')
+    diff.add_argument('candidate')
+    diff.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
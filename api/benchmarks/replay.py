@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+Replay captured traffic against a build and compare latency distributions
+Re-issues the requests recorded with CAPTURE_ENABLED=true (see capture.py) with their
+original inputs (or synthesized images of the same size and format where inputs were
+not kept), either over HTTP, through the app in this process, or straight to the
+upsampler (--direct, leaving HTTP, admission and scheduling out). Run from the
+repository root:
+
+    python api/benchmarks/replay.py run outputs/capture --url http://localhost:8080 --speed 4
+    python api/benchmarks/replay.py run outputs/capture --direct --max-speed --concurrency 2
+    python api/benchmarks/replay.py compare replay-results/a.json replay-results/b.json --fail-on-regression
+
+Requests are sent open loop at the captured arrival times divided by --speed, and
+latency counts from each request's scheduled start; --max-speed sends them back to
+back from --concurrency workers instead. compare reports percentiles per model and
+input size with a two-sample Kolmogorov-Smirnov test, so a shift in the distribution
+is told apart from run-to-run noise.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import threading
+from datetime import datetime
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, API_DIR)
+from benchmarks.loadtest import (HttpTarget, LocalTarget, Recorder, git_commit, percentile, summarize,  # noqa: E402
+                                 synthesize, wait_ready)
+from capture import load_records  # noqa: E402
+
+DEFAULT_OUTPUT_DIR = 'replay-results'
+JOB_POLL_INTERVAL = 0.25
+JOB_TERMINAL_STATES = {'done': 200, 'failed': 500, 'cancelled': 499}
+# Input sizes are compared in these megapixel buckets
+SIZE_BUCKETS = ((0.25, '<0.25MP'), (1.0, '0.25-1MP'), (4.0, '1-4MP'), (math.inf, '>4MP'))
+QUANTILES = (50, 90, 99)
+
+
+def size_bucket(width, height):
+    megapixels = width * height / 1e6
+    return next(label for limit, label in SIZE_BUCKETS if megapixels < limit)
+
+
+class Workload:
+    """Captured requests with their inputs, in arrival order.
+
+    Args:
+        directory (str): Capture store (CAPTURE_DIR).
+        records (list): Records to replay, from capture.load_records().
+        seed (int): Seed of the images synthesized for records without a stored input.
+    """
+
+    def __init__(self, directory, records, seed=0):
+        self.directory = directory
+        self.records = records
+        self.origin = records[0]['t'] if records else 0.0
+        self._rng = np.random.default_rng(seed)
+        self._synthesized = {}
+        self._lock = threading.Lock()
+
+    def offset(self, record, speed=1.0):
+        """Seconds after the first request that ``record`` is sent at ``speed`` times real time"""
+        return (record['t'] - self.origin) / speed
+
+    def input_of(self, record):
+        """The stored input, or a synthesized one of the same size and format"""
+        if record.get('input'):
+            path = os.path.join(self.directory, 'inputs', record['input'])
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return f.read()
+        fmt = 'jpeg' if record['format'] == 'jpeg' else 'png'
+        key = record['width'], record['height'], fmt
+        with self._lock:
+            # One image per size and format, as the same upload in flight twice would be coalesced
+            if key not in self._synthesized:
+                self._synthesized[key] = synthesize(record['width'], record['height'], self._rng, fmt)
+            return self._synthesized[key]
+
+
+def served_model(record):
+    """The model a record was served with (model=auto was routed to one)"""
+    return record.get('served_model') or record['model']
+
+
+def form_of(record):
+    """The /api/enhance form fields a record was sent with"""
+    form = {'model': record['model']}
+    if record.get('scale') is not None:
+        form['scale'] = str(record['scale'])
+    output_format = record.get('output_format') or {}
+    for field in ('format', 'quality', 'compression', 'lossless'):
+        if output_format.get(field) is not None:
+            form[field] = str(output_format[field]).lower()
+    if record.get('slo_ms'):
+        form['slo_ms'] = str(record['slo_ms'])
+    return form
+
+
+class ApiReplayer:
+    """Sends records through the API: jobs are submitted and polled until they end,
+    batch items go to /api/enhance one by one"""
+
+    def __init__(self, target):
+        self.target = target
+        self.name = target.name
+
+    def send(self, record, data):
+        """(status, fields) of one replayed request"""
+        filename = f"replay.{'jpg' if record['format'] == 'jpeg' else 'png'}"
+        files = {'image': (filename, data)}
+        if record['endpoint'] != 'job':
+            status, body = self.target.request('POST', '/api/enhance', form_of(record), files)
+            if status != 200:
+                return status, {}
+            response = json.loads(body)
+            return status, {'tier': (response.get('tier') or {}).get('name'), 'coalesced': response.get('coalesced')}
+        status, body = self.target.request('POST', '/api/jobs', form_of(record), files)
+        if status != 202:
+            return status, {}
+        status_url = json.loads(body)['status_url']
+        while True:
+            time.sleep(JOB_POLL_INTERVAL)
+            status, body = self.target.request('GET', status_url)
+            if status != 200:
+                return status, {}
+            job = json.loads(body)
+            if job['state'] in JOB_TERMINAL_STATES:
+                tier = ((job.get('result') or {}).get('tier') or {}).get('name')
+                return JOB_TERMINAL_STATES[job['state']], {'tier': tier}
+
+
+class DirectReplayer:
+    """Runs records straight through RealESRGANer: decode, enhance and encode, at the
+    model each request was served with. ``copies`` upsamplers per model are built up
+    front, so requests wait for a free one as they would for the server's workers."""
+
+    name = 'direct'
+
+    def __init__(self, records, copies):
+        from inference import build_upsampler
+        from model_config import MODEL_CONFIG
+        self.model_config = MODEL_CONFIG
+        self._idle = {}
+        for model_name in {served_model(record) for record in records} & set(MODEL_CONFIG):
+            self._idle[model_name] = Queue()
+            for _ in range(copies):
+                self._idle[model_name].put(build_upsampler(model_name))
+
+    def send(self, record, data):
+        model_name = served_model(record)
+        if model_name not in self._idle:
+            return 400, {'error': f'Unknown model: {model_name}'}
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+        if img is None:
+            return 400, {'error': 'Could not read image file'}
+        outscale = record.get('scale') or self.model_config[model_name]['scale']
+        upsampler = self._idle[model_name].get()
+        try:
+            output, _ = upsampler.enhance(img, outscale=outscale)
+        finally:
+            self._idle[model_name].put(upsampler)
+        ext = '.jpg' if (record.get('output_format') or {}).get('format') == 'jpeg' else '.png'
+        cv2.imencode(ext, output)
+        return 200, {}
+
+
+def replay_one(replayer, workload, record, recorder, clock, scheduled=None):
+    """Replay one record; latency counts from ``scheduled`` (paced) or from now"""
+    data = workload.input_of(record)
+    start = clock() if scheduled is None else scheduled
+    fields = {'model': served_model(record),
+              'size': size_bucket(record['width'], record['height'])}
+    try:
+        status, served = replayer.send(record, data)
+        fields.update(served)
+    except Exception as e:
+        status, fields['error'] = 0, f'{type(e).__name__}: {e}'
+    recorder.add(record['endpoint'], start, clock() - start, status, fields)
+
+
+def replay_paced(replayer, workload, speed, max_in_flight=64):
+    """Send every record at its captured arrival time divided by ``speed``"""
+    recorder = Recorder()
+    started = time.monotonic()
+    clock = lambda: time.monotonic() - started
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='replay') as pool:
+        for record in workload.records:
+            scheduled = workload.offset(record, speed)
+            delay = scheduled - clock()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(replay_one, replayer, workload, record, recorder, clock, scheduled)
+    return recorder.samples, clock()
+
+
+def replay_flat_out(replayer, workload, concurrency):
+    """Send the records in order from ``concurrency`` workers, each as soon as its last one finishes"""
+    recorder = Recorder()
+    started = time.monotonic()
+    clock = lambda: time.monotonic() - started
+    records = iter(workload.records)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                record = next(records, None)
+            if record is None:
+                return
+            replay_one(replayer, workload, record, recorder, clock)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.samples, clock()
+
+
+def ks_2samp(a, b):
+    """Two-sample Kolmogorov-Smirnov statistic and its asymptotic p-value"""
+    a, b = sorted(a), sorted(b)
+    n, m = len(a), len(b)
+    if not n or not m:
+        return None, None
+    statistic = 0.0
+    i = j = 0
+    while i < n and j < m:
+        value = min(a[i], b[j])
+        while i < n and a[i] == value:
+            i += 1
+        while j < m and b[j] == value:
+            j += 1
+        statistic = max(statistic, abs(i / n - j / m))
+    effective = math.sqrt(n * m / (n + m))
+    lam = (effective + 0.12 + 0.11 / effective) * statistic
+    if lam < 1e-3:
+        return statistic, 1.0
+    p = 2 * sum((-1) ** (k - 1) * math.exp(-2 * k * k * lam * lam) for k in range(1, 101))
+    return statistic, min(max(p, 0.0), 1.0)
+
+
+def group_latencies(samples):
+    """Latencies (ms) of successful requests, overall and by model and input size"""
+    groups = {'all': []}
+    for _, _, latency, status, fields in samples:
+        if not 200 <= status < 300:
+            continue
+        groups['all'].append(latency * 1000)
+        groups.setdefault(f"{fields['model']} {fields['size']}", []).append(latency * 1000)
+    return groups
+
+
+def distribution(latencies):
+    ordered = sorted(latencies)
+    stats = {f'p{q}': percentile(ordered, q) for q in QUANTILES}
+    stats['mean'] = sum(ordered) / len(ordered) if ordered else None
+    return {key: None if value is None else round(value, 1) for key, value in stats.items()}
+
+
+def compare_groups(baseline, candidate, alpha=0.01, threshold=0.05):
+    """Per-group percentiles of both runs, the KS test between them and whether the
+    candidate regressed: a significant shift with p50 or p90 over ``threshold`` slower"""
+    rows = {}
+    for name, after in candidate.items():
+        before = baseline.get(name)
+        if not before or not after:
+            continue
+        statistic, p = ks_2samp(before, after)
+        stats = {'n': [len(before), len(after)], 'baseline': distribution(before),
+                 'candidate': distribution(after), 'ks': round(statistic, 4), 'p_value': p}
+        slower = any(stats['candidate'][key] > stats['baseline'][key] * (1 + threshold) for key in ('p50', 'p90'))
+        stats['regression'] = p < alpha and slower
+        rows[name] = stats
+    return rows
+
+
+def run(args):
+    records = [record for record in load_records(args.capture)
+               if args.include_failed or record.get('outcome') == 'ok']
+    if args.endpoints:
+        records = [record for record in records if record['endpoint'] in args.endpoints]
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        sys.exit(f'No requests to replay in {args.capture}')
+    if args.direct:
+        replayer = DirectReplayer(records, args.concurrency)
+    else:
+        target = HttpTarget(args.url) if args.url else LocalTarget()
+        if args.wait_ready and not wait_ready(target, args.wait_ready):
+            sys.exit('Server did not become ready; pass --wait-ready 0 to skip waiting')
+        replayer = ApiReplayer(target)
+    workload = Workload(args.capture, records, args.seed)
+    span = workload.offset(records[-1])
+    print(f'Replaying {len(records)} requests captured over {span:.0f}s against {replayer.name} '
+          f'({"flat out" if args.max_speed else f"{args.speed:g}x speed"})')
+
+    started_at = datetime.now().isoformat()
+    if args.max_speed:
+        samples, elapsed = replay_flat_out(replayer, workload, args.concurrency)
+    else:
+        samples, elapsed = replay_paced(replayer, workload, args.speed, args.max_in_flight)
+
+    groups = group_latencies(samples)
+    config = {key: value for key, value in vars(args).items() if key not in ('func', 'output')}
+    result = {
+        'version': 1,
+        'started_at': started_at,
+        'commit': git_commit(),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'target': replayer.name,
+        'mode': 'flat_out' if args.max_speed else 'paced',
+        'config': config,
+        'elapsed_s': round(elapsed, 2),
+        'results': summarize(samples, elapsed),
+        'groups': {name: dict(distribution(latencies), n=len(latencies)) for name, latencies in groups.items()},
+        # Raw latencies, for the distribution tests in compare
+        'latencies_ms': {name: [round(value, 2) for value in latencies] for name, latencies in groups.items()}
+    }
+    for name, stats in result['groups'].items():
+        print(f'  {name:<36}{stats["n"]:>6}  p50 {stats["p50"]:>9.1f}  p90 {stats["p90"]:>9.1f}  '
+              f'p99 {stats["p99"]:>9.1f} ms')
+    errors = result['results']['all']['errors']
+    if errors:
+        print(f'  {errors} requests failed: {result["results"]["all"]["statuses"]}')
+
+    output = args.output
+    if output is None:
+        os.makedirs(DEFAULT_OUTPUT_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(DEFAULT_OUTPUT_DIR, f'{stamp}-{(result["commit"]["sha"] or "nogit")[:8]}.json')
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'Results written to {output}')
+
+
+def compare(args):
+    """Print latency changes group by group; exit 1 on a regression with --fail-on-regression"""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    for label, result in (('baseline', baseline), ('candidate', candidate)):
+        print(f"{label}: {result['commit']['sha'] and result['commit']['sha'][:10]} {result['started_at']} "
+              f"({result['mode']}, {result['target']})")
+    if baseline['mode'] != candidate['mode'] or baseline['config']['capture'] != candidate['config']['capture']:
+        print('warning: the runs replayed different captures or pacing')
+
+    rows = compare_groups(baseline['latencies_ms'], candidate['latencies_ms'], args.alpha, args.threshold)
+    for name, stats in rows.items():
+        print(f"\n{name} (n={stats['n'][0]}/{stats['n'][1]}, KS D={stats['ks']}, p={stats['p_value']:.3g})"
+              f"{'  REGRESSION' if stats['regression'] else ''}")
+        for key in ('p50', 'p90', 'p99', 'mean'):
+            before, after = stats['baseline'][key], stats['candidate'][key]
+            change = f'{(after - before) / before * 100:>+7.1f}%' if before else ''
+            print(f'  {key:<8}{before:>12}{after:>12}{change:>10}')
+    if args.fail_on_regression and any(stats['regression'] for stats in rows.values()):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    replay = commands.add_parser('run', help='Replay a capture and record the latencies')
+    replay.add_argument('capture', help='Capture store (CAPTURE_DIR of the server that recorded it)')
+    target = replay.add_mutually_exclusive_group()
+    target.add_argument('--url', help='Server to replay against (default: the app in this process)')
+    target.add_argument('--direct', action='store_true', help='Run the upsampler in this process, without the API')
+    pacing = replay.add_mutually_exclusive_group()
+    pacing.add_argument('--speed', type=float, default=1.0, help='Replay this many times faster than captured')
+    pacing.add_argument('--max-speed', action='store_true', help='Send requests back to back instead')
+    replay.add_argument('--concurrency', type=int, default=4,
+                        help='--max-speed: requests kept in flight; --direct: upsamplers per model')
+    replay.add_argument('--max-in-flight', type=int, default=64, help='Paced: concurrent request limit')
+    replay.add_argument('--endpoints', type=lambda spec: spec.split(','),
+                        help='Only replay these endpoints, e.g. enhance,job (default: all)')
+    replay.add_argument('--include-failed', action='store_true', help='Also replay requests that failed')
+    replay.add_argument('--limit', type=int, default=0, help='Replay the first N requests only (0: all)')
+    replay.add_argument('--seed', type=int, default=0, help='Seed of images synthesized for requests without inputs')
+    replay.add_argument('--wait-ready', type=float, default=600, help='Seconds to wait for /api/ready (0: skip)')
+    replay.add_argument('--output', help=f'Result file (default: {DEFAULT_OUTPUT_DIR}/<time>-<commit>.json)')
+    replay.set_defaults(func=run)
+
+    diff = commands.add_parser('compare', help='Compare the latency distributions of two replays')
+    diff.add_argument('baseline')
+    diff.add_argument('candidate')
+    diff.add_argument('--alpha', type=float, default=0.01, help='KS test significance level')
+    diff.add_argument('--threshold', type=float, default=0.05,
+                      help='Relative p50/p90 slowdown that counts as a regression')
+    diff.add_argument('--fail-on-regression', action='store_true', help='Exit 1 if any group regressed')
+    diff.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Evaluate model=auto routing on a labelled folder of images
+Images sit in one sub-folder per content type (anime/, photo/). Reports how often the
+router picks the model the label calls for, and the compute it saves against always
+running one model. --fit refits the classifier on the folder and prints ROUTER_WEIGHTS:
+
+    python api/benchmarks/route_eval.py labelled/ --baseline RealESRGAN_x4plus --fit
+"""
+
+import os
+import sys
+import argparse
+import statistics
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from admission import estimate_cost  # noqa: E402
+from image_probe import probe_image  # noqa: E402
+from model_config import MODEL_CONFIG  # noqa: E402
+from model_router import (ANIME, CONTENTS, ROUTER_MIN_CONFIDENCE, ROUTER_SIDE, ContentRouter,  # noqa: E402
+                          cheapest_model, content_features, thumbnail)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+
+
+def load_labelled(folder):
+    """(path, label, encoded bytes, ImageInfo) of every readable image in the label sub-folders"""
+    images = []
+    for label in CONTENTS:
+        directory = os.path.join(folder, label)
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(directory, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path, 'rb') as f:
+                info = probe_image(f)
+            if info is not None:
+                images.append((path, label, data, info))
+    return images
+
+
+def fit(features, labels, l2=0.03, steps=5000, learning_rate=0.5):
+    """Logistic regression (anime positive) on standardised features, returned as raw-feature weights and bias"""
+    mean, std = features.mean(axis=0), features.std(axis=0) + 1e-9
+    x = np.hstack([(features - mean) / std, np.ones((len(features), 1))])
+    w = np.zeros(x.shape[1])
+    for _ in range(steps):
+        p = 1 / (1 + np.exp(-x @ w))
+        w -= learning_rate * (x.T @ (p - labels) / len(labels) + l2 * np.append(w[:-1], 0))
+    weights = w[:-1] / std
+    return tuple(weights) + (w[-1] - float(weights @ mean),)
+
+
+def evaluate(router, images, baseline):
+    decisions = []
+    for path, label, data, info in images:
+        decision = router.route(data, info.width, info.height)
+        decisions.append((path, label, info, decision))
+
+    print(f'{"image":<40}{"label":>7}{"content":>9}{"conf":>6}  model')
+    for path, label, _, decision in decisions:
+        mark = '' if decision.model_name == cheapest_model(label) else '  ✗'
+        print(f'{os.path.basename(path)[:39]:<40}{label:>7}{decision.content or "-":>9}{decision.confidence:>6.2f}  '
+              f'{decision.model_name}{mark}')
+
+    correct = sum(label == decision.content for _, label, _, decision in decisions)
+    right_model = sum(decision.model_name == cheapest_model(label) for _, label, _, decision in decisions)
+    unsure = sum(not decision.routed for *_, decision in decisions)
+    print(f'\n{len(decisions)} images: classified {correct / len(decisions):.1%}, '
+          f'routed to the label\'s model {right_model / len(decisions):.1%}, unsure {unsure / len(decisions):.1%}')
+    for label in CONTENTS:
+        labelled = [decision for _, truth, _, decision in decisions if truth == label]
+        if labelled:
+            hits = sum(decision.content == label for decision in labelled)
+            print(f'  {label}: {hits}/{len(labelled)} ({cheapest_model(label)})')
+    print(f'  routing takes {statistics.median(d.elapsed_ms for *_, d in decisions):.1f}ms median')
+
+    routed = sum(estimate_cost(info.width, info.height, d.model_name) for _, _, info, d in decisions)
+    oracle = sum(estimate_cost(info.width, info.height, cheapest_model(label)) for _, label, info, _ in decisions)
+    print(f'\nCompute (relative cost x input megapixels): routed {routed:.2f}, with perfect labels {oracle:.2f}')
+    for name in baseline:
+        always = sum(estimate_cost(info.width, info.height, name) for _, _, info, _ in decisions)
+        print(f'  always {name}: {always:.2f}, routing saves {1 - routed / always:.1%}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('folder', help='Folder with anime/ and photo/ sub-folders')
+    parser.add_argument('--baseline', nargs='+', default=['RealESRGAN_x4plus'], choices=list(MODEL_CONFIG),
+                        help='Models to compare the compute of routing against')
+    parser.add_argument('--min-confidence', type=float, default=ROUTER_MIN_CONFIDENCE,
+                        help='Confidence below which the default model is used')
+    parser.add_argument('--fit', action='store_true', help='Refit the classifier on the folder and evaluate that')
+    args = parser.parse_args()
+
+    images = load_labelled(args.folder)
+    if not images:
+        sys.exit(f'No labelled images in {args.folder} (expected {"/, ".join(CONTENTS)}/ sub-folders)')
+
+    router = ContentRouter(min_confidence=args.min_confidence)
+    if args.fit:
+        features = np.array([content_features(thumbnail(data, info.width, info.height, ROUTER_SIDE))
+                             for _, _, data, info in images])
+        labels = np.array([label == ANIME for _, label, _, _ in images], dtype=float)
+        weights = fit(features, labels)
+        # Evaluated on its own training set, so expect held-out accuracy to be lower
+        print(f'ROUTER_WEIGHTS={",".join(f"{w:.2f}" for w in weights)}\n')
+        router = ContentRouter(weights, min_confidence=args.min_confidence)
+    evaluate(router, images, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
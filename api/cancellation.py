@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Request cancellation and deadlines
+A CancelToken travels with a request down to RealESRGANer's tile loop, which checks
+it between tiles. It is cancelled when the client disconnects, when a job is deleted
+(DELETE /api/jobs/<id>) or when its deadline passes, so abandoned work stops after the
+tile in progress instead of running to the end.
+"""
+
+import os
+import time
+import select
+import socket
+import threading
+
+# Longest an enhance request may run once its upload is in; ``deadline_ms`` can only shorten it
+REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE_SECONDS', 300))
+# Longest a background job may run, counted from submission
+JOB_DEADLINE = float(os.getenv('JOB_DEADLINE_SECONDS', 1800))
+# How often blocking waits (scheduler queue, model server reply) look at the token
+CANCEL_POLL_INTERVAL = 0.1
+
+CANCELLED = 'cancelled'
+DEADLINE = 'deadline'
+DISCONNECTED = 'disconnected'
+
+
+class Cancelled(Exception):
+    """Raised where cancelled work stops.
+
+    ``reason`` is 'cancelled', 'deadline' or 'disconnected'. ``tiles`` and
+    ``inference_seconds`` are the work ``model_name`` did before it stopped, which
+    was wasted (none if it stopped while waiting).
+    """
+
+    def __init__(self, reason, tiles=0, inference_seconds=0.0, model_name=None):
+        super().__init__(f'Request {reason}')
+        self.reason = reason
+        self.tiles = tiles
+        self.inference_seconds = inference_seconds
+        self.model_name = model_name
+
+
+class CancelToken:
+    """Cancellation state of one request.
+
+    Args:
+        deadline (float): time.monotonic() value after which the token counts as
+            cancelled with reason 'deadline'. Default: None (no deadline).
+        poll (callable): Called when the token is checked; returns a reason to cancel
+            with (e.g. 'disconnected') or None. Default: None.
+    """
+
+    def __init__(self, deadline=None, poll=None):
+        self.deadline = deadline
+        self._poll = poll
+        self._reason = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def after(cls, seconds, poll=None):
+        """Token whose deadline is ``seconds`` from now (none if ``seconds`` is falsy)"""
+        return cls(time.monotonic() + seconds if seconds else None, poll)
+
+    def remaining(self):
+        """Seconds until the deadline (never negative), or None without one"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def timeout(self, timeout):
+        """``timeout`` shortened so a wait ends by the deadline"""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def cancel(self, reason=CANCELLED):
+        """Cancel with ``reason``; returns False if the token was already cancelled"""
+        with self._lock:
+            if self._reason is not None:
+                return False
+            self._reason = reason
+            return True
+
+    @property
+    def reason(self):
+        """Why the token was cancelled, or None while it is live"""
+        if self._reason is None:
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                self.cancel(DEADLINE)
+            elif self._poll is not None:
+                reason = self._poll()
+                if reason is not None:
+                    self.cancel(reason)
+        return self._reason
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def check(self):
+        """Raise Cancelled if the token has been cancelled"""
+        reason = self.reason
+        if reason is not None:
+            raise Cancelled(reason)
+
+
+def socket_disconnected(sock):
+    """Whether the peer of a connection whose request has been read has closed it.
+
+    A closed connection is readable with nothing left to read; a pipelined next
+    request is readable too, but has data.
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        # Closed here already, or a TLS socket that cannot peek
+        return False
+
+
+def disconnect_poll(environ):
+    """Token poll that reports the client of a WSGI request disconnecting.
+
+    Uses the connection socket the server exposes (gunicorn and the Werkzeug
+    development server do); without one, disconnects are not detected.
+    """
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None:
+        return None
+    return lambda: DISCONNECTED if socket_disconnected(sock) else None
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Opt-in traffic capture for performance regression testing
+With CAPTURE_ENABLED=true every enhancement request (single, batch item or job) is
+recorded in CAPTURE_DIR/records.jsonl: when it arrived, the input's dimensions,
+format and size, the model, scale and output format asked for, how it was served and
+how long it took. CAPTURE_INPUTS keeps the inputs as well, anonymised, for
+benchmarks/replay.py to re-issue the real workload against another build.
+No filenames or client addresses are stored; tenants are kept as salted hashes.
+"""
+
+import os
+import hmac
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from queue import Queue, Full
+
+import cv2
+import numpy as np
+
+from image_io import decode_image, encode_image
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_ENABLED = os.getenv('CAPTURE_ENABLED', 'false').lower() == 'true'
+CAPTURE_DIR = os.getenv('CAPTURE_DIR', os.path.join('outputs', 'capture'))
+# Inputs kept with the records: 'none', 'stripped' (metadata removed) or 'scrambled'
+# (also shuffled in 16 px blocks: same size, format and texture, but not the picture)
+CAPTURE_INPUTS = os.getenv('CAPTURE_INPUTS', 'none')
+# Fraction of requests recorded
+CAPTURE_SAMPLE_RATE = float(os.getenv('CAPTURE_SAMPLE_RATE', 1.0))
+# Inputs stop being kept once the store reaches this size; records continue
+CAPTURE_MAX_BYTES = int(os.getenv('CAPTURE_MAX_MB', 2048)) * 1024 * 1024
+CAPTURE_QUEUE_SIZE = 256
+INPUT_MODES = ('none', 'stripped', 'scrambled')
+SCRAMBLE_BLOCK = 16
+# Extensions inputs are stored with, by probed format; others are stored as PNG
+INPUT_EXTENSIONS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp', 'bmp': '.bmp'}
+
+
+def anonymise(data, fmt, mode, seed=0):
+    """Re-encode an uploaded image without its metadata (EXIF, ICC, text chunks).
+
+    'scrambled' also permutes the image in SCRAMBLE_BLOCK blocks. Returns the encoded
+    bytes and their extension, or None if the image cannot be decoded.
+    """
+    img = decode_image(np.frombuffer(data, np.uint8))
+    if img is None:
+        return None
+    if mode == 'scrambled':
+        img = scramble(img, np.random.default_rng(seed))
+    ext = INPUT_EXTENSIONS.get(fmt, '.png')
+    if ext == '.jpg':
+        return encode_image(img, ext, [cv2.IMWRITE_JPEG_QUALITY, 95]), ext
+    if ext == '.webp':
+        return encode_image(img, ext, [cv2.IMWRITE_WEBP_QUALITY, 101]), ext
+    return encode_image(img, ext), ext
+
+
+def scramble(img, rng, block=SCRAMBLE_BLOCK):
+    """Shuffle the whole blocks of an image; the ragged right and bottom edges stay put"""
+    height, width = img.shape[:2]
+    rows, cols = height // block, width // block
+    if rows * cols < 2:
+        return img
+    out = img.copy()
+    core = img[:rows * block, :cols * block]
+    blocks = core.reshape(rows, block, cols, block, *img.shape[2:]).swapaxes(1, 2).reshape(rows * cols, block, block,
+                                                                                            *img.shape[2:])
+    blocks = blocks[rng.permutation(rows * cols)]
+    out[:rows * block, :cols * block] = blocks.reshape(rows, cols, block, block, *img.shape[2:]).swapaxes(1, 2) \
+        .reshape(rows * block, cols * block, *img.shape[2:])
+    return out
+
+
+class TrafficCapture:
+    """Record requests for replay, writing from a background thread.
+
+    Args:
+        directory (str): Capture store. Default: CAPTURE_DIR.
+        enabled (bool): Default: CAPTURE_ENABLED.
+        inputs (str): One of INPUT_MODES. Default: CAPTURE_INPUTS.
+        sample_rate (float): Default: CAPTURE_SAMPLE_RATE.
+        max_bytes (int): Default: CAPTURE_MAX_BYTES.
+    """
+
+    def __init__(self, directory=CAPTURE_DIR, enabled=CAPTURE_ENABLED, inputs=CAPTURE_INPUTS,
+                 sample_rate=CAPTURE_SAMPLE_RATE, max_bytes=CAPTURE_MAX_BYTES):
+        if inputs not in INPUT_MODES:
+            raise ValueError(f'CAPTURE_INPUTS must be one of {", ".join(INPUT_MODES)}, got {inputs}')
+        self.directory = directory
+        self.enabled = enabled
+        self.inputs = inputs
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self._queue = Queue(CAPTURE_QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._salt = None
+        self._stored = None
+        self.dropped = 0
+
+    @property
+    def records_path(self):
+        return os.path.join(self.directory, 'records.jsonl')
+
+    def input_path(self, name):
+        return os.path.join(self.directory, 'inputs', name)
+
+    def record(self, endpoint, info, outcome, latency_ms, data=None, tenant=None, **fields):
+        """Capture one finished request of an image described by ``info`` (an ImageInfo).
+
+        ``outcome`` is 'ok' or why it failed; ``data`` is the encoded upload, kept (anonymised)
+        when CAPTURE_INPUTS allows; ``fields`` are the request's parameters and how it was
+        served (model, scale, tier, ...).
+        """
+        if not self.enabled or random.random() >= self.sample_rate:
+            return
+        record = dict({
+            # When it arrived, for replay to keep the original pacing
+            't': round(time.time() - latency_ms / 1000, 3),
+            'endpoint': endpoint,
+            'outcome': outcome,
+            'latency_ms': round(latency_ms, 1),
+            'format': info.format,
+            'width': info.width,
+            'height': info.height,
+            'channels': info.channels,
+            'bytes': None if data is None else len(data)
+        }, **fields)
+        # The upload buffer is released with the request, so the input is copied now
+        data = bytes(data) if data is not None and self.inputs != 'none' else None
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='traffic-capture', daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait((record, tenant, data))
+        except Full:
+            self.dropped += 1
+
+    def flush(self, timeout=10.0):
+        """Wait until the requests recorded so far are written"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _run(self):
+        while True:
+            record, tenant, data = self._queue.get()
+            try:
+                self._write(record, tenant, data)
+            except (OSError, ValueError, cv2.error) as e:
+                logger.warning(f"⚠️ Could not capture request: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, record, tenant, data):
+        os.makedirs(os.path.join(self.directory, 'inputs'), exist_ok=True)
+        if tenant is not None:
+            record['tenant'] = hmac.new(self._tenant_salt(), tenant.encode(), hashlib.sha256).hexdigest()[:12]
+        record['input'] = None
+        if data is not None:
+            record['input'] = self._store_input(data, record['format'])
+        with open(self.records_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def _tenant_salt(self):
+        """Per-store secret, shared by every worker process writing to it"""
+        if self._salt is None:
+            path = os.path.join(self.directory, 'salt')
+            # Written aside and linked into place, so no process ever reads a half-written salt
+            partial_path = f'{path}.{os.getpid()}.part'
+            with open(partial_path, 'w') as f:
+                f.write(os.urandom(16).hex())
+            try:
+                os.link(partial_path, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(partial_path)
+            with open(path) as f:
+                self._salt = bytes.fromhex(f.read().strip())
+        return self._salt
+
+    def _store_input(self, data, fmt):
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        for ext in set(INPUT_EXTENSIONS.values()):
+            # The same image uploaded again is stored once
+            if os.path.exists(self.input_path(digest + ext)):
+                return digest + ext
+        if self._stored is None:
+            folder = os.path.join(self.directory, 'inputs')
+            self._stored = sum(entry.stat().st_size for entry in os.scandir(folder))
+        if self._stored >= self.max_bytes:
+            return None
+        anonymised = anonymise(data, fmt, self.inputs, seed=int(digest[:8], 16))
+        if anonymised is None:
+            return None
+        encoded, ext = anonymised
+        partial_path = self.input_path(f'{digest}{ext}.{os.getpid()}.part')
+        with open(partial_path, 'wb') as f:
+            f.write(encoded)
+        os.replace(partial_path, self.input_path(digest + ext))
+        self._stored += len(encoded)
+        return digest + ext
+
+
+def load_records(directory):
+    """Captured records in arrival order"""
+    records = []
+    with open(os.path.join(directory, 'records.jsonl')) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return sorted(records, key=lambda record: record['t'])
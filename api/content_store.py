@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Content-addressed store of uploaded sources and enhanced results
+Sources are kept under a key made from the SHA-256 of their bytes, and results under
+one made from that and the request parameters, so a client that sends only the hash
+of an image the server has seen (hash-first upload, see HASH-FIRST-UPLOAD-GUIDE.md)
+gets its result, or has it computed, without uploading the file again. The store
+lives on disk, shared by the worker processes, and the least recently used entries
+go once it is over its budget.
+"""
+
+import os
+import re
+import json
+import logging
+import threading
+
+from uploads import IngestStream
+from image_probe import ImageInfo
+
+logger = logging.getLogger(__name__)
+
+CONTENT_STORE_DIR = os.getenv('CONTENT_STORE_DIR', os.path.join('outputs', 'content'))
+# Disk budget for sources and results together
+CONTENT_STORE_MAX_BYTES = int(os.getenv('CONTENT_STORE_MAX_MB', 2048)) * 1024 * 1024
+# Evicting stops once the store is back under this share of the budget
+EVICT_TO = 0.9
+
+SOURCES = 'sources'
+RESULTS = 'results'
+_KEY = re.compile(r'^[0-9a-f]{64}$')
+
+
+def valid_key(key):
+    """Whether ``key`` is a hex SHA-256, as content hashes and store keys are"""
+    return bool(_KEY.match(key or ''))
+
+
+class ContentStore:
+    """Sources and results on disk, each a ``<key>.data`` file with a ``<key>.json`` sidecar.
+
+    Args:
+        directory (str): Default: CONTENT_STORE_DIR.
+        max_bytes (int): Default: CONTENT_STORE_MAX_BYTES.
+    """
+
+    def __init__(self, directory=CONTENT_STORE_DIR, max_bytes=CONTENT_STORE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+        for kind in (SOURCES, RESULTS):
+            os.makedirs(os.path.join(directory, kind), exist_ok=True)
+
+    def _paths(self, kind, key):
+        if not valid_key(key):
+            return None, None
+        base = os.path.join(self.directory, kind, key)
+        return f'{base}.data', f'{base}.json'
+
+    def _read(self, kind, key):
+        data_path, meta_path = self._paths(kind, key)
+        if data_path is None:
+            return None, None
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            # Recently used entries are evicted last
+            os.utime(data_path)
+        except (OSError, ValueError):
+            return None, None
+        return data_path, meta
+
+    def _write(self, kind, key, data, meta):
+        data_path, meta_path = self._paths(kind, key)
+        if data_path is None or os.path.exists(meta_path):
+            return
+        size = len(data)
+        if size > self.max_bytes * EVICT_TO:
+            return
+        partial = f'.{os.getpid()}.{threading.get_ident()}.part'
+        with open(data_path + partial, 'wb') as f:
+            f.write(data)
+        with open(meta_path + partial, 'w') as f:
+            json.dump(meta, f)
+        # The sidecar goes last: an entry exists once both files are in place
+        os.replace(data_path + partial, data_path)
+        os.replace(meta_path + partial, meta_path)
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            over = self._size is None or self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def has_source(self, key):
+        _, meta_path = self._paths(SOURCES, key)
+        return meta_path is not None and os.path.exists(meta_path)
+
+    def open_source(self, key, filename=None):
+        """IngestStream over a stored source, or None if it is not in the store.
+
+        Without a ``filename`` it is named after its format, e.g. image.png.
+        """
+        data_path, meta = self._read(SOURCES, key)
+        if data_path is None:
+            return None
+        info = ImageInfo(**meta['info'])
+        try:
+            return IngestStream.open(data_path, filename or f'image.{info.format}', meta['sha256'], info)
+        except OSError:
+            # Evicted since it was looked up
+            return None
+
+    def put_source(self, key, data, sha256, info):
+        """Keep an upload's encoded bytes, SHA-256 and ImageInfo under ``key``"""
+        self._write(SOURCES, key, data, {'sha256': sha256, 'info': info.to_dict(), 'size': len(data)})
+
+    def get_result(self, key):
+        """A stored result's bytes and meta, or None"""
+        data_path, meta = self._read(RESULTS, key)
+        if data_path is None:
+            return None
+        try:
+            with open(data_path, 'rb') as f:
+                return f.read(), meta
+        except OSError:
+            return None
+
+    def put_result(self, key, payload, meta):
+        """Keep a result's encoded bytes and JSON-serializable ``meta`` under ``key``"""
+        self._write(RESULTS, key, payload, meta)
+
+    def evict(self):
+        """Remove the least recently used entries until the store is within its budget"""
+        entries = []
+        for kind in (SOURCES, RESULTS):
+            folder = os.path.join(self.directory, kind)
+            for entry in os.scandir(folder):
+                if entry.name.endswith('.data'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, kind, entry.name[:-len('.data')]))
+        size = sum(entry[1] for entry in entries)
+        if size > self.max_bytes:
+            for _, entry_size, kind, key in sorted(entries):
+                if size <= self.max_bytes * EVICT_TO:
+                    break
+                # The sidecar first, so readers never see an entry without its data
+                for path in reversed(self._paths(kind, key)):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                size -= entry_size
+                logger.debug(f"Evicted {kind[:-1]} {key[:12]} from the content store")
+        with self._lock:
+            self._size = size
+
+    def stats(self):
+        with self._lock:
+            return {'bytes': self._size, 'max_bytes': self.max_bytes}
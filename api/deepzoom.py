@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Deep-zoom tile pyramids of enhanced images, rendered on demand
+An image is published as a Deep Zoom (DZI) pyramid of its enhanced result, but nothing
+is enhanced up front: a tile is rendered when a viewer asks for it, from just the source
+pixels under it plus a halo of context, and cached on disk. Levels no larger than the
+source are plain box-downscales of it and never touch the model.
+"""
+
+import os
+import json
+import math
+import time
+import shutil
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from cancellation import REQUEST_DEADLINE, CancelToken
+from image_io import OutputFormat
+
+logger = logging.getLogger(__name__)
+
+DEEPZOOM_TILE_SIZE = int(os.getenv('DEEPZOOM_TILE_SIZE', 256))
+DEEPZOOM_OVERLAP = int(os.getenv('DEEPZOOM_OVERLAP', 1))
+# Source pixels of context around a rendered region, so its edges match its neighbours'
+DEEPZOOM_HALO = int(os.getenv('DEEPZOOM_HALO', 16))
+# Pyramids nobody has viewed for this long are deleted with their tiles
+DEEPZOOM_TTL = int(os.getenv('DEEPZOOM_TTL_SECONDS', 24 * 3600))
+# Neighbours of a requested tile rendered ahead, on this many threads, up to this many waiting
+DEEPZOOM_PREFETCH_WORKERS = int(os.getenv('DEEPZOOM_PREFETCH_WORKERS', 1))
+DEEPZOOM_PREFETCH_QUEUE = int(os.getenv('DEEPZOOM_PREFETCH_QUEUE', 32))
+# Halos start and end on this grid, so the 2x2 and 4x4 pixel-unshuffle of the x2/x1
+# networks groups the same source pixels in every tile that covers them
+ALIGN = 4
+# Scheduler tenant of prefetches: they share one small slice instead of each viewer's
+PREFETCH_TENANT = 'deepzoom-prefetch'
+PREFETCH_WEIGHT = 0.25
+
+DZI_NAMESPACE = 'http://schemas.microsoft.com/deepzoom/2008'
+_TOUCH_INTERVAL = 60
+
+
+def _align_down(value, grid=ALIGN):
+    return value // grid * grid
+
+
+def _align_up(value, grid=ALIGN):
+    return -(-value // grid) * grid
+
+
+def _shrink(img, width, height, factor):
+    """Box-downscale by an integer ``factor`` (INTER_AREA averages whole blocks) to width x height"""
+    if factor == 1 and img.shape[1] == width and img.shape[0] == height:
+        return img
+    return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def render_region(source, x, y, width, height, level_scale, scale, enhance, halo=DEEPZOOM_HALO):
+    """Pixels ``[x, x + width) x [y, y + height)`` of the source image resized by ``level_scale``.
+
+    ``scale`` is the network scale, a power of two, and ``level_scale`` is ``scale``
+    divided by a power of two. Above 1, the source under the region plus ``halo``
+    pixels (aligned to ALIGN) is run through ``enhance(crop)`` and the result is
+    box-downscaled to the level; otherwise the source itself is box-downscaled.
+    Results for neighbouring regions meet without seams.
+    """
+    src_height, src_width = source.shape[:2]
+    if level_scale <= 1:
+        factor = round(1 / level_scale)
+        crop = source[y * factor:min(src_height, (y + height) * factor),
+                      x * factor:min(src_width, (x + width) * factor)]
+        return _shrink(np.ascontiguousarray(crop), width, height, factor)
+
+    level_scale = round(level_scale)
+    x0 = max(0, _align_down(x // level_scale - halo))
+    y0 = max(0, _align_down(y // level_scale - halo))
+    x1 = min(src_width, _align_up(-(-(x + width) // level_scale) + halo))
+    y1 = min(src_height, _align_up(-(-(y + height) // level_scale) + halo))
+    enhanced = enhance(np.ascontiguousarray(source[y0:y1, x0:x1]))
+    enhanced = _shrink(enhanced, (x1 - x0) * level_scale, (y1 - y0) * level_scale, scale // level_scale)
+    top, left = y - y0 * level_scale, x - x0 * level_scale
+    return np.ascontiguousarray(enhanced[top:top + height, left:left + width])
+
+
+class Pyramid:
+    """Geometry of one published image's Deep Zoom pyramid.
+
+    The full-resolution level is the source at the network ``scale``; each level
+    below halves it, down to a single pixel at level 0.
+
+    Args:
+        pyramid_id (str): Content hash of the source and the rendering parameters.
+        width (int): Source width.
+        height (int): Source height.
+        model_name (str): Model tiles are enhanced with.
+        scale (int): Network scale of the model (a power of two).
+        output_format (str): 'png', 'jpeg' or 'webp'.
+        tile_size (int): Tile edge in pixels, without overlap.
+        overlap (int): Pixels each tile repeats of its neighbours.
+    """
+
+    def __init__(self, pyramid_id, width, height, model_name, scale, output_format='jpeg',
+                 tile_size=DEEPZOOM_TILE_SIZE, overlap=DEEPZOOM_OVERLAP):
+        if scale < 1 or scale & (scale - 1):
+            raise ValueError(f'Deep zoom needs a power-of-two model scale, not {scale}')
+        self.id = pyramid_id
+        self.width = width
+        self.height = height
+        self.model_name = model_name
+        self.scale = scale
+        self.format = output_format
+        self.tile_size = tile_size
+        self.overlap = overlap
+
+    @property
+    def max_level(self):
+        return max(0, math.ceil(math.log2(max(self.width, self.height) * self.scale)))
+
+    def level_scale(self, level):
+        """Level pixels per source pixel"""
+        return self.scale / 2 ** (self.max_level - level)
+
+    def level_size(self, level):
+        divisor = 2 ** (self.max_level - level)
+        return -(-self.width * self.scale // divisor), -(-self.height * self.scale // divisor)
+
+    def grid(self, level):
+        """Columns and rows of tiles at a level"""
+        width, height = self.level_size(level)
+        return -(-width // self.tile_size), -(-height // self.tile_size)
+
+    def enhanced(self, level):
+        """Whether tiles at a level go through the model (it is larger than the source)"""
+        return self.level_scale(level) > 1
+
+    def tile_rect(self, level, col, row):
+        """(x, y, width, height) of a tile at its level, with overlap; None outside the grid"""
+        cols, rows = self.grid(level) if 0 <= level <= self.max_level else (0, 0)
+        if not (0 <= col < cols and 0 <= row < rows):
+            return None
+        width, height = self.level_size(level)
+        x = max(0, col * self.tile_size - self.overlap)
+        y = max(0, row * self.tile_size - self.overlap)
+        x_end = min(width, (col + 1) * self.tile_size + self.overlap)
+        y_end = min(height, (row + 1) * self.tile_size + self.overlap)
+        return x, y, x_end - x, y_end - y
+
+    @property
+    def ext(self):
+        return 'jpg' if self.format == 'jpeg' else self.format
+
+    def to_dzi(self):
+        """The .dzi descriptor viewers such as OpenSeadragon load"""
+        width, height = self.level_size(self.max_level)
+        return (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="{DZI_NAMESPACE}" Format="{self.ext}" Overlap="{self.overlap}" '
+                f'TileSize="{self.tile_size}">\n'
+                f'  <Size Width="{width}" Height="{height}"/>\n'
+                f'</Image>\n')
+
+    def to_dict(self):
+        return {
+            'pyramid_id': self.id,
+            'width': self.width,
+            'height': self.height,
+            'model': self.model_name,
+            'scale': self.scale,
+            'format': self.format,
+            'tile_size': self.tile_size,
+            'overlap': self.overlap
+        }
+
+    @classmethod
+    def from_dict(cls, fields):
+        return cls(fields['pyramid_id'], fields['width'], fields['height'], fields['model'], fields['scale'],
+                   fields['format'], fields['tile_size'], fields['overlap'])
+
+
+class DeepZoom:
+    """Publish pyramids and render their tiles when they are first requested.
+
+    Each pyramid is a directory holding its source pixels (memory-mapped when
+    rendering, so a tile reads only the rows under it), its metadata and its
+    rendered tiles, named as in a static DZI tree. Any worker process sharing the
+    directory can serve any pyramid.
+
+    Args:
+        directory (str): Where pyramids live.
+        enhance (callable): ``enhance(crop, model_name, tenant, cancel)`` returns the
+            crop upscaled at the model's network scale.
+        flights (SingleFlight): Coalesces concurrent renders of the same tile.
+        ttl (int): Seconds an unviewed pyramid is kept.
+    """
+
+    def __init__(self, directory, enhance, flights, ttl=DEEPZOOM_TTL, prefetch_workers=DEEPZOOM_PREFETCH_WORKERS,
+                 prefetch_queue=DEEPZOOM_PREFETCH_QUEUE):
+        self.directory = directory
+        self.enhance = enhance
+        self.flights = flights
+        self.ttl = ttl
+        self.prefetch_queue = prefetch_queue
+        os.makedirs(directory, exist_ok=True)
+        self._prefetching = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix='deepzoom')
+
+    def _path(self, pyramid_id, *parts):
+        if not pyramid_id.isalnum():
+            return None
+        return os.path.join(self.directory, pyramid_id, *parts)
+
+    def create(self, img, pyramid_id, model_name, scale, output_format='jpeg'):
+        """Publish a decoded image; an identical pyramid already published is reused with its tiles"""
+        self.purge()
+        pyramid = self.get(pyramid_id)
+        if pyramid is not None:
+            return pyramid
+        pyramid = Pyramid(pyramid_id, img.shape[1], img.shape[0], model_name, scale, output_format)
+        os.makedirs(self._path(pyramid_id), exist_ok=True)
+        # Metadata goes last: a pyramid exists once its source is complete
+        partial = self._path(pyramid_id, f'source.{threading.get_ident()}.npy')
+        np.save(partial, img)
+        os.replace(partial, self._path(pyramid_id, 'source.npy'))
+        partial = self._path(pyramid_id, f'pyramid.{threading.get_ident()}.json')
+        with open(partial, 'w') as f:
+            json.dump(pyramid.to_dict(), f)
+        os.replace(partial, self._path(pyramid_id, 'pyramid.json'))
+        return pyramid
+
+    def get(self, pyramid_id):
+        """A published pyramid, or None"""
+        path = self._path(pyramid_id, 'pyramid.json')
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                pyramid = Pyramid.from_dict(json.load(f))
+            if time.time() - os.path.getmtime(path) > _TOUCH_INTERVAL:
+                os.utime(path)  # viewed: keep it from purge()
+        except (OSError, ValueError):
+            return None
+        return pyramid
+
+    def source(self, pyramid):
+        return np.load(self._path(pyramid.id, 'source.npy'), mmap_mode='r')
+
+    def tile_path(self, pyramid, level, col, row):
+        return self._path(pyramid.id, f'{level}', f'{col}_{row}.{pyramid.ext}')
+
+    def tile(self, pyramid, level, col, row, tenant=None, cancel=None):
+        """Encoded tile, rendered unless it is cached. Returns None for a tile outside the pyramid"""
+        rect = pyramid.tile_rect(level, col, row)
+        if rect is None:
+            return None
+        path = self.tile_path(pyramid, level, col, row)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+        def compute():
+            # Read the source under the tile only; the memory map keeps the rest on disk
+            img = render_region(self.source(pyramid), *rect, pyramid.level_scale(level), pyramid.scale,
+                                lambda crop: self.enhance(crop, pyramid.model_name, tenant, cancel))
+            data = OutputFormat(pyramid.format).encode(img)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            partial = f'{path}.{threading.get_ident()}'
+            with open(partial, 'wb') as f:
+                f.write(data)
+            os.replace(partial, path)
+            return data, {}
+
+        (data, _), _ = self.flights.run(f'deepzoom:{pyramid.id}:{level}:{col}:{row}', compute, cancel=cancel)
+        return data
+
+    def prefetch(self, pyramid, level, col, row):
+        """Render the enhanced neighbours of a viewed tile in the background, lowest priority first"""
+        if not pyramid.enhanced(level):
+            return
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                key = (pyramid.id, level, col + dx, row + dy)
+                if (dx or dy) and pyramid.tile_rect(*key[1:]) is not None \
+                        and not os.path.exists(self.tile_path(pyramid, *key[1:])):
+                    with self._lock:
+                        if key in self._prefetching or len(self._prefetching) >= self.prefetch_queue:
+                            continue
+                        self._prefetching.add(key)
+                    self._pool.submit(self._prefetch, pyramid, key)
+
+    def _prefetch(self, pyramid, key):
+        try:
+            self.tile(pyramid, *key[1:], tenant=(PREFETCH_TENANT, PREFETCH_WEIGHT),
+                      cancel=CancelToken.after(REQUEST_DEADLINE))
+        except Exception as e:
+            logger.debug(f"Prefetch of tile {key} skipped: {e}")
+        finally:
+            with self._lock:
+                self._prefetching.discard(key)
+
+    def delete(self, pyramid_id):
+        path = self._path(pyramid_id)
+        if path is None or not os.path.isdir(path):
+            return False
+        shutil.rmtree(path, ignore_errors=True)
+        return True
+
+    def purge(self):
+        """Delete pyramids that nobody has viewed for ``ttl`` seconds"""
+        cutoff = time.time() - self.ttl
+        for pyramid_id in os.listdir(self.directory):
+            # A pyramid without metadata is still being created, or was left half-written by a crash
+            for name in ('pyramid.json', ''):
+                try:
+                    if os.path.getmtime(os.path.join(self.directory, pyramid_id, name)) < cutoff:
+                        self.delete(pyramid_id)
+                    break
+                except OSError:
+                    continue
@@ -0,0 +1,18 @@
+"""
+Gunicorn configuration for the Real-ESRGAN API
+Loaded automatically by gunicorn from the working directory
+"""
+
+
+def post_worker_init(worker):
+    """Start loading models in the background as soon as a worker is up"""
+    import realesrgan_api
+    realesrgan_api.inference.start()
+
+
+def child_exit(server, worker):
+    """Drop a dead worker's live gauges from the merged Prometheus metrics"""
+    import os
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
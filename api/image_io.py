@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+In-memory image I/O for the Real-ESRGAN APIs
+Uploads are decoded with cv2.imdecode and results encoded with cv2.imencode,
+so a request never touches the disk unless the upload is larger than the spill threshold
+"""
+
+import os
+import time
+import base64
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+import tracing
+
+# Uploads above this size are spooled to disk and memory-mapped instead of held in RAM
+SPILL_THRESHOLD = int(os.getenv('UPLOAD_SPILL_THRESHOLD', 16 * 1024 * 1024))  # 16MB
+COPY_CHUNK_SIZE = 1024 * 1024
+# Threads encoding results; cv2.imencode releases the GIL, so encodes run in parallel
+ENCODE_WORKERS = int(os.getenv('ENCODE_WORKERS', min(4, os.cpu_count() or 1)))
+
+
+class StageTimer:
+    """Collect wall-clock timings for the stages of a single request.
+
+    Each stage is also a tracing span of the current request (see tracing.py).
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, **attributes):
+        """Time the enclosed block and add it to the named stage; yields its span"""
+        start = time.perf_counter()
+        try:
+            with tracing.span(name, **attributes) as span:
+                yield span
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def record(self, name, since, **attributes):
+        """Add the time elapsed since ``since`` (a perf_counter value) to the named stage"""
+        self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - since) * 1000
+        tracing.record(name, since, **attributes)
+
+    def merge(self, stages):
+        """Add stage timings (in milliseconds) measured elsewhere, e.g. by the model server"""
+        for name, value in stages.items():
+            self.stages[name] = self.stages.get(name, 0.0) + value
+
+    def elapsed_ms(self):
+        """Milliseconds since the timer was created"""
+        return (time.perf_counter() - self._started) * 1000
+
+    def breakdown(self):
+        """Per-stage latency in milliseconds, plus the request total"""
+        result = {f'{name}_ms': round(value, 2) for name, value in self.stages.items()}
+        result['total_ms'] = round(self.elapsed_ms(), 2)
+        return result
+
+
+class EnhanceResult:
+    """An enhanced image plus the timings of the stages that produced it.
+
+    ``info`` carries per-request counters such as the number of tiles processed.
+    Use as a context manager: backends that hand out shared buffers release them on exit.
+    """
+
+    def __init__(self, image, timings, release=None, info=None):
+        self.image = image
+        self.timings = timings
+        self.info = info or {}
+        self._release = release
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.image = None
+        if self._release is not None:
+            self._release()
+            self._release = None
+        return False
+
+
+class UploadBuffer:
+    """Expose an uploaded file as a uint8 numpy buffer.
+
+    Small uploads are read straight into memory. Uploads above ``spill_threshold``
+    are copied to a temporary file and memory-mapped; the file is always removed
+    on exit, even when the request fails half-way. Uploads already spooled while the
+    request was parsed (uploads.IngestStream) are used in place, without a copy.
+    """
+
+    def __init__(self, file, spill_threshold=SPILL_THRESHOLD, spill_dir=None):
+        self.file = file
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.data = None
+        self.size = 0
+        self.spill_path = None
+        self._spooled = False
+
+    @property
+    def spilled(self):
+        return self.spill_path is not None or self._spooled
+
+    def __enter__(self):
+        stream = getattr(self.file, 'stream', self.file)
+        as_array = getattr(stream, 'as_array', None)
+        if as_array is not None:
+            self.data = as_array()
+            self.size = len(self.data)
+            self._spooled = stream.on_disk
+            return self
+
+        stream.seek(0, 2)
+        self.size = stream.tell()
+        stream.seek(0)
+
+        if self.size <= self.spill_threshold:
+            self.data = np.frombuffer(stream.read(), dtype=np.uint8)
+            return self
+
+        fd, self.spill_path = tempfile.mkstemp(suffix='.upload', dir=self.spill_dir)
+        with os.fdopen(fd, 'wb') as spill:
+            while True:
+                chunk = stream.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                spill.write(chunk)
+        self.data = np.memmap(self.spill_path, dtype=np.uint8, mode='r')
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Drop the mapping before removing the file (required on Windows)
+        self.data = None
+        if self.spill_path is not None and os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+        return False
+
+
+def decode_image(buffer):
+    """Decode an encoded image buffer, keeping alpha and bit depth. Returns None if undecodable"""
+    if buffer is None or len(buffer) == 0:
+        return None
+    return cv2.imdecode(buffer, cv2.IMREAD_UNCHANGED)
+
+
+_REDUCED_DECODE = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+
+def decode_reduced(buffer, width, height, size):
+    """Decode an encoded image as 8-bit BGR at a reduced size that still covers ``size``.
+
+    ``width`` and ``height`` are its full size; JPEG decodes reductions of 2, 4 and 8
+    directly. Returns None if the image cannot be decoded.
+    """
+    reduction = next((r for r in (8, 4, 2) if width // r >= size[0] and height // r >= size[1]), 1)
+    return cv2.imdecode(buffer, _REDUCED_DECODE[reduction])
+
+
+def encode_image(img, ext='.png', params=None):
+    """Encode an image array into bytes in the given format"""
+    ok, encoded = cv2.imencode(ext, img, params or [])
+    if not ok:
+        raise ValueError(f'Could not encode image as {ext}')
+    return encoded.tobytes()
+
+
+class OutputFormat:
+    """How a result is encoded: format and its size/effort settings.
+
+    Args:
+        name (str): 'png', 'jpeg' or 'webp'.
+        quality (int): JPEG and lossy WebP quality, 1-100. Default: 95 (JPEG), 90 (WebP).
+        compression (int): PNG deflate level, 0 to 9. Default: None, cv2's own setting
+            (level 1 with run-length strategy), which is the fastest; see
+            benchmarks/encode_formats.py for what the other levels cost.
+        lossless (bool): Lossless WebP (slow, smaller than PNG). Default: False.
+    """
+
+    EXTENSIONS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp'}
+    MIME_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+    DEFAULT_QUALITY = {'jpeg': 95, 'webp': 90}
+
+    def __init__(self, name='png', quality=None, compression=None, lossless=False):
+        if name == 'jpg':
+            name = 'jpeg'
+        if name not in self.EXTENSIONS:
+            raise ValueError(f'Unknown output format: {name}. Use png, jpeg or webp')
+        if quality is not None and not 1 <= quality <= 100:
+            raise ValueError('quality must be between 1 and 100')
+        if compression is not None and not 0 <= compression <= 9:
+            raise ValueError('compression must be between 0 and 9')
+        self.name = name
+        self.quality = quality if quality is not None else self.DEFAULT_QUALITY.get(name)
+        self.compression = compression
+        self.lossless = lossless and name == 'webp'
+
+    @classmethod
+    def from_form(cls, form):
+        """Read ``format``, ``quality``, ``compression`` and ``lossless`` request fields"""
+        try:
+            quality = form.get('quality')
+            compression = form.get('compression')
+            return cls(form.get('format', 'png').lower(),
+                       quality=int(quality) if quality else None,
+                       compression=int(compression) if compression else None,
+                       lossless=form.get('lossless', '').lower() in ('1', 'true', 'yes'))
+        except (TypeError, ValueError) as e:
+            raise ValueError(str(e)) from None
+
+    @property
+    def ext(self):
+        return self.EXTENSIONS[self.name]
+
+    @property
+    def mime(self):
+        return self.MIME_TYPES[self.name]
+
+    def params(self):
+        if self.name == 'png':
+            return [] if self.compression is None else [cv2.IMWRITE_PNG_COMPRESSION, self.compression]
+        if self.name == 'jpeg':
+            return [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        # cv2 encodes lossless WebP for a quality above 100
+        return [cv2.IMWRITE_WEBP_QUALITY, 101 if self.lossless else self.quality]
+
+    def prepare(self, img):
+        """Convert an image to what the format can store: 8 bits for JPEG and WebP, no alpha for JPEG"""
+        if self.name == 'png':
+            return img
+        if img.dtype == np.uint16:
+            img = (img >> 8).astype(np.uint8)
+        if self.name == 'jpeg' and img.ndim == 3 and img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+        return img
+
+    def encode(self, img):
+        return encode_image(self.prepare(img), self.ext, self.params())
+
+    def to_dict(self):
+        fields = {'format': self.name, 'mime': self.mime}
+        if self.name == 'png':
+            if self.compression is not None:
+                fields['compression'] = self.compression
+        elif self.lossless:
+            fields['lossless'] = True
+        else:
+            fields['quality'] = self.quality
+        return fields
+
+
+# Threads start on first use, so the pool is safe to create before gunicorn forks
+_encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix='encode')
+
+
+def encode_async(img, output_format):
+    """Encode an image on the shared encode pool. Returns a Future of the encoded bytes.
+
+    The caller must keep ``img`` alive (and its buffer mapped) until the future is done.
+    """
+    return _encode_pool.submit(output_format.encode, img)
+
+
+def bytes_to_base64(data):
+    """Convert encoded image bytes to a base64 string"""
+    return base64.b64encode(data).decode('utf-8')
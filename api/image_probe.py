@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Header-only probe of uploaded images
+Reads the dimensions, bit depth, channel count and frame count of PNG, JPEG, WebP,
+GIF and BMP files from their headers, without decoding any pixels, so oversized
+images are rejected before cv2.imdecode allocates memory for them
+"""
+
+import os
+import struct
+
+# Largest input accepted, in pixels; a few KB of compressed PNG can claim far more
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 25_000_000))
+
+# JPEG start-of-frame markers (SOF0-SOF15 without DHT, JPG and DAC)
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# JPEG markers without a length field
+_JPEG_STANDALONE = {0x01, *range(0xD0, 0xD8)}
+# PNG colour type -> channels as decoded by cv2.IMREAD_UNCHANGED (gray+alpha becomes BGRA)
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 4, 6: 4}
+
+
+class ImageInfo:
+    """Header fields of an encoded image"""
+
+    __slots__ = ('format', 'width', 'height', 'channels', 'bit_depth', 'frames')
+
+    def __init__(self, format, width, height, channels, bit_depth=8, frames=1):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.bit_depth = bit_depth
+        self.frames = frames
+
+    @property
+    def pixels(self):
+        return self.width * self.height
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return (f'ImageInfo({self.format} {self.width}x{self.height}, {self.channels}ch, '
+                f'{self.bit_depth}bit, {self.frames} frame(s))')
+
+
+class _Truncated(Exception):
+    pass
+
+
+def _read(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise _Truncated()
+    return data
+
+
+def _skip(stream, size):
+    stream.seek(size, os.SEEK_CUR)
+
+
+def _probe_png(stream):
+    _read(stream, 8)  # signature
+    length, chunk = struct.unpack('>I4s', _read(stream, 8))
+    if chunk != b'IHDR' or length < 13:
+        return None
+    width, height, bit_depth, color_type = struct.unpack('>IIBB', _read(stream, 10))
+    channels = _PNG_CHANNELS.get(color_type)
+    if channels is None:
+        return None
+    _skip(stream, length - 10 + 4)  # rest of IHDR and its CRC
+    frames = 1
+    # Ancillary chunks before the image data: transparency and APNG animation control
+    while True:
+        length, chunk = struct.unpack('>I4s', _read(stream, 8))
+        if chunk in (b'IDAT', b'IEND'):
+            break
+        if chunk == b'tRNS' and channels in (1, 3):
+            # cv2 expands palette and gray images with a transparent colour to BGRA
+            channels = 4
+        elif chunk == b'acTL':
+            frames = struct.unpack('>I', _read(stream, 4))[0]
+            length -= 4
+        _skip(stream, length + 4)
+    return ImageInfo('png', width, height, channels, bit_depth, frames)
+
+
+def _probe_jpeg(stream):
+    _read(stream, 2)  # SOI
+    while True:
+        byte = _read(stream, 1)
+        if byte != b'\xff':
+            return None
+        marker = _read(stream, 1)[0]
+        while marker == 0xFF:  # fill bytes
+            marker = _read(stream, 1)[0]
+        if marker in _JPEG_STANDALONE:
+            continue
+        if marker in (0xD9, 0xDA):  # end of image or start of scan before any frame header
+            return None
+        length = struct.unpack('>H', _read(stream, 2))[0]
+        if marker in _JPEG_SOF:
+            precision, height, width, components = struct.unpack('>BHHB', _read(stream, 6))
+            # cv2 decodes CMYK and YCCK to BGR
+            channels = 1 if components == 1 else 3
+            return ImageInfo('jpeg', width, height, channels, precision)
+        _skip(stream, length - 2)
+
+
+def _probe_webp(stream):
+    start = stream.tell()
+    riff_size = struct.unpack('<4sI4s', _read(stream, 12))[1]
+    end = start + 8 + riff_size
+    chunk, length = struct.unpack('<4sI', _read(stream, 8))
+    if chunk == b'VP8 ':
+        data = _read(stream, 10)
+        if data[3:6] != b'\x9d\x01\x2a':
+            return None
+        width, height = struct.unpack('<HH', data[6:10])
+        return ImageInfo('webp', width & 0x3FFF, height & 0x3FFF, 3)
+    if chunk == b'VP8L':
+        data = _read(stream, 5)
+        if data[0] != 0x2F:
+            return None
+        bits = struct.unpack('<I', data[1:5])[0]
+        width = (bits & 0x3FFF) + 1
+        height = ((bits >> 14) & 0x3FFF) + 1
+        has_alpha = bool(bits >> 28 & 1)
+        return ImageInfo('webp', width, height, 4 if has_alpha else 3)
+    if chunk == b'VP8X':
+        data = _read(stream, 10)
+        flags = data[0]
+        width = int.from_bytes(data[4:7], 'little') + 1
+        height = int.from_bytes(data[7:10], 'little') + 1
+        channels = 4 if flags & 0x10 else 3
+        frames = 1
+        if flags & 0x02:
+            # Animated: count the frame chunks
+            frames = 0
+            position = start + 12 + 8 + length + (length & 1)
+            while position + 8 <= end:
+                stream.seek(position)
+                header = stream.read(8)
+                if len(header) < 8:
+                    break
+                chunk, size = struct.unpack('<4sI', header)
+                frames += chunk == b'ANMF'
+                position += 8 + size + (size & 1)
+        return ImageInfo('webp', width, height, channels, frames=frames)
+    return None
+
+
+def _skip_gif_sub_blocks(stream):
+    while True:
+        size = _read(stream, 1)[0]
+        if size == 0:
+            return
+        _skip(stream, size)
+
+
+def _probe_gif(stream):
+    width, height, flags = struct.unpack('<6xHHB2x', _read(stream, 13))
+    if flags & 0x80:
+        _skip(stream, 3 << ((flags & 0x07) + 1))  # global colour table
+    frames = 0
+    transparent = False
+    while True:
+        block = stream.read(1)
+        if not block or block == b'\x3b':  # trailer (or a truncated file that cv2 may still show)
+            break
+        if block == b'\x21':  # extension
+            label = _read(stream, 1)[0]
+            if label == 0xF9:  # graphic control: transparency flag
+                size = _read(stream, 1)[0]
+                if _read(stream, size)[0] & 0x01:
+                    transparent = True
+            _skip_gif_sub_blocks(stream)
+        elif block == b'\x2c':  # image descriptor
+            frames += 1
+            local_flags = _read(stream, 9)[8]
+            if local_flags & 0x80:
+                _skip(stream, 3 << ((local_flags & 0x07) + 1))
+            _read(stream, 1)  # LZW minimum code size
+            _skip_gif_sub_blocks(stream)
+        else:
+            return None
+    if frames == 0:
+        return None
+    return ImageInfo('gif', width, height, 4 if transparent else 3, frames=frames)
+
+
+def _probe_bmp(stream):
+    header_size = struct.unpack('<14xI', _read(stream, 18))[0]
+    if header_size == 12:  # OS/2 BITMAPCOREHEADER
+        width, height, _, bits = struct.unpack('<HHHH', _read(stream, 8))
+    elif header_size >= 40:
+        width, height, _, bits = struct.unpack('<iiHH', _read(stream, 12))
+    else:
+        return None
+    # A negative height marks a top-down bitmap
+    return ImageInfo('bmp', abs(width), abs(height), 4 if bits == 32 else 3)
+
+
+_PROBES = {'png': _probe_png, 'jpeg': _probe_jpeg, 'webp': _probe_webp, 'gif': _probe_gif, 'bmp': _probe_bmp}
+
+
+def sniff_format(signature):
+    """Image format named by the first 12 bytes of a file, or None"""
+    if signature.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if signature.startswith(b'\xff\xd8'):
+        return 'jpeg'
+    if signature[:4] == b'RIFF' and signature[8:12] == b'WEBP':
+        return 'webp'
+    if signature[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if signature[:2] == b'BM':
+        return 'bmp'
+    return None
+
+
+def _probe(stream):
+    signature = stream.read(12)
+    stream.seek(-len(signature), os.SEEK_CUR)
+    probe = _PROBES.get(sniff_format(signature))
+    return None if probe is None else probe(stream)
+
+
+def probe_image(stream):
+    """Read an image's ImageInfo from its header, without decoding it.
+
+    ``stream`` is a seekable binary file object; it is rewound afterwards.
+    Returns None for unsupported formats and malformed or truncated headers.
+    """
+    position = stream.tell()
+    try:
+        info = _probe(stream)
+    except (_Truncated, struct.error, IndexError):
+        info = None
+    finally:
+        stream.seek(position)
+    if info is None or info.width <= 0 or info.height <= 0 or info.frames <= 0:
+        return None
+    return info
+
+
+def check_image_info(info):
+    """Error message and HTTP status for an image that cannot be enhanced, else None.
+
+    Rejects unreadable headers, images over the pixel budget and animations: decoding
+    keeps only the first frame, so the rest would be silently dropped.
+    """
+    if info is None:
+        return 'Could not read image file', 400
+    if info.pixels > MAX_IMAGE_PIXELS:
+        return f'Image too large. Maximum is {MAX_IMAGE_PIXELS // 1_000_000} megapixels', 413
+    if info.frames > 1:
+        return f'Animated images are not supported ({info.frames} frames)', 400
+    return None
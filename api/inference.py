@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+In-process Real-ESRGAN inference backend
+Owns the model registry and the background preloader; used directly by the Flask app
+or behind the model server process (model_server.py)
+"""
+
+import os
+import sys
+import math
+import threading
+import time
+import logging
+from functools import lru_cache
+
+import psutil
+import torch
+
+# Add Real-ESRGAN path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'REAL-ESRGAN'))
+
+from realesrgan import RealESRGANer
+
+import tracing
+from admission import AdmissionController, estimate_cost
+from cancellation import Cancelled
+from image_io import StageTimer, EnhanceResult
+from latency_model import LatencyModel, work_of
+from model_config import MODEL_CONFIG, DEFAULT_MODEL, ModelNotReady
+from model_registry import ModelRegistry, load_state_dict_file
+from preloader import ModelPreloader, PRELOAD_MODELS, READY
+from scheduler import FairScheduler
+
+logger = logging.getLogger(__name__)
+
+MODEL_WAIT_TIMEOUT = float(os.getenv('MODEL_WAIT_TIMEOUT', 120))
+
+
+@lru_cache(maxsize=None)
+def detect_device():
+    """Detect best available device for inference (logged once, not on every model build)"""
+    if torch.cuda.is_available():
+        device_count = torch.cuda.device_count()
+        logger.info(f"🚀 CUDA detected! Available GPUs: {device_count}")
+        for i in range(device_count):
+            gpu_name = torch.cuda.get_device_name(i)
+            logger.info(f"   GPU {i}: {gpu_name}")
+        return 0  # Use first GPU
+    else:
+        logger.warning("⚠️  CUDA not available, using CPU (will be slower)")
+        return None
+
+
+def device_name():
+    """Name of the inference device; learned latencies are specific to it"""
+    if torch.cuda.is_available():
+        return torch.cuda.get_device_name(0)
+    return f'cpu x{torch.get_num_threads()}'
+
+
+def default_tile_size():
+    """Tile size of the upsamplers: larger tiles for GPU"""
+    return 512 if torch.cuda.is_available() else 256
+
+
+def weights_path(model_name):
+    """Local path of a model's weights file"""
+    weights_dir = os.path.join(os.path.dirname(__file__), '..', 'Real-ESRGAN', 'weights')
+    os.makedirs(weights_dir, exist_ok=True)
+    return os.path.join(weights_dir, f'{model_name}.pth')
+
+
+_download_lock = threading.Lock()
+
+
+def ensure_weights(model_name):
+    """Return the local weights file of a model, downloading it if needed"""
+    # Check for local model file first
+    model_path = weights_path(model_name)
+
+    # Download model if not exists (one download at a time, never a partial file)
+    with _download_lock:
+        if not os.path.exists(model_path):
+            logger.info(f"📥 Downloading {model_name} model...")
+            import urllib.request
+            partial_path = f'{model_path}.part'
+            urllib.request.urlretrieve(MODEL_CONFIG[model_name]['url'], partial_path)
+            os.replace(partial_path, model_path)
+            logger.info(f"✅ Model downloaded: {model_path}")
+    return model_path
+
+
+def estimate_model_size(model_name):
+    """Expected memory of a model before loading it, from its weights file"""
+    model_path = weights_path(model_name)
+    return os.path.getsize(model_path) if os.path.exists(model_path) else 0
+
+
+def build_upsampler(model_name):
+    """Build a Real-ESRGAN upsampler with CUDA optimization"""
+    if model_name not in MODEL_CONFIG:
+        raise ValueError(f'Unknown model: {model_name}')
+
+    config = MODEL_CONFIG[model_name]
+    model = config['model']()
+    model_path = ensure_weights(model_name)
+
+    # Detect best device
+    gpu_id = detect_device()
+    use_half = gpu_id is not None  # Use fp16 only with GPU
+
+    # Initialize upsampler with CUDA optimization
+    upsampler = RealESRGANer(
+        scale=config['scale'],
+        model_path=model_path,
+        model=model,
+        tile=default_tile_size(),
+        tile_pad=10,
+        pre_pad=0,
+        half=use_half,  # Use fp16 for GPU, fp32 for CPU
+        gpu_id=gpu_id  # Auto-detect GPU or use CPU
+    )
+
+    device_info = f"GPU {gpu_id}" if gpu_id is not None else "CPU"
+    precision = "fp16" if use_half else "fp32"
+    logger.info(f"✅ {model_name} initialized successfully on {device_info} ({precision})")
+    return upsampler
+
+
+def _passes(img):
+    # An alpha channel is upsampled with the model as a second pass
+    return 2 if img.ndim == 3 and img.shape[2] == 4 else 1
+
+
+def count_tiles(upsampler, img):
+    """Number of tiles RealESRGANer runs through the model for an image"""
+    if not upsampler.tile_size:
+        return _passes(img)
+    height, width = img.shape[:2]
+    return _passes(img) * math.ceil(height / upsampler.tile_size) * math.ceil(width / upsampler.tile_size)
+
+
+def _overall_progress(progress, passes):
+    """Turn RealESRGANer's per-pass tile progress into progress over all passes"""
+    if progress is None:
+        return None
+    passes_done = [0]
+
+    def callback(done, total):
+        # Every pass covers the same tiles
+        finished = passes_done[0] * total + done
+        if done == total:
+            passes_done[0] += 1
+        progress(finished, passes * total)
+    return callback
+
+
+class LocalInference:
+    """Run Real-ESRGAN in this process.
+
+    Loaded models are shared by all requests and kept within MODEL_MEMORY_BUDGET_MB
+    (a share of it under supervisor.py, see set_memory_budgets).
+    PRELOAD_MODELS are loaded in the background at startup; requests for models that
+    are not loaded yet queue behind the preloader instead of loading them themselves.
+    Requests take turns on the models in fair order across tenants (see scheduler.py).
+    """
+
+    def __init__(self, preload=None):
+        self.registry = ModelRegistry(
+            build_upsampler,
+            estimate=estimate_model_size,
+            signature=lambda model_name: MODEL_CONFIG[model_name]['arch'],
+            weights=lambda model_name: load_state_dict_file(ensure_weights(model_name))
+        )
+        self.preloader = ModelPreloader(
+            self.registry, preload if preload is not None else (PRELOAD_MODELS or [DEFAULT_MODEL]),
+            prepare=ensure_weights)
+        self.admission = AdmissionController()
+        self.scheduler = FairScheduler()
+        self.latency = LatencyModel(device_name())
+        self.tile_size = default_tile_size()
+
+    def start(self):
+        """Start loading models in the background"""
+        self.preloader.start()
+
+    def device_info(self):
+        cuda_available = torch.cuda.is_available()
+        return {'device': 'GPU' if cuda_available else 'CPU', 'cuda_available': cuda_available}
+
+    def is_loaded(self, model_name):
+        return self.registry.is_loaded(model_name)
+
+    def model_state(self, model_name):
+        return self.preloader.status(model_name)['state']
+
+    def readiness(self):
+        return self.preloader.readiness()
+
+    def snapshot(self):
+        return dict(self.registry.snapshot(), admission=self.admission.snapshot())
+
+    def scheduler_stats(self):
+        return dict(self.scheduler.snapshot(), latency_model=self.latency.snapshot())
+
+    def predict_latency(self, works):
+        """Predicted inference seconds of each of ``works`` (see latency_model.work_of) once
+        it runs, with as many requests alongside as are running now; None per request
+        until a request has completed"""
+        concurrency = min(self.scheduler.concurrency, self.scheduler.running + 1)
+        return [self.latency.predict(work['model'], work['width'], work['height'], self.tile_size * work['tile_scale'],
+                                     work['passes'], concurrency) for work in works]
+
+    def estimate_latency(self, works):
+        """Seconds until a request of each of ``works`` would finish, counting the requests
+        ahead of it; None until run times can be predicted"""
+        rate = self.scheduler.seconds_per_cost
+        seconds = []
+        for work, predicted in zip(works, self.predict_latency(works)):
+            if predicted is None:
+                if rate is None:
+                    return None
+                predicted = estimate_cost(work['width'], work['height'], work['model']) * rate
+            seconds.append(predicted)
+        backlog = self.admission.queued_seconds(rate)
+        if backlog is None:
+            return None
+        return self.scheduler.estimate(seconds, backlog=backlog)
+
+    def admit(self, cost, memory, timeout=None, work=None):
+        """Wait for room in the admission budgets; raises AdmissionRejected"""
+        seconds = self.predict_latency([work])[0] if work is not None else None
+        return self.admission.admit(cost, memory, timeout=timeout, seconds=seconds)
+
+    def release_admission(self, ticket):
+        self.admission.release(ticket)
+
+    def set_memory_budgets(self, model_budget, admission_budget):
+        """Change the bytes of loaded models and of admitted requests this process may hold"""
+        self.registry.set_budget(model_budget)
+        self.admission.set_memory_budget(admission_budget)
+
+    def memory_info(self):
+        """Resident and CUDA memory of this process"""
+        cuda_available = torch.cuda.is_available()
+        return {
+            'rss_bytes': psutil.Process().memory_info().rss,
+            'device_allocated_bytes': torch.cuda.memory_allocated() if cuda_available else 0,
+            'device_reserved_bytes': torch.cuda.memory_reserved() if cuda_available else 0
+        }
+
+    def preload(self, model_name, timeout=MODEL_WAIT_TIMEOUT):
+        """Load a model ahead of use, raising ModelNotReady if it is not ready in time"""
+        status = self.preloader.wait_ready(model_name, timeout=timeout)
+        if status['state'] != READY:
+            raise ModelNotReady(model_name, status)
+        return status
+
+    def enhance(self, img, model_name, outscale=None, timeout=MODEL_WAIT_TIMEOUT, progress=None, tenant=None,
+                weight=1.0, tile_scale=1, cancel=None):
+        """Enhance a decoded image with the given model.
+
+        ``progress(done, total)`` is called as tiles finish, counting every pass
+        (an alpha channel is a second pass over the same tiles). ``tenant`` and
+        ``weight`` place the request in the fair scheduler. ``tile_scale`` multiplies
+        the tile size for this request (fewer, larger tiles do less padding work).
+        A ``cancel`` token stops the request in the scheduler queue or between tiles;
+        the Cancelled it raises carries the tiles and inference time already spent.
+        """
+        timer = StageTimer()
+        if not self.registry.is_loaded(model_name):
+            with timer.stage('model_load', model=model_name):
+                self.preload(model_name, timeout=timeout)
+
+        height, width = img.shape[:2]
+        passes = _passes(img)
+        cost = estimate_cost(width, height, model_name)
+        predicted, = self.predict_latency([work_of(model_name, width, height, tile_scale, passes)])
+        queued = time.perf_counter()
+        with self.scheduler.slot(tenant, cost, weight, cancel=cancel, seconds=predicted):
+            timer.record('queue', queued, tenant=str(tenant), cost=round(cost, 4))
+            concurrency = self.scheduler.running
+            model_wait = time.perf_counter()
+            with self.registry.acquire(model_name) as upsampler:
+                timer.record('model', model_wait)
+                # The caller has exclusive use of the upsampler, so its tile size can be changed for the request
+                tile_size = upsampler.tile_size
+                upsampler.tile_size = tile_size * tile_scale
+                done = [0]
+
+                def on_progress(finished, total):
+                    done[0] = finished
+                    if progress is not None:
+                        progress(finished, total)
+
+                started = time.perf_counter()
+                try:
+                    tiles = count_tiles(upsampler, img)
+                    run_tile_size = upsampler.tile_size
+                    with timer.stage('inference', model=model_name, width=width, height=height, tiles=tiles,
+                                     tile_size=run_tile_size, passes=passes, concurrency=concurrency):
+                        output, _ = upsampler.enhance(
+                            img, outscale=outscale, progress_callback=_overall_progress(on_progress, passes),
+                            cancel=cancel, trace=tracing.span)
+                    elapsed = time.perf_counter() - started
+                except Cancelled as e:
+                    e.tiles, e.inference_seconds, e.model_name = done[0], time.perf_counter() - started, model_name
+                    raise
+                finally:
+                    upsampler.tile_size = tile_size
+            # Requests running alongside, averaged over the start and end of this one
+            concurrency = (concurrency + self.scheduler.running) / 2
+        self.latency.observe(model_name, width, height, run_tile_size, elapsed, passes, concurrency)
+        return EnhanceResult(output, timer.stages, info={'tiles': tiles, 'predicted_seconds': predicted})
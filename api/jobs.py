@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Background enhancement jobs with progress events
+A job emits a cheap bicubic preview straight away, then tile progress with an ETA
+while the model runs, then the URL of the finished image. Clients follow the events
+over Server-Sent Events (see /api/jobs/<id>/events in realesrgan_api.py).
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import tracing
+from cancellation import JOB_DEADLINE, CancelToken, Cancelled
+from image_io import decode_reduced, encode_image, bytes_to_base64
+
+logger = logging.getLogger(__name__)
+
+JOB_TTL = int(os.getenv('JOB_TTL_SECONDS', 600))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+# Jobs waiting or running at once; each holds its encoded upload (on disk above the spill threshold)
+JOB_MAX_PENDING = int(os.getenv('JOB_MAX_PENDING', 32))
+# Jobs are asynchronous, so they may wait longer for admission than a blocking request
+JOB_ADMISSION_WAIT = float(os.getenv('JOB_ADMISSION_WAIT', 300))
+# Longest side of the preview; it only has to fill the result pane until the real image arrives
+PREVIEW_MAX_SIDE = int(os.getenv('PREVIEW_MAX_SIDE', 512))
+# Progress events are coalesced to at most one per interval
+PROGRESS_INTERVAL = 0.25
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+_JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def make_preview(data, width, height, scale, max_side=PREVIEW_MAX_SIDE):
+    """Bicubic upscale of an encoded image, capped at ``max_side``.
+
+    Returns JPEG bytes and (width, height), or None if the image cannot be decoded.
+    """
+    factor = min(scale, max_side / max(width, height))
+    size = (max(1, round(width * factor)), max(1, round(height * factor)))
+    img = decode_reduced(np.frombuffer(data, dtype=np.uint8), width, height, size)
+    if img is None:
+        return None
+    interpolation = cv2.INTER_CUBIC if size[0] >= img.shape[1] else cv2.INTER_AREA
+    preview = cv2.resize(img, size, interpolation=interpolation)
+    return encode_image(preview, '.jpg', [cv2.IMWRITE_JPEG_QUALITY, 75]), size
+
+
+def sse_event(index, name, data):
+    """Format one Server-Sent Event"""
+    return f'id: {index}\nevent: {name}\ndata: {json.dumps(data)}\n\n'
+
+
+class Job:
+    """State and event log of one enhancement job.
+
+    ``cancel_token`` is cancelled by cancel() or once ``deadline`` seconds have
+    passed since submission; the job's work passes it down to the tile loop.
+    """
+
+    def __init__(self, model_name, scale, filename, deadline=JOB_DEADLINE):
+        self.id = uuid.uuid4().hex
+        self.model_name = model_name
+        self.scale = scale
+        self.filename = filename
+        self.state = QUEUED
+        self.created = time.time()
+        self.finished = None
+        self.progress = {'done': 0, 'total': 0, 'percent': 0.0, 'eta_s': None}
+        self.estimate_s = None
+        self.result = None
+        self.error = None
+        self.cancel_reason = None
+        self.cancel_token = CancelToken.after(deadline)
+        self.events = []
+        self._started = None
+        self._expected_done = None
+        self._last_progress = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def terminal(self):
+        return self.state in (DONE, FAILED, CANCELLED)
+
+    def emit(self, name, data):
+        with self._cond:
+            self.events.append((name, data))
+            self._cond.notify_all()
+
+    def wait_events(self, since, timeout):
+        """Events after index ``since``, waiting up to ``timeout`` seconds for one"""
+        with self._cond:
+            if len(self.events) <= since and not self.terminal:
+                self._cond.wait(timeout)
+            return self.events[since:]
+
+    def stream_events(self, since, keepalive=15):
+        """Server-Sent Events from index ``since`` on, until the job has ended and its
+        last event was sent; a comment line every ``keepalive`` seconds without one"""
+        while True:
+            with self._cond:
+                # A client resuming after the final event gets nothing more to wait for
+                if self.terminal and since >= len(self.events):
+                    return
+            events = self.wait_events(since, keepalive)
+            if not events:
+                # Keeps proxies from closing an idle stream
+                yield ': keep-alive\n\n'
+                continue
+            for name, data in events:
+                yield sse_event(since, name, data)
+                since += 1
+
+    def emit_preview(self, data, width, height):
+        """Send the bicubic preview of the encoded input as the first event"""
+        made = make_preview(data, width, height, self.scale)
+        if made is None:
+            return False
+        preview, (width, height) = made
+        self.emit('preview', {
+            'image': bytes_to_base64(preview),
+            'mime': 'image/jpeg',
+            'width': width,
+            'height': height
+        })
+        return True
+
+    def start(self):
+        """Mark the job running; returns False if it was cancelled while queued"""
+        with self._cond:
+            if self.state != QUEUED:
+                return False
+            self.state = RUNNING
+            self._started = time.monotonic()
+            self.emit('state', {'state': RUNNING})
+            return True
+
+    def expect(self, estimated_ms):
+        """Record the predicted time until the job is done (see latency_model.py), the ETA
+        until tiles finish; None if there is no prediction yet"""
+        if estimated_ms is None:
+            return
+        self.estimate_s = round(estimated_ms / 1000, 1)
+        self._expected_done = time.monotonic() + estimated_ms / 1000
+        self.progress = dict(self.progress, eta_s=self.estimate_s)
+        self.emit('progress', dict(self.progress, estimate_s=self.estimate_s))
+
+    def report_progress(self, done, total):
+        """Tile progress callback; estimates the time left from the rate so far, or the prediction before that"""
+        elapsed = time.monotonic() - self._started
+        if done:
+            eta = elapsed / done * (total - done)
+        elif self._expected_done is not None:
+            eta = max(0.0, self._expected_done - time.monotonic())
+        else:
+            eta = None
+        self.progress = {
+            'done': done,
+            'total': total,
+            'percent': round(100.0 * done / total, 1) if total else 0.0,
+            'eta_s': round(eta, 1) if eta is not None else None
+        }
+        now = time.monotonic()
+        if done == total or now - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = now
+            self.emit('progress', dict(self.progress, elapsed_s=round(elapsed, 1)))
+
+    def finish(self, result):
+        # The state and its event change together, so a reader that sees the job ended has the event too
+        with self._cond:
+            self.result = result
+            self.finished = time.time()
+            self.state = DONE
+            self.emit('done', result)
+
+    def fail(self, error):
+        with self._cond:
+            self.error = error
+            self.finished = time.time()
+            self.state = FAILED
+            self.emit('error', {'error': error})
+
+    def cancel(self):
+        """Cancel the job: a queued job ends now, a running one after its current tile.
+
+        Returns False if the job had already ended.
+        """
+        with self._cond:
+            if self.terminal:
+                return False
+            self.cancel_token.cancel()
+            if self.state == QUEUED:
+                self.stop(self.cancel_token.reason)
+            return True
+
+    def stop(self, reason):
+        """End the job as cancelled with ``reason`` ('cancelled', 'deadline' or 'disconnected')"""
+        with self._cond:
+            self.cancel_reason = reason
+            self.finished = time.time()
+            self.state = CANCELLED
+            self.emit('cancelled', {'reason': reason})
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'state': self.state,
+            'model': self.model_name,
+            'scale': self.scale,
+            'filename': self.filename,
+            'progress': self.progress,
+            'estimate_s': self.estimate_s,
+            'result': self.result,
+            'error': self.error,
+            'cancel_reason': self.cancel_reason,
+            'created': self.created,
+            'finished': self.finished
+        }
+
+
+class JobQueueFull(Exception):
+    """Raised when JOB_MAX_PENDING jobs are already waiting or running"""
+
+
+class JobStore:
+    """Run jobs on a small thread pool and keep them for JOB_TTL seconds after they end.
+
+    Job state lives in the process that accepted the job. Results are written to
+    ``result_dir`` so any worker process sharing the directory can serve them.
+    """
+
+    def __init__(self, result_dir, ttl=JOB_TTL, workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING):
+        self.result_dir = result_dir
+        self.ttl = ttl
+        self.max_pending = max_pending
+        os.makedirs(result_dir, exist_ok=True)
+        self._jobs = {}
+        self._work = {}  # job id -> work of jobs not started yet
+        self._cleanup = {}  # job id -> called once the job has ended
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+
+    def result_path(self, job_id):
+        """Result file of a job, or None for a malformed id.
+
+        The file has no extension: its format was chosen by the request (see OutputFormat).
+        """
+        if not _JOB_ID.match(job_id):
+            return None
+        return os.path.join(self.result_dir, job_id)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def submit(self, job, work, cleanup=None):
+        """Queue ``work(job)``, which returns the job's result fields.
+
+        The job is traced as a continuation of the current trace (the submitting request).
+        ``cleanup()`` runs once the job has ended, however it ended (e.g. to close its upload);
+        it does not run if the queue is full, so the caller still owns what it would release.
+        """
+        self.purge()
+        with self._lock:
+            if sum(not other.terminal for other in self._jobs.values()) >= self.max_pending:
+                raise JobQueueFull()
+            self._jobs[job.id] = job
+            self._work[job.id] = work, tracing.context()
+            if cleanup is not None:
+                self._cleanup[job.id] = cleanup
+        self._pool.submit(self._run, job)
+        return job
+
+    def cancel(self, job):
+        """Cancel a job; returns False if it had already ended"""
+        if not job.cancel():
+            return False
+        if job.terminal:
+            # Cancelled while queued: drop its work, and the upload it holds, now
+            with self._lock:
+                self._work.pop(job.id, None)
+            self._release(job)
+        return True
+
+    def _run(self, job):
+        with self._lock:
+            work, parent = self._work.pop(job.id, (None, None))
+        if work is None or not job.start():
+            self._release(job)
+            return
+        with tracing.trace('job', parent, job_id=job.id) as span:
+            try:
+                job.finish(work(job))
+            except Cancelled as e:
+                logger.info(f"Job {job.id} {e.reason} after {e.tiles} tiles")
+                span.fail(e)
+                job.stop(e.reason)
+            except Exception as e:
+                logger.warning(f"Job {job.id} failed: {e}")
+                span.fail(e)
+                job.fail(str(e))
+            finally:
+                self._release(job)
+
+    def _release(self, job):
+        """Run the job's cleanup, once"""
+        with self._lock:
+            cleanup = self._cleanup.pop(job.id, None)
+        if cleanup is None:
+            return
+        try:
+            cleanup()
+        except Exception as e:
+            logger.warning(f"Cleanup of job {job.id} failed: {e}")
+
+    def purge(self):
+        """Forget jobs that ended more than ``ttl`` seconds ago and delete their results"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [job for job in self._jobs.values() if job.finished and job.finished < cutoff]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            try:
+                os.remove(self.result_path(job.id))
+            except OSError:
+                pass
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Online latency model for inference
+Learns how long each model takes on this device from the requests it completes, with a
+recursive least squares fit of inference seconds against the padded pixels and tile
+count of the image at its tile size and the number of requests running alongside.
+Coefficients are saved to disk so estimates survive restarts. The scheduler, admission
+control, SLO tiers and job ETAs all use its predictions.
+"""
+
+import os
+import json
+import math
+import time
+import threading
+import logging
+
+import numpy as np
+
+import metrics
+from model_config import MODEL_CONFIG
+
+logger = logging.getLogger(__name__)
+
+LATENCY_MODEL_PATH = os.getenv('LATENCY_MODEL_PATH', os.path.join('outputs', 'latency_model.json'))
+# Weight of past requests relative to the latest; below 1 the fit follows drift (thermal limits, other load)
+LATENCY_FORGETTING = float(os.getenv('LATENCY_FORGETTING', 0.98))
+# Requests a model needs before its own fit is used instead of the device-wide one
+LATENCY_MIN_SAMPLES = int(os.getenv('LATENCY_MIN_SAMPLES', 3))
+# Coefficients are saved at most this often
+LATENCY_SAVE_INTERVAL = float(os.getenv('LATENCY_SAVE_INTERVAL', 30))
+# Tile padding of the upsamplers (see inference.build_upsampler)
+TILE_PAD = 10
+# Initial coefficient covariance; large means the first requests move the fit freely
+PRIOR_VARIANCE = 100.0
+
+FEATURES = ('intercept', 'padded_megapixels', 'tiles', 'contention')
+# Fit shared by all models, with pixels weighted by the models' relative cost
+SHARED = '*'
+
+
+def worker_path(slot, path=LATENCY_MODEL_PATH):
+    """Coefficients file of supervised worker ``slot``: each worker learns its own fit,
+    and a worker started again in a slot picks up where the last one left off"""
+    root, extension = os.path.splitext(path)
+    return f'{root}-{slot}{extension}'
+
+
+def work_of(model_name, width, height, tile_scale=1, passes=1):
+    """Describe the inference of a request for prediction (sent as is to the model server)"""
+    return {'model': model_name, 'width': width, 'height': height, 'tile_scale': tile_scale, 'passes': passes}
+
+
+def features(width, height, tile, passes=1, concurrency=1, cost=1.0):
+    """Regression inputs: RealESRGANer runs every tile with its padding, and every tile
+    has a fixed overhead; requests running alongside slow the pixels down"""
+    columns = math.ceil(width / tile) if tile else 1
+    rows = math.ceil(height / tile) if tile else 1
+    padded = passes * (width + 2 * TILE_PAD * (columns - 1)) * (height + 2 * TILE_PAD * (rows - 1)) / 1e6
+    padded *= cost
+    return np.array([1.0, padded, passes * columns * rows, padded * max(0, concurrency - 1)])
+
+
+class _Fit:
+    """Recursive least squares with exponential forgetting"""
+
+    def __init__(self, theta=None, covariance=None, samples=0, error=None):
+        size = len(FEATURES)
+        self.theta = np.zeros(size) if theta is None else np.array(theta, dtype=float)
+        self.covariance = np.eye(size) * PRIOR_VARIANCE if covariance is None else np.array(covariance, dtype=float)
+        self.samples = samples
+        self.error = error  # moving average of |log(actual / predicted)|
+
+    def predict(self, x):
+        return max(0.0, float(x @ self.theta))
+
+    def update(self, x, seconds, forgetting):
+        if self.samples and seconds > 0:
+            predicted = self.predict(x)
+            if predicted > 0:
+                error = abs(math.log(seconds / predicted))
+                self.error = error if self.error is None else 0.9 * self.error + 0.1 * error
+        px = self.covariance @ x
+        gain = px / (forgetting + x @ px)
+        self.theta += gain * (seconds - x @ self.theta)
+        self.covariance = (self.covariance - np.outer(gain, px)) / forgetting
+        # Directions no request excites (e.g. contention on a serial server) would otherwise grow without bound
+        limit = PRIOR_VARIANCE * len(FEATURES)
+        trace = np.trace(self.covariance)
+        if trace > limit:
+            self.covariance *= limit / trace
+        self.samples += 1
+
+    def to_dict(self):
+        return {
+            'theta': self.theta.tolist(),
+            'covariance': self.covariance.tolist(),
+            'samples': self.samples,
+            'error': self.error
+        }
+
+
+class LatencyModel:
+    """Predict inference seconds per model on one device, learning from completed requests.
+
+    Models with fewer than ``min_samples`` requests are predicted by a fit shared
+    across models, in which pixels are weighted by the models' relative 'cost'.
+
+    Args:
+        device (str): Device the fit is for; saved fits of another device are ignored.
+        path (str): JSON file the coefficients are saved to and loaded from; None keeps
+            them in memory. Default: LATENCY_MODEL_PATH.
+        forgetting (float): RLS forgetting factor. Default: LATENCY_FORGETTING.
+        min_samples (int): Default: LATENCY_MIN_SAMPLES.
+        save_interval (float): Seconds between saves. Default: LATENCY_SAVE_INTERVAL.
+    """
+
+    def __init__(self, device, path=LATENCY_MODEL_PATH, forgetting=LATENCY_FORGETTING,
+                 min_samples=LATENCY_MIN_SAMPLES, save_interval=LATENCY_SAVE_INTERVAL):
+        self.device = device
+        self.path = path
+        self.forgetting = forgetting
+        self.min_samples = min_samples
+        self.save_interval = save_interval
+        self._fits = {}
+        self._saved = time.monotonic()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            if saved.get('device') != self.device or saved.get('features') != list(FEATURES):
+                logger.info(f"Ignoring latency model saved for {saved.get('device')}, this is {self.device}")
+                return
+            self._fits = {name: _Fit(**fit) for name, fit in saved['fits'].items()}
+            logger.info(f"Loaded latency model for {self.device} ({len(self._fits) - 1} models)")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"⚠️ Could not load latency model from {self.path}: {e}")
+
+    def save(self):
+        """Write the coefficients to ``path``"""
+        if not self.path:
+            return
+        with self._lock:
+            data = {
+                'device': self.device,
+                'features': list(FEATURES),
+                'fits': {name: fit.to_dict() for name, fit in self._fits.items()}
+            }
+            self._saved = time.monotonic()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        partial_path = f'{self.path}.{os.getpid()}.part'
+        with open(partial_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(partial_path, self.path)
+
+    def predict(self, model_name, width, height, tile, passes=1, concurrency=1):
+        """Predicted inference seconds, or None before any request has completed"""
+        with self._lock:
+            fit = self._fits.get(model_name)
+            if fit is not None and fit.samples >= self.min_samples:
+                return fit.predict(features(width, height, tile, passes, concurrency))
+            shared = self._fits.get(SHARED)
+            if shared is None:
+                return None
+            return shared.predict(features(width, height, tile, passes, concurrency, MODEL_CONFIG[model_name]['cost']))
+
+    def observe(self, model_name, width, height, tile, seconds, passes=1, concurrency=1):
+        """Learn from a request that ran for ``seconds``"""
+        predicted = self.predict(model_name, width, height, tile, passes, concurrency)
+        if predicted:
+            metrics.LATENCY_PREDICTION_RATIO.labels(model_name).observe(seconds / predicted)
+        with self._lock:
+            x = features(width, height, tile, passes, concurrency)
+            self._fits.setdefault(model_name, _Fit()).update(x, seconds, self.forgetting)
+            x = features(width, height, tile, passes, concurrency, MODEL_CONFIG[model_name]['cost'])
+            self._fits.setdefault(SHARED, _Fit()).update(x, seconds, self.forgetting)
+            due = time.monotonic() - self._saved >= self.save_interval
+        if due:
+            try:
+                self.save()
+            except OSError as e:
+                logger.warning(f"⚠️ Could not save latency model to {self.path}: {e}")
+
+    def snapshot(self):
+        """Coefficients and accuracy of every fit, for /api/scheduler"""
+        with self._lock:
+            return {
+                'device': self.device,
+                'features': list(FEATURES),
+                'models': {
+                    name: {
+                        'samples': fit.samples,
+                        'coefficients': [round(value, 6) for value in fit.theta],
+                        'mean_error_pct': None if fit.error is None else round(100 * (math.exp(fit.error) - 1), 1)
+                    }
+                    for name, fit in self._fits.items()
+                }
+            }
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Non-blocking structured logging for the APIs and the model server
+A log call only builds the record and puts it on a bounded queue; a background thread
+formats it (one JSON object per line by default) and writes it to the log file and
+stderr, so handler locks and disk writes stay off the request path. When the writer
+falls behind, records are dropped and counted instead of blocking. High-volume events
+(a line per tile, per request) are sampled before they are queued
+"""
+
+import os
+import json
+import time
+import atexit
+import random
+import logging
+import threading
+from queue import Queue, Full
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+import tracing
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'json' (one object per line, with the trace ids of the request) or 'text'
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Share of the records kept for each sampled event; records tagged with another
+# event (or none) are always kept
+LOG_SAMPLE_RATES = {
+    # Debug line per tile from the upsampler (LOG_LEVEL=DEBUG)
+    'tile': float(os.getenv('LOG_TILE_SAMPLE_RATE', 0.01)),
+    # Info line per request served
+    'request': float(os.getenv('LOG_REQUEST_SAMPLE_RATE', 1.0))
+}
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Attributes every LogRecord has; anything else was passed as ``extra``
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    """A record as one JSON line: time, level, logger, message, exception and ``extra`` fields"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Queue records for the writer thread without ever blocking the caller.
+
+    Records with an ``event`` in ``sample_rates`` are kept at that rate, tagged with
+    their ``sample_rate`` so counts can be scaled back up. Records that find the queue
+    full are dropped and counted by level.
+    """
+
+    def __init__(self, queue, sample_rates=None):
+        super().__init__(queue)
+        self.sample_rates = LOG_SAMPLE_RATES if sample_rates is None else sample_rates
+        self.dropped = {}
+        self.sampled_out = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        rate = self.sample_rates.get(getattr(record, 'event', None))
+        if rate is not None and rate < 1:
+            if random.random() >= rate:
+                with self._lock:
+                    self.sampled_out += 1
+                return False
+            record.sample_rate = rate
+        return super().filter(record)
+
+    def prepare(self, record):
+        # Arguments and tracebacks are rendered here, as they may not outlive the call;
+        # the trace ids are only known in the caller's context
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+        record = logging.makeLogRecord(vars(record))
+        record.msg, record.args, record.exc_info, record.exc_text = message, None, None, exc_text
+        span = tracing.current_span()
+        if span is not None:
+            record.trace_id = span.trace.trace_id
+            record.span_id = span.span_id
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self._lock:
+                self.dropped[record.levelname] = self.dropped.get(record.levelname, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {'queued': self.queue.qsize(), 'dropped': dict(self.dropped), 'sampled_out': self.sampled_out}
+
+
+_handler = None
+_listener = None
+
+
+def configure(log_file=None, level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """Log through a background writer to stderr and ``log_file`` (if given).
+
+    Like logging.basicConfig, a root logger that already has handlers is left alone.
+    Returns the queue handler, or None if logging was already configured.
+    """
+    global _handler, _listener
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    formatter = JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    queue = Queue(LOG_QUEUE_SIZE)
+    _handler = BoundedQueueHandler(queue)
+    _listener = QueueListener(queue, *handlers)
+    _listener.start()
+    # Write out what is still queued when the process exits
+    atexit.register(_listener.stop)
+    root.setLevel(level)
+    root.addHandler(_handler)
+    return _handler
+
+
+def flush(timeout=5.0):
+    """Wait until the records logged so far are written"""
+    if _handler is None:
+        return
+    deadline = time.monotonic() + timeout
+    while _handler.queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def stats():
+    """Queue length, dropped records by level and sampled-out records, or None if not configured"""
+    return None if _handler is None else _handler.stats()
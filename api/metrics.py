@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Prometheus metrics for the Real-ESRGAN API
+Request-path updates are a lock and an add; registry, memory and cache figures are
+read from the inference backend only when /metrics is scraped
+"""
+
+import os
+import logging
+
+import psutil
+
+import logs
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST,
+                                   REGISTRY, generate_latest, multiprocess)
+    from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+    METRICS_AVAILABLE = True
+except ImportError:
+    logger.warning("⚠️ prometheus_client not installed, /metrics is disabled")
+    METRICS_AVAILABLE = False
+    CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Request stages run from about a millisecond (decode) to minutes (CPU inference)
+STAGE_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+THROUGHPUT_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 25, 50)
+# Actual over predicted inference time; 1 is a perfect prediction
+RATIO_BUCKETS = (.25, .5, .67, .8, .9, 1, 1.1, 1.25, 1.5, 2, 4)
+
+
+class _NoopMetric:
+    """Stands in for a metric when prometheus_client is missing"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, *args, **kwargs):
+        pass
+
+    def dec(self, *args, **kwargs):
+        pass
+
+    def set(self, *args, **kwargs):
+        pass
+
+    def observe(self, *args, **kwargs):
+        pass
+
+
+if METRICS_AVAILABLE:
+    REQUEST_DURATION = Histogram(
+        'hdess_request_duration_seconds', 'End-to-end enhance request latency', ['model', 'status'],
+        buckets=STAGE_BUCKETS)
+    STAGE_DURATION = Histogram(
+        'hdess_request_stage_seconds', 'Latency of each enhance request stage', ['model', 'stage'],
+        buckets=STAGE_BUCKETS)
+    TILES_PROCESSED = Counter('hdess_tiles_processed_total', 'Tiles run through a model', ['model'])
+    MEGAPIXELS_PROCESSED = Counter('hdess_megapixels_processed_total', 'Output megapixels produced', ['model'])
+    THROUGHPUT = Histogram(
+        'hdess_inference_megapixels_per_second', 'Output megapixels per second of inference', ['model'],
+        buckets=THROUGHPUT_BUCKETS)
+    QUEUE_DEPTH = Gauge(
+        'hdess_inference_queue_depth', 'Requests waiting for or running inference', multiprocess_mode='livesum')
+    TIER_DECISIONS = Counter(
+        'hdess_slo_tier_decisions_total', 'Quality tier chosen to meet the latency SLO', ['endpoint', 'tier', 'model'])
+    SLO_VIOLATIONS = Counter(
+        'hdess_slo_violations_total', 'Requests that finished later than their latency SLO', ['endpoint', 'tier'])
+    COALESCED = Counter(
+        'hdess_coalesced_requests_total', 'Requests served from an identical in-flight request', ['source'])
+    CANCELLED = Counter(
+        'hdess_cancelled_requests_total', 'Requests stopped by a cancel, deadline or client disconnect',
+        ['endpoint', 'reason'])
+    WASTED_INFERENCE = Counter(
+        'hdess_wasted_inference_seconds_total', 'Inference time spent on requests that were then cancelled',
+        ['model', 'reason'])
+    WASTED_TILES = Counter('hdess_wasted_tiles_total', 'Tiles run for requests that were then cancelled', ['model'])
+    LATENCY_PREDICTION_RATIO = Histogram(
+        'hdess_latency_prediction_ratio', 'Actual inference time over the latency model\'s prediction', ['model'],
+        buckets=RATIO_BUCKETS)
+    ROUTED = Counter(
+        'hdess_routed_requests_total', 'model=auto requests by classified content and the model chosen',
+        ['content', 'model'])
+    CONTENT_STORE_LOOKUPS = Counter(
+        'hdess_content_store_lookups_total', 'Requests that found their result or source in the content store, '
+        'or sent only a hash the store did not have', ['outcome'])
+else:
+    REQUEST_DURATION = STAGE_DURATION = TILES_PROCESSED = MEGAPIXELS_PROCESSED = THROUGHPUT = QUEUE_DEPTH = \
+        TIER_DECISIONS = SLO_VIOLATIONS = COALESCED = CANCELLED = WASTED_INFERENCE = WASTED_TILES = ROUTED = \
+        LATENCY_PREDICTION_RATIO = CONTENT_STORE_LOOKUPS = _NoopMetric()
+
+
+def observe_request(model_name, status, stages_ms, total_ms, tiles=0, output_pixels=0):
+    """Record a finished enhance request"""
+    REQUEST_DURATION.labels(model_name, status).observe(total_ms / 1000)
+    for stage, value in stages_ms.items():
+        STAGE_DURATION.labels(model_name, stage).observe(value / 1000)
+    if tiles:
+        TILES_PROCESSED.labels(model_name).inc(tiles)
+    if output_pixels:
+        megapixels = output_pixels / 1e6
+        MEGAPIXELS_PROCESSED.labels(model_name).inc(megapixels)
+        inference_s = stages_ms.get('inference', 0) / 1000
+        if inference_s > 0:
+            THROUGHPUT.labels(model_name).observe(megapixels / inference_s)
+
+
+def observe_cancelled(endpoint, model_name, error, total_ms):
+    """Record a request stopped by Cancelled ``error``, and the compute it had already used"""
+    REQUEST_DURATION.labels(model_name, 'cancelled').observe(total_ms / 1000)
+    CANCELLED.labels(endpoint, error.reason).inc()
+    if error.inference_seconds:
+        WASTED_INFERENCE.labels(model_name, error.reason).inc(error.inference_seconds)
+    if error.tiles:
+        WASTED_TILES.labels(model_name).inc(error.tiles)
+
+
+def _ratio(hits, misses):
+    total = hits + misses
+    return hits / total if total else 0.0
+
+
+class InferenceCollector:
+    """Scrape-time metrics read from the inference backend (in-process or model server)"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def collect(self):
+        http_rss = GaugeMetricFamily(
+            'hdess_http_resident_memory_bytes', 'Resident memory of the HTTP process serving this scrape')
+        http_rss.add_metric([], psutil.Process().memory_info().rss)
+        yield http_rss
+
+        log_stats = logs.stats()
+        if log_stats is not None:
+            dropped = CounterMetricFamily(
+                'hdess_log_records_dropped', 'Log records dropped because the log writer fell behind',
+                labels=['level'])
+            for level, count in log_stats['dropped'].items():
+                dropped.add_metric([level], count)
+            yield dropped
+            sampled_out = CounterMetricFamily('hdess_log_records_sampled_out', 'Sampled log events left out')
+            sampled_out.add_metric([], log_stats['sampled_out'])
+            yield sampled_out
+            queued = GaugeMetricFamily('hdess_log_queue_depth', 'Log records waiting to be written')
+            queued.add_metric([], log_stats['queued'])
+            yield queued
+
+        try:
+            snapshot = self.backend.snapshot()
+            memory = self.backend.memory_info()
+        except Exception as e:
+            logger.warning(f"Could not read inference metrics: {e}")
+            return
+        stats = snapshot['stats']
+
+        for name, help_text in (('loads', 'Models built'), ('load_failures', 'Failed model loads'),
+                                ('evictions', 'Models or cached weights evicted'),
+                                ('swaps', 'Weights swapped into a shared slot')):
+            counter = CounterMetricFamily(f'hdess_model_{name}', help_text)
+            counter.add_metric([], stats[name])
+            yield counter
+
+        hit_ratio = GaugeMetricFamily('hdess_cache_hit_ratio', 'Hit ratio of the model caches', labels=['cache'])
+        hit_ratio.add_metric(['model'], _ratio(stats['hits'], stats['misses']))
+        hit_ratio.add_metric(['weights'], _ratio(stats['weight_cache_hits'], stats['weight_cache_misses']))
+        yield hit_ratio
+
+        model_memory = GaugeMetricFamily('hdess_model_memory_bytes', 'Memory held by loaded models')
+        model_memory.add_metric([], snapshot['used_mb'] * 1024 * 1024)
+        yield model_memory
+
+        admission = snapshot.get('admission')
+        if admission is not None:
+            in_use = GaugeMetricFamily(
+                'hdess_admission_in_use', 'Admitted share of the admission budgets', labels=['budget'])
+            in_use.add_metric(['cost'], admission['cost_in_use'])
+            in_use.add_metric(['memory_bytes'], admission['memory_in_use_mb'] * 1024 * 1024)
+            yield in_use
+            waiting = GaugeMetricFamily('hdess_admission_queue_depth', 'Requests waiting for admission')
+            waiting.add_metric([], admission['queued'])
+            yield waiting
+            decisions = CounterMetricFamily(
+                'hdess_admission_decisions', 'Admission decisions by outcome', labels=['outcome'])
+            for outcome, count in admission['stats'].items():
+                decisions.add_metric([outcome], count)
+            yield decisions
+
+        inference_rss = GaugeMetricFamily(
+            'hdess_inference_resident_memory_bytes', 'Resident memory of the process running inference')
+        inference_rss.add_metric([], memory['rss_bytes'])
+        yield inference_rss
+
+        device_memory = GaugeMetricFamily(
+            'hdess_device_memory_bytes', 'CUDA memory of the inference process', labels=['kind'])
+        device_memory.add_metric(['allocated'], memory['device_allocated_bytes'])
+        device_memory.add_metric(['reserved'], memory['device_reserved_bytes'])
+        yield device_memory
+
+
+_inference_collector = None
+
+
+def register_backend(backend):
+    """Export scrape-time metrics for an inference backend"""
+    global _inference_collector
+    if METRICS_AVAILABLE:
+        _inference_collector = InferenceCollector(backend)
+        if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+            REGISTRY.register(_inference_collector)
+
+
+def render():
+    """Exposition text for /metrics"""
+    if not METRICS_AVAILABLE:
+        return None
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # gunicorn workers: merge the per-process metric files
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        if _inference_collector is not None:
+            registry.register(_inference_collector)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
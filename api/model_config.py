@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Model configuration for the Real-ESRGAN API
+Kept free of torch imports so HTTP workers can validate requests without loading PyTorch
+"""
+
+import os
+
+
+def _rrdbnet(**kwargs):
+    from basicsr.archs.rrdbnet_arch import RRDBNet
+    return RRDBNet(**kwargs)
+
+
+def _srvgg(**kwargs):
+    from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+    return SRVGGNetCompact(**kwargs)
+
+
+# Available models configuration
+# Models with the same 'arch' have identical parameter shapes and share one loaded module
+# 'cost' is compute per input megapixel relative to RealESRGAN_x4plus (measured on CPU);
+# 'activation_bytes' is the approximate working memory per input pixel of a tile;
+# 'content' is what model=auto may route to the model (see model_router.py)
+MODEL_CONFIG = {
+    'RealESRGAN_x4plus': {
+        'model': lambda: _rrdbnet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4),
+        'arch': 'RRDBNet-b23-x4',
+        'scale': 4,
+        'cost': 1.0,
+        'activation_bytes': 8192,
+        'url': 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth',
+        'content': ('photo', 'anime'),
+        'description': 'General purpose 4x upscaling model'
+    },
+    'RealESRGAN_x4plus_anime_6B': {
+        'model': lambda: _rrdbnet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4),
+        'arch': 'RRDBNet-b6-x4',
+        'scale': 4,
+        'cost': 0.35,
+        'activation_bytes': 8192,
+        'url': 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.2.4/RealESRGAN_x4plus_anime_6B.pth',
+        'content': ('anime',),
+        'description': 'Optimized for anime/illustrations (faster)'
+    },
+    'RealESRNet_x4plus': {
+        'model': lambda: _rrdbnet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4),
+        'arch': 'RRDBNet-b23-x4',
+        'scale': 4,
+        'cost': 1.0,
+        'activation_bytes': 8192,
+        'url': 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.1/RealESRNet_x4plus.pth',
+        'content': ('photo',),
+        'description': 'Clean upscaling without artifacts'
+    },
+    'realesr-general-x4v3': {
+        'model': lambda: _srvgg(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=32, upscale=4, act_type='prelu'),
+        'arch': 'SRVGGNetCompact-c32-x4',
+        'scale': 4,
+        'cost': 0.06,
+        'activation_bytes': 1024,
+        'url': 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-x4v3.pth',
+        'content': ('photo',),
+        'description': 'Latest model with denoise control (RECOMMENDED)'
+    },
+    'RealESRGAN_x2plus': {
+        'model': lambda: _rrdbnet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2),
+        'arch': 'RRDBNet-b23-x2',
+        'scale': 2,
+        'cost': 0.25,
+        'activation_bytes': 2048,
+        'url': 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth',
+        'content': ('photo',),
+        'description': '2x upscaling model'
+    }
+}
+
+
+DEFAULT_MODEL = os.getenv('DEFAULT_MODEL', 'realesr-general-x4v3')
+
+
+class ModelLoadError(Exception):
+    """Raised when a model cannot be loaded"""
+
+
+class ModelNotReady(Exception):
+    """Raised when a model is still loading or failed to load in the background"""
+
+    def __init__(self, model_name, status):
+        super().__init__(f"{model_name} is {status['state']}")
+        self.model_name = model_name
+        self.status = status
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Model registry for the Real-ESRGAN API
+Keeps loaded upsamplers within a memory budget, evicting idle models in LRU order.
+Models that share an architecture share one live module ("slot"); switching
+between them copies cached weights into the slot instead of building a new model.
+"""
+
+import os
+import threading
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+from model_config import ModelLoadError
+
+logger = logging.getLogger(__name__)
+
+# Memory budget for loaded models (the backend container is limited to 4G)
+MODEL_MEMORY_BUDGET = int(os.getenv('MODEL_MEMORY_BUDGET_MB', 1536)) * 1024 * 1024
+
+
+def model_memory_bytes(upsampler):
+    """Bytes held by an upsampler's parameters and buffers"""
+    tensors = list(upsampler.model.parameters()) + list(upsampler.model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def load_state_dict_file(model_path):
+    """Load the weights of a Real-ESRGAN checkpoint, memory-mapped when possible.
+
+    Returns the state dict and the number of bytes it keeps resident: a
+    memory-mapped state dict lives in the page cache and costs nothing until read.
+    """
+    try:
+        loadnet = torch.load(model_path, map_location=torch.device('cpu'), mmap=True)
+        resident = 0
+    except (TypeError, RuntimeError):
+        # torch < 2.1 has no mmap argument, and legacy (non-zip) checkpoints cannot be mapped
+        loadnet = torch.load(model_path, map_location=torch.device('cpu'))
+        resident = None
+
+    # prefer to use params_ema
+    state_dict = loadnet['params_ema'] if 'params_ema' in loadnet else loadnet['params']
+    if resident is None:
+        resident = sum(t.numel() * t.element_size() for t in state_dict.values())
+    return state_dict, resident
+
+
+class _Slot:
+    """A live upsampler shared by every model with the same architecture"""
+
+    def __init__(self, key, upsampler, size, current):
+        self.key = key
+        self.upsampler = upsampler
+        self.size = size
+        self.current = current  # name of the model whose weights are in the module
+        self.refs = 0
+        # RealESRGANer keeps per-call state on the instance, so only one request may run it at a time
+        self.lock = threading.Lock()
+
+
+class ModelRegistry:
+    """Load upsamplers on demand, keyed by model name.
+
+    Args:
+        loader (callable): ``loader(name)`` builds and returns a RealESRGANer.
+        budget (int): Memory budget in bytes for all loaded models.
+        estimate (callable): ``estimate(name)`` returns the expected size in bytes of a model
+            before it is loaded, used to make room ahead of the load. Default: None.
+        signature (callable): ``signature(name)`` returns the architecture key of a model.
+            Models with equal keys must have identical parameter shapes and share one slot.
+            Default: None, every model gets its own slot.
+        weights (callable): ``weights(name)`` returns ``(state_dict, resident_bytes)`` for a
+            model, used to swap it into a shared slot. Default: None.
+    """
+
+    def __init__(self, loader, budget=MODEL_MEMORY_BUDGET, estimate=None, signature=None, weights=None):
+        self._loader = loader
+        self._estimate = estimate or (lambda name: 0)
+        self._signature = signature or (lambda name: name)
+        self._weights = weights
+        self.budget = budget
+        self._slots = OrderedDict()  # least recently used first
+        self._weight_cache = OrderedDict()  # model name -> (state_dict, resident bytes)
+        self._loading = set()
+        self._reserved = 0
+        self._cond = threading.Condition()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'loads': 0,
+            'load_failures': 0,
+            'evictions': 0,
+            'swaps': 0,
+            'weight_cache_hits': 0,
+            'weight_cache_misses': 0
+        }
+
+    @property
+    def used(self):
+        """Bytes held by slots, resident cached weights and reservations for loads in progress"""
+        return (sum(slot.size for slot in self._slots.values()) +
+                sum(resident for _, resident in self._weight_cache.values()) + self._reserved)
+
+    def is_loaded(self, name):
+        """Whether ``name`` can be served without building a model"""
+        slot = self._slots.get(self._signature(name))
+        return slot is not None and (slot.current == name or name in self._weight_cache)
+
+    def loaded_models(self):
+        """Names of models that can be served without building a model"""
+        with self._cond:
+            names = [slot.current for slot in self._slots.values()]
+            names += [name for name in self._weight_cache if name not in names and self.is_loaded(name)]
+            return names
+
+    def snapshot(self):
+        """Registry state for health and model listing endpoints"""
+        with self._cond:
+            return {
+                'budget_mb': round(self.budget / (1024 * 1024), 1),
+                'used_mb': round(self.used / (1024 * 1024), 1),
+                'slots': {
+                    key: {
+                        'model': slot.current,
+                        'size_mb': round(slot.size / (1024 * 1024), 1),
+                        'in_use': slot.refs
+                    }
+                    for key, slot in self._slots.items()
+                },
+                'cached_weights': {
+                    name: {'resident_mb': round(resident / (1024 * 1024), 1)}
+                    for name, (_, resident) in self._weight_cache.items()
+                },
+                'loading': sorted(self._loading),
+                'stats': dict(self.stats)
+            }
+
+    @contextmanager
+    def acquire(self, name):
+        """Check out the upsampler for ``name``, loading it if needed.
+
+        The model cannot be evicted while it is checked out, and the caller has
+        exclusive use of it for the duration of the block.
+        """
+        slot = self._checkout(name)
+        try:
+            with slot.lock:
+                if slot.current != name:
+                    self._swap(slot, name)
+                yield slot.upsampler
+        finally:
+            with self._cond:
+                slot.refs -= 1
+                self._cond.notify_all()
+
+    def ensure_loaded(self, name):
+        """Load ``name`` without running it"""
+        with self.acquire(name):
+            pass
+
+    def _checkout(self, name):
+        key = self._signature(name)
+        with self._cond:
+            while True:
+                slot = self._slots.get(key)
+                if slot is not None:
+                    slot.refs += 1
+                    self._slots.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return slot
+                if key not in self._loading:
+                    break
+                # Another request is already building this slot; wait for it instead of loading twice
+                self._cond.wait()
+
+            self.stats['misses'] += 1
+            self._loading.add(key)
+            estimate = self._estimate(name)
+            self._make_room(estimate)
+            self._reserved += estimate
+
+        try:
+            upsampler = self._loader(name)
+            size = model_memory_bytes(upsampler)
+        except Exception as e:
+            with self._cond:
+                self._loading.discard(key)
+                self._reserved -= estimate
+                self.stats['load_failures'] += 1
+                self._cond.notify_all()
+            raise ModelLoadError(f'{name}: {e}') from e
+
+        with self._cond:
+            self._reserved -= estimate
+            # Still loading while waiting for room, so no other request builds it again
+            self._make_room(size)
+            slot = _Slot(key, upsampler, size, name)
+            slot.refs += 1
+            self._slots[key] = slot
+            self._loading.discard(key)
+            self.stats['loads'] += 1
+            self._cond.notify_all()
+        logger.info(f"Loaded {name} into slot {key} ({size / (1024 * 1024):.1f}MB, "
+                    f"{self.used / (1024 * 1024):.1f}MB in use)")
+        return slot
+
+    def _swap(self, slot, name):
+        """Copy the weights of ``name`` into a slot. Called with the slot lock held."""
+        if self._weights is None:
+            raise ModelLoadError(f'{name}: no weight source to swap into slot {slot.key}')
+
+        with self._cond:
+            cached = self._weight_cache.get(name)
+            if cached is not None:
+                self._weight_cache.move_to_end(name)
+                self.stats['weight_cache_hits'] += 1
+        if cached is None:
+            try:
+                cached = self._weights(name)
+            except Exception as e:
+                with self._cond:
+                    self.stats['load_failures'] += 1
+                raise ModelLoadError(f'{name}: {e}') from e
+            with self._cond:
+                self.stats['weight_cache_misses'] += 1
+                self._make_room(cached[1], waiting=False)
+                self._weight_cache[name] = cached
+
+        # load_state_dict copies in place, converting to the slot's device and precision
+        slot.upsampler.model.load_state_dict(cached[0], strict=True)
+        with self._cond:
+            slot.current = name
+            self.stats['swaps'] += 1
+        logger.info(f"Swapped {name} into slot {slot.key}")
+
+    def set_budget(self, budget):
+        """Change the memory budget, evicting idle models that no longer fit.
+
+        Models in use stay until they are released and room is needed.
+        """
+        with self._cond:
+            self.budget = budget
+            while self.used > budget and self._evict_idle():
+                pass
+            # Loads waiting for room may fit a larger budget
+            self._cond.notify_all()
+
+    def _evict_idle(self):
+        """Evict the least recently used of what is not in use; returns False if there is none.
+        Called with the lock held."""
+        # Resident cached weights are cheapest to drop: they can be re-read from disk
+        name = next((name for name, (_, resident) in self._weight_cache.items() if resident), None)
+        if name is not None:
+            del self._weight_cache[name]
+            self.stats['evictions'] += 1
+            logger.info(f"Evicted cached weights of {name}")
+            return True
+        victim = next((slot for slot in self._slots.values() if slot.refs == 0), None)
+        if victim is not None:
+            self._evict(victim)
+            return True
+        return False
+
+    def _make_room(self, needed, waiting=True):
+        """Evict idle models until ``needed`` bytes fit in the budget. Called with the lock held."""
+        while self.used + needed > self.budget:
+            if self._evict_idle():
+                continue
+            if not waiting or (not self._slots and not self._reserved):
+                # Nothing left to evict: the model alone exceeds the budget, load it anyway
+                logger.warning(f"Model of {needed / (1024 * 1024):.1f}MB exceeds the memory budget")
+                return
+            # Every loaded model is in use or still loading; wait for one to be released
+            self._cond.wait()
+
+    def _evict(self, slot):
+        del self._slots[slot.key]
+        slot.upsampler = None
+        self.stats['evictions'] += 1
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logger.info(f"Evicted slot {slot.key} ({slot.current}, {slot.size / (1024 * 1024):.1f}MB)")
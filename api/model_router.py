@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Content-based model routing for model=auto
+A small classifier tells line art (anime, illustrations, graphics) from photographs on
+a downsampled copy of the upload, and the request is served by the cheapest model in
+MODEL_CONFIG whose 'content' covers it. Unsure decisions fall back to DEFAULT_MODEL.
+Evaluate and refit the classifier on a labelled folder with benchmarks/route_eval.py.
+"""
+
+import os
+import math
+import time
+import logging
+
+import cv2
+import numpy as np
+
+import metrics
+import tracing
+from image_io import decode_reduced
+from model_config import MODEL_CONFIG, DEFAULT_MODEL
+
+logger = logging.getLogger(__name__)
+
+AUTO_MODEL = 'auto'
+ANIME = 'anime'
+PHOTO = 'photo'
+CONTENTS = (ANIME, PHOTO)
+
+# Longest side the classifier looks at; decoding at a reduced size keeps routing to a few ms
+ROUTER_SIDE = int(os.getenv('ROUTER_SIDE', 256))
+# Below this confidence the request gets DEFAULT_MODEL instead of a routed model
+ROUTER_MIN_CONFIDENCE = float(os.getenv('ROUTER_MIN_CONFIDENCE', 0.6))
+# Logistic regression weights of FEATURES and the bias, comma-separated (route_eval.py --fit prints them)
+ROUTER_WEIGHTS = tuple(float(w) for w in os.getenv('ROUTER_WEIGHTS', '8.71,3.74,4.97,-5.38,-3.93').split(','))
+
+FEATURES = ('fills', 'flat', 'edge_contrast', 'palette')
+# Gradient magnitudes (3x3 Sobel of 8-bit gray) of a flat area, soft shading and a hard edge
+FLAT_GRADIENT = 6
+SHADING_GRADIENT = (12, 48)
+EDGE_GRADIENT = 96
+
+
+def content_features(img):
+    """Features of an 8-bit BGR image that separate line art from photographs.
+
+    - fills: fraction of pixels equal (within 2 levels) to the median of their 3x3
+      neighbourhood; flat colour fills are, sensor noise and texture are not
+    - flat: fraction of pixels with no gradient
+    - edge_contrast: hard edges minus soft shading; line art has outlines, photos gradients
+    - palette: fraction of pixels in the 32 most common colours (15-bit)
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    gradient = cv2.magnitude(cv2.Sobel(gray, cv2.CV_32F, 1, 0), cv2.Sobel(gray, cv2.CV_32F, 0, 1))
+    flat = np.count_nonzero(gradient < FLAT_GRADIENT) / gradient.size
+    shading = np.count_nonzero((gradient >= SHADING_GRADIENT[0]) & (gradient < SHADING_GRADIENT[1])) / gradient.size
+    edges = np.count_nonzero(gradient >= EDGE_GRADIENT) / gradient.size
+
+    median = cv2.medianBlur(img, 3)
+    fills = np.count_nonzero(cv2.absdiff(img, median).max(axis=2) <= 2) / gradient.size
+
+    quantized = (img >> 3).astype(np.int32)
+    colours = (quantized[..., 0] << 10) | (quantized[..., 1] << 5) | quantized[..., 2]
+    counts = np.bincount(colours.ravel(), minlength=1 << 15)
+    palette = np.sort(counts)[-32:].sum() / colours.size
+    return np.array([fills, flat, edges - shading, palette])
+
+
+def thumbnail(data, width, height, side=ROUTER_SIDE):
+    """Decode an encoded image as 8-bit BGR with its longest side at most ``side``"""
+    factor = min(1.0, side / max(width, height))
+    size = (max(1, round(width * factor)), max(1, round(height * factor)))
+    img = decode_reduced(np.frombuffer(data, dtype=np.uint8), width, height, size)
+    if img is None:
+        return None
+    if img.shape[1] > size[0]:
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    return img
+
+
+def cheapest_model(content, outscale=None):
+    """Cheapest model for ``content``, preferring models that reach ``outscale`` without a resize"""
+    candidates = [name for name, config in MODEL_CONFIG.items() if content in config['content']]
+    native = [name for name in candidates if outscale is None or MODEL_CONFIG[name]['scale'] >= outscale]
+    return min(native or candidates, key=lambda name: MODEL_CONFIG[name]['cost'])
+
+
+class RoutingDecision:
+    """What model=auto made of one image.
+
+    Args:
+        content (str): 'anime' or 'photo', or None if the image could not be read.
+        confidence (float): Classifier probability of ``content``.
+        model_name (str): Model serving the request.
+        routed (bool): Whether ``model_name`` was chosen for the content (False when
+            the classifier was unsure and DEFAULT_MODEL is used).
+        elapsed_ms (float): Time spent decoding and classifying.
+    """
+
+    def __init__(self, content, confidence, model_name, routed, elapsed_ms=0.0):
+        self.content = content
+        self.confidence = confidence
+        self.model_name = model_name
+        self.routed = routed
+        self.elapsed_ms = elapsed_ms
+
+    def to_dict(self):
+        return {
+            'content': self.content,
+            'confidence': round(self.confidence, 3),
+            'model': self.model_name,
+            'routed': self.routed,
+            'elapsed_ms': round(self.elapsed_ms, 1)
+        }
+
+
+class ContentRouter:
+    """Route model=auto requests by image content.
+
+    Args:
+        weights (tuple): Logistic regression weights of FEATURES followed by the bias;
+            positive scores mean anime. Default: ROUTER_WEIGHTS.
+        min_confidence (float): Confidence below which DEFAULT_MODEL is used.
+            Default: ROUTER_MIN_CONFIDENCE.
+        side (int): Longest side of the image the classifier sees. Default: ROUTER_SIDE.
+    """
+
+    def __init__(self, weights=ROUTER_WEIGHTS, min_confidence=ROUTER_MIN_CONFIDENCE, side=ROUTER_SIDE):
+        if len(weights) != len(FEATURES) + 1:
+            raise ValueError(f'Expected {len(FEATURES) + 1} router weights, got {len(weights)}')
+        self.weights = np.array(weights[:-1])
+        self.bias = weights[-1]
+        self.min_confidence = min_confidence
+        self.side = side
+
+    def classify(self, img):
+        """Content of a decoded 8-bit BGR image and the classifier's confidence in it"""
+        score = float(content_features(img) @ self.weights + self.bias)
+        anime = 1 / (1 + math.exp(-max(-50.0, min(50.0, score))))
+        return (ANIME, anime) if anime >= 0.5 else (PHOTO, 1 - anime)
+
+    def route(self, data, width, height, outscale=None):
+        """Pick the model for an encoded ``width`` x ``height`` image. Returns a RoutingDecision"""
+        started = time.perf_counter()
+        img = thumbnail(data, width, height, self.side)
+        if img is None:
+            # The request fails to decode later on with its usual error
+            return RoutingDecision(None, 0.0, DEFAULT_MODEL, False)
+        content, confidence = self.classify(img)
+        routed = confidence >= self.min_confidence
+        model_name = cheapest_model(content, outscale) if routed else DEFAULT_MODEL
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        decision = RoutingDecision(content, confidence, model_name, routed, elapsed_ms)
+        metrics.ROUTED.labels(content, model_name).inc()
+        tracing.record('route', started, content=content, confidence=round(confidence, 3), model=model_name)
+        logger.info(f"model=auto: {width}x{height} image is {content} ({confidence:.2f}), "
+                    f"{'routed to' if routed else 'unsure, using'} {model_name} in {elapsed_ms:.1f}ms")
+        return decision
+
+    def to_dict(self):
+        """Models model=auto routes to at the models' own scale"""
+        return {
+            'routes': {content: cheapest_model(content) for content in CONTENTS},
+            'fallback': DEFAULT_MODEL,
+            'min_confidence': self.min_confidence
+        }
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Real-ESRGAN model server
+Owns the loaded upsamplers in one process so any number of HTTP worker processes can
+share them. Workers connect with shm_transport.RemoteInference; images are passed in
+shared memory and only control messages go over the connection.
+
+Usage:
+    MODEL_SERVER_ADDRESS=localhost:6070 python model_server.py
+    MODEL_SERVER_ADDRESS=localhost:6070 gunicorn --workers 4 --threads 4 realesrgan_api:app
+"""
+
+import sys
+import time
+import threading
+import logging
+from multiprocessing.connection import Listener
+
+from dotenv import load_dotenv
+
+# Load environment variables before the modules that read them
+load_dotenv()
+
+import logs
+import tracing
+from inference import LocalInference, MODEL_WAIT_TIMEOUT
+from admission import AdmissionRejected
+from cancellation import CANCELLED, DISCONNECTED, CancelToken, Cancelled
+from model_config import ModelLoadError, ModelNotReady
+from shm_transport import (MODEL_SERVER_ADDRESS, MODEL_SERVER_AUTHKEY, parse_address, set_nodelay, share_array,
+                           attach_array)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = 'localhost:6070'
+
+
+class Session:
+    """What one worker connection holds: output blocks until released, and admission tickets"""
+
+    def __init__(self):
+        self.blocks = {}
+        self.tickets = set()
+
+
+def dispatch(backend, message, session, notify=None, poll=None):
+    """Run one control message against the backend and build its reply.
+
+    ``notify`` sends interim messages (tile progress) ahead of the reply. ``poll()``
+    returns a reason to cancel a running enhance (the worker cancelled it or went
+    away), or None.
+    """
+    op = message.get('op')
+    if op == 'enhance':
+        progress = None
+        if message.get('progress') and notify is not None:
+            progress = lambda done, total: notify({'ok': True, 'progress': (done, total)})
+        deadline = message.get('deadline')
+        cancel = CancelToken(None if deadline is None else time.monotonic() + deadline, poll)
+        shm_in, img = attach_array(message['image'])
+        try:
+            # Traced as part of the worker's request and sent back with the reply
+            with tracing.remote_trace('model_server.enhance', message.get('trace'), model=message['model']) as spans:
+                result = backend.enhance(img, message['model'], outscale=message.get('outscale'),
+                                         timeout=message.get('timeout') or MODEL_WAIT_TIMEOUT, progress=progress,
+                                         tenant=message.get('tenant'), weight=message.get('weight', 1.0),
+                                         tile_scale=message.get('tile_scale', 1), cancel=cancel)
+        finally:
+            del img
+            shm_in.close()
+        with result:
+            shm_out, descriptor = share_array(result.image)
+        # Kept until the worker sends 'release' (or disconnects)
+        session.blocks[shm_out.name] = shm_out
+        return {'ok': True, 'image': descriptor, 'timings': result.timings, 'info': result.info, 'spans': spans}
+    if op == 'device':
+        return {'ok': True, 'device': backend.device_info()}
+    if op == 'is_loaded':
+        return {'ok': True, 'loaded': backend.is_loaded(message['model'])}
+    if op == 'model_state':
+        return {'ok': True, 'state': backend.model_state(message['model'])}
+    if op == 'readiness':
+        ready, models = backend.readiness()
+        return {'ok': True, 'ready': ready, 'models': models}
+    if op == 'snapshot':
+        return {'ok': True, 'snapshot': backend.snapshot()}
+    if op == 'admit':
+        ticket = backend.admit(message['cost'], message['memory'], timeout=message.get('timeout'),
+                               work=message.get('work'))
+        session.tickets.add(ticket)
+        return {'ok': True, 'ticket': ticket}
+    if op == 'predict':
+        return {'ok': True, 'seconds': backend.predict_latency(message['works'])}
+    if op == 'estimate':
+        return {'ok': True, 'seconds': backend.estimate_latency(message['works'])}
+    if op == 'scheduler':
+        return {'ok': True, 'scheduler': backend.scheduler_stats()}
+    if op == 'memory':
+        return {'ok': True, 'memory': backend.memory_info()}
+    if op == 'budgets':
+        # Sent by supervisor.py when the number of workers sharing the budgets changes
+        backend.set_memory_budgets(message['model_mb'] * 1024 * 1024, message['admission_mb'] * 1024 * 1024)
+        return {'ok': True}
+    if op == 'preload':
+        status = backend.preload(message['model'], timeout=message.get('timeout') or MODEL_WAIT_TIMEOUT)
+        return {'ok': True, 'status': status}
+    return {'ok': False, 'error': 'bad_request', 'message': f'Unknown op: {op}'}
+
+
+def release_block(shm):
+    shm.close()
+    shm.unlink()
+
+
+def handle_oneway(backend, message, session):
+    """Handle a message that gets no reply; returns False for any other message"""
+    op = message.get('op')
+    if op == 'release':
+        shm = session.blocks.pop(message['shm'], None)
+        if shm is not None:
+            release_block(shm)
+        return True
+    if op == 'release_admission':
+        if message['ticket'] in session.tickets:
+            session.tickets.discard(message['ticket'])
+            backend.release_admission(message['ticket'])
+        return True
+    # A cancel that crossed the reply of the request it was meant for
+    return op == 'cancel'
+
+
+def handle_connection(conn, backend):
+    """Serve one HTTP worker thread until it disconnects"""
+    session = Session()
+
+    def poll():
+        # The worker only sends 'cancel' while its request runs; a closed connection cancels too
+        try:
+            while conn.poll():
+                message = conn.recv()
+                if message.get('op') == 'cancel':
+                    return message.get('reason') or CANCELLED
+                if not handle_oneway(backend, message, session):
+                    logger.warning(f"Ignoring {message.get('op')} sent while a request runs")
+        except (EOFError, OSError):
+            return DISCONNECTED
+        return None
+
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if handle_oneway(backend, message, session):
+                continue
+
+            try:
+                reply = dispatch(backend, message, session, notify=conn.send, poll=poll)
+            except Cancelled as e:
+                logger.info(f"Request {e.reason} after {e.tiles} tiles")
+                reply = {'ok': False, 'error': 'cancelled', 'reason': e.reason, 'tiles': e.tiles,
+                         'inference_seconds': e.inference_seconds, 'model': e.model_name}
+            except AdmissionRejected as e:
+                reply = {'ok': False, 'error': 'rejected', 'reason': e.reason, 'retry_after': e.retry_after}
+            except ModelNotReady as e:
+                reply = {'ok': False, 'error': 'not_ready', 'model': e.model_name, 'status': e.status}
+            except ModelLoadError as e:
+                reply = {'ok': False, 'error': 'load_failed', 'message': str(e)}
+            except Exception as e:
+                logger.exception(f"Model server error handling {message.get('op')}")
+                reply = {'ok': False, 'error': 'failed', 'message': str(e)}
+
+            try:
+                conn.send(reply)
+            except (EOFError, OSError):
+                break
+    finally:
+        for shm in session.blocks.values():
+            release_block(shm)
+        for ticket in session.tickets:
+            backend.release_admission(ticket)
+        conn.close()
+
+
+def serve(address, backend, authkey=MODEL_SERVER_AUTHKEY):
+    """Accept worker connections forever, one thread per connection"""
+    address = parse_address(address)
+    with Listener(address, authkey=authkey) as listener:
+        logger.info(f"Model server listening on {address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # Failed handshake (wrong authkey, port scan); keep serving
+                logger.warning(f"Rejected model server connection: {e}")
+                continue
+            if isinstance(address, tuple):
+                set_nodelay(conn)
+            threading.Thread(target=handle_connection, args=(conn, backend), daemon=True).start()
+
+
+if __name__ == '__main__':
+    logs.configure()
+
+    address = MODEL_SERVER_ADDRESS or DEFAULT_ADDRESS
+    logger.info(f"🚀 Starting Real-ESRGAN model server on {address}...")
+    backend = LocalInference()
+    backend.start()
+    try:
+        serve(address, backend)
+    except KeyboardInterrupt:
+        sys.exit(0)
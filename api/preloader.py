@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Background model preloader for the Real-ESRGAN API
+Downloads, loads and warms up models off the request path and reports their readiness
+"""
+
+import os
+import time
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Models loaded at startup, in order
+PRELOAD_MODELS = [name.strip() for name in os.getenv('PRELOAD_MODELS', '').split(',') if name.strip()]
+WARMUP_SIZE = int(os.getenv('WARMUP_SIZE', 64))
+
+PENDING, DOWNLOADING, LOADING, WARMING, READY, FAILED = 'pending', 'downloading', 'loading', 'warming', 'ready', 'failed'
+
+
+class ModelPreloader(threading.Thread):
+    """Load models one at a time in a background thread.
+
+    Requests for a model that is not loaded yet are queued here with :meth:`wait_ready`
+    instead of loading it themselves, so every model is downloaded and built once.
+
+    Args:
+        registry (ModelRegistry): Registry the models are loaded into.
+        model_names (list[str]): Models to load at startup, in order.
+        prepare (callable): ``prepare(name)`` runs before loading, e.g. to download weights. Default: None.
+        warmup_size (int): Side of the blank image run through each model after loading. Default: 64.
+    """
+
+    def __init__(self, registry, model_names, prepare=None, warmup_size=WARMUP_SIZE):
+        super().__init__(name='model-preloader', daemon=True)
+        self.registry = registry
+        self.prepare = prepare
+        self.warmup_size = warmup_size
+        self._cond = threading.Condition()
+        self._queue = []
+        self._status = {}
+        self._running = False
+        for name in model_names:
+            self._enqueue(name)
+
+    def start(self):
+        """Start the loader thread (only once)"""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        super().start()
+
+    def status(self, name):
+        with self._cond:
+            return dict(self._status.get(name, {'state': PENDING}))
+
+    def readiness(self):
+        """Per-model readiness, and whether every queued model is ready"""
+        with self._cond:
+            models = {name: dict(status) for name, status in self._status.items()}
+        for name, status in models.items():
+            if status['state'] == READY and not self.registry.is_loaded(name):
+                # Evicted since it was loaded; it will be loaded again on the next request
+                status['state'] = 'evicted'
+        ready = all(status['state'] in (READY, 'evicted') for status in models.values())
+        return ready, models
+
+    def wait_ready(self, name, timeout=None):
+        """Queue ``name`` ahead of the startup models and wait until it is ready.
+
+        Returns the model's status; its state is not ``ready`` if loading failed or timed out.
+        """
+        self.start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            status = self._status.get(name)
+            if status is None or (status['state'] == READY and not self.registry.is_loaded(name)) \
+                    or status['state'] == FAILED:
+                self._enqueue(name, front=True)
+            elif name in self._queue:
+                # Move it to the front: a request is waiting for it
+                self._queue.remove(name)
+                self._queue.insert(0, name)
+            self._cond.notify_all()
+
+            while self._status[name]['state'] not in (READY, FAILED) or name in self._queue:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return dict(self._status[name])
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                name = self._queue.pop(0)
+            self._load(name)
+
+    def _enqueue(self, name, front=False):
+        # Called with the lock held (or before the thread starts)
+        if name in self._queue:
+            return
+        self._status[name] = {'state': PENDING, 'error': None, 'load_ms': None, 'warmup_ms': None}
+        if front:
+            self._queue.insert(0, name)
+        else:
+            self._queue.append(name)
+
+    def _set(self, name, **fields):
+        with self._cond:
+            self._status[name].update(fields)
+            self._cond.notify_all()
+
+    def _load(self, name):
+        try:
+            start = time.perf_counter()
+            if self.prepare is not None:
+                self._set(name, state=DOWNLOADING)
+                self.prepare(name)
+            self._set(name, state=LOADING)
+            with self.registry.acquire(name) as upsampler:
+                loaded = time.perf_counter()
+                self._set(name, state=WARMING, load_ms=round((loaded - start) * 1000, 1))
+                # The first forward pass allocates buffers and picks kernels; pay for it here
+                upsampler.enhance(np.zeros((self.warmup_size, self.warmup_size, 3), dtype=np.uint8))
+                warmup_ms = round((time.perf_counter() - loaded) * 1000, 1)
+            self._set(name, state=READY, warmup_ms=warmup_ms)
+            logger.info(f"Preloaded {name} (load {self._status[name]['load_ms']}ms, warmup {warmup_ms}ms)")
+        except Exception as e:
+            self._set(name, state=FAILED, error=str(e))
+            logger.error(f"Failed to preload {name}: {e}")
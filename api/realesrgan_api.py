@@ -4,48 +4,59 @@ Flask API for Real-ESRGAN Image Enhancement
 Optimized version with caching, rate limiting, and security enhancements
 """
 
+import io
 import os
 import sys
 import cv2
-import base64
 import numpy as np
-import torch
 import redis
+import jwt
 # import magic  # Commented out due to Windows compatibility issues
 import psutil
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context, send_file, url_for, after_this_request
 from flask_cors import CORS, cross_origin
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-import tempfile
-import uuid
+import zipfile
+import time
 from datetime import datetime
 import logging
-from functools import lru_cache
-import hashlib
+from contextlib import contextmanager
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('api.log'),
-        logging.StreamHandler()
-    ]
-)
+# Configure logging: written from a background thread, as JSON lines unless LOG_FORMAT=text
+import logs
+logs.configure('api.log')
 logger = logging.getLogger(__name__)
 
-# Add Real-ESRGAN path
-sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'REAL-ESRGAN'))
-
-from basicsr.archs.rrdbnet_arch import RRDBNet
-from realesrgan import RealESRGANer
-from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+import metrics
+import tracing
+from admission import AdmissionRejected, TOO_LARGE, admitted, estimate_cost, estimate_peak_memory
+from cancellation import REQUEST_DEADLINE, JOB_DEADLINE, DEADLINE, CancelToken, Cancelled, disconnect_poll
+from capture import TrafficCapture
+from content_store import ContentStore, valid_key
+from batch import (BATCH_MAX_ITEMS, is_archive, detach_stream, archive_members, iter_archive, iter_uploads, run_pipelined,
+                   stream_zip, stream_ndjson)
+from deepzoom import DEEPZOOM_OVERLAP, DEEPZOOM_TILE_SIZE, DeepZoom, render_region
+from image_io import StageTimer, UploadBuffer, OutputFormat, decode_image, encode_async, bytes_to_base64
+from image_probe import check_image_info, probe_image
+from model_config import MODEL_CONFIG, DEFAULT_MODEL, ModelLoadError, ModelNotReady
+from model_router import AUTO_MODEL, ContentRouter, cheapest_model, CONTENTS
+from preloader import FAILED
+from scheduler import SCHEDULER_USER_WEIGHT
+from singleflight import LEADER, SingleFlight, content_key, flight_key
+from latency_model import work_of
+from slo import FULL, SLO_MS, Tier, select_tier, observe_latency
+from jobs import Job, JobStore, JobQueueFull, JOB_ADMISSION_WAIT, sse_event
+from jobs import DONE as JOB_DONE, CANCELLED as JOB_CANCELLED
+from shm_transport import MODEL_SERVER_ADDRESS, RemoteInference, ModelServerUnavailable
+from uploads import (MAX_UPLOAD_SIZE, RESUMABLE_CHUNK_SIZE, IngestRequest, ResumableUploads, UploadConflict,
+                     UploadRejected)
 
 app = Flask(__name__)
 
@@ -71,310 +82,1233 @@ limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri=f"redis://{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', 6379)}" if redis_client else "memory://"
+    storage_uri=f"redis://{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', 6379)}" if redis_client else "memory://",
+    # RATELIMIT_ENABLED=false for load tests (api/benchmarks/loadtest.py) against a local server
+    enabled=os.getenv('RATELIMIT_ENABLED', 'true').lower() != 'false'
 )
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
-MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+MAX_FILE_SIZE = MAX_UPLOAD_SIZE  # 10MB unless MAX_UPLOAD_MB is set
+# Shared with auth_api.py: signed-in users are scheduled by user instead of by IP
+JWT_SECRET = os.getenv('JWT_SECRET', 'your-secret-key-change-this-in-production')
 
 # Create directories
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-# Initialize Real-ESRGAN models
-models = {}
-current_model = None
-
-# Available models configuration
-MODEL_CONFIG = {
-    'RealESRGAN_x4plus': {
-        'model': lambda: RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4),
-        'scale': 4,
-        'url': 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth',
-        'description': 'General purpose 4x upscaling model'
-    },
-    'RealESRGAN_x4plus_anime_6B': {
-        'model': lambda: RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4),
-        'scale': 4,
-        'url': 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.2.4/RealESRGAN_x4plus_anime_6B.pth',
-        'description': 'Optimized for anime/illustrations (faster)'
-    },
-    'RealESRNet_x4plus': {
-        'model': lambda: RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4),
-        'scale': 4,
-        'url': 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.1/RealESRNet_x4plus.pth',
-        'description': 'Clean upscaling without artifacts'
-    },
-    'realesr-general-x4v3': {
-        'model': lambda: SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=32, upscale=4, act_type='prelu'),
-        'scale': 4,
-        'url': 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-x4v3.pth',
-        'description': 'Latest model with denoise control (RECOMMENDED)'
-    },
-    'RealESRGAN_x2plus': {
-        'model': lambda: RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2),
-        'scale': 2,
-        'url': 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth',
-        'description': '2x upscaling model'
-    }
-}
-
-def detect_device():
-    """Detect best available device for inference"""
-    if torch.cuda.is_available():
-        device_count = torch.cuda.device_count()
-        print(f"🚀 CUDA detected! Available GPUs: {device_count}")
-        for i in range(device_count):
-            gpu_name = torch.cuda.get_device_name(i)
-            print(f"   GPU {i}: {gpu_name}")
-        return 0  # Use first GPU
+class UploadRequest(IngestRequest):
+    """Uploads are hashed, probed and spooled while the body is parsed; rejected ones are not kept"""
+    image_extensions = ALLOWED_EXTENSIONS
+    max_file_size = MAX_FILE_SIZE
+    spill_dir = UPLOAD_FOLDER
+
+app.request_class = UploadRequest
+
+# Every request is a trace (see tracing.py), continuing the caller's from a traceparent header
+TRACE_IGNORED_PATHS = {'/metrics', '/api/ready', '/api/health'}
+
+@app.before_request
+def start_request_trace():
+    if request.path in TRACE_IGNORED_PATHS:
+        return
+    route = request.url_rule.rule if request.url_rule else request.path
+    g.trace_span = tracing.start_trace(f'{request.method} {route}',
+                                       parent=tracing.parse_traceparent(request.headers.get('traceparent')),
+                                       kind=tracing.SERVER,
+                                       **{'http.method': request.method, 'http.route': route,
+                                          'http.target': request.path})
+
+@app.after_request
+def add_trace_header(response):
+    span = g.get('trace_span')
+    if span is not None:
+        span.set(**{'http.status_code': response.status_code})
+        response.headers['X-Trace-Id'] = span.trace.trace_id
+        if response.is_streamed:
+            # A streamed response (batch results, files) is done once its body is
+            response.response = traced_body(response.response, span)
+            g.trace_span = None
+    return response
+
+def traced_body(body, span):
+    try:
+        yield from body
+    finally:
+        span.end()
+
+@app.teardown_request
+def end_request_trace(error):
+    span = g.pop('trace_span', None)
+    if span is not None:
+        if error is not None:
+            span.fail(error)
+        span.end()
+
+# Inference backend: a separate model server process when MODEL_SERVER_ADDRESS is set
+# (so several HTTP workers share one copy of every model), otherwise in this process
+if MODEL_SERVER_ADDRESS:
+    inference = RemoteInference(MODEL_SERVER_ADDRESS)
+else:
+    from inference import LocalInference
+    inference = LocalInference()
+metrics.register_backend(inference)
+
+# Background jobs; results go to OUTPUT_FOLDER so every worker process can serve them
+jobs = JobStore(os.path.join(OUTPUT_FOLDER, 'jobs'))
+
+# model=auto picks the cheapest model suited to each image's content
+router = ContentRouter()
+
+# Resumable chunked uploads, also on disk so any worker process can take the next chunk
+resumable_uploads = ResumableUploads(os.path.join(UPLOAD_FOLDER, 'resumable'))
+
+# Sources and results by content hash, for hash-first uploads (see HASH-FIRST-UPLOAD-GUIDE.md)
+content_store = ContentStore()
+# 'tenant': clients only get back sources and results of their own uploads by hash, so
+# a hash cannot tell whether someone else uploaded an image; 'global' shares them all
+CONTENT_STORE_SCOPE = os.getenv('CONTENT_STORE_SCOPE', 'tenant')
+
+# Identical concurrent enhance requests share one inference; across worker processes
+# through Redis (with its own client, as results are binary), else within this process
+flights = SingleFlight(redis.Redis(
+    host=os.getenv('REDIS_HOST', 'localhost'),
+    port=int(os.getenv('REDIS_PORT', 6379)),
+    db=0
+) if redis_client else None)
+
+# Requests are recorded for benchmarks/replay.py when CAPTURE_ENABLED is set (see capture.py)
+traffic = TrafficCapture()
+
+def enhance_crop(crop, model_name, tenant=None, cancel=None):
+    """Enhance part of an image at the model's network scale, for deep-zoom tiles and regions"""
+    tenant_name, weight = tenant or (None, 1.0)
+    channels = 1 if crop.ndim == 2 else crop.shape[2]
+    cost = estimate_cost(crop.shape[1], crop.shape[0], model_name)
+    memory = estimate_peak_memory(crop.shape[1], crop.shape[0], channels, model_name,
+                                  bit_depth=crop.dtype.itemsize * 8)
+    work = work_of(model_name, crop.shape[1], crop.shape[0], passes=2 if channels == 4 else 1)
+    with admitted(inference, cost, memory, cancel=cancel, work=work):
+        result = inference.enhance(crop, model_name, tenant=tenant_name, weight=weight, cancel=cancel)
+        with result:
+            # The result may live in a shared memory block that release() unmaps
+            return result.image.copy()
+
+# Deep-zoom pyramids, rendered a tile at a time as viewers ask for them
+deepzoom = DeepZoom(os.path.join(OUTPUT_FOLDER, 'deepzoom'), enhance_crop, flights)
+
+def model_not_ready_response(model_name, status):
+    """Error response for a model that failed or is still loading"""
+    if status['state'] == FAILED:
+        return jsonify({'error': f'Failed to load model: {model_name}', 'detail': status.get('error')}), 500
+    response = jsonify({'error': f'Model is still loading: {model_name}', 'state': status['state']})
+    response.headers['Retry-After'] = '10'
+    return response, 503
+
+def allowed_file(filename):
+    """Check if file extension is allowed"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def validate_image_file(file):
+    """Validate an uploaded image's extension, size and header, without decoding it.
+    
+    The size and header were checked while the request body was streamed in
+    (see UploadRequest). Returns the probed ImageInfo (None if invalid), an error
+    message and its HTTP status.
+    """
+    if not allowed_file(file.filename):
+        return None, 'Invalid file type', 400
+    
+    stream = file.stream
+    if stream.rejection is not None:
+        message, status = stream.rejection
+        return None, message, status
+    error = check_image_info(stream.info)
+    if error is not None:
+        message, status = error
+        return None, message, status
+    return stream.info, 'OK', 200
+
+def request_image_file():
+    """The image of the current request: the ``image`` file, a finished resumable ``upload_id``
+    or, for a hash-first upload, the ``sha256`` of an image in the content store.
+    
+    Returns the file (a FileStorage) and None, or None and an error response. A hash
+    the store does not have answers 404 with ``upload_required``.
+    """
+    upload_id = request.form.get('upload_id')
+    sha256 = request.form.get('sha256', '').lower()
+    if upload_id:
+        stream = resumable_uploads.open(upload_id)
+        if stream is None:
+            upload = resumable_uploads.status(upload_id)
+            if upload is None:
+                return None, (jsonify({'error': 'Upload not found'}), 404)
+            return None, (jsonify({'error': 'Upload is not complete', 'offset': upload['offset']}), 409)
+    elif sha256 and 'image' not in request.files:
+        stream = content_store.open_source(store_key(sha256, 'source'), request.form.get('filename'))
+        metrics.CONTENT_STORE_LOOKUPS.labels('source' if stream is not None else 'miss').inc()
+        if stream is None:
+            return None, (jsonify({'error': 'Image not on the server, upload it', 'upload_required': True}), 404)
     else:
-        print("⚠️  CUDA not available, using CPU (will be slower)")
+        stream = None
+    if stream is not None:
+        file = FileStorage(stream, stream.filename, 'image')
+        
+        @after_this_request
+        def close_upload(response):
+            file.close()
+            return response
+        return file, None
+    
+    # Check if file is in request
+    if 'image' not in request.files:
+        return None, (jsonify({'error': 'No image file provided'}), 400)
+    file = request.files['image']
+    if file.filename == '':
+        return None, (jsonify({'error': 'No file selected'}), 400)
+    return file, None
+
+def store_key(sha256, *params):
+    """Content store key of the image with SHA-256 ``sha256`` and ``params``, in CONTENT_STORE_SCOPE"""
+    scope = request_tenant()[0] if CONTENT_STORE_SCOPE == 'tenant' else None
+    return content_key(sha256, scope, *params) if valid_key(sha256) else None
+
+def request_sha256():
+    """SHA-256 of the current request's image: of the upload, or the hash-first ``sha256`` field.
+    
+    None when it is not known yet (an unfinished resumable upload).
+    """
+    upload_id = request.form.get('upload_id')
+    if upload_id:
+        upload = resumable_uploads.status(upload_id)
+        return upload and upload['sha256']
+    if 'image' in request.files:
+        return request.files['image'].stream.sha256
+    return request.form.get('sha256', '').lower() or None
+
+def request_result_key():
+    """Content store key of the /api/enhance result asked for, or None.
+    
+    Made from the fields as sent (model=auto included), so a result is found before
+    the image is probed or routed, or even uploaded.
+    """
+    sha256 = request_sha256()
+    if sha256 is None:
+        return None
+    try:
+        scale = request.form.get('scale')
+        output_format = OutputFormat.from_form(request.form)
+    except ValueError:
         return None
+    return store_key(sha256, 'enhance', request.form.get('model', DEFAULT_MODEL), float(scale) if scale else None,
+                     output_format.to_dict())
 
-def init_realesrgan(model_name='realesr-general-x4v3'):
-    """Initialize Real-ESRGAN model with CUDA optimization"""
-    global models, current_model
+def request_model(data, info):
+    """The ``model`` field: a MODEL_CONFIG name, or 'auto' to route by the content of ``data``.
     
-    if model_name in models:
-        current_model = model_name
-        print(f"✅ Switched to model: {model_name}")
-        return True
+    ``data`` is the encoded image and ``info`` its ImageInfo. Returns the model name
+    and the RoutingDecision (None unless routed); raises ValueError for an unknown model.
+    """
+    model_name = request.form.get('model', DEFAULT_MODEL)
+    if model_name == AUTO_MODEL:
+        scale = request.form.get('scale')
+        routing = router.route(data, info.width, info.height, outscale=float(scale) if scale else None)
+        return routing.model_name, routing
+    if model_name not in MODEL_CONFIG:
+        raise ValueError(f'Unknown model: {model_name}')
+    return model_name, None
+
+def admission_rejected_response(error):
+    """413 for a request too large to ever fit, 429 with Retry-After when the server is busy"""
+    if error.reason == TOO_LARGE:
+        return jsonify({'error': 'Image too large to process'}), 413
+    response = jsonify({'error': 'Server busy, please retry later', 'retry_after': error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
+def request_slo(endpoint):
+    """Latency SLO of the current request in ms: ``max_latency_ms`` if given, else the endpoint's"""
+    value = request.form.get('max_latency_ms')
+    if not value:
+        return SLO_MS[endpoint]
+    try:
+        slo_ms = int(value)
+    except ValueError:
+        slo_ms = 0
+    if slo_ms <= 0:
+        raise ValueError('max_latency_ms must be a positive integer')
+    return slo_ms
+
+def request_deadline(default):
+    """Seconds the current request may run: ``deadline_ms`` if given, never more than ``default``"""
+    value = request.form.get('deadline_ms')
+    if not value:
+        return default
+    try:
+        deadline_ms = int(value)
+    except ValueError:
+        deadline_ms = 0
+    if deadline_ms <= 0:
+        raise ValueError('deadline_ms must be a positive integer')
+    return min(deadline_ms / 1000, default) if default else deadline_ms / 1000
+
+def cancelled_response(error):
+    """504 when the request ran out of time; 499 (client closed request) when the client went away"""
+    if error.reason == DEADLINE:
+        return jsonify({'error': 'Deadline exceeded', 'tiles_done': error.tiles}), 504
+    return jsonify({'error': f'Request {error.reason}'}), 499
+
+def tier_info(tier, estimated_ms, slo_ms):
+    """Response fields describing the quality tier a request was served at"""
+    return dict(tier.to_dict(), estimated_ms=estimated_ms, slo_ms=slo_ms or None)
+
+def enhanced_response(enhanced_bytes, served, timer, **fields):
+    """/api/enhance answer: the encoded result as base64 and how it was served"""
+    with timer.stage('base64'):
+        enhanced_base64 = bytes_to_base64(enhanced_bytes)
+    return jsonify(dict(
+        served,
+        success=True,
+        enhanced_image=enhanced_base64,
+        enhanced_size=len(enhanced_bytes),
+        device=inference.device_info()['device'],
+        processing_time='completed',
+        timings=timer.breakdown(),
+        **fields
+    ))
+
+FAILURE_STATUS = {ModelNotReady: 'not_ready', ModelLoadError: 'load_failed', ModelServerUnavailable: 'unavailable',
+                  AdmissionRejected: 'rejected'}
+
+@contextmanager
+def captured(endpoint, info, data, tenant, timer, **fields):
+    """Record the request served in the block for replay, when traffic capture is on.
     
+    ``data`` is the encoded upload and ``fields`` the parameters asked for. Yields a dict
+    for what is only known once the request is served (tier, output size, ...); its
+    'outcome' is 'ok' unless the block sets it or raises. The latency is ``timer``'s.
+    """
+    served = {}
+    if not traffic.enabled:
+        yield served
+        return
+    outcome = 'ok'
     try:
-        # Get model configuration
-        if model_name not in MODEL_CONFIG:
-            print(f"❌ Unknown model: {model_name}")
-            return False
-            
-        config = MODEL_CONFIG[model_name]
-        model = config['model']()
-        
-        # Check for local model file first
-        weights_dir = os.path.join(os.path.dirname(__file__), '..', 'Real-ESRGAN', 'weights')
-        os.makedirs(weights_dir, exist_ok=True)
-        model_path = os.path.join(weights_dir, f'{model_name}.pth')
-        
-        # Download model if not exists
-        if not os.path.exists(model_path):
-            print(f"📥 Downloading {model_name} model...")
-            import urllib.request
-            urllib.request.urlretrieve(config['url'], model_path)
-            print(f"✅ Model downloaded: {model_path}")
-        
-        # Detect best device
-        gpu_id = detect_device()
-        use_half = gpu_id is not None  # Use fp16 only with GPU
-        
-        # Initialize upsampler with CUDA optimization
-        upsampler = RealESRGANer(
-            scale=config['scale'],
-            model_path=model_path,
-            model=model,
-            tile=512 if gpu_id is not None else 256,  # Larger tiles for GPU
-            tile_pad=10,
-            pre_pad=0,
-            half=use_half,  # Use fp16 for GPU, fp32 for CPU
-            gpu_id=gpu_id  # Auto-detect GPU or use CPU
-        )
-        
-        models[model_name] = upsampler
-        current_model = model_name
-        
-        device_info = f"GPU {gpu_id}" if gpu_id is not None else "CPU"
-        precision = "fp16" if use_half else "fp32"
-        print(f"✅ {model_name} initialized successfully on {device_info} ({precision})")
-        return True
-        
+        yield served
+    except Cancelled as e:
+        outcome = e.reason
+        raise
     except Exception as e:
-        print(f"❌ Error initializing {model_name}: {e}")
-        return False
+        outcome = FAILURE_STATUS.get(type(e), 'error')
+        raise
+    finally:
+        traffic.record(endpoint, info, served.pop('outcome', outcome), timer.elapsed_ms(), data=data,
+                       tenant=tenant[0], **fields, **served)
 
-def allowed_file(filename):
-    """Check if file extension is allowed"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def estimate_latency_ms(info, model_name, outscale):
+    """Predicted ms until a full-quality request for an image would be done, queue included.
+    
+    None until the backend can predict run times, or while it is unreachable.
+    """
+    try:
+        estimates = inference.estimate_latency([Tier(FULL, model_name, outscale).work(info)])
+    except ModelServerUnavailable:
+        return None
+    return None if estimates is None else round(estimates[0] * 1000, 1)
+
+def request_tenant():
+    """Scheduling tenant and weight of the current request: the signed-in user, else the client IP"""
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        try:
+            payload = jwt.decode(auth[len('Bearer '):], JWT_SECRET, algorithms=['HS256'])
+            if payload.get('user_id') is not None:
+                return f"user:{payload['user_id']}", SCHEDULER_USER_WEIGHT
+        except jwt.InvalidTokenError:
+            pass
+    return f'ip:{get_remote_address()}', 1.0
+
+def model_server_unavailable_response(error):
+    """Error response for when the model server cannot be reached"""
+    logger.error(f"❌ {error}")
+    response = jsonify({'error': 'Model server unavailable'})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+# Inference failures a client can act on; each has its own response (see inference_error_response)
+INFERENCE_ERRORS = (ModelNotReady, ModelLoadError, AdmissionRejected, ModelServerUnavailable, Cancelled)
+
+def inference_error_response(error, model_name, timer, endpoint):
+    """Error response for one of INFERENCE_ERRORS raised while ``endpoint`` ran ``model_name``.
+    
+    Rejections and cancellations are recorded with the time ``timer`` has run.
+    """
+    # The model the error is about, when it is not the one asked for (e.g. a cheaper tier)
+    model_name = getattr(error, 'model_name', None) or model_name
+    if isinstance(error, ModelNotReady):
+        return model_not_ready_response(model_name, error.status)
+    if isinstance(error, ModelLoadError):
+        logger.error(f"❌ Error initializing {model_name}: {error}")
+        return jsonify({'error': f'Failed to load model: {model_name}'}), 500
+    if isinstance(error, AdmissionRejected):
+        metrics.observe_request(model_name, 'rejected', {}, timer.elapsed_ms())
+        return admission_rejected_response(error)
+    if isinstance(error, ModelServerUnavailable):
+        return model_server_unavailable_response(error)
+    logger.info(f"⏹️ {endpoint} {error.reason} after {error.tiles} tiles")
+    metrics.observe_cancelled(endpoint, model_name, error, timer.elapsed_ms())
+    return cancelled_response(error)
 
-def image_to_base64(image_path):
-    """Convert image to base64 string"""
-    with open(image_path, "rb") as img_file:
-        return base64.b64encode(img_file.read()).decode('utf-8')
+def read_upload(file, timer):
+    """Read and decode an uploaded image (spilled to disk only above the threshold).
+    
+    Returns the image (None if it cannot be decoded), the upload size and whether it spilled.
+    """
+    with timer.stage('read'), UploadBuffer(file, spill_dir=UPLOAD_FOLDER) as upload:
+        with timer.stage('decode'):
+            img = decode_image(upload.data)
+        return img, upload.size, upload.spilled
 
-def base64_to_image(base64_string, output_path):
-    """Convert base64 string to image file"""
-    image_data = base64.b64decode(base64_string)
-    with open(output_path, 'wb') as f:
-        f.write(image_data)
+def enhance_decoded(img, tier, timer, progress=None, tenant=None, output_format=None, cancel=None):
+    """Run a decoded image through the inference backend at a quality tier and encode the result.
+    
+    Stage timings are added to ``timer`` and tile progress is reported to
+    ``progress(done, total)``. ``tenant`` is a (name, weight) pair from
+    request_tenant(). The result is encoded as ``output_format`` (PNG by default)
+    on the encode pool. A ``cancel`` token stops the inference between tiles.
+    Returns the encoded bytes and the output width, height and tile count.
+    """
+    model_name = tier.model_name
+    tenant_name, weight = tenant or (None, 1.0)
+    if tier.prescale < 1:
+        with timer.stage('prescale'):
+            img = cv2.resize(img, None, fx=tier.prescale, fy=tier.prescale, interpolation=cv2.INTER_AREA)
+    metrics.QUEUE_DEPTH.inc()
+    try:
+        # The backend's own stages are spans within this one
+        with timer.stage('dispatch', model=model_name, tier=tier.name, width=img.shape[1], height=img.shape[0]):
+            result = inference.enhance(img, model_name, outscale=tier.network_outscale, progress=progress,
+                                       tenant=tenant_name, weight=weight, tile_scale=tier.tile_scale,
+                                       cancel=cancel)
+    except (ModelNotReady, ModelLoadError, ModelServerUnavailable) as e:
+        metrics.observe_request(model_name, FAILURE_STATUS[type(e)], {}, timer.elapsed_ms())
+        raise
+    finally:
+        metrics.QUEUE_DEPTH.dec()
+    
+    with result:
+        # Time spent outside the backend's own stages is transport overhead
+        timer.merge(result.timings)
+        timer.stages['dispatch'] -= sum(result.timings.values())
+        info = {
+            'width': result.image.shape[1],
+            'height': result.image.shape[0],
+            'tiles': result.info.get('tiles', 0)
+        }
+        
+        # Encode enhanced image in memory, off the request thread; the result buffer
+        # stays mapped until the encode is done
+        with timer.stage('encode'):
+            enhanced_bytes = encode_async(result.image, output_format or OutputFormat()).result()
+    return enhanced_bytes, info
 
 @app.route('/api/health', methods=['GET'])
 @limiter.limit("10 per minute")
 def health_check():
     """Health check endpoint"""
+    try:
+        snapshot = inference.snapshot()
+        device_info = inference.device_info()
+    except ModelServerUnavailable as e:
+        return model_server_unavailable_response(e)
     return jsonify({
         'status': 'healthy',
-        'model_loaded': len(models) > 0,
-        'current_model': current_model,
-        'cuda_available': torch.cuda.is_available(),
+        'model_loaded': len(snapshot['slots']) > 0,
+        'default_model': DEFAULT_MODEL,
+        'models': snapshot,
+        'cuda_available': device_info['cuda_available'],
+        'model_server': MODEL_SERVER_ADDRESS or None,
         'timestamp': datetime.now().isoformat()
     })
 
+@app.route('/api/ready', methods=['GET'])
+@limiter.exempt
+def readiness_check():
+    """Readiness endpoint: 200 once every preloaded model is loaded and warmed up"""
+    try:
+        ready, model_states = inference.readiness()
+    except ModelServerUnavailable as e:
+        return model_server_unavailable_response(e)
+    return jsonify({
+        'ready': ready,
+        'models': model_states,
+        'timestamp': datetime.now().isoformat()
+    }), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt
+def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    body = metrics.render()
+    if body is None:
+        return jsonify({'error': 'prometheus_client is not installed'}), 503
+    return Response(body, content_type=metrics.CONTENT_TYPE_LATEST)
+
 @app.route('/api/enhance', methods=['POST'])
 @cross_origin()
 @limiter.limit("5 per minute")
 def enhance_image():
-    """Enhance image using Real-ESRGAN"""
-    global models, current_model
-    
-    if not models or current_model not in models:
-        return jsonify({'error': 'Model not initialized'}), 500
-    
-    upsampler = models[current_model]
+    """Enhance image using Real-ESRGAN.
     
+    Send the image as the ``image`` file, or the ``upload_id`` of a finished resumable upload.
+    Hash-first clients send just its ``sha256`` and upload the file only if asked to
+    (404 with ``upload_required``); see HASH-FIRST-UPLOAD-GUIDE.md.
+    """
     try:
-        # Check if file is in request
-        if 'image' not in request.files:
-            return jsonify({'error': 'No image file provided'}), 400
-        
-        file = request.files['image']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
+        # A result made before for this image and these fields is answered straight away
+        result_key = request_result_key()
+        stored = content_store.get_result(result_key) if result_key else None
+        if stored is not None:
+            metrics.CONTENT_STORE_LOOKUPS.labels('result').inc()
+            enhanced_bytes, served = stored
+            return enhanced_response(enhanced_bytes, served, StageTimer(), coalesced=False, cached=True)
         
-        is_valid, message = validate_image_file(file)
-        if not is_valid:
-            return jsonify({'error': message}), 400
+        file, error = request_image_file()
+        if error is not None:
+            return error
         
-        # Get enhancement parameters
-        requested_model = request.form.get('model', current_model)
-        scale = float(request.form.get('scale', MODEL_CONFIG[current_model]['scale']))
+        # Dimensions come from the header, before anything is decoded
+        info, message, status = validate_image_file(file)
+        if info is None:
+            return jsonify({'error': message}), status
         
-        # Switch model if requested
-        if requested_model != current_model and requested_model in MODEL_CONFIG:
-            if not init_realesrgan(requested_model):
-                return jsonify({'error': f'Failed to load model: {requested_model}'}), 500
-            upsampler = models[current_model]
+        try:
+            # Get enhancement parameters (the model is chosen per request, or routed by content)
+            model_name, routing = request_model(file.stream.as_array(), info)
+            scale = float(request.form.get('scale', MODEL_CONFIG[model_name]['scale']))
+            output_format = OutputFormat.from_form(request.form)
+            slo_ms = request_slo('enhance')
+            deadline = request_deadline(REQUEST_DEADLINE)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Generate unique filename
-        unique_id = str(uuid.uuid4())
-        input_filename = f"{unique_id}_input.png"
-        output_filename = f"{unique_id}_output.png"
+        timer = StageTimer()
+        tenant = request_tenant()
+        # Stops the inference between tiles once the deadline passes or the client hangs up
+        cancel = CancelToken.after(deadline, poll=disconnect_poll(request.environ))
         
-        input_path = os.path.join(UPLOAD_FOLDER, input_filename)
-        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
-        
-        # Save uploaded file
-        file.save(input_path)
+        def compute():
+            # Degrade to a cheaper tier if the work queued ahead would make this request miss its SLO
+            tier, estimated_ms = select_tier(inference, info, model_name, scale, slo_ms, 'enhance')
+            cost, memory = tier.estimate(info)
+            with admitted(inference, cost, memory, timer=timer, cancel=cancel, work=tier.work(info)):
+                img, original_size, spilled = read_upload(file, timer)
+                if img is None:
+                    return None
+                
+                # Enhance image
+                logger.info(f"Enhancing image: {secure_filename(file.filename)} ({img.shape[1]}x{img.shape[0]}) "
+                            f"at tier {tier.name} with {tier.model_name}",
+                            extra={'event': 'request', 'model': tier.model_name, 'tier': tier.name,
+                                   'width': img.shape[1], 'height': img.shape[0]})
+                enhanced_bytes, output = enhance_decoded(img, tier, timer, tenant=tenant, output_format=output_format,
+                                                         cancel=cancel)
+            
+            metrics.observe_request(tier.model_name, 'ok', timer.stages, timer.elapsed_ms(),
+                                    tiles=output['tiles'], output_pixels=output['width'] * output['height'])
+            observe_latency('enhance', tier, slo_ms, timer.elapsed_ms())
+            return enhanced_bytes, {
+                'model_used': tier.model_name,
+                'scale': tier.outscale,
+                'tier': tier_info(tier, estimated_ms, slo_ms),
+                'original_size': original_size,
+                'disk_io': {'spilled': spilled, 'round_trips': 2 if spilled else 0}
+            }
         
-        # Read and process image
-        img = cv2.imread(input_path, cv2.IMREAD_UNCHANGED)
-        if img is None:
+        try:
+            # Requests for the same image and parameters already in flight share its result
+            key = flight_key(file.stream, 'enhance', model_name, scale, output_format.to_dict(), slo_ms)
+            with captured('enhance', info, file.stream.as_array(), tenant, timer, output_format=output_format.to_dict(),
+                          slo_ms=slo_ms, model=request.form.get('model', DEFAULT_MODEL),
+                          scale=scale if 'scale' in request.form else None) as capture:
+                started = time.perf_counter()
+                result, source = flights.run(key, compute, cancel=cancel)
+                if source != LEADER:
+                    timer.record('coalesced', started)
+                    metrics.COALESCED.labels(source).inc()
+                if result is None:
+                    capture['outcome'] = 'unreadable'
+                else:
+                    capture.update(served_model=result[1]['model_used'], tier=result[1]['tier']['name'],
+                                   coalesced=source != LEADER, timings=timer.breakdown())
+        except INFERENCE_ERRORS as e:
+            return inference_error_response(e, model_name, timer, 'enhance')
+        if result is None:
             return jsonify({'error': 'Could not read image file'}), 400
+        enhanced_bytes, served = result
+        served = dict(served, output_format=output_format.to_dict())
+        if routing is not None:
+            served['routing'] = routing.to_dict()
         
-        # Enhance image
-        print(f"Enhancing image: {input_filename}")
-        enhanced_img, _ = upsampler.enhance(img, outscale=scale)
-        
-        # Save enhanced image
-        cv2.imwrite(output_path, enhanced_img)
+        # Kept for requests that send only the image's hash; a degraded result is not
+        # what the next request for this image asks for
+        with timer.stage('store'):
+            content_store.put_source(store_key(file.stream.sha256, 'source'), file.stream.as_array(),
+                                     file.stream.sha256, info)
+            if result_key and not served['tier']['degraded']:
+                content_store.put_result(result_key, enhanced_bytes, served)
         
-        # Convert to base64 for response
-        enhanced_base64 = image_to_base64(output_path)
-        
-        # Get file sizes
-        original_size = os.path.getsize(input_path)
-        enhanced_size = os.path.getsize(output_path)
-        
-        # Clean up files
-        os.remove(input_path)
-        os.remove(output_path)
-        
-        return jsonify({
-            'success': True,
-            'enhanced_image': enhanced_base64,
-            'model_used': current_model,
-            'scale': scale,
-            'original_size': original_size,
-            'enhanced_size': enhanced_size,
-            'device': 'GPU' if torch.cuda.is_available() else 'CPU',
-            'processing_time': 'completed'
-        })
+        return enhanced_response(enhanced_bytes, served, timer, coalesced=source != LEADER, cached=False)
         
     except Exception as e:
-        print(f"Enhancement error: {e}")
+        logger.exception(f"Enhancement error: {e}")
         return jsonify({'error': f'Enhancement failed: {str(e)}'}), 500
 
+@app.route('/api/deepzoom', methods=['POST'])
+@cross_origin()
+@limiter.limit("10 per minute")
+def create_deepzoom():
+    """Publish an image as a Deep Zoom pyramid of its enhanced result.
+    
+    Takes the ``image`` file (or ``upload_id``), ``model`` and the tile ``format``
+    (jpeg by default). Nothing is enhanced yet: point a DZI viewer such as
+    OpenSeadragon at ``dzi_url`` and tiles are rendered as it asks for them.
+    """
+    file, error = request_image_file()
+    if error is not None:
+        return error
+    info, message, status = validate_image_file(file)
+    if info is None:
+        return jsonify({'error': message}), status
+    
+    try:
+        model_name, _ = request_model(file.stream.as_array(), info)
+        output_format = OutputFormat(request.form.get('format', 'jpeg').lower())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Content-addressed: publishing the same image again reuses the tiles already rendered
+    pyramid_id = flight_key(file.stream, 'deepzoom', model_name, output_format.name, DEEPZOOM_TILE_SIZE,
+                            DEEPZOOM_OVERLAP)[:32]
+    pyramid = deepzoom.get(pyramid_id)
+    status = 200
+    if pyramid is None:
+        timer = StageTimer()
+        img, _, _ = read_upload(file, timer)
+        if img is None:
+            return jsonify({'error': 'Could not read image file'}), 400
+        pyramid = deepzoom.create(img, pyramid_id, model_name, MODEL_CONFIG[model_name]['scale'],
+                                  output_format.name)
+        status = 201
+        logger.info(f"Published deep zoom {pyramid_id}: {secure_filename(file.filename)} "
+                    f"({img.shape[1]}x{img.shape[0]}) with {model_name} in {timer.elapsed_ms():.0f}ms",
+                    extra={'event': 'request', 'model': model_name, 'width': img.shape[1], 'height': img.shape[0]})
+    
+    dzi_url = url_for('deepzoom_dzi', pyramid_id=pyramid.id)
+    width, height = pyramid.level_size(pyramid.max_level)
+    response = jsonify(dict(
+        pyramid.to_dict(),
+        dzi_url=dzi_url,
+        tiles_url=f'{dzi_url[:-len(".dzi")]}_files/',
+        levels=pyramid.max_level + 1,
+        enhanced_width=width,
+        enhanced_height=height
+    ))
+    response.headers['Location'] = dzi_url
+    return response, status
+
+@app.route('/api/deepzoom/<pyramid_id>.dzi', methods=['GET'])
+@cross_origin()
+@limiter.limit("120 per minute")
+def deepzoom_dzi(pyramid_id):
+    """Deep Zoom descriptor of a published pyramid"""
+    pyramid = deepzoom.get(pyramid_id)
+    if pyramid is None:
+        return jsonify({'error': 'Pyramid not found'}), 404
+    return Response(pyramid.to_dzi(), mimetype='application/xml')
+
+@app.route('/api/deepzoom/<pyramid_id>_files/<int:level>/<int:col>_<int:row>.<ext>', methods=['GET'])
+@cross_origin()
+@limiter.limit("1200 per minute")
+def deepzoom_tile(pyramid_id, level, col, row, ext):
+    """One tile of a pyramid, rendered on first request; its neighbours are rendered ahead"""
+    pyramid = deepzoom.get(pyramid_id)
+    if pyramid is None or ext != pyramid.ext:
+        return jsonify({'error': 'Tile not found'}), 404
+    
+    timer = StageTimer()
+    # A viewer drops tiles that scroll out of view before they arrive; stop rendering those
+    cancel = CancelToken.after(REQUEST_DEADLINE, poll=disconnect_poll(request.environ))
+    try:
+        data = deepzoom.tile(pyramid, level, col, row, tenant=request_tenant(), cancel=cancel)
+    except INFERENCE_ERRORS as e:
+        return inference_error_response(e, pyramid.model_name, timer, 'deepzoom')
+    if data is None:
+        return jsonify({'error': 'Tile not found'}), 404
+    deepzoom.prefetch(pyramid, level, col, row)
+    
+    response = Response(data, mimetype=OutputFormat(pyramid.format).mime)
+    # Pyramid ids are content hashes, so a tile never changes
+    response.headers['Cache-Control'] = 'public, max-age=86400, immutable'
+    return response
+
+def region_rect(form, width, height):
+    """The ``x``, ``y``, ``width`` and ``height`` fields, checked against an image's size"""
+    try:
+        rect = [int(form.get(name, '')) for name in ('x', 'y', 'width', 'height')]
+    except ValueError:
+        raise ValueError('x, y, width and height must be integers') from None
+    x, y, w, h = rect
+    if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > width or y + h > height:
+        raise ValueError(f'Region must lie within the {width}x{height} image')
+    return rect
+
+@app.route('/api/enhance/region', methods=['POST'])
+@cross_origin()
+@limiter.limit("60 per minute")
+def enhance_region():
+    """Enhance one rectangle of an image at the model's scale.
+    
+    ``x``, ``y``, ``width`` and ``height`` are in source pixels. The image is a
+    published ``pyramid_id`` (no upload, only the pixels under the region are read),
+    or the ``image`` file or ``upload_id``. Pixels around the rectangle are used as
+    context, so regions tile together without seams. Answers the encoded image.
+    """
+    timer = StageTimer()
+    pyramid_id = request.form.get('pyramid_id')
+    if pyramid_id:
+        pyramid = deepzoom.get(pyramid_id)
+        if pyramid is None:
+            return jsonify({'error': 'Pyramid not found'}), 404
+        model_name = pyramid.model_name
+        source = deepzoom.source(pyramid)
+    else:
+        file, error = request_image_file()
+        if error is not None:
+            return error
+        info, message, status = validate_image_file(file)
+        if info is None:
+            return jsonify({'error': message}), status
+        try:
+            model_name, _ = request_model(file.stream.as_array(), info)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        source, _, _ = read_upload(file, timer)
+        if source is None:
+            return jsonify({'error': 'Could not read image file'}), 400
+    
+    scale = MODEL_CONFIG[model_name]['scale']
+    try:
+        output_format = OutputFormat.from_form(request.form)
+        x, y, width, height = region_rect(request.form, source.shape[1], source.shape[0])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    cancel = CancelToken.after(REQUEST_DEADLINE, poll=disconnect_poll(request.environ))
+    try:
+        with timer.stage('inference'):
+            img = render_region(source, x * scale, y * scale, width * scale, height * scale, scale, scale,
+                                lambda crop: enhance_crop(crop, model_name, request_tenant(), cancel))
+    except INFERENCE_ERRORS as e:
+        return inference_error_response(e, model_name, timer, 'region')
+    with timer.stage('encode'):
+        data = output_format.encode(img)
+    
+    response = Response(data, mimetype=output_format.mime)
+    response.headers['X-Region'] = f'{x},{y},{width},{height}'
+    response.headers['X-Scale'] = str(scale)
+    return response
+
+@app.route('/api/enhance/batch', methods=['POST'])
+@cross_origin()
+@limiter.limit("2 per minute")
+def enhance_batch():
+    """Enhance many images in one request, streaming results as they finish.
+    
+    Send several ``images`` files or one zip ``archive``. Results come back as a zip
+    with a results.ndjson manifest (``output=zip``, the default) or as NDJSON with one
+    line per image (``output=ndjson``). A failed image does not fail the batch.
+    ``format``, ``quality``, ``compression`` and ``lossless`` choose the image encoding.
+    """
+    model_name = request.form.get('model', DEFAULT_MODEL)
+    # With model=auto every image is routed by its own content
+    auto = model_name == AUTO_MODEL
+    if not auto and model_name not in MODEL_CONFIG:
+        return jsonify({'error': f'Unknown model: {model_name}'}), 400
+    output = request.form.get('output', 'zip')
+    if output not in ('zip', 'ndjson'):
+        return jsonify({'error': 'output must be zip or ndjson'}), 400
+    try:
+        scale = request.form.get('scale')
+        scale = float(scale) if scale else None
+        output_format = OutputFormat.from_form(request.form)
+        slo_ms = request_slo('batch')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    archive_file = request.files.get('archive')
+    files = [file for file in request.files.getlist('images') if file.filename]
+    if archive_file and archive_file.filename:
+        if not is_archive(archive_file.filename):
+            return jsonify({'error': 'Archive must be a .zip file'}), 400
+        try:
+            archive = zipfile.ZipFile(detach_stream(archive_file))
+        except zipfile.BadZipFile:
+            return jsonify({'error': 'Could not read zip archive'}), 400
+        count = len(archive_members(archive))
+        items = iter_archive(archive, ALLOWED_EXTENSIONS, MAX_FILE_SIZE)
+    else:
+        count = len(files)
+        items = iter_uploads([(file.filename, detach_stream(file)) for file in files], ALLOWED_EXTENSIONS,
+                             MAX_FILE_SIZE)
+    
+    if count == 0:
+        return jsonify({'error': 'No images provided'}), 400
+    if count > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'Too many images. Maximum is {BATCH_MAX_ITEMS} per batch'}), 400
+    
+    # Fail fast instead of streaming the same error for every image
+    models = {cheapest_model(content, scale) for content in CONTENTS} | {DEFAULT_MODEL} if auto else {model_name}
+    try:
+        for name in models:
+            inference.preload(name)
+    except (ModelNotReady, ModelServerUnavailable) as e:
+        return inference_error_response(e, model_name, None, 'batch')
+    
+    logger.info(f"Enhancing batch of {count} images with {model_name}",
+                extra={'event': 'request', 'model': model_name, 'images': count})
+    tenant = request_tenant()
+    # Cancelled when the client hangs up, or stops reading the streamed results
+    cancel = CancelToken(poll=disconnect_poll(request.environ))
+    
+    def process(item):
+        info = probe_image(io.BytesIO(item.data))
+        error = check_image_info(info)
+        if error is not None:
+            raise ValueError(error[0])
+        timer = StageTimer()
+        with captured('batch', info, item.data, tenant, timer, model=model_name, scale=scale,
+                      output_format=output_format.to_dict(), slo_ms=slo_ms) as capture:
+            routing = router.route(item.data, info.width, info.height, outscale=scale) if auto else None
+            item_model = routing.model_name if auto else model_name
+            outscale = scale or MODEL_CONFIG[item_model]['scale']
+            tier, estimated_ms = select_tier(inference, info, item_model, outscale, slo_ms, 'batch')
+            cost, memory = tier.estimate(info)
+            try:
+                with admitted(inference, cost, memory, timer=timer, cancel=cancel, work=tier.work(info)):
+                    with timer.stage('decode'):
+                        img = decode_image(np.frombuffer(item.data, dtype=np.uint8))
+                    if img is None:
+                        raise ValueError('Could not read image file')
+                    enhanced_bytes, info = enhance_decoded(img, tier, timer, tenant=tenant,
+                                                           output_format=output_format, cancel=cancel)
+                    del img
+            except Cancelled as e:
+                metrics.observe_cancelled('batch', e.model_name or tier.model_name, e, timer.elapsed_ms())
+                raise
+            metrics.observe_request(tier.model_name, 'ok', timer.stages, timer.elapsed_ms(),
+                                    tiles=info['tiles'], output_pixels=info['width'] * info['height'])
+            observe_latency('batch', tier, slo_ms, timer.elapsed_ms())
+            stem = secure_filename(os.path.splitext(os.path.basename(item.filename))[0]) or 'image'
+            served = {
+                'output': f'{item.index:04d}_{stem}{output_format.ext}',
+                'width': info['width'],
+                'height': info['height'],
+                'enhanced_size': len(enhanced_bytes),
+                'tier': tier_info(tier, estimated_ms, slo_ms),
+                'timings': timer.breakdown()
+            }
+            if routing is not None:
+                served['routing'] = routing.to_dict()
+            capture.update(served_model=tier.model_name, tier=tier.name, timings=served['timings'])
+            return enhanced_bytes, served
+    
+    results = run_pipelined(items, process, cancel=cancel)
+    if output == 'ndjson':
+        return Response(stream_with_context(stream_ndjson(results)), mimetype='application/x-ndjson')
+    response = Response(stream_with_context(stream_zip(results)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename=enhanced.zip'
+    return response
+
+@app.route('/api/jobs', methods=['POST'])
+@cross_origin()
+@limiter.limit("5 per minute")
+def create_job():
+    """Start enhancing an image in the background.
+    
+    Takes the same form fields as /api/enhance and answers 202 straight away.
+    Follow /api/jobs/<id>/events for a preview, progress with an ETA and the result URL.
+    """
+    file, error = request_image_file()
+    if error is not None:
+        return error
+    
+    info, message, status = validate_image_file(file)
+    if info is None:
+        return jsonify({'error': message}), status
+    
+    # Only the encoded upload is kept until the job is admitted, spooled to disk when large;
+    # it is decoded when it runs
+    timer = StageTimer()
+    upload = detach_stream(file)
+    with timer.stage('read'):
+        data = upload.as_array()
+    
+    try:
+        model_name, routing = request_model(data, info)
+        scale = float(request.form.get('scale', MODEL_CONFIG[model_name]['scale']))
+        output_format = OutputFormat.from_form(request.form)
+        slo_ms = request_slo('job')
+        deadline = request_deadline(JOB_DEADLINE)
+    except ValueError as e:
+        upload.close()
+        return jsonify({'error': str(e)}), 400
+    
+    job = Job(model_name, scale, secure_filename(file.filename), deadline=deadline)
+    if not job.emit_preview(data, info.width, info.height):
+        upload.close()
+        return jsonify({'error': 'Could not read image file'}), 400
+    result_path = jobs.result_path(job.id)
+    result_url = url_for('get_job_result', job_id=job.id)
+    tenant = request_tenant()
+    # As asked for, for traffic capture: the job runs outside this request
+    requested = {'model': request.form.get('model', DEFAULT_MODEL),
+                 'scale': scale if 'scale' in request.form else None}
+    
+    def work(job):
+        # The SLO counts from submission, so time spent in the job queue is already used up
+        remaining_ms = max(1, slo_ms - timer.elapsed_ms()) if slo_ms else 0
+        with captured('job', info, data, tenant, timer, output_format=output_format.to_dict(), slo_ms=slo_ms,
+                      **requested) as capture:
+            tier, estimated_ms = select_tier(inference, info, model_name, scale, remaining_ms, 'job')
+            job.expect(estimated_ms)
+            cost, memory = tier.estimate(info)
+            try:
+                with admitted(inference, cost, memory, timeout=JOB_ADMISSION_WAIT, timer=timer, cancel=job.cancel_token,
+                              work=tier.work(info)):
+                    with timer.stage('decode'):
+                        img = decode_image(data)
+                    if img is None:
+                        raise ValueError('Could not read image file')
+                    enhanced_bytes, output = enhance_decoded(img, tier, timer, progress=job.report_progress,
+                                                             tenant=tenant, output_format=output_format,
+                                                             cancel=job.cancel_token)
+                    del img
+            except Cancelled as e:
+                metrics.observe_cancelled('job', e.model_name or tier.model_name, e, timer.elapsed_ms())
+                raise
+            metrics.observe_request(tier.model_name, 'ok', timer.stages, timer.elapsed_ms(),
+                                    tiles=output['tiles'], output_pixels=output['width'] * output['height'])
+            observe_latency('job', tier, slo_ms, timer.elapsed_ms())
+            partial_path = f'{result_path}.part'
+            with open(partial_path, 'wb') as f:
+                f.write(enhanced_bytes)
+            os.replace(partial_path, result_path)
+            result = {
+                'result_url': result_url,
+                'width': output['width'],
+                'height': output['height'],
+                'enhanced_size': len(enhanced_bytes),
+                'output_format': output_format.to_dict(),
+                'tier': tier_info(tier, estimated_ms, slo_ms),
+                'timings': timer.breakdown()
+            }
+            if routing is not None:
+                result['routing'] = routing.to_dict()
+            capture.update(served_model=tier.model_name, tier=tier.name, timings=result['timings'])
+            return result
+    
+    # The progress bar has an ETA before the job starts
+    estimated_ms = estimate_latency_ms(info, model_name, scale)
+    job.expect(estimated_ms)
+    try:
+        jobs.submit(job, work, cleanup=upload.close)
+    except JobQueueFull:
+        upload.close()
+        response = jsonify({'error': 'Too many jobs in progress, please retry later'})
+        response.headers['Retry-After'] = '30'
+        return response, 429
+    logger.info(f"Queued job {job.id}: {job.filename} ({info.width}x{info.height}) with {model_name}",
+                extra={'event': 'request', 'job_id': job.id, 'model': model_name, 'width': info.width,
+                       'height': info.height})
+    
+    response = jsonify({
+        'job_id': job.id,
+        'state': job.state,
+        'status_url': url_for('get_job', job_id=job.id),
+        'events_url': url_for('job_events', job_id=job.id),
+        'result_url': result_url,
+        'estimated_ms': estimated_ms
+    })
+    response.headers['Location'] = url_for('get_job', job_id=job.id)
+    return response, 202
+
+def finished_elsewhere(job_id):
+    """Whether another worker process finished this job (its result file exists)"""
+    result_path = jobs.result_path(job_id)
+    return result_path is not None and os.path.exists(result_path)
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@limiter.limit("120 per minute")
+def get_job(job_id):
+    """Job state and progress"""
+    job = jobs.get(job_id)
+    if job is not None:
+        return jsonify(job.to_dict())
+    if finished_elsewhere(job_id):
+        return jsonify({'job_id': job_id, 'state': JOB_DONE,
+                        'result': {'result_url': url_for('get_job_result', job_id=job_id)}})
+    return jsonify({'error': 'Job not found'}), 404
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+@limiter.limit("30 per minute")
+def cancel_job(job_id):
+    """Cancel a job: a queued job ends now, a running one after the tile in progress.
+    
+    Answers 202 while a running job winds down; its events end with ``cancelled``.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        if finished_elsewhere(job_id):
+            return jsonify({'error': 'Job already finished', 'state': JOB_DONE}), 409
+        return jsonify({'error': 'Job not found'}), 404
+    if not jobs.cancel(job):
+        return jsonify({'error': 'Job already finished', 'state': job.state}), 409
+    logger.info(f"Cancelling job {job.id}")
+    return jsonify(job.to_dict()), 200 if job.state == JOB_CANCELLED else 202
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+@limiter.limit("30 per minute")
+def job_events(job_id):
+    """Server-Sent Events for a job: preview, state, progress, then done, error or cancelled.
+    
+    Reconnecting clients resume after the Last-Event-ID they saw.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        if not finished_elsewhere(job_id):
+            return jsonify({'error': 'Job not found'}), 404
+        events = [sse_event(0, 'done', {'result_url': url_for('get_job_result', job_id=job_id)})]
+        return Response(events, mimetype='text/event-stream')
+    
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    since = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+    
+    response = Response(job.stream_events(since), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx: do not buffer the stream
+    return response
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+@limiter.limit("30 per minute")
+def get_job_result(job_id):
+    """Enhanced image of a finished job"""
+    result_path = jobs.result_path(job_id)
+    if result_path is None or not os.path.exists(result_path):
+        job = jobs.get(job_id)
+        if job is not None and not job.terminal:
+            return jsonify({'error': 'Job is not finished', 'state': job.state}), 409
+        return jsonify({'error': 'Result not found'}), 404
+    with open(result_path, 'rb') as f:
+        info = probe_image(f)
+    output_format = OutputFormat(info.format if info is not None else 'png')
+    return send_file(os.path.abspath(result_path), mimetype=output_format.mime,
+                     download_name=f'{job_id}{output_format.ext}')
+
+def upload_response(upload, status=200):
+    """Status of a resumable upload, with its offset also in the Upload-Offset header"""
+    response = jsonify({
+        'upload_id': upload['upload_id'],
+        'filename': upload['filename'],
+        'size': upload['size'],
+        'offset': upload['offset'],
+        'complete': upload['complete'],
+        'sha256': upload['sha256'],
+        'image': upload['info'],
+        'chunk_size': RESUMABLE_CHUNK_SIZE,
+        'upload_url': url_for('upload_chunk', upload_id=upload['upload_id'])
+    })
+    response.headers['Upload-Offset'] = str(upload['offset'])
+    response.headers['Upload-Length'] = str(upload['size'])
+    return response, status
+
+@app.route('/api/uploads', methods=['POST'])
+@cross_origin()
+@limiter.limit("10 per minute")
+def create_upload():
+    """Start a resumable upload for an image too large to send in one request.
+    
+    Send ``filename`` and the total ``size`` in bytes (JSON or form fields), then
+    PATCH the bytes to ``upload_url`` in chunks, each with an ``Upload-Offset``
+    header. After an interrupted chunk, HEAD the upload for the offset to resume
+    from. Pass the ``upload_id`` of the finished upload to /api/enhance or /api/jobs.
+    """
+    fields = request.get_json(silent=True) or request.form
+    filename = fields.get('filename', '')
+    if not allowed_file(filename):
+        return jsonify({'error': 'Invalid file type'}), 400
+    try:
+        size = int(fields.get('size', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'size must be the upload size in bytes'}), 400
+    try:
+        upload = resumable_uploads.create(secure_filename(filename), size)
+    except UploadRejected as e:
+        return jsonify({'error': e.message}), e.status
+    
+    response, status = upload_response(upload, 201)
+    response.headers['Location'] = url_for('upload_chunk', upload_id=upload['upload_id'])
+    return response, status
+
+@app.route('/api/uploads/<upload_id>', methods=['HEAD', 'GET', 'PATCH', 'DELETE'])
+@cross_origin(expose_headers=['Upload-Offset', 'Upload-Length'])
+@limiter.limit("300 per minute")
+def upload_chunk(upload_id):
+    """Offset of a resumable upload (HEAD, GET), its next chunk (PATCH) or abort it (DELETE)"""
+    if request.method == 'DELETE':
+        if not resumable_uploads.delete(upload_id):
+            return jsonify({'error': 'Upload not found'}), 404
+        return '', 204
+    
+    if request.method == 'PATCH':
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return jsonify({'error': 'Upload-Offset header is required'}), 400
+        try:
+            # The body is copied to the upload file as it arrives, never held in memory
+            upload = resumable_uploads.append(upload_id, offset, request.stream)
+        except UploadConflict as e:
+            response = jsonify({'error': 'Upload-Offset does not match the upload', 'offset': e.offset})
+            response.headers['Upload-Offset'] = str(e.offset)
+            return response, 409
+        except UploadRejected as e:
+            return jsonify({'error': e.message}), e.status
+    else:
+        upload = resumable_uploads.status(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return upload_response(upload)
+
 @app.route('/api/models', methods=['GET'])
 @limiter.limit("10 per minute")
 def get_models():
     """Get available models"""
+    try:
+        snapshot = inference.snapshot()
+        _, model_states = inference.readiness()
+        device_info = inference.device_info()
+        # Learned run time of a 1 megapixel input on this device, None until the model has run
+        predicted = inference.predict_latency([work_of(name, 1000, 1000) for name in MODEL_CONFIG])
+    except ModelServerUnavailable as e:
+        return model_server_unavailable_response(e)
+    
+    loaded = {slot['model'] for slot in snapshot['slots'].values()}
     available_models = []
-    for name, config in MODEL_CONFIG.items():
+    for (name, config), seconds in zip(MODEL_CONFIG.items(), predicted):
         available_models.append({
             'name': name,
             'scale': config['scale'],
             'description': config['description'],
-            'loaded': name in models,
-            'current': name == current_model
+            'loaded': name in loaded,
+            'state': model_states.get(name, {}).get('state', 'pending'),
+            'default': name == DEFAULT_MODEL,
+            'content': list(config['content']),
+            'cost': config['cost'],
+            'predicted_seconds_per_megapixel': None if seconds is None else round(seconds, 2)
         })
     
     return jsonify({
         'models': available_models,
-        'cuda_available': torch.cuda.is_available(),
-        'current_model': current_model
+        'cuda_available': device_info['cuda_available'],
+        'default_model': DEFAULT_MODEL,
+        'auto': router.to_dict(),
+        'memory': snapshot
     })
 
+@app.route('/api/scheduler', methods=['GET'])
+@limiter.limit("30 per minute")
+def scheduler_status():
+    """Scheduler queue state, with the calling tenant's share and waits.
+    
+    Other tenants are only counted: their names are user ids and client IPs.
+    """
+    try:
+        snapshot = inference.scheduler_stats()
+    except ModelServerUnavailable as e:
+        return model_server_unavailable_response(e)
+    tenant, weight = request_tenant()
+    tenants = snapshot.pop('tenants')
+    snapshot['tenants'] = len(tenants)
+    snapshot['tenant'] = dict(tenants.get(tenant, {'weight': weight}), name=tenant)
+    return jsonify(snapshot)
+
 @app.route('/api/switch-model', methods=['POST'])
 @cross_origin()
 @limiter.limit("5 per minute")
 def switch_model():
-    """Switch to a different model"""
+    """Load a model ahead of use.
+
+    Models are selected per request with the ``model`` field of /api/enhance,
+    so this only warms the registry and does not change other users' model.
+    """
     data = request.get_json()
     model_name = data.get('model')
     
     if not model_name or model_name not in MODEL_CONFIG:
         return jsonify({'error': 'Invalid model name'}), 400
     
-    if init_realesrgan(model_name):
-        return jsonify({
-            'success': True,
-            'current_model': current_model,
-            'message': f'Switched to {model_name}'
-        })
-    else:
-        return jsonify({'error': f'Failed to load model: {model_name}'}), 500
+    try:
+        inference.preload(model_name)
+    except ModelNotReady as e:
+        return model_not_ready_response(model_name, e.status)
+    except ModelServerUnavailable as e:
+        return model_server_unavailable_response(e)
+    
+    return jsonify({
+        'success': True,
+        'model': model_name,
+        'message': f'{model_name} is loaded; pass it as "model" to /api/enhance'
+    })
 
 if __name__ == '__main__':
     print("🚀 Starting Real-ESRGAN API Server...")
     
-    # Initialize default model (best performance)
-    if init_realesrgan('realesr-general-x4v3'):
-        # Try different ports if 5000 is unavailable
-        ports_to_try = [8080, 8000, 3000, 5001, 8888]
-        port = None
-        
-        for try_port in ports_to_try:
-            try:
-                print(f"🌐 Attempting to start server on http://localhost:{try_port}")
-                print("📝 API Endpoints:")
-                print("  - GET  /api/health      - Health check")
-                print("  - POST /api/enhance     - Enhance image")
-                print("  - GET  /api/models      - Available models")
-                print("  - POST /api/switch-model - Switch AI model")
-                print(f"🤖 Current Model: {current_model}")
-                print(f"🔧 Device: {'GPU' if torch.cuda.is_available() else 'CPU'}")
-                
-                app.run(debug=True, host='0.0.0.0', port=try_port)
-                break
-            except OSError as e:
-                if "Address already in use" in str(e) or "access permissions" in str(e).lower():
-                    print(f"❌ Port {try_port} is unavailable, trying next port...")
-                    continue
-                else:
-                    raise e
-        else:
-            print("❌ Could not find an available port. Please check your system configuration.")
-            sys.exit(1)
+    # Load models in the background; /api/ready reports when they are warmed up
+    inference.start()
+    
+    # Try different ports if 5000 is unavailable
+    ports_to_try = [8080, 8000, 3000, 5001, 8888]
+    port = None
+    
+    for try_port in ports_to_try:
+        try:
+            print(f"🌐 Attempting to start server on http://localhost:{try_port}")
+            print("📝 API Endpoints:")
+            print("  - GET  /api/health      - Health check")
+            print("  - GET  /api/ready       - Model readiness")
+            print("  - POST /api/enhance     - Enhance image")
+            print("  - POST /api/enhance/batch - Enhance many images (zip/NDJSON stream)")
+            print("  - POST /api/jobs        - Start a background job")
+            print("  - GET  /api/jobs/<id>/events - Job preview and progress (SSE)")
+            print("  - GET  /api/models      - Available models")
+            print("  - GET  /api/scheduler   - Scheduler queue and your share")
+            print("  - POST /api/switch-model - Preload AI model")
+            print("  - GET  /metrics         - Prometheus metrics")
+            print(f"🤖 Default Model: {DEFAULT_MODEL}")
+            print(f"🔧 Model server: {MODEL_SERVER_ADDRESS or 'in-process'}")
+            
+            app.run(debug=True, host='0.0.0.0', port=try_port)
+            break
+        except OSError as e:
+            if "Address already in use" in str(e) or "access permissions" in str(e).lower():
+                print(f"❌ Port {try_port} is unavailable, trying next port...")
+                continue
+            else:
+                raise e
     else:
-        print("❌ Failed to initialize Real-ESRGAN model")
+        print("❌ Could not find an available port. Please check your system configuration.")
         sys.exit(1)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Fair scheduling of inference across tenants (signed-in users or client IPs)
+Tenants are served in weighted fair order by the cost they have consumed (start-time
+fair queuing), so one tenant's large jobs cannot starve everyone else. Within a tenant
+the shortest job runs first (by its predicted duration, see latency_model.py), and
+waiting jobs age so large ones still run.
+"""
+
+import os
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+
+from cancellation import CANCEL_POLL_INTERVAL
+
+SCHEDULER_CONCURRENCY = int(os.getenv('SCHEDULER_CONCURRENCY', 1))
+# A job that has waited this many seconds counts as half its cost when picking within a tenant
+SCHEDULER_AGEING = float(os.getenv('SCHEDULER_AGEING', 30))
+# Share of signed-in users relative to anonymous clients (keyed by IP)
+SCHEDULER_USER_WEIGHT = float(os.getenv('SCHEDULER_USER_WEIGHT', 2.0))
+# Idle tenants are forgotten after this many seconds
+SCHEDULER_TENANT_TTL = float(os.getenv('SCHEDULER_TENANT_TTL', 600))
+# Weight of the latest job in the moving average of seconds per unit of cost
+SERVICE_RATE_SMOOTHING = 0.2
+
+DEFAULT_TENANT = 'default'
+
+
+class _Entry:
+    __slots__ = ('tenant', 'cost', 'seconds', 'arrived', 'order', 'granted', 'started')
+
+    def __init__(self, tenant, cost, arrived, order, seconds=None):
+        self.tenant = tenant
+        self.cost = cost
+        self.seconds = seconds
+        self.arrived = arrived
+        self.order = order
+        self.granted = False
+        self.started = None
+
+
+class _Tenant:
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        self.vtime = 0.0  # virtual time: cost served so far divided by weight
+        self.queue = []
+        self.running = 0
+        self.served = 0
+        self.served_cost = 0.0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_seen = 0.0
+
+    @property
+    def idle(self):
+        return not self.queue and not self.running
+
+
+class FairScheduler:
+    """Decide which waiting inference job runs next.
+
+    ``enqueue``, ``next_entry`` and ``finish`` are the policy and are called with
+    the scheduler lock held (or from a single thread, as in the simulation tests);
+    ``slot`` wraps them for concurrent callers.
+
+    Args:
+        concurrency (int): Jobs allowed to run at once.
+        ageing (float): Seconds of waiting after which a job counts as half its cost.
+        clock (callable): Time source. Default: time.monotonic.
+    """
+
+    def __init__(self, concurrency=SCHEDULER_CONCURRENCY, ageing=SCHEDULER_AGEING, clock=time.monotonic):
+        self.concurrency = concurrency
+        self.ageing = ageing
+        self.clock = clock
+        self.running = 0
+        self.seconds_per_cost = None  # moving average of run time per unit of cost
+        self._running = set()
+        self._tenants = {}
+        self._virtual = 0.0  # virtual time of the job that started last
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+
+    def enqueue(self, tenant, cost, weight=1.0, seconds=None):
+        """Add a job for ``tenant`` with an estimated ``cost`` and, once predictable, run time in ``seconds``"""
+        now = self.clock()
+        state = self._tenants.get(tenant)
+        if state is None:
+            state = self._tenants[tenant] = _Tenant(tenant, weight)
+        state.weight = weight
+        if state.idle:
+            # A returning tenant starts at the current virtual time: idle time earns no credit
+            state.vtime = max(state.vtime, self._virtual)
+        state.last_seen = now
+        entry = _Entry(tenant, cost, now, next(self._order), seconds)
+        state.queue.append(entry)
+        return entry
+
+    def _duration(self, entry):
+        """Predicted run time of a job, else its cost at the measured service rate (None if unknown)"""
+        if entry.seconds is not None:
+            return entry.seconds
+        if self.seconds_per_cost is None:
+            return None
+        return entry.cost * self.seconds_per_cost
+
+    def _effective_cost(self, entry, now):
+        duration = self._duration(entry)
+        return (entry.cost if duration is None else duration) / (1.0 + (now - entry.arrived) / self.ageing)
+
+    def next_entry(self):
+        """Take the job that should run next, or None if nothing is waiting"""
+        waiting = [state for state in self._tenants.values() if state.queue]
+        if not waiting:
+            return None
+        now = self.clock()
+        # Least served tenant first (ties: the one waiting longest)
+        state = min(waiting, key=lambda s: (s.vtime, min(entry.order for entry in s.queue)))
+        # Shortest effective job within the tenant
+        entry = min(state.queue, key=lambda e: (self._effective_cost(e, now), e.order))
+        state.queue.remove(entry)
+
+        self._virtual = state.vtime
+        state.vtime += entry.cost / state.weight
+        state.running += 1
+        wait = now - entry.arrived
+        state.total_wait += wait
+        state.max_wait = max(state.max_wait, wait)
+        self.running += 1
+        self._running.add(entry)
+        entry.granted = True
+        entry.started = now
+        return entry
+
+    def finish(self, entry):
+        """Mark a job started by ``next_entry`` as done"""
+        state = self._tenants[entry.tenant]
+        state.running -= 1
+        state.served += 1
+        state.served_cost += entry.cost
+        state.last_seen = self.clock()
+        self.running -= 1
+        self._running.discard(entry)
+        if entry.cost > 0:
+            rate = (state.last_seen - entry.started) / entry.cost
+            self.seconds_per_cost = rate if self.seconds_per_cost is None else \
+                (1 - SERVICE_RATE_SMOOTHING) * self.seconds_per_cost + SERVICE_RATE_SMOOTHING * rate
+
+    def _dispatch(self):
+        while self.running < self.concurrency and self.next_entry() is not None:
+            pass
+        self._cond.notify_all()
+
+    def _forget_idle(self):
+        cutoff = self.clock() - SCHEDULER_TENANT_TTL
+        for name in [name for name, state in self._tenants.items() if state.idle and state.last_seen < cutoff]:
+            del self._tenants[name]
+
+    @contextmanager
+    def slot(self, tenant=None, cost=0.0, weight=1.0, cancel=None, seconds=None):
+        """Wait for this job's turn, then hold a run slot for the duration of the block.
+
+        ``seconds`` is the job's predicted run time, if known. A job whose ``cancel``
+        token is cancelled while it waits leaves the queue and raises Cancelled.
+        """
+        with self._cond:
+            entry = self.enqueue(tenant or DEFAULT_TENANT, cost, weight, seconds)
+            self._dispatch()
+            while not entry.granted:
+                if cancel is not None and cancel.cancelled:
+                    self._tenants[entry.tenant].queue.remove(entry)
+                    break
+                self._cond.wait(None if cancel is None else CANCEL_POLL_INTERVAL)
+        if not entry.granted:
+            cancel.check()
+        try:
+            yield entry
+        finally:
+            with self._cond:
+                self.finish(entry)
+                self._forget_idle()
+                self._dispatch()
+
+    def estimate(self, seconds, backlog=0.0):
+        """Seconds until a job running for each of ``seconds`` would finish if it were queued now.
+
+        Assumes every queued job runs first, plus ``backlog`` seconds of jobs waiting
+        elsewhere (for admission). Returns None while the duration of a job ahead is
+        unknown (before any job has finished).
+        """
+        with self._cond:
+            now = self.clock()
+            ahead = [(self._duration(entry), now - entry.started) for entry in self._running]
+            ahead += [(self._duration(entry), 0.0) for state in self._tenants.values() for entry in state.queue]
+            if any(duration is None for duration, _ in ahead):
+                return None
+            wait = (sum(max(0.0, duration - elapsed) for duration, elapsed in ahead) + backlog) / self.concurrency
+            return [wait + own for own in seconds]
+
+    def snapshot(self):
+        """Per-tenant queue statistics"""
+        with self._cond:
+            total_cost = sum(state.served_cost for state in self._tenants.values()) or 1.0
+            return {
+                'concurrency': self.concurrency,
+                'seconds_per_cost': None if self.seconds_per_cost is None else round(self.seconds_per_cost, 4),
+                'running': self.running,
+                'queued': sum(len(state.queue) for state in self._tenants.values()),
+                'tenants': {
+                    name: {
+                        'weight': state.weight,
+                        'queued': len(state.queue),
+                        'queued_cost': round(sum(entry.cost for entry in state.queue), 4),
+                        'running': state.running,
+                        'served': state.served,
+                        'served_cost': round(state.served_cost, 4),
+                        'share': round(state.served_cost / total_cost, 3),
+                        'mean_wait_ms': round(state.total_wait / max(state.served + state.running, 1) * 1000, 1),
+                        'max_wait_ms': round(state.max_wait * 1000, 1)
+                    }
+                    for name, state in self._tenants.items()
+                }
+            }
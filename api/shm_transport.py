@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Shared-memory transport between the HTTP workers and the model server
+Image arrays travel in multiprocessing.shared_memory blocks; only small control
+messages (block names, shapes, model names, timings) go over the connection.
+This is not zero-copy: cv2.imdecode and the upsampler allocate their own arrays,
+so the decoded input is copied into a block once, and so is the enhanced output.
+Neither is pickled or sent through the socket, and the receiving side maps the
+block in place
+"""
+
+import os
+import socket
+import threading
+import logging
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client
+
+import numpy as np
+
+import tracing
+from admission import AdmissionRejected
+from cancellation import CANCEL_POLL_INTERVAL, Cancelled
+from image_io import EnhanceResult
+from model_config import ModelLoadError, ModelNotReady
+
+logger = logging.getLogger(__name__)
+
+# Set to run inference in a separate model server process (see model_server.py)
+MODEL_SERVER_ADDRESS = os.getenv('MODEL_SERVER_ADDRESS', '')
+MODEL_SERVER_AUTHKEY = os.getenv('MODEL_SERVER_AUTHKEY', 'hdess-model-server').encode('utf-8')
+
+
+# Requests that are safe to send again after the connection was lost mid-request
+RETRY_OPS = frozenset({'device', 'is_loaded', 'model_state', 'readiness', 'snapshot', 'scheduler', 'predict',
+                       'estimate', 'memory', 'preload'})
+
+
+class ModelServerUnavailable(Exception):
+    """Raised when the model server cannot be reached"""
+
+
+def parse_address(address):
+    """'host:port' becomes a TCP address; anything else is a Unix socket or named pipe path"""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and not address.startswith('/'):
+        return (host or 'localhost', int(port))
+    return address
+
+
+def set_nodelay(conn):
+    """Disable Nagle's algorithm on a TCP connection.
+
+    Control messages are tiny and a 'release' is followed by the next request without
+    waiting for a reply, which otherwise stalls ~40ms on delayed ACKs.
+    """
+    try:
+        sock = socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    except (OSError, AttributeError, ValueError):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass  # Unix socket or named pipe
+    finally:
+        sock.close()
+
+
+def share_array(array):
+    """Copy an array into a new shared memory block (the one copy per direction).
+
+    Returns the block and its descriptor.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    view[...] = array
+    del view
+    return shm, {'shm': shm.name, 'shape': tuple(array.shape), 'dtype': array.dtype.str}
+
+
+def attach_array(descriptor):
+    """Map a block created by another process. Returns the block and an array view onto it"""
+    try:
+        shm = shared_memory.SharedMemory(name=descriptor['shm'], track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the block with this process's resource
+        # tracker, which would unlink it when this process exits; the creator owns it
+        shm = shared_memory.SharedMemory(name=descriptor['shm'])
+        if os.name == 'posix':
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+    array = np.ndarray(descriptor['shape'], dtype=np.dtype(descriptor['dtype']), buffer=shm.buf)
+    return shm, array
+
+
+def raise_for_reply(reply):
+    """Re-raise an error reported by the model server"""
+    if reply.get('ok'):
+        return
+    if reply.get('error') == 'not_ready':
+        raise ModelNotReady(reply['model'], reply['status'])
+    if reply.get('error') == 'load_failed':
+        raise ModelLoadError(reply['message'])
+    if reply.get('error') == 'unavailable':
+        # The supervisor has no model worker serving (see supervisor.py)
+        raise ModelServerUnavailable(reply['message'])
+    if reply.get('error') == 'rejected':
+        raise AdmissionRejected(reply['reason'], reply.get('retry_after'))
+    if reply.get('error') == 'cancelled':
+        raise Cancelled(reply['reason'], reply.get('tiles', 0), reply.get('inference_seconds', 0.0),
+                        reply.get('model'))
+    raise RuntimeError(reply.get('message', 'Model server error'))
+
+
+class RemoteInference:
+    """Inference backend that forwards work to the model server.
+
+    Has the same interface as inference.LocalInference, so the Flask app does not
+    care which one it uses. Each thread keeps its own connection.
+    """
+
+    def __init__(self, address=MODEL_SERVER_ADDRESS, authkey=MODEL_SERVER_AUTHKEY):
+        self.address = parse_address(address)
+        self.authkey = authkey
+        self._local = threading.local()
+        self._device_info = None
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn.poll():
+            # Nothing is due between requests: the server closed the connection
+            self._drop_connection()
+            conn = None
+        if conn is None:
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+            except OSError as e:
+                raise ModelServerUnavailable(f'Cannot reach model server at {self.address}: {e}') from e
+            if isinstance(self.address, tuple):
+                set_nodelay(conn)
+            self._local.conn = conn
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _receive(self, conn, cancel, cancel_sent):
+        """Wait for the next message, telling the server once if ``cancel`` is cancelled meanwhile.
+
+        Returns the message and whether the server has been told.
+        """
+        if cancel is not None:
+            while not conn.poll(CANCEL_POLL_INTERVAL):
+                if not cancel_sent and cancel.cancelled:
+                    # The server stops after the tile in progress and replies 'cancelled'
+                    conn.send({'op': 'cancel', 'reason': cancel.reason})
+                    cancel_sent = True
+        return conn.recv(), cancel_sent
+
+    def _call(self, message, on_progress=None, cancel=None):
+        for attempt in range(2):
+            conn = self._connection()
+            sent = False
+            try:
+                conn.send(message)
+                sent = True
+                reply, cancel_sent = self._receive(conn, cancel, False)
+                # Interim progress messages come ahead of the reply
+                while 'progress' in reply:
+                    if on_progress is not None:
+                        on_progress(*reply['progress'])
+                    reply, cancel_sent = self._receive(conn, cancel, cancel_sent)
+                break
+            except (EOFError, OSError) as e:
+                # The server restarted or dropped us; reconnect once. Only status requests
+                # are sent again once they went out: an enhance could run twice, an admit
+                # take a second ticket
+                self._drop_connection()
+                if attempt or (sent and message['op'] not in RETRY_OPS):
+                    raise ModelServerUnavailable(f'Lost connection to model server: {e}') from e
+        raise_for_reply(reply)
+        return reply
+
+    def start(self):
+        """Models are loaded by the model server; nothing to start here"""
+
+    def device_info(self):
+        if self._device_info is None:
+            self._device_info = self._call({'op': 'device'})['device']
+        return self._device_info
+
+    def is_loaded(self, model_name):
+        return self._call({'op': 'is_loaded', 'model': model_name})['loaded']
+
+    def model_state(self, model_name):
+        return self._call({'op': 'model_state', 'model': model_name})['state']
+
+    def readiness(self):
+        reply = self._call({'op': 'readiness'})
+        return reply['ready'], reply['models']
+
+    def snapshot(self):
+        return self._call({'op': 'snapshot'})['snapshot']
+
+    def scheduler_stats(self):
+        return self._call({'op': 'scheduler'})['scheduler']
+
+    def predict_latency(self, works):
+        return self._call({'op': 'predict', 'works': list(works)})['seconds']
+
+    def estimate_latency(self, works):
+        return self._call({'op': 'estimate', 'works': list(works)})['seconds']
+
+    def admit(self, cost, memory, timeout=None, work=None):
+        return self._call({'op': 'admit', 'cost': cost, 'memory': memory, 'timeout': timeout, 'work': work})['ticket']
+
+    def release_admission(self, ticket):
+        try:
+            # No reply: the server also releases a connection's tickets when it disconnects
+            self._connection().send({'op': 'release_admission', 'ticket': ticket})
+        except (OSError, ModelServerUnavailable):
+            pass
+
+    def memory_info(self):
+        return self._call({'op': 'memory'})['memory']
+
+    def preload(self, model_name, timeout=None):
+        return self._call({'op': 'preload', 'model': model_name, 'timeout': timeout})['status']
+
+    def enhance(self, img, model_name, outscale=None, timeout=None, progress=None, tenant=None, weight=1.0,
+                tile_scale=1, cancel=None):
+        """Enhance a decoded image in the model server.
+
+        The server enforces ``cancel``'s deadline itself and is told when it is cancelled.
+        """
+        if cancel is not None:
+            cancel.check()
+        shm_in, descriptor = share_array(img)
+        try:
+            reply = self._call({
+                'op': 'enhance',
+                'image': descriptor,
+                'model': model_name,
+                'outscale': outscale,
+                'timeout': timeout,
+                'progress': progress is not None,
+                'tenant': tenant,
+                'weight': weight,
+                'tile_scale': tile_scale,
+                'deadline': None if cancel is None else cancel.remaining(),
+                'trace': tracing.context()
+            }, on_progress=progress, cancel=cancel)
+        finally:
+            shm_in.close()
+            shm_in.unlink()
+
+        # The server's spans join this request's trace
+        tracing.adopt(reply.get('spans'))
+        shm_out, output = attach_array(reply['image'])
+        conn = self._connection()
+
+        def release():
+            try:
+                shm_out.close()
+            except BufferError:
+                # A view is still referenced; the mapping goes away when it is collected
+                pass
+            try:
+                # The server owns the output block and unlinks it once we are done
+                conn.send({'op': 'release', 'shm': reply['image']['shm']})
+            except OSError:
+                pass
+
+        return EnhanceResult(output, reply['timings'], release, info=reply.get('info'))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Single-flight coalescing of identical in-flight requests
+Requests with the same upload content and parameters share one computation: the
+first computes and later ones wait for its result. Threads of a process coalesce on
+an in-process flight; across worker processes the leader holds a Redis lease and
+publishes its result, and the other processes wait for it.
+"""
+
+import os
+import json
+import time
+import uuid
+import struct
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+from cancellation import CANCEL_POLL_INTERVAL
+
+try:
+    from redis.exceptions import RedisError
+except ImportError:
+    RedisError = OSError
+
+logger = logging.getLogger(__name__)
+
+# The leader's lease is renewed while it computes; a crashed leader loses it after this long
+SINGLEFLIGHT_LEASE = float(os.getenv('SINGLEFLIGHT_LEASE_SECONDS', 15))
+# Published results stay readable this long for processes that were about to attach
+SINGLEFLIGHT_RESULT_TTL = int(os.getenv('SINGLEFLIGHT_RESULT_TTL', 60))
+# Longest a request waits for another's result before computing on its own
+SINGLEFLIGHT_MAX_WAIT = float(os.getenv('SINGLEFLIGHT_MAX_WAIT', 600))
+# Larger results are not copied through Redis; waiting processes compute their own
+SINGLEFLIGHT_MAX_RESULT = int(os.getenv('SINGLEFLIGHT_MAX_RESULT_MB', 64)) * 1024 * 1024
+
+KEY_PREFIX = 'hdess:flight:'
+LEADER = 'leader'
+LOCAL = 'local'
+REMOTE = 'redis'
+
+_FAILED = b'failed'
+_DONE = b'done'
+_HASH_CHUNK = 1024 * 1024
+
+# Delete or extend the lease only while this leader still holds it
+_RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+_EXTEND_SCRIPT = ("if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end "
+                  "return 0")
+
+
+def flight_key(stream, *params):
+    """Hash of an upload's content and the request parameters; the stream is rewound.
+
+    Streams that were hashed while they were received (uploads.IngestStream) are not read again.
+    """
+    content = getattr(stream, 'sha256', None)
+    if content is None:
+        position = stream.tell()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: stream.read(_HASH_CHUNK), b''):
+            digest.update(chunk)
+        stream.seek(position)
+        content = digest.hexdigest()
+    return content_key(content, *params)
+
+
+def content_key(sha256, *params):
+    """Hash of content known by its SHA-256 and the request parameters"""
+    params = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(f'{sha256}:{params}'.encode()).hexdigest()
+
+
+def _pack(result):
+    payload, meta = result
+    meta = json.dumps(meta).encode()
+    return struct.pack('>I', len(meta)) + meta + payload
+
+
+def _unpack(data):
+    size = struct.unpack('>I', data[:4])[0]
+    return data[4 + size:], json.loads(data[4:4 + size])
+
+
+class _Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class SingleFlight:
+    """Run one computation per key at a time and share its result with concurrent callers.
+
+    ``compute()`` returns ``(payload_bytes, meta)`` with a JSON-serializable ``meta``,
+    or None for a result that must not be shared. If the leader fails, a waiting
+    caller takes over and computes itself.
+
+    Args:
+        redis_client (redis.Redis): Binary-safe client (decode_responses off) for
+            coalescing across processes. Default: None (in-process only).
+        lease (float): Seconds of the leader's renewable lease.
+        max_wait (float): Seconds to wait for another caller's result.
+    """
+
+    def __init__(self, redis_client=None, lease=SINGLEFLIGHT_LEASE, max_wait=SINGLEFLIGHT_MAX_WAIT,
+                 result_ttl=SINGLEFLIGHT_RESULT_TTL, max_result=SINGLEFLIGHT_MAX_RESULT):
+        self.redis = redis_client
+        self.lease = lease
+        self.max_wait = max_wait
+        self.result_ttl = result_ttl
+        self.max_result = max_result
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {LEADER: 0, LOCAL: 0, REMOTE: 0}
+        if redis_client is not None:
+            self._release = redis_client.register_script(_RELEASE_SCRIPT)
+            self._extend = redis_client.register_script(_EXTEND_SCRIPT)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
+
+    def run(self, key, compute, cancel=None):
+        """Compute or attach to the result for ``key``.
+
+        Returns the result and where it came from: LEADER (computed here), LOCAL
+        (another thread of this process) or REMOTE (another process, via Redis).
+        While it waits for another caller's result, the caller's ``cancel`` token is
+        checked and Cancelled raised once it is cancelled (deadline, client gone).
+        """
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+            if leader:
+                break
+            self._wait(flight.done, deadline, cancel)
+            if flight.result is not None:
+                return self._count(flight.result, LOCAL)
+            if time.monotonic() >= deadline:
+                return self._count(compute(), LEADER)
+            # The leader failed or shared nothing: try to lead
+
+        try:
+            result, source = self._lead(key, compute, deadline, cancel)
+            flight.result = result
+            return self._count(result, source)
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    @staticmethod
+    def _wait(done, deadline, cancel):
+        """Wait for the ``done`` event until ``deadline``; raises Cancelled once ``cancel`` is cancelled"""
+        while True:
+            timeout = max(0.0, deadline - time.monotonic())
+            if cancel is not None:
+                timeout = min(cancel.timeout(timeout), CANCEL_POLL_INTERVAL)
+            if done.wait(timeout):
+                return
+            if cancel is not None:
+                cancel.check()
+            if time.monotonic() >= deadline:
+                return
+
+    def _count(self, result, source):
+        with self._lock:
+            self.stats[source] += 1
+        return result, source
+
+    def _lead(self, key, compute, deadline, cancel=None):
+        if self.redis is None:
+            return compute(), LEADER
+        lock_key = f'{KEY_PREFIX}{key}:lock'
+        token = uuid.uuid4().hex
+        while True:
+            try:
+                acquired = self.redis.set(lock_key, token, nx=True, px=int(self.lease * 1000))
+            except RedisError as e:
+                logger.warning(f"Single-flight lease unavailable, computing without it: {e}")
+                return compute(), LEADER
+            if acquired:
+                return self._compute_and_publish(key, lock_key, token, compute), LEADER
+            result = self._wait_remote(key, lock_key, deadline, cancel)
+            if result is not None:
+                return result, REMOTE
+            if time.monotonic() >= deadline:
+                return compute(), LEADER
+
+    @contextmanager
+    def _renewing(self, lock_key, token):
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease / 3):
+                try:
+                    self._extend(keys=[lock_key], args=[token, int(self.lease * 1000)])
+                except RedisError as e:
+                    logger.warning(f"Could not renew single-flight lease: {e}")
+
+        thread = threading.Thread(target=renew, name='flight-lease', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def _compute_and_publish(self, key, lock_key, token, compute):
+        channel = f'{KEY_PREFIX}{key}'
+        result = None
+        try:
+            with self._renewing(lock_key, token):
+                result = compute()
+            return result
+        finally:
+            try:
+                data = _pack(result) if result is not None else None
+                if data is not None and len(data) <= self.max_result:
+                    self.redis.set(f'{channel}:result', data, ex=self.result_ttl)
+                    self.redis.publish(channel, _DONE)
+                else:
+                    self.redis.publish(channel, _FAILED)
+                self._release(keys=[lock_key], args=[token])
+            except RedisError as e:
+                logger.warning(f"Could not publish single-flight result: {e}")
+
+    def _wait_remote(self, key, lock_key, deadline, cancel=None):
+        """Wait for the leader in another process; None if it failed or went away.
+
+        Raises Cancelled once ``cancel`` is cancelled.
+        """
+        channel = f'{KEY_PREFIX}{key}'
+        result_key = f'{channel}:result'
+        try:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(channel)
+            try:
+                while True:
+                    # Checked after subscribing, so a result published in between is not missed
+                    data = self.redis.get(result_key)
+                    if data is not None:
+                        return _unpack(data)
+                    if not self.redis.exists(lock_key) or time.monotonic() >= deadline:
+                        return None
+                    timeout = min(1.0, self.lease / 3)
+                    if cancel is not None:
+                        cancel.check()
+                        timeout = min(cancel.timeout(timeout), CANCEL_POLL_INTERVAL)
+                    message = pubsub.get_message(timeout=timeout)
+                    if message is not None and message['data'] == _FAILED:
+                        return None
+            finally:
+                pubsub.close()
+        except RedisError as e:
+            logger.warning(f"Lost single-flight leader's result: {e}")
+            return None
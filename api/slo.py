@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Latency SLOs with load-shedding quality tiers
+Before a request is admitted its latency is predicted (see latency_model.py) along with
+the work queued ahead of it.
+When the full-quality estimate misses the request's SLO, the best cheaper tier that
+meets it is used instead: larger tiles, then cheaper loaded models, then a lower outscale.
+"""
+
+import os
+
+import metrics
+from admission import ADMISSION_TILE, estimate_cost, estimate_peak_memory
+from latency_model import work_of
+from model_config import MODEL_CONFIG
+from preloader import READY
+
+# Default SLOs per endpoint in milliseconds; 0 disables degradation for the endpoint
+SLO_MS = {
+    'enhance': int(os.getenv('SLO_ENHANCE_MS', 30000)),
+    'batch': int(os.getenv('SLO_BATCH_ITEM_MS', 120000)),
+    'job': int(os.getenv('SLO_JOB_MS', 0))
+}
+# Tile padding of the upsamplers (see inference.build_upsampler)
+TILE_PAD = 10
+
+FULL = 'full'
+COARSE_TILES = 'coarse_tiles'
+FAST_MODEL = 'fast_model'
+REDUCED_SCALE = 'reduced_scale'
+
+
+def _tile_overhead(info, tile):
+    """Work of a tiled run relative to an untiled one: every tile is run with its padding"""
+    if not tile or max(info.width, info.height) <= tile:
+        return 1.0
+    return ((tile + 2 * TILE_PAD) / tile) ** 2
+
+
+class Tier:
+    """One way to serve a request, from full quality down to the cheapest.
+
+    Args:
+        name (str): FULL, COARSE_TILES, FAST_MODEL or REDUCED_SCALE.
+        model_name (str): Model to run.
+        outscale (float): Output scale relative to the uploaded image.
+        prescale (float): Factor the image is shrunk by before the model runs. Default: 1.
+        tile_scale (int): Multiplier of the upsampler's tile size. Default: 1.
+    """
+
+    def __init__(self, name, model_name, outscale, prescale=1.0, tile_scale=1):
+        self.name = name
+        self.model_name = model_name
+        self.outscale = outscale
+        self.prescale = prescale
+        self.tile_scale = tile_scale
+
+    @property
+    def degraded(self):
+        return self.name != FULL
+
+    @property
+    def network_outscale(self):
+        """Outscale to request from the model for the prescaled image"""
+        return self.outscale / self.prescale
+
+    def _size(self, info):
+        return max(1, round(info.width * self.prescale)), max(1, round(info.height * self.prescale))
+
+    def estimate(self, info):
+        """Compute cost and peak memory of serving an image at this tier"""
+        width, height = self._size(info)
+        tile = ADMISSION_TILE * self.tile_scale
+        cost = estimate_cost(width, height, self.model_name) * _tile_overhead(info, tile) / \
+            _tile_overhead(info, ADMISSION_TILE)
+        memory = estimate_peak_memory(width, height, info.channels, self.model_name, outscale=self.network_outscale,
+                                      tile=tile, bit_depth=info.bit_depth)
+        return cost, memory
+
+    def work(self, info):
+        """The inference of an image at this tier, for latency predictions"""
+        width, height = self._size(info)
+        # An alpha channel is a second pass through the model
+        return work_of(self.model_name, width, height, self.tile_scale, 2 if info.channels == 4 else 1)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'degraded': self.degraded,
+            'model': self.model_name,
+            'outscale': self.outscale,
+            'prescale': self.prescale,
+            'tile_scale': self.tile_scale
+        }
+
+
+def plan_tiers(info, model_name, outscale, ready_models=()):
+    """Tiers for a request in order of decreasing quality and cost.
+
+    Only models in ``ready_models`` are considered as cheaper substitutes, so
+    degrading never waits for a model to load.
+    """
+    tiers = [Tier(FULL, model_name, outscale)]
+    tile_scale = 1
+    if max(info.width, info.height) > ADMISSION_TILE:
+        tile_scale = 2
+        tiers.append(Tier(COARSE_TILES, model_name, outscale, tile_scale=tile_scale))
+
+    cost = MODEL_CONFIG[model_name]['cost']
+    cheaper = sorted((name for name in ready_models if MODEL_CONFIG[name]['cost'] < cost),
+                     key=lambda name: MODEL_CONFIG[name]['cost'], reverse=True)
+    for name in cheaper:
+        tiers.append(Tier(FAST_MODEL, name, outscale, tile_scale=tile_scale))
+
+    if outscale > 1:
+        # Half the output scale; the model runs on a smaller image instead of being resized after
+        fastest = tiers[-1].model_name
+        reduced = max(1.0, outscale / 2)
+        prescale = min(1.0, reduced / MODEL_CONFIG[fastest]['scale'])
+        tiers.append(Tier(REDUCED_SCALE, fastest, reduced, prescale=prescale, tile_scale=tile_scale))
+    return tiers
+
+
+def select_tier(backend, info, model_name, outscale, slo_ms, endpoint):
+    """Pick the best tier whose estimated latency meets ``slo_ms``.
+
+    Returns the tier and its estimated latency in ms, queue included (None until the
+    backend can predict run times). Without ``slo_ms`` the full tier is always used.
+    When no tier meets the SLO the cheapest one is used.
+    """
+    full = Tier(FULL, model_name, outscale)
+    tier, estimate = full, None
+    estimates = backend.estimate_latency([full.work(info)])
+    if estimates is not None:
+        estimate = estimates[0] * 1000
+        if slo_ms and estimate > slo_ms:
+            _, models = backend.readiness()
+            ready = [name for name, status in models.items() if status['state'] == READY]
+            tiers = plan_tiers(info, model_name, outscale, ready)
+            estimates = backend.estimate_latency([candidate.work(info) for candidate in tiers])
+            if estimates is not None:
+                tier, estimate = tiers[-1], estimates[-1] * 1000
+                for candidate, seconds in zip(tiers, estimates):
+                    if seconds * 1000 <= slo_ms:
+                        tier, estimate = candidate, seconds * 1000
+                        break
+    metrics.TIER_DECISIONS.labels(endpoint, tier.name, tier.model_name).inc()
+    return tier, None if estimate is None else round(estimate, 1)
+
+
+def observe_latency(endpoint, tier, slo_ms, elapsed_ms):
+    """Count a finished request that missed its SLO"""
+    if slo_ms and elapsed_ms > slo_ms:
+        metrics.SLO_VIOLATIONS.labels(endpoint, tier.name).inc()
@@ -0,0 +1,660 @@
+#!/usr/bin/env python3
+"""
+Model worker supervisor
+Stands in for the model server at MODEL_SERVER_ADDRESS and runs model_server.py worker
+processes behind it, between SUPERVISOR_MIN_WORKERS and SUPERVISOR_MAX_WORKERS of them.
+Every request from the HTTP workers is relayed to one model worker (images stay in
+shared memory, as with a single model server). Workers are added while requests queue
+up or wait too long, and drained, then stopped, once the load has gone, as long as the
+models they load fit SUPERVISOR_MEMORY_BUDGET_MB. The workers share MODEL_MEMORY_BUDGET_MB
+and ADMISSION_MEMORY_BUDGET_MB equally, so together they hold what one model server would.
+
+Usage:
+    MODEL_SERVER_ADDRESS=localhost:6070 python supervisor.py
+    MODEL_SERVER_ADDRESS=localhost:6070 gunicorn --workers 4 --threads 4 realesrgan_api:app
+"""
+
+import os
+import sys
+import time
+import signal
+import itertools
+import threading
+import subprocess
+import logging
+from multiprocessing.connection import Client, Listener, arbitrary_address
+
+from dotenv import load_dotenv
+
+# Load environment variables before the modules that read them
+load_dotenv()
+
+import logs
+from cancellation import CANCEL_POLL_INTERVAL, DISCONNECTED
+from latency_model import worker_path
+from shm_transport import (MODEL_SERVER_ADDRESS, MODEL_SERVER_AUTHKEY, ModelServerUnavailable, parse_address,
+                           set_nodelay)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = 'localhost:6070'
+SUPERVISOR_MIN_WORKERS = int(os.getenv('SUPERVISOR_MIN_WORKERS', 1))
+SUPERVISOR_MAX_WORKERS = int(os.getenv('SUPERVISOR_MAX_WORKERS', 2))
+# Memory of the models loaded by all workers together, as they report it; a worker loads
+# a model that does not fit its share of MODEL_MEMORY_BUDGET_MB anyway, so this bounds how many run
+SUPERVISOR_MEMORY_BUDGET = int(os.getenv('SUPERVISOR_MEMORY_BUDGET_MB', 3072)) * 1024 * 1024
+# The budgets of one model server (see model_registry.py and admission.py), shared out equally
+# among the workers so that all of them together stay within them
+MODEL_MEMORY_BUDGET_MB = int(os.getenv('MODEL_MEMORY_BUDGET_MB', 1536))
+ADMISSION_MEMORY_BUDGET_MB = int(os.getenv('ADMISSION_MEMORY_BUDGET_MB', 1536))
+# A worker is added when more requests than this are queued per worker...
+SUPERVISOR_TARGET_QUEUE = float(os.getenv('SUPERVISOR_TARGET_QUEUE', 2))
+# ...or requests waited longer than this (admission and scheduler queue, seconds)
+SUPERVISOR_TARGET_WAIT = float(os.getenv('SUPERVISOR_TARGET_WAIT', 5))
+# Seconds between two changes to the number of workers
+SUPERVISOR_COOLDOWN = float(os.getenv('SUPERVISOR_COOLDOWN', 10))
+# Seconds the other workers must have been able to carry the load before one is drained
+SUPERVISOR_IDLE_SECONDS = float(os.getenv('SUPERVISOR_IDLE_SECONDS', 60))
+# A draining worker is stopped after this many seconds even if requests are still running
+SUPERVISOR_DRAIN_TIMEOUT = float(os.getenv('SUPERVISOR_DRAIN_TIMEOUT', 300))
+# Seconds between polls of the workers' queues
+SUPERVISOR_INTERVAL = float(os.getenv('SUPERVISOR_INTERVAL', 2))
+# Seconds a request waits for a worker when none is serving (all of them starting)
+SUPERVISOR_START_TIMEOUT = float(os.getenv('SUPERVISOR_START_TIMEOUT', 60))
+# Status requests do not wait that long
+INFO_WAIT = 2.0
+
+# Worker states
+STARTING = 'starting'
+SERVING = 'serving'
+DRAINING = 'draining'
+
+# Autoscaler decisions
+SPAWN = 'spawn'
+RESUME = 'resume'
+DRAIN = 'drain'
+STOP = 'stop'
+
+# Requests that hold a worker's capacity; the rest are status requests
+WORK_OPS = {'admit', 'enhance', 'preload'}
+
+
+class Worker:
+    """One model worker process and what the supervisor last learned about it"""
+
+    def __init__(self, worker_id, address, process=None, started=None, slot=0):
+        self.id = worker_id
+        self.address = address
+        # Lowest index free among the live workers when it was started; names its files
+        self.slot = slot
+        self.process = process
+        self.state = STARTING
+        self.started = time.monotonic() if started is None else started
+        self.drain_started = None
+        # Reported by the worker: requests waiting for admission or a scheduler slot,
+        # requests running and how many may, and the models it has loaded
+        self.queued = 0
+        self.running = 0
+        self.concurrency = 1
+        self.memory = 0
+        self.models = []
+        # Admission tickets, enhances and output blocks relayed to it and not yet released
+        self.leases = 0
+        self.control = None
+        # Its shares of the memory budgets, in MB, as it was last started or told
+        self.budgets = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'slot': self.slot,
+            'pid': None if self.process is None else self.process.pid,
+            'state': self.state,
+            'queued': self.queued,
+            'running': self.running,
+            'leases': self.leases,
+            'memory_mb': round(self.memory / (1024 * 1024), 1),
+            'models': list(self.models),
+            'budgets_mb': self.budgets
+        }
+
+
+class Autoscaler:
+    """Decide when to start, drain, resume and stop model workers.
+
+    A worker is added while the serving workers have more than ``target_queue``
+    requests queued each, or requests waited longer than ``target_wait`` seconds on
+    average. One is drained after ``idle_seconds`` in which the others could have
+    carried the load, and stopped once its last request is done. A draining worker is
+    resumed before a new one is started, as its models are loaded already, and the
+    worker with the fewest models loaded is the one drained. Workers are only added
+    while the models of all of them fit ``memory_budget``; a worker that has not
+    loaded its models yet counts as the largest one.
+
+    Args:
+        min_workers (int): Default: SUPERVISOR_MIN_WORKERS.
+        max_workers (int): Default: SUPERVISOR_MAX_WORKERS.
+        memory_budget (int): Bytes. Default: SUPERVISOR_MEMORY_BUDGET.
+        target_queue (float): Default: SUPERVISOR_TARGET_QUEUE.
+        target_wait (float): Default: SUPERVISOR_TARGET_WAIT.
+        cooldown (float): Default: SUPERVISOR_COOLDOWN.
+        idle_seconds (float): Default: SUPERVISOR_IDLE_SECONDS.
+        drain_timeout (float): Default: SUPERVISOR_DRAIN_TIMEOUT.
+    """
+
+    def __init__(self, min_workers=SUPERVISOR_MIN_WORKERS, max_workers=SUPERVISOR_MAX_WORKERS,
+                 memory_budget=SUPERVISOR_MEMORY_BUDGET, target_queue=SUPERVISOR_TARGET_QUEUE,
+                 target_wait=SUPERVISOR_TARGET_WAIT, cooldown=SUPERVISOR_COOLDOWN,
+                 idle_seconds=SUPERVISOR_IDLE_SECONDS, drain_timeout=SUPERVISOR_DRAIN_TIMEOUT):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.memory_budget = memory_budget
+        self.target_queue = target_queue
+        self.target_wait = target_wait
+        self.cooldown = cooldown
+        self.idle_seconds = idle_seconds
+        self.drain_timeout = drain_timeout
+        self._changed = None
+        self._idle_since = None
+        self.stats = {SPAWN: 0, RESUME: 0, DRAIN: 0, STOP: 0, 'memory_limited': 0}
+
+    def step(self, workers, wait=None, now=None):
+        """Decisions for ``workers`` given the mean queue ``wait`` of recent requests.
+
+        Returns (decision, worker) pairs; the worker is None for SPAWN.
+        """
+        now = time.monotonic() if now is None else now
+        serving = [worker for worker in workers if worker.state != DRAINING]
+        stopping = [worker for worker in workers if worker.state == DRAINING
+                    and (worker.leases == 0 or now - worker.drain_started >= self.drain_timeout)]
+        resumable = [worker for worker in workers if worker.state == DRAINING and worker not in stopping]
+        decisions = [(STOP, worker) for worker in stopping]
+
+        largest = max((worker.memory for worker in workers), default=0)
+        memory = sum(worker.memory if worker.state != STARTING else max(worker.memory, largest)
+                     for worker in workers if worker not in stopping)
+        queued = sum(worker.queued for worker in serving)
+        busy = queued > self.target_queue * len(serving) or (wait is not None and wait > self.target_wait)
+        cooled = self._changed is None or now - self._changed >= self.cooldown
+
+        if len(serving) < self.min_workers:
+            # Up to the minimum whatever the memory
+            decisions += [(SPAWN, None)] * (self.min_workers - len(serving))
+        elif memory > self.memory_budget and len(serving) > self.min_workers:
+            # Workers loaded more models since they started
+            if cooled:
+                decisions.append((DRAIN, self._coldest(serving)))
+        elif busy:
+            self._idle_since = None
+            if cooled:
+                decisions += self._scale_up(serving, resumable, memory, largest)
+        else:
+            decisions += self._scale_down(serving, queued, now, cooled)
+
+        for decision, _ in decisions:
+            self.stats[decision] += 1
+            if decision != STOP:
+                self._changed = now
+        return decisions
+
+    def _scale_up(self, serving, resumable, memory, largest):
+        if resumable and memory <= self.memory_budget:
+            return [(RESUME, max(resumable, key=lambda worker: (len(worker.models), worker.memory)))]
+        if len(serving) >= self.max_workers:
+            return []
+        if memory + largest > self.memory_budget:
+            self.stats['memory_limited'] += 1
+            return []
+        return [(SPAWN, None)]
+
+    def _scale_down(self, serving, queued, now, cooled):
+        coldest = self._coldest(serving)
+        running = sum(worker.running for worker in serving)
+        spare = queued == 0 and running <= sum(worker.concurrency for worker in serving) - coldest.concurrency
+        if len(serving) <= self.min_workers or not spare:
+            self._idle_since = None
+            return []
+        if self._idle_since is None:
+            self._idle_since = now
+        if now - self._idle_since < self.idle_seconds or not cooled:
+            return []
+        self._idle_since = None
+        return [(DRAIN, coldest)]
+
+    @staticmethod
+    def _coldest(workers):
+        # Fewest models loaded, then least busy, then the newest
+        return min(workers, key=lambda worker: (len(worker.models), worker.memory, worker.leases, -worker.started))
+
+
+class Relay:
+    """What one HTTP worker connection holds: worker connections, output blocks and admission tickets"""
+
+    def __init__(self, supervisor, client):
+        self.supervisor = supervisor
+        self.client = client
+        self.client_gone = False
+        self.upstream = {}
+        self.blocks = {}
+        # Our ticket -> (worker, the worker's ticket); tickets of different workers may clash
+        self.tickets = {}
+        self._tickets = itertools.count(1)
+        self._admission_wait = 0.0
+
+    def _connection(self, worker):
+        conn = self.upstream.get(worker.id)
+        if conn is None:
+            try:
+                conn = Client(parse_address(worker.address), authkey=self.supervisor.authkey)
+            except OSError as e:
+                raise ModelServerUnavailable(f'Cannot reach model worker {worker.id}: {e}') from e
+            self.upstream[worker.id] = conn
+        return conn
+
+    def _drop(self, worker):
+        conn = self.upstream.pop(worker.id, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _pump(self, upstream):
+        """Pass on what the HTTP worker sends while a request runs: cancels and releases"""
+        if self.client_gone:
+            return
+        try:
+            while self.client.poll():
+                message = self.client.recv()
+                if message.get('op') == 'cancel':
+                    upstream.send(message)
+                else:
+                    self.oneway(message)
+        except (EOFError, OSError):
+            # The worker stops the request as it would for a closed connection
+            self.client_gone = True
+            upstream.send({'op': 'cancel', 'reason': DISCONNECTED})
+
+    def forward(self, worker, message):
+        """Send ``message`` to ``worker`` and return its reply, relaying progress on the way"""
+        conn = self._connection(worker)
+        try:
+            conn.send(message)
+            while True:
+                while not conn.poll(CANCEL_POLL_INTERVAL):
+                    self._pump(conn)
+                reply = conn.recv()
+                if 'progress' not in reply:
+                    return reply
+                if not self.client_gone:
+                    self.client.send(reply)
+        except (EOFError, OSError) as e:
+            self._drop(worker)
+            raise ModelServerUnavailable(f'Lost model worker {worker.id}: {e}') from e
+
+    def _held_worker(self):
+        """The worker of the latest admission ticket still held: its request is enhanced there"""
+        if not self.tickets:
+            return None
+        worker, _ = self.tickets[max(self.tickets)]
+        return worker if worker in self.supervisor.workers else None
+
+    def oneway(self, message):
+        """Handle a message that gets no reply; returns False for any other message"""
+        op = message.get('op')
+        if op == 'release':
+            worker = self.blocks.pop(message['shm'], None)
+            if worker is not None:
+                self.supervisor.lease(worker, -1)
+                self._send(worker, message)
+            return True
+        if op == 'release_admission':
+            held = self.tickets.pop(message['ticket'], None)
+            if held is not None:
+                worker, ticket = held
+                self.supervisor.lease(worker, -1)
+                self._send(worker, dict(message, ticket=ticket))
+            return True
+        return op == 'cancel'
+
+    def _send(self, worker, message):
+        try:
+            self._connection(worker).send(message)
+        except (OSError, ModelServerUnavailable):
+            # A stopped worker has let go of everything already
+            self._drop(worker)
+
+    def call(self, message):
+        op = message.get('op')
+        model = message.get('model') or (message.get('work') or {}).get('model')
+        timeout = SUPERVISOR_START_TIMEOUT if op in WORK_OPS else INFO_WAIT
+        if op == 'preload':
+            # Every serving worker loads it, so requests for it are served warm anywhere
+            reply = None
+            for worker in self.supervisor.serving(timeout):
+                reply = self.forward(worker, message)
+                if not reply.get('ok'):
+                    break
+            return reply
+        held = self._held_worker()
+        worker = held or self.supervisor.pick(model, timeout)
+        if op == 'admit':
+            started = time.perf_counter()
+            self.supervisor.lease(worker, 1)
+            try:
+                reply = self.forward(worker, message)
+            finally:
+                self.supervisor.lease(worker, -1)
+            self._admission_wait = time.perf_counter() - started
+            if reply.get('ok'):
+                ticket = next(self._tickets)
+                self.tickets[ticket] = (worker, reply['ticket'])
+                self.supervisor.lease(worker, 1)
+                reply = dict(reply, ticket=ticket)
+            return reply
+        if op == 'enhance':
+            # An admitted request holds the worker with its ticket already
+            lease = 0 if held else 1
+            self.supervisor.lease(worker, lease)
+            try:
+                reply = self.forward(worker, message)
+            finally:
+                self.supervisor.lease(worker, -lease)
+            if reply.get('ok'):
+                self.blocks[reply['image']['shm']] = worker
+                self.supervisor.lease(worker, 1)
+                self.supervisor.observe(self._admission_wait + reply['timings'].get('queue', 0.0) / 1000)
+            self._admission_wait = 0.0
+            return reply
+        reply = self.forward(worker, message)
+        if op == 'snapshot' and reply.get('ok'):
+            reply = dict(reply, snapshot=self.supervisor.merge_snapshot(worker, reply['snapshot']))
+        return reply
+
+    def close(self):
+        # Closing the connections releases the blocks and tickets in the workers
+        for worker in list(self.blocks.values()) + [worker for worker, _ in self.tickets.values()]:
+            self.supervisor.lease(worker, -1)
+        self.blocks.clear()
+        self.tickets.clear()
+        for conn in self.upstream.values():
+            try:
+                conn.close()
+            except OSError:
+                pass
+        self.upstream.clear()
+
+
+class Supervisor:
+    """Run model worker processes and route the HTTP workers' requests to them.
+
+    Every worker, draining ones included, gets an equal share of the model and admission
+    memory budgets. The shares are set when a worker starts and sent to the others when
+    the number of workers changes: lowered before a worker is added, raised after one
+    has stopped.
+
+    Args:
+        autoscaler (Autoscaler): Default: one with the SUPERVISOR_* settings.
+        command (list): Command that starts a worker listening on MODEL_SERVER_ADDRESS.
+            Default: model_server.py with this interpreter.
+        authkey (bytes): Default: MODEL_SERVER_AUTHKEY.
+        model_budget_mb (int): Default: MODEL_MEMORY_BUDGET_MB.
+        admission_budget_mb (int): Default: ADMISSION_MEMORY_BUDGET_MB.
+    """
+
+    def __init__(self, autoscaler=None, command=None, authkey=MODEL_SERVER_AUTHKEY,
+                 model_budget_mb=MODEL_MEMORY_BUDGET_MB, admission_budget_mb=ADMISSION_MEMORY_BUDGET_MB):
+        self.autoscaler = autoscaler or Autoscaler()
+        self.command = command or [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                'model_server.py')]
+        self.authkey = authkey
+        self.model_budget_mb = model_budget_mb
+        self.admission_budget_mb = admission_budget_mb
+        self.workers = []
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+        self._waits = []
+
+    def spawn(self):
+        # A private Unix socket (named pipe on Windows) per worker
+        address = arbitrary_address('AF_PIPE' if sys.platform == 'win32' else 'AF_UNIX')
+        # The others make room first
+        budgets = self.share_budgets(len(self.workers) + 1)
+        with self._cond:
+            taken = {worker.slot for worker in self.workers}
+            slot = next(slot for slot in itertools.count() if slot not in taken)
+            process = subprocess.Popen(self.command, env=dict(
+                os.environ, MODEL_SERVER_ADDRESS=address, LATENCY_MODEL_PATH=worker_path(slot),
+                MODEL_MEMORY_BUDGET_MB=str(budgets['model_mb']),
+                ADMISSION_MEMORY_BUDGET_MB=str(budgets['admission_mb'])))
+            worker = Worker(next(self._ids), address, process, slot=slot)
+            worker.budgets = budgets
+            self.workers.append(worker)
+        logger.info(f"🚀 Started model worker {worker.id} (pid {process.pid})")
+        return worker
+
+    def share_budgets(self, count=None):
+        """Send the workers their shares of the memory budgets with ``count`` workers
+        (default: as many as there are); returns the shares"""
+        with self._cond:
+            workers = list(self.workers)
+        count = max(1, len(workers) if count is None else count)
+        budgets = {'model_mb': self.model_budget_mb // count, 'admission_mb': self.admission_budget_mb // count}
+        for worker in workers:
+            if worker.budgets == budgets or worker.control is None:
+                # Not listening yet: sent with the first poll that reaches it
+                continue
+            try:
+                worker.control.send(dict(budgets, op='budgets'))
+                worker.control.recv()
+            except (EOFError, OSError):
+                worker.control.close()
+                worker.control = None
+                continue
+            worker.budgets = budgets
+            logger.info(f"Model worker {worker.id} now has {budgets['model_mb']}MB for models and "
+                        f"{budgets['admission_mb']}MB for requests")
+        return budgets
+
+    def stop(self, worker):
+        with self._cond:
+            if worker in self.workers:
+                self.workers.remove(worker)
+        if worker.control is not None:
+            worker.control.close()
+        if worker.process is not None and worker.process.poll() is None:
+            worker.process.terminate()
+            try:
+                worker.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                worker.process.kill()
+                worker.process.wait()
+        if sys.platform != 'win32' and os.path.exists(worker.address):
+            # The Unix socket outlives a terminated worker
+            os.remove(worker.address)
+        logger.info(f"🛑 Stopped model worker {worker.id}")
+        # The rest take over its memory
+        self.share_budgets()
+
+    def lease(self, worker, count):
+        with self._cond:
+            worker.leases += count
+
+    def observe(self, wait):
+        """Record how long a request waited for admission and a scheduler slot"""
+        with self._cond:
+            self._waits.append(wait)
+
+    def serving(self, timeout):
+        """Workers taking new requests, waiting up to ``timeout`` seconds for one to start"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                workers = [worker for worker in self.workers if worker.state == SERVING]
+                remaining = deadline - time.monotonic()
+                if workers or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+        if not workers:
+            raise ModelServerUnavailable('No model worker is serving')
+        return workers
+
+    def pick(self, model=None, timeout=INFO_WAIT):
+        """The serving worker for a request for ``model``.
+
+        The least busy, counted in batches of what a worker runs at once, and within
+        that one that has ``model`` loaded.
+        """
+        workers = self.serving(timeout)
+        with self._cond:
+            return min(workers, key=lambda worker: (worker.leases // max(worker.concurrency, 1),
+                                                    model is not None and model not in worker.models,
+                                                    worker.leases))
+
+    def poll(self, worker):
+        """Refresh what ``worker`` reports; it is serving from the first answer on"""
+        try:
+            if worker.control is None:
+                worker.control = Client(parse_address(worker.address), authkey=self.authkey)
+            worker.control.send({'op': 'scheduler'})
+            scheduler = worker.control.recv()['scheduler']
+            worker.control.send({'op': 'snapshot'})
+            snapshot = worker.control.recv()['snapshot']
+        except (EOFError, OSError, KeyError):
+            # Not listening yet, or gone (noticed from its exit code)
+            if worker.control is not None:
+                worker.control.close()
+                worker.control = None
+            return
+        with self._cond:
+            worker.queued = scheduler['queued'] + snapshot['admission']['queued']
+            worker.running = scheduler['running']
+            worker.concurrency = scheduler['concurrency']
+            worker.memory = int(snapshot['used_mb'] * 1024 * 1024)
+            worker.models = sorted({slot['model'] for slot in snapshot['slots'].values() if slot['model']})
+            if worker.state == STARTING:
+                worker.state = SERVING
+                logger.info(f"✅ Model worker {worker.id} is serving")
+                self._cond.notify_all()
+
+    def tick(self, now=None):
+        """Poll the workers and carry out the autoscaler's decisions"""
+        for worker in list(self.workers):
+            if worker.process is not None and worker.process.poll() is not None:
+                logger.warning(f"Model worker {worker.id} exited with code {worker.process.returncode}")
+                self.stop(worker)
+        for worker in list(self.workers):
+            self.poll(worker)
+        # Workers that could not be reached when the count last changed
+        self.share_budgets()
+        with self._cond:
+            waits, self._waits = self._waits, []
+            wait = sum(waits) / len(waits) if waits else None
+            decisions = self.autoscaler.step(self.workers, wait, now)
+        for decision, worker in decisions:
+            if decision == SPAWN:
+                self.spawn()
+            elif decision == STOP:
+                self.stop(worker)
+            else:
+                with self._cond:
+                    worker.state = DRAINING if decision == DRAIN else SERVING
+                    worker.drain_started = (time.monotonic() if now is None else now) if decision == DRAIN else None
+                    self._cond.notify_all()
+                logger.info(f"{'Draining' if decision == DRAIN else 'Resuming'} model worker {worker.id} "
+                            f"({len(self.workers)} workers)")
+        return decisions
+
+    def run(self, interval=SUPERVISOR_INTERVAL):
+        while True:
+            try:
+                self.tick()
+            except Exception:
+                logger.exception("Supervisor tick failed")
+            time.sleep(interval)
+
+    def start(self):
+        """Start the minimum of workers and keep scaling them in the background"""
+        self.tick()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'workers': [worker.to_dict() for worker in self.workers],
+                'min_workers': self.autoscaler.min_workers,
+                'max_workers': self.autoscaler.max_workers,
+                'memory_budget_mb': round(self.autoscaler.memory_budget / (1024 * 1024), 1),
+                'stats': dict(self.autoscaler.stats)
+            }
+
+    def merge_snapshot(self, worker, snapshot):
+        """One worker's registry snapshot, with the models and memory of every worker"""
+        with self._cond:
+            others = [other for other in self.workers if other is not worker]
+        snapshot = dict(snapshot, supervisor=self.snapshot())
+        snapshot['used_mb'] = round(snapshot['used_mb'] + sum(other.memory for other in others) / (1024 * 1024), 1)
+        snapshot['slots'] = {f'{worker.id}/{key}': slot for key, slot in snapshot['slots'].items()}
+        for other in others:
+            for model in other.models:
+                snapshot['slots'].setdefault(f'{other.id}/{model}', {'model': model, 'size_mb': None, 'in_use': None})
+        return snapshot
+
+    def handle_connection(self, conn):
+        """Relay one HTTP worker thread's requests until it disconnects"""
+        relay = Relay(self, conn)
+        try:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    break
+                if relay.oneway(message):
+                    continue
+                try:
+                    reply = relay.call(message)
+                except ModelServerUnavailable as e:
+                    reply = {'ok': False, 'error': 'unavailable', 'message': str(e)}
+                if relay.client_gone:
+                    break
+                try:
+                    conn.send(reply)
+                except (EOFError, OSError):
+                    break
+        finally:
+            relay.close()
+            conn.close()
+
+
+def serve(address, supervisor, authkey=MODEL_SERVER_AUTHKEY):
+    """Accept HTTP worker connections forever, one thread per connection"""
+    address = parse_address(address)
+    with Listener(address, authkey=authkey) as listener:
+        logger.info(f"Supervisor listening on {address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                logger.warning(f"Rejected supervisor connection: {e}")
+                continue
+            if isinstance(address, tuple):
+                set_nodelay(conn)
+            threading.Thread(target=supervisor.handle_connection, args=(conn,), daemon=True).start()
+
+
+if __name__ == '__main__':
+    logs.configure()
+
+    address = MODEL_SERVER_ADDRESS or DEFAULT_ADDRESS
+    logger.info(f"🚀 Starting model worker supervisor on {address}...")
+    supervisor = Supervisor()
+    # Workers go down with the supervisor
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    supervisor.start()
+    try:
+        serve(address, supervisor)
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        for worker in list(supervisor.workers):
+            supervisor.stop(worker)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The API modules import each other as top-level modules (they run from api/)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Traces of the code under test are not written to outputs/
+os.environ.setdefault('TRACE_EXPORT', 'none')
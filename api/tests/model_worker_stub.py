@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Model worker for the supervisor tests: model_server.py serving a DoublingBackend
+(see test_model_server.py) instead of Real-ESRGAN
+"""
+
+import os
+import sys
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(TESTS), TESTS]
+
+import model_server
+from test_model_server import DoublingBackend
+
+
+class StubWorker(DoublingBackend):
+    """Reports what the supervisor polls for, and the memory budgets it was given in MB"""
+
+    def __init__(self):
+        super().__init__()
+        self.budgets = {'model_mb': int(os.environ['MODEL_MEMORY_BUDGET_MB']),
+                        'admission_mb': int(os.environ['ADMISSION_MEMORY_BUDGET_MB'])}
+
+    def scheduler_stats(self):
+        return {'queued': 0, 'running': 0, 'concurrency': 1}
+
+    def set_memory_budgets(self, model_budget, admission_budget):
+        self.budgets = {'model_mb': model_budget // (1024 * 1024), 'admission_mb': admission_budget // (1024 * 1024)}
+
+    def snapshot(self):
+        return dict(super().snapshot(), used_mb=0.0, slots={}, admission={'queued': 0}, budgets=self.budgets)
+
+
+if __name__ == '__main__':
+    model_server.serve(os.environ['MODEL_SERVER_ADDRESS'], StubWorker())
@@ -0,0 +1,143 @@
+import threading
+import time
+
+import pytest
+
+from admission import (AdmissionController, AdmissionRejected, BUSY, TOO_LARGE, admitted, estimate_cost,
+                       estimate_peak_memory)
+
+MB = 1024 * 1024
+
+
+class Backend:
+    """The admission part of an inference backend"""
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    def admit(self, cost, memory, timeout=None, work=None):
+        return self.controller.admit(cost, memory, timeout=timeout)
+
+    def release_admission(self, ticket):
+        self.controller.release(ticket)
+
+
+def test_requests_are_admitted_within_the_budgets():
+    controller = AdmissionController(cost_budget=2.0, memory_budget=100 * MB, max_wait=0, max_queue=4)
+    first = controller.admit(1.0, 40 * MB)
+    second = controller.admit(1.0, 40 * MB)
+    # Over the cost budget, and no time to wait
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit(0.5, 10 * MB)
+    assert rejected.value.reason == BUSY and rejected.value.retry_after >= 1
+
+    controller.release(first)
+    controller.admit(0.5, 10 * MB)
+    assert controller.snapshot()['active'] == 2 and controller.memory_in_use == 50 * MB
+    controller.release(second)
+    assert controller.stats == {'admitted': 3, 'queued': 0, 'rejected': 1, 'too_large': 0}
+
+
+def test_one_request_runs_alone_whatever_its_cost_unless_it_cannot_fit_in_memory():
+    controller = AdmissionController(cost_budget=1.0, memory_budget=100 * MB)
+    ticket = controller.admit(50.0, 90 * MB)
+    controller.release(ticket)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit(0.1, 101 * MB)
+    assert rejected.value.reason == TOO_LARGE and rejected.value.retry_after is None
+
+
+def test_waiting_requests_are_admitted_in_arrival_order():
+    controller = AdmissionController(cost_budget=1.0, memory_budget=100 * MB, max_wait=5)
+    running = controller.admit(1.0, MB)
+    order = []
+
+    def wait(name, cost):
+        ticket = controller.admit(cost, MB)
+        order.append(name)
+        controller.release(ticket)
+
+    threads = []
+    for name, cost in (('large', 1.0), ('small', 0.1)):
+        threads.append(threading.Thread(target=wait, args=(name, cost)))
+        threads[-1].start()
+        # The small request may not overtake the large one queued ahead of it
+        while controller.snapshot()['queued'] < len(threads):
+            time.sleep(0.01)
+    controller.release(running)
+    for thread in threads:
+        thread.join(5)
+    assert order == ['large', 'small'] and controller.stats['queued'] == 2
+
+
+def test_a_full_queue_rejects_with_retry_after_from_predicted_run_times():
+    controller = AdmissionController(cost_budget=1.0, memory_budget=100 * MB, max_wait=5, max_queue=0)
+    controller.admit(1.0, MB, seconds=30.0)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit(1.0, MB, seconds=10.0)
+    # The request ahead has about 30 seconds left
+    assert rejected.value.reason == BUSY and 29 <= rejected.value.retry_after <= 30
+
+
+def test_a_wait_that_runs_out_is_rejected_and_releases_its_place():
+    controller = AdmissionController(cost_budget=1.0, memory_budget=100 * MB, max_wait=0.1)
+    ticket = controller.admit(1.0, MB)
+    started = time.monotonic()
+    with pytest.raises(AdmissionRejected):
+        controller.admit(1.0, MB)
+    assert 0.1 <= time.monotonic() - started < 1.0
+    assert controller.snapshot()['queued'] == 0
+    controller.release(ticket)
+
+    backend = Backend(controller)
+    with admitted(backend, 1.0, MB) as held:
+        assert held in controller._active
+    assert controller.snapshot()['active'] == 0
+
+
+def test_a_lowered_memory_budget_holds_new_requests_back_until_running_ones_finish():
+    controller = AdmissionController(cost_budget=10.0, memory_budget=100 * MB, max_wait=5)
+    running = controller.admit(1.0, 60 * MB)
+    controller.set_memory_budget(50 * MB)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit(1.0, 60 * MB)
+    assert rejected.value.reason == TOO_LARGE
+
+    outcome = []
+
+    def wait(memory):
+        try:
+            outcome.append(controller.release(controller.admit(1.0, memory)) or memory)
+        except AdmissionRejected as e:
+            outcome.append(e.reason)
+
+    small = threading.Thread(target=wait, args=(10 * MB,))
+    small.start()
+    # Over the new budget while the earlier request runs
+    while controller.snapshot()['queued'] < 1:
+        time.sleep(0.01)
+    controller.release(running)
+    small.join(5)
+    assert outcome == [10 * MB]
+
+    # A request queued under a larger budget is rejected once it no longer fits
+    running = controller.admit(1.0, 40 * MB)
+    large = threading.Thread(target=wait, args=(45 * MB,))
+    large.start()
+    while controller.snapshot()['queued'] < 1:
+        time.sleep(0.01)
+    controller.set_memory_budget(40 * MB)
+    large.join(5)
+    assert outcome == [10 * MB, TOO_LARGE] and controller.snapshot()['queued'] == 0
+    controller.release(running)
+
+
+def test_estimates_grow_with_the_image_and_the_model():
+    small = estimate_peak_memory(500, 500, 3, 'realesr-general-x4v3')
+    assert estimate_peak_memory(1000, 1000, 3, 'realesr-general-x4v3') > 3 * small
+    assert estimate_peak_memory(500, 500, 4, 'realesr-general-x4v3') > small
+    # 16-bit samples take twice the bytes wherever the image is held as integers
+    deep = estimate_peak_memory(500, 500, 3, 'realesr-general-x4v3', bit_depth=16)
+    assert 1.2 * small < deep < 2 * small
+    assert estimate_cost(1000, 1000, 'RealESRGAN_x4plus') == 1.0
+    assert estimate_cost(1000, 1000, 'realesr-general-x4v3') < 1.0
@@ -0,0 +1,128 @@
+import socket
+import threading
+import time
+
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from cancellation import CANCELLED, DEADLINE, DISCONNECTED, CancelToken, Cancelled, socket_disconnected
+from jobs import CANCELLED as JOB_CANCELLED, DONE, Job, JobStore
+from scheduler import FairScheduler
+
+
+def test_token_deadline_and_poll():
+    token = CancelToken.after(0.05)
+    assert not token.cancelled and 0 < token.remaining() <= 0.05
+    assert token.timeout(10) <= 0.05 and token.timeout(None) <= 0.05
+    time.sleep(0.06)
+    with pytest.raises(Cancelled) as cancelled:
+        token.check()
+    assert cancelled.value.reason == DEADLINE
+    # The first reason sticks
+    assert not token.cancel()
+    assert token.reason == DEADLINE
+
+    polls = []
+    token = CancelToken(poll=lambda: polls.append(1) or (DISCONNECTED if len(polls) >= 3 else None))
+    assert token.remaining() is None and token.timeout(5) == 5
+    assert [token.cancelled for _ in range(3)] == [False, False, True]
+    assert token.reason == DISCONNECTED and len(polls) == 3
+
+    token = CancelToken.after(0)
+    assert token.deadline is None
+    assert token.cancel() and token.reason == CANCELLED
+
+
+def test_socket_disconnected():
+    client, server = socket.socketpair()
+    try:
+        assert not socket_disconnected(server)
+        # Bytes of a pipelined next request are not a disconnect, and are left unread
+        client.sendall(b'GET')
+        assert not socket_disconnected(server)
+        client.close()
+        assert server.recv(3) == b'GET'
+        assert socket_disconnected(server)
+    finally:
+        server.close()
+
+
+def upsampler(tmp_path, tile):
+    from realesrgan import RealESRGANer
+
+    model = nn.Sequential(nn.Conv2d(3, 12, 1), nn.PixelShuffle(2))
+    path = tmp_path / 'tiny.pth'
+    torch.save({'params': model.state_dict()}, path)
+    return RealESRGANer(2, str(path), model=model, tile=tile, tile_pad=2, pre_pad=0, device=torch.device('cpu'))
+
+
+def test_tile_loop_stops_between_tiles_and_frees_buffers(tmp_path):
+    esrgan = upsampler(tmp_path, tile=16)
+    img = np.random.randint(0, 256, (48, 48, 3), np.uint8)
+    token = CancelToken()
+    progress = []
+
+    def on_progress(done, total):
+        progress.append((done, total))
+        if done == 3:
+            token.cancel()
+
+    with pytest.raises(Cancelled):
+        esrgan.enhance(img, progress_callback=on_progress, cancel=token)
+    assert progress == [(1, 9), (2, 9), (3, 9)]
+    assert esrgan.img is None and esrgan.output is None
+
+    output, _ = esrgan.enhance(img, cancel=CancelToken())
+    assert output.shape == (96, 96, 3)
+
+
+def test_scheduler_slot_leaves_queue_when_cancelled():
+    scheduler = FairScheduler(concurrency=1)
+    token = CancelToken()
+    with scheduler.slot('a', 1.0):
+        threading.Timer(0.05, token.cancel).start()
+        with pytest.raises(Cancelled):
+            with scheduler.slot('b', 1.0, cancel=token):
+                pass
+        assert scheduler.snapshot()['queued'] == 0
+    with scheduler.slot('b', 1.0):
+        assert scheduler.running == 1
+
+
+def test_cancel_queued_and_running_jobs(tmp_path):
+    store = JobStore(str(tmp_path), workers=1)
+    started = threading.Event()
+
+    def work(job):
+        started.set()
+        for tile in range(1000):
+            job.cancel_token.check()
+            time.sleep(0.01)
+        return {}
+
+    running = store.submit(Job('m', 4, 'a.png'), work)
+    queued = store.submit(Job('m', 4, 'b.png'), work)
+    assert started.wait(1)
+
+    # A queued job ends straight away and its work is dropped
+    assert store.cancel(queued)
+    assert queued.state == JOB_CANCELLED and queued.cancel_reason == CANCELLED
+
+    assert store.cancel(running)
+    deadline = time.monotonic() + 2
+    while not running.terminal and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert running.state == JOB_CANCELLED
+    assert [name for name, _ in running.events][-1] == 'cancelled'
+
+    expired = store.submit(Job('m', 4, 'c.png', deadline=0.05), work)
+    while not expired.terminal and time.monotonic() < deadline + 2:
+        time.sleep(0.01)
+    assert (expired.state, expired.cancel_reason) == (JOB_CANCELLED, DEADLINE)
+
+    done = store.submit(Job('m', 4, 'd.png'), lambda job: {'ok': True})
+    while not done.terminal:
+        time.sleep(0.01)
+    assert done.state == DONE and not store.cancel(done)
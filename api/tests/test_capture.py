@@ -0,0 +1,121 @@
+import json
+import random
+import zlib
+
+import cv2
+import numpy as np
+import pytest
+
+from benchmarks.replay import Workload, compare_groups, form_of, ks_2samp, replay_flat_out, size_bucket
+from capture import TrafficCapture, anonymise, load_records, scramble
+from image_probe import ImageInfo
+
+
+def png(img):
+    return cv2.imencode('.png', img)[1].tobytes()
+
+
+def test_records_are_written_in_the_background(tmp_path):
+    capture = TrafficCapture(str(tmp_path), enabled=True, inputs='none')
+    info = ImageInfo('png', 64, 48, 3)
+    capture.record('enhance', info, 'ok', 812.25, data=b'x' * 100, tenant='ip:10.0.0.1',
+                   model='auto', served_model='realesr-animevideov3', scale=None)
+    capture.record('job', info, 'deadline', 30000, data=b'x' * 100, tenant='ip:10.0.0.2')
+    capture.flush()
+
+    # In arrival order: the job started 30 s before it ended
+    second, first = load_records(str(tmp_path))
+    assert first['endpoint'] == 'enhance' and second['outcome'] == 'deadline'
+    assert (first['width'], first['height'], first['format'], first['bytes']) == (64, 48, 'png', 100)
+    assert first['served_model'] == 'realesr-animevideov3' and first['latency_ms'] == 812.2
+    # Tenants are salted hashes, stable within the store; no inputs unless asked for
+    assert len(first['tenant']) == 12 and first['tenant'] != second['tenant']
+    assert 'ip:' not in (tmp_path / 'records.jsonl').read_text()
+    assert first['input'] is None and not list((tmp_path / 'inputs').iterdir())
+
+    disabled = TrafficCapture(str(tmp_path / 'off'), enabled=False)
+    disabled.record('enhance', info, 'ok', 1.0)
+    sampled = TrafficCapture(str(tmp_path / 'sampled'), enabled=True, sample_rate=0.0)
+    sampled.record('enhance', info, 'ok', 1.0)
+    assert not (tmp_path / 'off').exists() and not (tmp_path / 'sampled').exists()
+    with pytest.raises(ValueError):
+        TrafficCapture(str(tmp_path), inputs='raw')
+
+
+def test_inputs_are_anonymised(tmp_path):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (40, 56, 3), np.uint8)
+    # A tEXt chunk with something identifying in it
+    data = bytearray(png(img))
+    text = b'tEXtAuthor\x00Jane Doe'
+    chunk = len(text[4:]).to_bytes(4, 'big') + text + zlib.crc32(text).to_bytes(4, 'big')
+    data[33:33] = chunk
+
+    stripped, ext = anonymise(bytes(data), 'png', 'stripped')
+    assert ext == '.png' and b'Jane Doe' not in stripped
+    assert np.array_equal(cv2.imdecode(np.frombuffer(stripped, np.uint8), cv2.IMREAD_UNCHANGED), img)
+
+    scrambled, _ = anonymise(bytes(data), 'png', 'scrambled', seed=1)
+    shuffled = cv2.imdecode(np.frombuffer(scrambled, np.uint8), cv2.IMREAD_UNCHANGED)
+    assert shuffled.shape == img.shape and not np.array_equal(shuffled, img)
+    # Same pixels in other places, and the ragged edges are left alone
+    assert sorted(shuffled[:32, :48].reshape(-1, 3).tolist()) == sorted(img[:32, :48].reshape(-1, 3).tolist())
+    assert np.array_equal(shuffled[32:], img[32:]) and np.array_equal(shuffled[:, 48:], img[:, 48:])
+    assert np.array_equal(scramble(img[:16, :16], np.random.default_rng(0)), img[:16, :16])
+
+    capture = TrafficCapture(str(tmp_path), enabled=True, inputs='scrambled')
+    info = ImageInfo('png', 56, 40, 3)
+    for _ in range(2):
+        capture.record('enhance', info, 'ok', 100.0, data=np.frombuffer(bytes(data), np.uint8))
+    capture.flush()
+    records = load_records(str(tmp_path))
+    # The same upload is stored once
+    assert records[0]['input'] == records[1]['input'] and len(list((tmp_path / 'inputs').iterdir())) == 1
+    stored = Workload(str(tmp_path), records).input_of(records[0])
+    assert b'Jane Doe' not in stored and cv2.imdecode(np.frombuffer(stored, np.uint8), 1).shape == img.shape
+
+
+def test_replay_keeps_pacing_and_synthesizes_missing_inputs(tmp_path):
+    records = [{'t': 100.0, 'endpoint': 'enhance', 'format': 'jpeg', 'width': 64, 'height': 32, 'input': None,
+                'model': 'auto', 'served_model': 'realesr-general-x4v3', 'scale': 2.0,
+                'output_format': {'format': 'webp', 'mime': 'image/webp', 'lossless': True}},
+               {'t': 103.0, 'endpoint': 'job', 'format': 'png', 'width': 2000, 'height': 1500, 'input': 'gone.png',
+                'model': 'RealESRGAN_x4plus', 'scale': None, 'output_format': {'format': 'png', 'mime': 'image/png'}}]
+    workload = Workload(str(tmp_path), records)
+    assert [workload.offset(record, speed=2) for record in records] == [0.0, 1.5]
+    data = workload.input_of(records[0])
+    assert cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED).shape == (32, 64, 3)
+    assert workload.input_of(records[0]) is data
+    assert form_of(records[0]) == {'model': 'auto', 'scale': '2.0', 'format': 'webp', 'lossless': 'true'}
+    assert form_of(records[1]) == {'model': 'RealESRGAN_x4plus', 'format': 'png'}
+    assert size_bucket(64, 32) == '<0.25MP' and size_bucket(2000, 1500) == '1-4MP'
+
+    class Replayer:
+        def __init__(self):
+            self.sent = []
+
+        def send(self, record, data):
+            self.sent.append(record['endpoint'])
+            return (200 if record['endpoint'] == 'enhance' else 500), {}
+
+    replayer = Replayer()
+    samples, _ = replay_flat_out(replayer, workload, concurrency=1)
+    assert replayer.sent == ['enhance', 'job']
+    assert [(sample[0], sample[3], sample[4]['model']) for sample in samples] == [
+        ('enhance', 200, 'realesr-general-x4v3'), ('job', 500, 'RealESRGAN_x4plus')]
+
+
+def test_distributions_are_compared():
+    rng = random.Random(0)
+    same = [rng.gauss(100, 10) for _ in range(300)], [rng.gauss(100, 10) for _ in range(300)]
+    statistic, p = ks_2samp(*same)
+    assert statistic < 0.1 and p > 0.05
+    statistic, p = ks_2samp([1, 2, 3], [4, 5, 6])
+    assert statistic == 1.0 and p < 0.1
+    assert ks_2samp([], [1]) == (None, None)
+
+    slower = [value * 1.3 for value in same[1]]
+    rows = compare_groups({'all': same[0], 'x4 <0.25MP': same[0]}, {'all': same[1], 'x4 <0.25MP': slower})
+    assert not rows['all']['regression']
+    assert rows['x4 <0.25MP']['regression'] and rows['x4 <0.25MP']['candidate']['p50'] > 120
+    json.dumps(rows)
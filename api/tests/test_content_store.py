@@ -0,0 +1,59 @@
+import hashlib
+import io
+import os
+import time
+
+import cv2
+import numpy as np
+
+from content_store import ContentStore
+from image_probe import probe_image
+from singleflight import content_key, flight_key
+
+
+def encoded(width, height, seed=0):
+    img = np.random.default_rng(seed).integers(0, 256, (height, width, 3), np.uint8)
+    return cv2.imencode('.png', img)[1].tobytes()
+
+
+def test_sources_and_results_by_key(tmp_path):
+    store = ContentStore(str(tmp_path))
+    data = encoded(40, 30)
+    sha256 = hashlib.sha256(data).hexdigest()
+    key = content_key(sha256, 'ip:1', 'source')
+    assert store.open_source(key) is None and not store.has_source(key)
+
+    store.put_source(key, np.frombuffer(data, np.uint8), sha256, probe_image(io.BytesIO(data)))
+    stream = store.open_source(key)
+    with stream:
+        assert stream.read() == data
+        assert stream.filename == 'image.png' and stream.sha256 == sha256
+        assert (stream.info.width, stream.info.height) == (40, 30)
+    # The hash of the stored stream keys the same flights as the upload did
+    assert flight_key(store.open_source(key, 'a.png'), 'enhance', 2.0) == flight_key(io.BytesIO(data), 'enhance', 2.0)
+
+    result_key = content_key(sha256, 'ip:1', 'enhance', 'realesr-general-x4v3', 2.0, {'format': 'png'})
+    assert store.get_result(result_key) is None
+    store.put_result(result_key, b'enhanced', {'model_used': 'realesr-general-x4v3'})
+    assert store.get_result(result_key) == (b'enhanced', {'model_used': 'realesr-general-x4v3'})
+    # Anything but a hex SHA-256 is not a key, and cannot reach outside the store
+    assert store.get_result('../../etc/passwd') is None and store.open_source('') is None
+    assert not [name for name in os.listdir(tmp_path / 'results') if name.endswith('.part')]
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    store = ContentStore(str(tmp_path), max_bytes=1000)
+    keys = [hashlib.sha256(bytes([index])).hexdigest() for index in range(4)]
+    for index, key in enumerate(keys[:3]):
+        store.put_result(key, bytes(300), {'index': index})
+        os.utime(tmp_path / 'results' / f'{key}.data', (time.time() - 100 + index,) * 2)
+    # Reading the oldest makes it the most recently used
+    assert store.get_result(keys[0]) is not None
+    store.put_result(keys[3], bytes(300), {'index': 3})
+
+    assert store.get_result(keys[1]) is None
+    assert all(store.get_result(key) is not None for key in (keys[0], keys[2], keys[3]))
+    assert store.stats() == {'bytes': 900, 'max_bytes': 1000}
+    # Too large for the budget: not kept at all
+    store.put_result(hashlib.sha256(b'big').hexdigest(), bytes(950), {})
+    assert store.stats()['bytes'] == 900
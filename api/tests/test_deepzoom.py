@@ -0,0 +1,111 @@
+import os
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from deepzoom import DeepZoom, Pyramid, render_region
+from singleflight import SingleFlight
+
+SCALE = 4
+
+
+def fake_enhance(crop):
+    """Local like a network: each output pixel depends on a 3x3 neighbourhood of the input"""
+    blurred = cv2.blur(crop, (3, 3), borderType=cv2.BORDER_REFLECT)
+    return cv2.resize(blurred, (crop.shape[1] * SCALE, crop.shape[0] * SCALE), interpolation=cv2.INTER_NEAREST)
+
+
+@pytest.fixture
+def source():
+    return np.random.default_rng(0).integers(0, 256, (96, 160, 3), dtype=np.uint8)
+
+
+def test_pyramid_geometry():
+    pyramid = Pyramid('a' * 32, 1000, 600, 'm', 4, tile_size=256, overlap=1)
+    # 4000 px across at full size: 12 levels, the last 4 of them larger than the source
+    assert pyramid.max_level == 12
+    assert pyramid.level_size(12) == (4000, 2400) and pyramid.level_size(10) == (1000, 600)
+    assert pyramid.level_size(0) == (1, 1)
+    assert [pyramid.enhanced(level) for level in (10, 11, 12)] == [False, True, True]
+    assert pyramid.grid(12) == (16, 10)
+    assert pyramid.tile_rect(12, 0, 0) == (0, 0, 257, 257)
+    assert pyramid.tile_rect(12, 1, 1) == (255, 255, 258, 258)
+    assert pyramid.tile_rect(12, 15, 9) == (3839, 2303, 161, 97)
+    assert pyramid.tile_rect(12, 16, 0) is None and pyramid.tile_rect(13, 0, 0) is None
+    assert 'Format="jpg" Overlap="1" TileSize="256"' in pyramid.to_dzi()
+    assert '<Size Width="4000" Height="2400"/>' in pyramid.to_dzi()
+    assert Pyramid.from_dict(pyramid.to_dict()).to_dict() == pyramid.to_dict()
+    with pytest.raises(ValueError):
+        Pyramid('a' * 32, 10, 10, 'm', 3)
+
+
+def assemble(pyramid, source, level):
+    width, height = pyramid.level_size(level)
+    cols, rows = pyramid.grid(level)
+    out = np.zeros((height, width, 3), np.uint8)
+    for row in range(rows):
+        for col in range(cols):
+            x, y, w, h = pyramid.tile_rect(level, col, row)
+            tile = render_region(source, x, y, w, h, pyramid.level_scale(level), SCALE, fake_enhance, halo=4)
+            assert tile.shape == (h, w, 3)
+            out[y:y + h, x:x + w] = tile
+    return out
+
+
+@pytest.mark.parametrize('level_offset', [0, 1, 2, 3])
+def test_tiles_are_seamless(source, level_offset):
+    pyramid = Pyramid('a' * 32, 160, 96, 'm', SCALE, tile_size=64, overlap=1)
+    level = pyramid.max_level - level_offset
+    width, height = pyramid.level_size(level)
+    whole = render_region(source, 0, 0, width, height, pyramid.level_scale(level), SCALE, fake_enhance, halo=4)
+    if level_offset >= 2:
+        # At or below the source size tiles are box-downscales of the source
+        expected = cv2.resize(source, (width, height), interpolation=cv2.INTER_AREA)
+        assert np.array_equal(whole, expected)
+    assert np.array_equal(assemble(pyramid, source, level), whole)
+
+
+def test_region_is_the_same_pixels_as_the_whole_image(source):
+    whole = fake_enhance(source)
+    region = render_region(source, 37 * SCALE, 21 * SCALE, 50 * SCALE, 30 * SCALE, SCALE, SCALE, fake_enhance)
+    assert np.array_equal(region, whole[21 * SCALE:51 * SCALE, 37 * SCALE:87 * SCALE])
+
+
+def test_tiles_render_once_and_prefetch_neighbours(source, tmp_path):
+    crops = []
+
+    def enhance(crop, model_name, tenant, cancel):
+        crops.append((crop.shape, model_name, tenant))
+        return fake_enhance(crop)
+
+    deepzoom = DeepZoom(str(tmp_path), enhance, SingleFlight(), prefetch_workers=1)
+    pyramid = deepzoom.create(source, 'b' * 32, 'm', SCALE, 'png')
+    assert deepzoom.create(source, 'b' * 32, 'other', SCALE, 'png').model_name == 'm'
+    assert deepzoom.get('../etc') is None and deepzoom.get('c' * 32) is None
+
+    level = pyramid.max_level
+    data = deepzoom.tile(pyramid, level, 1, 1, tenant=('ip:1', 1.0))
+    tile = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    x, y, w, h = pyramid.tile_rect(level, 1, 1)
+    assert np.array_equal(tile, render_region(source, x, y, w, h, SCALE, SCALE, fake_enhance))
+    assert crops == [(crops[0][0], 'm', ('ip:1', 1.0))]
+    assert deepzoom.tile(pyramid, level, 1, 1) == data and len(crops) == 1
+    assert deepzoom.tile(pyramid, level, 99, 0) is None
+
+    deepzoom.prefetch(pyramid, level, 1, 1)
+    # The full-size level is 3x2 tiles of 256
+    neighbours = [(col, row) for col in range(3) for row in range(2) if (col, row) != (1, 1)]
+    deadline = time.monotonic() + 10
+    while not all(os.path.exists(deepzoom.tile_path(pyramid, level, *n)) for n in neighbours):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert len(crops) == 6 and crops[-1][2][0] == 'deepzoom-prefetch'
+
+    # Overview levels never reach the model
+    assert deepzoom.tile(pyramid, 3, 0, 0) is not None and len(crops) == 6
+
+    deepzoom.ttl = -1
+    deepzoom.purge()
+    assert deepzoom.get(pyramid.id) is None
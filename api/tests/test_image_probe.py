@@ -0,0 +1,94 @@
+import io
+import struct
+import zlib
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from image_probe import check_image_info, probe_image
+
+
+def pil_bytes(image, fmt, **params):
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **params)
+    return buffer.getvalue()
+
+
+def frames(mode, fmt, **params):
+    first, *rest = [Image.new(mode, (123, 45), color) for color in ('black', 'red', 'blue')]
+    return pil_bytes(first, fmt, save_all=True, append_images=rest, **params)
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+CASES = {
+    'png_rgb': (pil_bytes(Image.new('RGB', (123, 45)), 'PNG'), ('png', 3, 8, 1)),
+    'png_rgba': (pil_bytes(Image.new('RGBA', (123, 45)), 'PNG'), ('png', 4, 8, 1)),
+    'png_gray': (pil_bytes(Image.new('L', (123, 45)), 'PNG'), ('png', 1, 8, 1)),
+    'png_gray_alpha': (pil_bytes(Image.new('LA', (123, 45)), 'PNG'), ('png', 4, 8, 1)),
+    'png_palette_transparent': (pil_bytes(Image.new('P', (123, 45)), 'PNG', transparency=0), ('png', 4, 1, 1)),
+    'png_16bit': (cv2.imencode('.png', np.zeros((45, 123, 3), np.uint16))[1].tobytes(), ('png', 3, 16, 1)),
+    'apng': (frames('RGB', 'PNG'), ('png', 3, 8, 3)),
+    'jpeg': (pil_bytes(Image.new('RGB', (123, 45)), 'JPEG'), ('jpeg', 3, 8, 1)),
+    'jpeg_gray': (pil_bytes(Image.new('L', (123, 45)), 'JPEG'), ('jpeg', 1, 8, 1)),
+    'jpeg_progressive': (pil_bytes(Image.new('RGB', (123, 45)), 'JPEG', progressive=True), ('jpeg', 3, 8, 1)),
+    'jpeg_cmyk': (pil_bytes(Image.new('CMYK', (123, 45)), 'JPEG'), ('jpeg', 3, 8, 1)),
+    'webp_lossy': (pil_bytes(Image.new('RGB', (123, 45)), 'WEBP'), ('webp', 3, 8, 1)),
+    'webp_lossless_alpha': (pil_bytes(Image.new('RGBA', (123, 45), (1, 2, 3, 4)), 'WEBP', lossless=True),
+                            ('webp', 4, 8, 1)),
+    'webp_extended_alpha': (pil_bytes(Image.new('RGBA', (123, 45)), 'WEBP'), ('webp', 4, 8, 1)),
+    'webp_animated': (frames('RGB', 'WEBP'), ('webp', 3, 8, 3)),
+    'gif': (pil_bytes(Image.new('P', (123, 45)), 'GIF'), ('gif', 3, 8, 1)),
+    'gif_animated': (frames('RGB', 'GIF'), ('gif', 4, 8, 3)),
+    'bmp': (cv2.imencode('.bmp', np.zeros((45, 123, 3), np.uint8))[1].tobytes(), ('bmp', 3, 8, 1)),
+}
+
+
+@pytest.mark.parametrize('name', CASES)
+def test_probe_matches_decoder(name):
+    data, (fmt, channels, bit_depth, frame_count) = CASES[name]
+    info = probe_image(io.BytesIO(data))
+    assert (info.format, info.width, info.height) == (fmt, 123, 45)
+    assert (info.channels, info.bit_depth, info.frames) == (channels, bit_depth, frame_count)
+
+    decoded = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    assert decoded.shape[:2] == (45, 123)
+    # The channel count bounds what cv2 allocates
+    assert (decoded.shape[2] if decoded.ndim == 3 else 1) <= info.channels
+
+
+def test_probe_rewinds_stream():
+    stream = io.BytesIO(b'junk' + CASES['webp_animated'][0])
+    stream.seek(4)
+    assert probe_image(stream).frames == 3
+    assert stream.tell() == 4
+
+
+@pytest.mark.parametrize('data', [b'', b'not an image', CASES['png_rgb'][0][:20], CASES['jpeg'][0][:40],
+                                  CASES['gif'][0][:12], b'BM' + b'\0' * 10])
+def test_probe_rejects_malformed(data):
+    assert probe_image(io.BytesIO(data)) is None
+
+
+def test_probe_reads_decompression_bomb_without_decoding():
+    # A few KB claiming 400 megapixels
+    ihdr = struct.pack('>IIBBBBB', 20000, 20000, 8, 2, 0, 0, 0)
+    data = (b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', ihdr) + png_chunk(b'IDAT', zlib.compress(b'\0' * 60001 * 64))
+            + png_chunk(b'IEND', b''))
+    assert len(data) < 10000
+    info = probe_image(io.BytesIO(data))
+    assert info.pixels == 400_000_000
+    assert check_image_info(info) == ('Image too large. Maximum is 25 megapixels', 413)
+
+
+@pytest.mark.parametrize('case', ['apng', 'webp_animated', 'gif_animated'])
+def test_animations_are_rejected(case):
+    # Decoding would keep the first frame only
+    assert check_image_info(probe_image(io.BytesIO(CASES[case][0]))) == (
+        'Animated images are not supported (3 frames)', 400)
+    assert check_image_info(probe_image(io.BytesIO(CASES['png_rgb'][0]))) is None
+    assert check_image_info(None) == ('Could not read image file', 400)
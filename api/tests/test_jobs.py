@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+
+import pytest
+
+from jobs import CANCELLED, DONE, FAILED, Job, JobQueueFull, JobStore, sse_event
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_uploads_are_released_however_the_job_ends(tmp_path):
+    store = JobStore(str(tmp_path), workers=1)
+    released = []
+    gate = threading.Event()
+
+    def blocked(job):
+        gate.wait(5)
+        return {}
+
+    def broken(job):
+        raise ValueError('Could not read image file')
+
+    done = store.submit(Job('m', 4, 'a.png'), blocked, cleanup=lambda: released.append('done'))
+    failed = store.submit(Job('m', 4, 'b.png'), broken, cleanup=lambda: released.append('failed'))
+    queued = store.submit(Job('m', 4, 'c.png'), blocked, cleanup=lambda: released.append('queued'))
+    # Cancelled before it started: its upload goes straight away
+    assert store.cancel(queued) and released == ['queued']
+    gate.set()
+
+    wait_for(lambda: len(released) == 3)
+    assert sorted(released) == ['done', 'failed', 'queued']
+    assert (done.state, failed.state, queued.state) == (DONE, FAILED, CANCELLED)
+
+
+def test_a_full_queue_leaves_the_upload_to_the_caller(tmp_path):
+    store = JobStore(str(tmp_path), workers=1, max_pending=1)
+    gate = threading.Event()
+    released = []
+    running = store.submit(Job('m', 4, 'a.png'), lambda job: gate.wait(5) and {})
+    with pytest.raises(JobQueueFull):
+        store.submit(Job('m', 4, 'b.png'), lambda job: {}, cleanup=lambda: released.append('b'))
+    gate.set()
+    wait_for(lambda: running.terminal)
+    assert released == []
+
+
+def test_events_are_numbered_and_waiters_wake_on_the_next_one():
+    job = Job('m', 4, 'a.png')
+    job.expect(2000)
+    assert job.wait_events(0, timeout=0) == [('progress', {'done': 0, 'total': 0, 'percent': 0.0, 'eta_s': 2.0,
+                                                             'estimate_s': 2.0})]
+
+    seen = []
+    waiter = threading.Thread(target=lambda: seen.extend(job.wait_events(1, timeout=5)))
+    waiter.start()
+    time.sleep(0.05)
+    assert job.start()
+    waiter.join(5)
+    assert seen == [('state', {'state': 'running'})]
+    # Ended jobs answer at once rather than waiting out the timeout
+    job.finish({'result_url': '/r'})
+    started = time.monotonic()
+    assert job.wait_events(3, timeout=5) == [] and time.monotonic() - started < 1
+    assert sse_event(2, 'done', {'a': 1}) == 'id: 2\nevent: done\ndata: {"a": 1}\n\n'
+
+
+def test_ended_jobs_and_their_results_are_purged_after_the_ttl(tmp_path):
+    store = JobStore(str(tmp_path), ttl=60)
+    old, recent = Job('m', 4, 'a.png'), Job('m', 4, 'b.png')
+    for job in (old, recent):
+        store.submit(job, lambda job: {})
+        wait_for(lambda: job.terminal)
+        with open(store.result_path(job.id), 'wb') as f:
+            f.write(b'result')
+    old.finished -= 61
+
+    store.purge()
+    assert store.get(old.id) is None and not os.path.exists(store.result_path(old.id))
+    assert store.get(recent.id) is recent and os.path.exists(store.result_path(recent.id))
+    assert store.result_path('../etc/passwd') is None
+
+
+def test_event_streams_end_after_the_last_event_even_when_resumed_past_it():
+    job = Job('m', 4, 'a.png')
+    streamed = []
+    reader = threading.Thread(target=lambda: streamed.extend(job.stream_events(0, keepalive=0.05)))
+    reader.start()
+    time.sleep(0.2)
+    job.start()
+    job.finish({'result_url': '/r'})
+    reader.join(5)
+    assert not reader.is_alive()
+    events = [chunk for chunk in streamed if not chunk.startswith(':')]
+    assert events[-1] == sse_event(1, 'done', {'result_url': '/r'}) and len(events) == 2
+
+    # An EventSource reconnects with the id of the last event it got once the stream closes
+    assert list(job.stream_events(2)) == []
+    assert list(job.stream_events(1)) == [sse_event(1, 'done', {'result_url': '/r'})]
@@ -0,0 +1,79 @@
+import json
+
+import numpy as np
+import pytest
+
+from latency_model import SHARED, LatencyModel, features, worker_path
+
+
+def run_time(width, height, tile, concurrency=1, passes=1):
+    """Ground truth: 0.05s overhead, 2s per padded megapixel, 10ms per tile, 50% slower per extra request"""
+    x = features(width, height, tile, passes, concurrency)
+    return float(x @ np.array([0.05, 2.0, 0.01, 1.0]))
+
+
+def train(model, name, requests=40, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(requests):
+        width, height = (int(v) for v in rng.integers(64, 1600, 2))
+        concurrency = int(rng.integers(1, 4))
+        model.observe(name, width, height, 400, run_time(width, height, 400, concurrency), concurrency=concurrency)
+
+
+def test_learns_run_times_online():
+    model = LatencyModel('cpu', path=None, forgetting=1.0)
+    assert model.predict('RealESRGAN_x4plus', 1000, 1000, 400) is None
+
+    train(model, 'RealESRGAN_x4plus')
+    for width, height, concurrency in [(1000, 1000, 1), (300, 200, 1), (1920, 1080, 2)]:
+        expected = run_time(width, height, 400, concurrency)
+        assert model.predict('RealESRGAN_x4plus', width, height, 400, concurrency=concurrency) == \
+            pytest.approx(expected, rel=0.02, abs=0.01)
+    # Smaller tiles mean more tile overhead and padding
+    assert model.predict('RealESRGAN_x4plus', 1000, 1000, 200) > model.predict('RealESRGAN_x4plus', 1000, 1000, 400)
+    assert model.snapshot()['models']['RealESRGAN_x4plus']['mean_error_pct'] < 5
+
+
+def test_unseen_models_use_the_shared_fit_scaled_by_cost():
+    model = LatencyModel('cpu', path=None, forgetting=1.0, min_samples=3)
+    train(model, 'RealESRGAN_x4plus')
+    full = model.predict('RealESRGAN_x4plus', 1000, 1000, 400)
+    # realesr-general-x4v3 costs 0.06 of x4plus per pixel
+    fast = model.predict('realesr-general-x4v3', 1000, 1000, 400)
+    assert 0 < fast < full * 0.2
+
+    # Its own fit takes over after min_samples requests
+    for _ in range(3):
+        model.observe('realesr-general-x4v3', 1000, 1000, 400, 0.5)
+    assert model.predict('realesr-general-x4v3', 1000, 1000, 400) == pytest.approx(0.5, rel=0.1)
+
+
+def test_coefficients_persist_per_device(tmp_path):
+    path = str(tmp_path / 'latency.json')
+    model = LatencyModel('cpu', path=path, forgetting=1.0, save_interval=0)
+    train(model, 'RealESRGAN_x4plus', requests=10)
+    predicted = model.predict('RealESRGAN_x4plus', 800, 600, 400)
+    with open(path) as f:
+        assert set(json.load(f)['fits']) == {'RealESRGAN_x4plus', SHARED}
+
+    assert LatencyModel('cpu', path=path).predict('RealESRGAN_x4plus', 800, 600, 400) == pytest.approx(predicted)
+    # Another device's run times do not apply
+    assert LatencyModel('cuda:0', path=path).predict('RealESRGAN_x4plus', 800, 600, 400) is None
+
+    with open(path, 'w') as f:
+        f.write('{')
+    assert LatencyModel('cpu', path=path).predict('RealESRGAN_x4plus', 800, 600, 400) is None
+
+
+def test_instant_requests_do_not_break_the_error_average():
+    model = LatencyModel('cpu', path=None)
+    train(model, 'RealESRGAN_x4plus', requests=5)
+    error = model._fits['RealESRGAN_x4plus'].error
+    # A clock too coarse to see the request run
+    model.observe('RealESRGAN_x4plus', 64, 64, 400, 0.0)
+    assert model._fits['RealESRGAN_x4plus'].error == error and model._fits['RealESRGAN_x4plus'].samples == 6
+
+
+def test_supervised_workers_keep_fits_of_their_own():
+    assert worker_path(1, 'outputs/latency_model.json') == 'outputs/latency_model-1.json'
+    assert worker_path(0, 'latency') == 'latency-0'
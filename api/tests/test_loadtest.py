@@ -0,0 +1,94 @@
+import json
+import time
+
+import cv2
+import numpy as np
+import pytest
+from flask import Flask, jsonify, request
+
+from benchmarks.loadtest import (ImagePool, LocalTarget, Workload, parse_size, parse_weights, percentile,
+                                 run_closed_loop, run_open_loop, scrape_rss, summarize, synthesize)
+
+
+def test_parse_weights():
+    assert parse_weights('enhance=9,models') == [('enhance', 9.0), ('models', 1.0)]
+    assert parse_weights('128x128=3, 64x32=1', parse_size) == [((128, 128), 3.0), ((64, 32), 1.0)]
+    with pytest.raises(Exception):
+        parse_weights('a=0')
+
+
+def test_synthesized_images_decode_at_size():
+    rng = np.random.default_rng(0)
+    for fmt in ('png', 'jpeg'):
+        img = cv2.imdecode(np.frombuffer(synthesize(96, 48, rng, fmt), np.uint8), cv2.IMREAD_UNCHANGED)
+        assert img.shape == (48, 96, 3)
+
+
+def test_percentile_and_summary():
+    assert percentile([], 50) is None
+    assert percentile([1.0, 2.0, 3.0, 4.0], 50) == 2.5
+    assert percentile(list(range(101)), 99) == 99
+
+    samples = [('enhance', 0.5, 0.1, 200, {'tier': 'full', 'coalesced': False}),
+               ('enhance', 1.0, 0.3, 200, {'tier': 'fast_model', 'coalesced': True}),
+               ('enhance', 1.5, 0.01, 429, {}),
+               ('models', 2.0, 0.02, 200, {}),
+               ('models', 0.1, 5.0, 200, {})]  # started during warmup
+    summary = summarize(samples, elapsed=4.5, warmup=0.5)
+    assert summary['all']['requests'] == 4
+    assert summary['all']['throughput_rps'] == 1.0
+    enhance = summary['enhance']
+    assert (enhance['ok'], enhance['errors'], enhance['statuses']) == (2, 1, {'200': 2, '429': 1})
+    assert enhance['latency_ms']['p50'] == 200.0 and enhance['latency_ms']['max'] == 300.0
+    assert enhance['tiers'] == {'full': 1, 'fast_model': 1} and enhance['coalesced'] == 1
+    assert summary['models']['latency_ms']['max'] == 20.0
+
+
+@pytest.fixture
+def target():
+    app = Flask(__name__)
+    seen = []
+
+    @app.route('/api/enhance', methods=['POST'])
+    def enhance():
+        seen.append((request.files['image'].filename, request.form.get('model')))
+        time.sleep(0.02)
+        return jsonify(success=True, tier={'name': 'full'}, coalesced=False)
+
+    @app.route('/api/models')
+    def models():
+        return jsonify(models=[]), 503
+
+    @app.route('/metrics')
+    def metrics():
+        return 'hdess_http_resident_memory_bytes 1048576.0\nhdess_inference_resident_memory_bytes 2097152.0\n'
+
+    target = LocalTarget(app)
+    target.seen = seen
+    return target
+
+
+def workload():
+    pool = ImagePool([((32, 32), 1.0)], [('png', 1.0)], per_size=2, seed=0)
+    return Workload([('enhance', 3.0), ('models', 1.0)], pool, {'model': 'm'}, 'm')
+
+
+def test_closed_loop_keeps_concurrency(target):
+    samples, elapsed = run_closed_loop(target, workload(), concurrency=3, duration=5, max_requests=30, seed=0)
+    assert len(samples) == 30
+    assert all(filename == 'load_32x32.png' and model == 'm' for filename, model in target.seen)
+    summary = summarize(samples, elapsed)
+    assert summary['enhance']['ok'] == len(target.seen)
+    assert summary['models']['error_rate'] == 1.0
+    json.dumps(summary)
+
+
+def test_open_loop_counts_from_scheduled_start(target):
+    samples, elapsed = run_open_loop(target, workload(), rate=50, duration=0.5, max_requests=0, seed=1)
+    assert 5 <= len(samples) <= 60
+    starts = [start for _, start, _, _, _ in samples]
+    assert all(0 <= start < 0.5 for start in starts)
+
+
+def test_scrape_rss(target):
+    assert scrape_rss(target) == {'http': 1048576.0, 'inference': 2097152.0}
@@ -0,0 +1,94 @@
+import json
+import logging
+import threading
+import time
+from queue import Queue
+
+import tracing
+from logs import BoundedQueueHandler, JsonFormatter
+
+
+class SlowHandler(logging.Handler):
+    """A log file on a stalled disk"""
+
+    def __init__(self, unblock):
+        super().__init__()
+        # Not ``release``: that is the handler's lock, released after every emit
+        self.unblock = unblock
+        self.lines = []
+        self.setFormatter(JsonFormatter())
+
+    def emit(self, record):
+        self.unblock.wait()
+        self.lines.append(json.loads(self.format(record)))
+
+
+def make_logger(handler):
+    logger = logging.getLogger(f'test_logs.{id(handler)}')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    return logger
+
+
+def test_records_are_json_with_fields_and_trace_ids():
+    queue = Queue()
+    logger = make_logger(BoundedQueueHandler(queue, {}))
+    with tracing.trace('POST /api/enhance') as root:
+        logger.info('Enhancing %s', 'a.png', extra={'event': 'request', 'model': 'x4', 'width': 640})
+    try:
+        raise ValueError('bad tile')
+    except ValueError:
+        logger.exception('Enhancement error')
+
+    formatter = JsonFormatter()
+    first, second = (json.loads(formatter.format(queue.get_nowait())) for _ in range(2))
+    assert first['message'] == 'Enhancing a.png' and first['level'] == 'INFO'
+    assert (first['event'], first['model'], first['width']) == ('request', 'x4', 640)
+    assert (first['trace_id'], first['span_id']) == (root.trace.trace_id, root.span_id)
+    assert first['time'].endswith('+00:00')
+    assert 'trace_id' not in second and 'ValueError: bad tile' in second['exception']
+
+
+def test_sampled_events_and_a_full_queue_never_block():
+    queue = Queue(maxsize=5)
+    handler = BoundedQueueHandler(queue, {'tile': 0.0, 'request': 0.5})
+    logger = make_logger(handler)
+    for index in range(100):
+        logger.debug('Tile %d/100', index + 1, extra={'event': 'tile'})
+    assert queue.empty() and handler.stats()['sampled_out'] == 100
+
+    started = time.perf_counter()
+    for index in range(20):
+        logger.warning('Could not capture request', extra={'event': 'other'})
+    assert time.perf_counter() - started < 1.0
+    assert handler.stats() == {'queued': 5, 'dropped': {'WARNING': 15}, 'sampled_out': 100}
+
+    queue = Queue()
+    logger = make_logger(BoundedQueueHandler(queue, {'request': 0.5}))
+    for index in range(400):
+        logger.info('Enhancing', extra={'event': 'request'})
+    kept = [queue.get_nowait() for _ in range(queue.qsize())]
+    assert 120 < len(kept) < 280 and {record.sample_rate for record in kept} == {0.5}
+
+
+def test_writes_happen_off_the_calling_thread(monkeypatch):
+    from logging.handlers import QueueListener
+    errors = []
+    monkeypatch.setattr(threading, 'excepthook', errors.append)
+    unblock = threading.Event()
+    slow = SlowHandler(unblock)
+    queue = Queue()
+    listener = QueueListener(queue, slow)
+    listener.start()
+    logger = make_logger(BoundedQueueHandler(queue, {}))
+    started = time.perf_counter()
+    logger.info('Queued job %s', 'abc', extra={'job_id': 'abc'})
+    logger.info('Queued job %s', 'def', extra={'job_id': 'def'})
+    # The disk is stuck, the caller is not
+    assert time.perf_counter() - started < 0.5 and not slow.lines
+    unblock.set()
+    listener.stop()
+    # Both were written, and the listener thread outlived them
+    assert [line['job_id'] for line in slow.lines] == ['abc', 'def'] and slow.lines[0]['message'] == 'Queued job abc'
+    assert errors == []
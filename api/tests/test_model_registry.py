@@ -0,0 +1,167 @@
+import threading
+import time
+
+import pytest
+import torch
+
+from model_config import ModelLoadError
+from model_registry import ModelRegistry
+
+MB = 1024 * 1024
+
+
+class FakeUpsampler:
+    """An upsampler whose model holds ``size`` bytes of float32 weights"""
+
+    def __init__(self, name, size=MB):
+        self.name = name
+        self.model = torch.nn.Module()
+        self.model.weight = torch.nn.Parameter(torch.zeros(size // 4))
+
+
+class CountingLoader:
+
+    def __init__(self, delay=0.0, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, name):
+        with self._lock:
+            self.calls.append(name)
+        time.sleep(self.delay)
+        if name in self.fail:
+            raise RuntimeError('weights missing')
+        return FakeUpsampler(name)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_least_recently_used_idle_models_are_evicted():
+    loader = CountingLoader()
+    registry = ModelRegistry(loader, budget=3 * MB)
+    for name in ('a', 'b', 'c'):
+        registry.ensure_loaded(name)
+    # 'a' becomes the most recently used, so 'b' is the one to go
+    registry.ensure_loaded('a')
+    registry.ensure_loaded('d')
+
+    assert registry.loaded_models() == ['c', 'a', 'd']
+    assert registry.stats['evictions'] == 1 and registry.stats['hits'] == 1
+    assert loader.calls == ['a', 'b', 'c', 'd']
+
+
+def test_models_in_use_are_never_evicted():
+    registry = ModelRegistry(CountingLoader(), budget=MB)
+    loaded = threading.Event()
+
+    def load_b():
+        registry.ensure_loaded('b')
+        loaded.set()
+
+    with registry.acquire('a') as upsampler:
+        thread = threading.Thread(target=load_b)
+        thread.start()
+        # 'b' does not fit next to 'a', which cannot go while it runs
+        assert not loaded.wait(0.3)
+        assert registry.loaded_models() == ['a'] and upsampler.name == 'a'
+    thread.join(5)
+
+    assert loaded.is_set() and registry.loaded_models() == ['b']
+
+
+def test_concurrent_requests_load_a_model_once():
+    loader = CountingLoader(delay=0.1)
+    registry = ModelRegistry(loader, budget=4 * MB)
+    seen = []
+
+    def use():
+        with registry.acquire('a') as upsampler:
+            seen.append(upsampler)
+
+    threads = [threading.Thread(target=use) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert loader.calls == ['a'] and len(seen) == 5 and len({id(upsampler) for upsampler in seen}) == 1
+
+
+def test_a_load_waiting_for_room_is_not_started_again():
+    loader = CountingLoader()
+    registry = ModelRegistry(loader, budget=MB)
+    seen = []
+
+    def use_b():
+        with registry.acquire('b') as upsampler:
+            seen.append(upsampler)
+
+    with registry.acquire('a'):
+        first = threading.Thread(target=use_b)
+        first.start()
+        # Built, and waiting for 'a' to make room for it
+        wait_for(lambda: loader.calls == ['a', 'b'])
+        second = threading.Thread(target=use_b)
+        second.start()
+        time.sleep(0.2)
+    first.join(5)
+    second.join(5)
+
+    assert loader.calls == ['a', 'b'] and len(seen) == 2 and seen[0] is seen[1]
+
+
+def test_models_of_one_architecture_share_a_slot():
+    loader = CountingLoader()
+    weights = {'x': torch.ones(MB // 4), 'y': torch.full((MB // 4,), 2.0)}
+    registry = ModelRegistry(loader, budget=4 * MB, signature=lambda name: 'arch',
+                             weights=lambda name: ({'weight': weights[name]}, 0))
+
+    with registry.acquire('x') as upsampler:
+        first = upsampler
+    with registry.acquire('y') as upsampler:
+        assert upsampler is first and float(upsampler.model.weight.detach()[0]) == 2.0
+    with registry.acquire('x') as upsampler:
+        assert float(upsampler.model.weight.detach()[0]) == 1.0
+
+    assert loader.calls == ['x'] and registry.stats['swaps'] == 2
+    assert registry.is_loaded('x') and registry.is_loaded('y')
+    assert list(registry.snapshot()['slots']) == ['arch']
+
+
+def test_failed_loads_raise_and_can_be_retried():
+    loader = CountingLoader(fail={'a'})
+    registry = ModelRegistry(loader, budget=MB)
+    with pytest.raises(ModelLoadError):
+        registry.ensure_loaded('a')
+    loader.fail.clear()
+    registry.ensure_loaded('a')
+
+    assert loader.calls == ['a', 'a'] and registry.stats['load_failures'] == 1
+    assert registry.snapshot()['loading'] == []
+
+
+def test_a_lowered_budget_evicts_idle_models_and_a_raised_one_lets_a_waiting_load_in():
+    registry = ModelRegistry(CountingLoader(), budget=3 * MB)
+    for name in ('a', 'b'):
+        registry.ensure_loaded(name)
+    with registry.acquire('c'):
+        # 'c' is in use, so it stays over the new budget; the least recently used idle one goes first
+        registry.set_budget(2 * MB)
+        assert registry.loaded_models() == ['b', 'c']
+        registry.set_budget(MB)
+        assert registry.loaded_models() == ['c']
+
+        loaded = threading.Event()
+        thread = threading.Thread(target=lambda: registry.ensure_loaded('d') or loaded.set())
+        thread.start()
+        assert not loaded.wait(0.2)
+        registry.set_budget(2 * MB)
+        thread.join(5)
+    assert loaded.is_set() and registry.loaded_models() == ['c', 'd']
@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+import pytest
+
+from image_io import decode_reduced, encode_image
+from model_config import DEFAULT_MODEL
+from model_router import ANIME, PHOTO, ContentRouter, cheapest_model, thumbnail
+
+
+def line_art(width=640, height=480):
+    """Flat colour fills with dark outlines"""
+    img = np.full((height, width, 3), (235, 220, 250), np.uint8)
+    cv2.circle(img, (200, 240), 120, (40, 170, 250), -1)
+    cv2.circle(img, (200, 240), 120, (20, 20, 20), 4)
+    cv2.rectangle(img, (380, 100), (580, 400), (200, 90, 60), -1)
+    cv2.rectangle(img, (380, 100), (580, 400), (20, 20, 20), 4)
+    return img
+
+
+def photograph(width=640, height=480):
+    """Smooth lighting with fine texture and sensor noise"""
+    rng = np.random.default_rng(0)
+    ys, xs = np.mgrid[0:height, 0:width]
+    light = 90 + 60 * np.sin(xs / 90) * np.cos(ys / 70)
+    texture = cv2.GaussianBlur(rng.normal(0, 25, (height, width)), (0, 0), 1.5)
+    base = light + texture + rng.normal(0, 4, (height, width))
+    img = np.stack([base * 0.8, base, base * 1.1 + 20], axis=2)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def test_classifies_line_art_and_photographs():
+    router = ContentRouter()
+    content, confidence = router.classify(line_art()[::2, ::2])
+    assert content == ANIME and confidence > 0.8
+    content, confidence = router.classify(photograph()[::2, ::2])
+    assert content == PHOTO and confidence > 0.8
+
+
+def test_routes_to_the_cheapest_suitable_model():
+    assert cheapest_model(ANIME) == 'RealESRGAN_x4plus_anime_6B'
+    assert cheapest_model(PHOTO) == 'realesr-general-x4v3'
+    # No anime model is 8x, so the cheapest anime model is still used
+    assert cheapest_model(ANIME, outscale=8) == 'RealESRGAN_x4plus_anime_6B'
+
+    router = ContentRouter()
+    decision = router.route(encode_image(line_art(), '.png'), 640, 480)
+    assert (decision.content, decision.model_name, decision.routed) == (ANIME, 'RealESRGAN_x4plus_anime_6B', True)
+    assert decision.to_dict()['model'] == 'RealESRGAN_x4plus_anime_6B'
+    decision = router.route(encode_image(photograph(), '.jpg'), 640, 480)
+    assert (decision.content, decision.model_name) == (PHOTO, 'realesr-general-x4v3')
+
+    unsure = ContentRouter(min_confidence=1.0).route(encode_image(line_art(), '.png'), 640, 480)
+    assert unsure.content == ANIME and not unsure.routed and unsure.model_name == DEFAULT_MODEL
+    unreadable = router.route(b'not an image', 640, 480)
+    assert unreadable.content is None and unreadable.model_name == DEFAULT_MODEL
+    with pytest.raises(ValueError):
+        ContentRouter(weights=(1.0, 2.0))
+
+
+def test_thumbnails_are_decoded_reduced():
+    data = np.frombuffer(encode_image(photograph(2048, 1024), '.jpg'), np.uint8)
+    # A 4x reduction still covers 400x200; 8x would not
+    assert decode_reduced(data, 2048, 1024, (400, 200)).shape == (256, 512, 3)
+    assert thumbnail(data, 2048, 1024, side=256).shape == (128, 256, 3)
+    gray = encode_image(np.zeros((64, 48), np.uint16), '.png')
+    assert thumbnail(gray, 48, 64).shape == (64, 48, 3)
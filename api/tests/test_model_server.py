@@ -0,0 +1,99 @@
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pytest
+
+import model_server
+from image_io import EnhanceResult
+from shm_transport import ModelServerUnavailable, RemoteInference
+
+AUTHKEY = b'test'
+
+
+class DoublingBackend:
+    """Enhances by repeating every pixel twice in each direction"""
+
+    def __init__(self):
+        self.enhanced = 0
+        self.tickets = set()
+        self._tickets = iter(range(1, 1000))
+
+    def device_info(self):
+        return {'device': 'CPU', 'cuda_available': False}
+
+    def admit(self, cost, memory, timeout=None, work=None):
+        ticket = next(self._tickets)
+        self.tickets.add(ticket)
+        return ticket
+
+    def release_admission(self, ticket):
+        self.tickets.discard(ticket)
+
+    def snapshot(self):
+        return {'tickets': len(self.tickets), 'enhanced': self.enhanced}
+
+    def enhance(self, img, model_name, outscale=None, timeout=None, progress=None, tenant=None, weight=1.0,
+                tile_scale=1, cancel=None):
+        self.enhanced += 1
+        if progress is not None:
+            progress(1, 1)
+        return EnhanceResult(img.repeat(2, axis=0).repeat(2, axis=1), {'inference': 1.0}, info={'tiles': 1})
+
+
+@pytest.fixture
+def server(tmp_path):
+    # A process of its own, as in production: shared memory blocks have one owner each
+    address = str(tmp_path / 'model_server.sock')
+    process = multiprocessing.get_context('fork').Process(
+        target=model_server.serve, args=(address, DoublingBackend(), AUTHKEY), daemon=True)
+    process.start()
+    while not os.path.exists(address):
+        time.sleep(0.01)
+    yield address
+    process.terminate()
+    process.join()
+
+
+def test_images_round_trip_through_shared_memory(server):
+    remote = RemoteInference(server, authkey=AUTHKEY)
+    img = np.arange(4 * 6 * 3, dtype=np.uint8).reshape(4, 6, 3)
+    progress = []
+
+    ticket = remote.admit(0.1, 1000)
+    with remote.enhance(img, 'realesr-general-x4v3', progress=lambda done, total: progress.append(done)) as result:
+        assert result.image.shape == (8, 12, 3)
+        assert np.array_equal(result.image[::2, ::2], img)
+        assert result.timings == {'inference': 1.0} and result.info == {'tiles': 1}
+    remote.release_admission(ticket)
+
+    assert progress == [1] and remote.device_info()['device'] == 'CPU'
+    # The release messages have arrived by the time a later request is answered
+    assert remote.snapshot() == {'tickets': 0, 'enhanced': 1}
+
+
+def test_requests_the_server_may_have_received_are_not_sent_twice(server):
+    remote = RemoteInference(server, authkey=AUTHKEY)
+    remote.device_info()
+    remote._device_info = None
+
+    conn = remote._connection()
+    sent = []
+    original = conn.send
+
+    def send_then_drop(message):
+        original(message)
+        sent.append(message['op'])
+        conn.close()
+
+    conn.send = send_then_drop
+    with pytest.raises(ModelServerUnavailable):
+        remote.enhance(np.zeros((2, 2, 3), np.uint8), 'realesr-general-x4v3')
+    # Status requests are safe to repeat on a new connection
+    conn = remote._connection()
+    original = conn.send
+    conn.send = send_then_drop
+    assert remote.device_info()['device'] == 'CPU'
+    # The enhance went out once (the server may or may not have run it before the drop)
+    assert sent == ['enhance', 'device'] and remote.snapshot()['enhanced'] <= 1
@@ -0,0 +1,63 @@
+import cv2
+import numpy as np
+import pytest
+
+from image_io import OutputFormat, encode_async
+
+
+def decode(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+def gradient(channels=3, dtype=np.uint8):
+    ramp = np.linspace(0, np.iinfo(dtype).max, 64, dtype=np.float64)
+    img = np.broadcast_to(ramp[None, :, None], (48, 64, channels))
+    return np.ascontiguousarray(img.astype(dtype))
+
+
+@pytest.mark.parametrize('output_format', [
+    OutputFormat('png'), OutputFormat('png', compression=9), OutputFormat('webp', lossless=True)])
+def test_lossless_formats_round_trip(output_format):
+    img = gradient(4)
+    assert np.array_equal(decode(output_format.encode(img)), img)
+
+
+def test_png_keeps_16_bit():
+    img = gradient(3, np.uint16)
+    assert np.array_equal(decode(OutputFormat('png').encode(img)), img)
+
+
+@pytest.mark.parametrize('name', ['jpeg', 'webp'])
+def test_lossy_formats_take_16_bit_and_alpha(name):
+    output_format = OutputFormat(name, quality=90)
+    decoded = decode(output_format.encode(gradient(4, np.uint16)))
+    assert decoded.dtype == np.uint8
+    assert decoded.shape[2] == (3 if name == 'jpeg' else 4)
+    assert np.abs(decoded[..., :3].astype(int) - gradient(3)).mean() < 4
+
+
+def test_quality_trades_size():
+    img = cv2.resize(np.random.RandomState(0).randint(0, 255, (16, 16, 3), np.uint8), (256, 256))
+    sizes = [len(OutputFormat('jpeg', quality=q).encode(img)) for q in (50, 95)]
+    assert sizes[0] < sizes[1]
+
+
+def test_from_form():
+    output_format = OutputFormat.from_form({'format': 'JPG', 'quality': '80'})
+    assert (output_format.name, output_format.ext, output_format.mime) == ('jpeg', '.jpg', 'image/jpeg')
+    assert output_format.to_dict() == {'format': 'jpeg', 'mime': 'image/jpeg', 'quality': 80}
+    assert OutputFormat.from_form({}).to_dict() == {'format': 'png', 'mime': 'image/png'}
+    assert OutputFormat.from_form({'format': 'webp', 'lossless': 'true'}).to_dict()['lossless'] is True
+
+
+@pytest.mark.parametrize('form', [{'format': 'tiff'}, {'format': 'jpeg', 'quality': '0'},
+                                  {'compression': '10'}, {'quality': 'high'}])
+def test_from_form_rejects_invalid(form):
+    with pytest.raises(ValueError):
+        OutputFormat.from_form(form)
+
+
+def test_encode_async():
+    img = gradient()
+    futures = [encode_async(img, OutputFormat('png')) for _ in range(4)]
+    assert all(np.array_equal(decode(future.result()), img) for future in futures)
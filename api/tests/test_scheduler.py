@@ -0,0 +1,213 @@
+import math
+import threading
+
+from scheduler import FairScheduler
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulate(scheduler, clock, arrivals):
+    """Run jobs on one server, taking ``cost`` seconds each.
+
+    ``arrivals`` is a list of (time, tenant, cost). Returns {tenant: [latency, ...]}
+    and the start time of every job keyed by (tenant, cost, arrival).
+    """
+    arrivals = sorted(arrivals, key=lambda a: a[0])
+    latencies = {}
+    starts = {}
+    running = None  # (completion time, entry)
+    i = 0
+    while i < len(arrivals) or running is not None or scheduler.running or any(
+            s['queued'] for s in scheduler.snapshot()['tenants'].values()):
+        next_arrival = arrivals[i][0] if i < len(arrivals) else math.inf
+        if running is not None and running[0] <= next_arrival:
+            clock.now, entry = running
+            scheduler.finish(entry)
+            latencies.setdefault(entry.tenant, []).append(clock.now - entry.arrived)
+            running = None
+        else:
+            clock.now, tenant, cost = arrivals[i]
+            scheduler.enqueue(tenant, cost, weight=tenant_weight(tenant))
+            i += 1
+        if running is None:
+            entry = scheduler.next_entry()
+            if entry is not None:
+                starts[(entry.tenant, entry.cost, entry.arrived)] = clock.now
+                running = (clock.now + entry.cost, entry)
+    return latencies, starts
+
+
+def tenant_weight(tenant):
+    return 2.0 if tenant.startswith('user:') else 1.0
+
+
+def fifo(arrivals):
+    latencies = {}
+    free_at = 0.0
+    for arrived, tenant, cost in sorted(arrivals, key=lambda a: a[0]):
+        free_at = max(free_at, arrived) + cost
+        latencies.setdefault(tenant, []).append(free_at - arrived)
+    return latencies
+
+
+def p95(values):
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(0.95 * len(values)) - 1)]
+
+
+def mixed_workload():
+    # One client submits 20 large images at once; two others send a small one every 2s
+    arrivals = [(0.0, 'ip:heavy', 4.0) for _ in range(20)]
+    for k in range(40):
+        arrivals.append((0.5 + 2.0 * k, 'ip:light-a', 0.1))
+        arrivals.append((1.5 + 2.0 * k, 'ip:light-b', 0.1))
+    return arrivals
+
+
+def test_small_jobs_p95_beats_fifo():
+    arrivals = mixed_workload()
+    clock = FakeClock()
+    fair, _ = simulate(FairScheduler(concurrency=1, clock=clock), clock, arrivals)
+    baseline = fifo(arrivals)
+
+    small = fair['ip:light-a'] + fair['ip:light-b']
+    small_fifo = baseline['ip:light-a'] + baseline['ip:light-b']
+    # A small job waits for at most the large job already running
+    assert p95(small) <= 4.0 + 0.1 + 1e-9
+    assert p95(small) < p95(small_fifo) / 10
+    # The heavy client still gets all of its work done, in about the same total time
+    assert len(fair['ip:heavy']) == 20
+    assert max(fair['ip:heavy']) <= max(baseline['ip:heavy']) + 8.0 + 1e-9
+
+
+def test_ageing_prevents_starvation_within_a_tenant():
+    # A stream of small jobs from the same tenant, slightly faster than they are served,
+    # always has a shorter job waiting than the large one
+    arrivals = [(0.05, 'ip:a', 2.0)] + [(0.199 * k, 'ip:a', 0.2) for k in range(600)]
+
+    clock = FakeClock()
+    _, aged = simulate(FairScheduler(concurrency=1, ageing=5.0, clock=clock), clock, arrivals)
+    clock = FakeClock()
+    _, unaged = simulate(FairScheduler(concurrency=1, ageing=1e12, clock=clock), clock, arrivals)
+
+    large = ('ip:a', 2.0, 0.05)
+    assert aged[large] < 60
+    assert unaged[large] >= 600 * 0.2 - 1e-9
+
+
+def test_weighted_share_under_saturation():
+    # Both tenants always have work waiting; a signed-in user gets twice the compute
+    arrivals = [(0.0, 'ip:anon', 1.0) for _ in range(300)] + [(0.0, 'user:1', 1.0) for _ in range(300)]
+    clock = FakeClock()
+    scheduler = FairScheduler(concurrency=1, clock=clock)
+    for arrived, tenant, cost in arrivals:
+        scheduler.enqueue(tenant, cost, weight=tenant_weight(tenant))
+    for _ in range(300):
+        scheduler.finish(scheduler.next_entry())
+
+    tenants = scheduler.snapshot()['tenants']
+    assert tenants['user:1']['served'] == 200
+    assert tenants['ip:anon']['served'] == 100
+    assert tenants['user:1']['share'] == round(2 / 3, 3)
+
+
+def test_returning_tenant_gets_no_idle_credit():
+    clock = FakeClock()
+    scheduler = FairScheduler(concurrency=1, clock=clock)
+    for _ in range(10):
+        scheduler.enqueue('ip:busy', 1.0)
+    for _ in range(5):
+        scheduler.finish(scheduler.next_entry())
+    # A newcomer alternates with the busy tenant instead of running its backlog first
+    for _ in range(4):
+        scheduler.enqueue('ip:new', 1.0)
+    order = []
+    for _ in range(6):
+        entry = scheduler.next_entry()
+        order.append(entry.tenant)
+        scheduler.finish(entry)
+    assert order.count('ip:new') == 3
+    assert order.count('ip:busy') == 3
+
+
+def test_snapshot_statistics():
+    clock = FakeClock()
+    arrivals = mixed_workload()
+    scheduler = FairScheduler(concurrency=1, clock=clock)
+    latencies, _ = simulate(scheduler, clock, arrivals)
+
+    snapshot = scheduler.snapshot()
+    assert snapshot['running'] == 0
+    assert snapshot['queued'] == 0
+    heavy = snapshot['tenants']['ip:heavy']
+    assert heavy['served'] == 20
+    assert heavy['served_cost'] == 80.0
+    assert heavy['queued'] == 0
+    # Waits exclude the job's own run time
+    assert heavy['max_wait_ms'] == round((max(latencies['ip:heavy']) - 4.0) * 1000, 1)
+    assert abs(sum(tenant['share'] for tenant in snapshot['tenants'].values()) - 1.0) < 0.01
+
+
+def test_slot_limits_concurrency():
+    scheduler = FairScheduler(concurrency=2)
+    active = []
+    peak = []
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def job(tenant):
+        with scheduler.slot(tenant, cost=1.0):
+            with lock:
+                active.append(tenant)
+                peak.append(len(active))
+            release.wait(5)
+            with lock:
+                active.remove(tenant)
+
+    threads = [threading.Thread(target=job, args=(f'ip:{i % 3}',)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert max(peak) <= 2
+    snapshot = scheduler.snapshot()
+    assert snapshot['running'] == 0
+    assert sum(tenant['served'] for tenant in snapshot['tenants'].values()) == 6
+
+
+def test_estimate_counts_the_work_ahead():
+    clock = FakeClock()
+    scheduler = FairScheduler(concurrency=1, clock=clock)
+    assert scheduler.estimate([1.0]) == [1.0]
+    # A job ahead of unknown duration
+    unknown = FairScheduler(concurrency=1, clock=clock)
+    unknown.enqueue('ip:a', 1.0)
+    assert unknown.estimate([1.0]) is None
+
+    # Learn the rate: 2 seconds per unit of cost
+    scheduler.enqueue('ip:a', 1.0)
+    entry = scheduler.next_entry()
+    clock.now = 2.0
+    scheduler.finish(entry)
+    assert scheduler.seconds_per_cost == 2.0
+
+    running = scheduler.enqueue('ip:a', 3.0)
+    scheduler.next_entry()
+    scheduler.enqueue('ip:b', 1.0)
+    clock.now = 4.0
+    # 4s left of the running job, 2s for the queued one, 2s waiting for admission, then the job itself
+    assert scheduler.estimate([1.0, 4.0], backlog=2.0) == [9.0, 12.0]
+    assert running.granted
+
+    # Predicted durations take precedence over the learned rate
+    scheduler.enqueue('ip:c', 1.0, seconds=10.0)
+    assert scheduler.estimate([1.0]) == [17.0]
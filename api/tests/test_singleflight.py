@@ -0,0 +1,267 @@
+import io
+import threading
+import time
+
+import fakeredis
+import pytest
+
+from cancellation import DEADLINE, DISCONNECTED, CancelToken, Cancelled
+from singleflight import KEY_PREFIX, LEADER, LOCAL, REMOTE, SingleFlight, _unpack, flight_key
+
+
+def run_concurrently(flights, key, compute, count):
+    results = [None] * count
+    barrier = threading.Barrier(count)
+
+    def call(index):
+        barrier.wait()
+        try:
+            results[index] = flights.run(key, compute)
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_identical_requests_compute_once():
+    flights = SingleFlight()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return b'png', {'width': 4}
+
+    results = run_concurrently(flights, 'key', compute, 8)
+    assert len(calls) == 1
+    assert all(result == (b'png', {'width': 4}) for result, _ in results)
+    assert sorted(source for _, source in results) == [LEADER] + [LOCAL] * 7
+    assert flights.stats == {LEADER: 1, LOCAL: 7, 'redis': 0}
+    assert flights.in_flight() == 0
+
+
+def test_different_keys_do_not_coalesce():
+    flights = SingleFlight()
+    assert flights.run('a', lambda: (b'a', {}))[1] == LEADER
+    assert flights.run('a', lambda: (b'a', {}))[1] == LEADER
+    assert flights.run('b', lambda: (b'b', {})) == ((b'b', {}), LEADER)
+
+
+@pytest.mark.parametrize('failure', ['raise', 'none'])
+def test_follower_takes_over_when_leader_fails(failure):
+    flights = SingleFlight()
+    calls = []
+    lock = threading.Lock()
+
+    def compute():
+        with lock:
+            calls.append(1)
+            first = len(calls) == 1
+        time.sleep(0.2)
+        if first:
+            if failure == 'raise':
+                raise RuntimeError('model server went away')
+            return None
+        return b'png', {}
+
+    results = run_concurrently(flights, 'key', compute, 4)
+    # The failed leader's caller sees its own failure; one follower recomputes for the rest
+    assert len(calls) == 2
+    failed = [result for result in results if isinstance(result, Exception) or result[0] is None]
+    assert len(failed) == 1
+    assert sum(1 for result in results if result not in failed and result[1] == LEADER) == 1
+    assert sum(1 for result in results if result not in failed and result[1] == LOCAL) == 2
+
+
+def test_follower_gives_up_waiting():
+    flights = SingleFlight(max_wait=0.1)
+    release = threading.Event()
+    leader = threading.Thread(target=flights.run, args=('key', lambda: release.wait() and (b'slow', {})))
+    leader.start()
+    while not flights.in_flight():
+        time.sleep(0.01)
+    assert flights.run('key', lambda: (b'own', {})) == ((b'own', {}), LEADER)
+    release.set()
+    leader.join()
+
+
+def test_flight_key_covers_content_and_parameters():
+    stream = io.BytesIO(b'..image bytes')
+    stream.seek(2)
+    key = flight_key(stream, 'enhance', 'RealESRGAN_x4plus', 4.0, {'format': 'png'})
+    assert stream.tell() == 2
+    # Only the content from the stream position onwards is hashed
+    assert key == flight_key(io.BytesIO(b'image bytes'), 'enhance', 'RealESRGAN_x4plus', 4.0, {'format': 'png'})
+    assert key != flight_key(io.BytesIO(b'image bytes'), 'enhance', 'RealESRGAN_x4plus', 2.0, {'format': 'png'})
+    assert key != flight_key(io.BytesIO(b'other'), 'enhance', 'RealESRGAN_x4plus', 4.0, {'format': 'png'})
+
+
+class Processes:
+    """Single-flight instances of separate worker processes, sharing one Redis"""
+
+    def __init__(self, count=2, **options):
+        self.server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=self.server)
+        self.flights = [SingleFlight(fakeredis.FakeRedis(server=self.server), **options) for _ in range(count)]
+
+    def lock(self, key):
+        return self.redis.get(f'{KEY_PREFIX}{key}:lock')
+
+    def result(self, key):
+        return self.redis.get(f'{KEY_PREFIX}{key}:result')
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def lead_in_background(flights, key, compute):
+    """Start ``flights.run`` in a thread; returns the thread and the list its outcome goes to"""
+    outcome = []
+
+    def run():
+        try:
+            outcome.append(flights.run(key, compute))
+        except Exception as e:
+            outcome.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+def test_other_processes_receive_the_leaders_result():
+    processes = Processes(lease=1.0, result_ttl=60)
+    first, second = processes.flights
+    release = threading.Event()
+    thread, outcome = lead_in_background(first, 'key', lambda: release.wait(5) and (b'png', {'width': 4}))
+    wait_for(lambda: processes.lock('key') is not None)
+
+    threading.Timer(0.2, release.set).start()
+    assert second.run('key', lambda: pytest.fail('computed twice')) == ((b'png', {'width': 4}), REMOTE)
+    thread.join(5)
+
+    assert outcome == [((b'png', {'width': 4}), LEADER)]
+    assert second.stats[REMOTE] == 1
+    # The lease is given back; the result stays readable for processes about to attach
+    assert processes.lock('key') is None
+    assert 0 < processes.redis.ttl(f'{KEY_PREFIX}key:result') <= 60
+
+
+def test_the_lease_is_renewed_while_the_leader_computes():
+    processes = Processes(lease=0.3)
+    first, second = processes.flights
+
+    def slow():
+        time.sleep(1.0)
+        return b'png', {}
+
+    thread, outcome = lead_in_background(first, 'key', slow)
+    wait_for(lambda: processes.lock('key') is not None)
+    # Well past the lease, the leader still holds it and nobody else computes
+    time.sleep(0.6)
+    assert processes.lock('key') is not None
+    assert second.run('key', lambda: pytest.fail('computed twice'))[1] == REMOTE
+    thread.join(5)
+    assert outcome[0][1] == LEADER
+
+
+@pytest.mark.parametrize('failure', ['raise', 'too_large'])
+def test_another_process_takes_over_when_the_leader_shares_nothing(failure):
+    processes = Processes(lease=5.0, max_result=100)
+    first, second = processes.flights
+    release = threading.Event()
+
+    def leader():
+        release.wait(5)
+        if failure == 'raise':
+            raise RuntimeError('model server went away')
+        # Too large to copy through Redis
+        return b'x' * 1000, {}
+
+    thread, outcome = lead_in_background(first, 'key', leader)
+    wait_for(lambda: processes.lock('key') is not None)
+    threading.Timer(0.2, release.set).start()
+    started = time.monotonic()
+    # Told straight away over pub/sub, rather than when the lease runs out
+    assert second.run('key', lambda: (b'own', {})) == ((b'own', {}), LEADER)
+    assert time.monotonic() - started < 2
+    thread.join(5)
+
+    assert isinstance(outcome[0], RuntimeError) if failure == 'raise' else outcome[0][1] == LEADER
+    # Only the result computed by the process that took over was shared
+    assert _unpack(processes.result('key')) == (b'own', {})
+    assert processes.lock('key') is None
+
+
+def test_a_crashed_leaders_lease_runs_out():
+    processes = Processes(lease=0.3)
+    # Held by a process that died without publishing anything
+    processes.redis.set(f'{KEY_PREFIX}key:lock', b'gone', px=300)
+    started = time.monotonic()
+    assert processes.flights[0].run('key', lambda: (b'own', {})) == ((b'own', {}), LEADER)
+    assert 0.2 < time.monotonic() - started < 2
+
+
+def test_a_leader_does_not_release_a_lease_it_lost():
+    processes = Processes(lease=5.0)
+    flights = processes.flights[0]
+
+    def compute():
+        # The lease expired and another process took it
+        processes.redis.set(f'{KEY_PREFIX}key:lock', b'other')
+        return b'png', {}
+
+    assert flights.run('key', compute)[1] == LEADER
+    assert processes.lock('key') == b'other'
+
+
+def test_computes_without_a_lease_when_redis_is_down():
+    processes = Processes()
+    processes.server.connected = False
+    assert processes.flights[0].run('key', lambda: (b'png', {})) == ((b'png', {}), LEADER)
+
+
+@pytest.mark.parametrize('reason', [DEADLINE, DISCONNECTED])
+def test_a_waiter_stops_waiting_when_its_request_is_cancelled(reason):
+    flights = SingleFlight()
+    release = threading.Event()
+    leader = threading.Thread(target=flights.run, args=('key', lambda: release.wait(5) and (b'slow', {})))
+    leader.start()
+    wait_for(flights.in_flight)
+
+    if reason == DEADLINE:
+        cancel = CancelToken.after(0.2)
+    else:
+        started = time.monotonic()
+        cancel = CancelToken(poll=lambda: DISCONNECTED if time.monotonic() - started > 0.2 else None)
+    started = time.monotonic()
+    with pytest.raises(Cancelled) as cancelled:
+        flights.run('key', lambda: pytest.fail('computed twice'), cancel=cancel)
+    assert cancelled.value.reason == reason and time.monotonic() - started < 1
+    release.set()
+    leader.join()
+
+
+def test_a_waiter_for_another_process_stops_at_its_deadline():
+    processes = Processes(lease=5.0)
+    first, second = processes.flights
+    release = threading.Event()
+    thread, outcome = lead_in_background(first, 'key', lambda: release.wait(5) and (b'png', {}))
+    wait_for(lambda: processes.lock('key') is not None)
+
+    started = time.monotonic()
+    with pytest.raises(Cancelled) as cancelled:
+        second.run('key', lambda: pytest.fail('computed twice'), cancel=CancelToken.after(0.2))
+    assert cancelled.value.reason == DEADLINE and time.monotonic() - started < 1
+    release.set()
+    thread.join(5)
+    assert outcome[0][1] == LEADER
@@ -0,0 +1,78 @@
+from admission import estimate_cost
+from image_probe import ImageInfo
+from preloader import READY
+from slo import COARSE_TILES, FAST_MODEL, FULL, REDUCED_SCALE, plan_tiers, select_tier
+
+PHOTO = ImageInfo('jpeg', 1024, 768, 3)
+READY_MODELS = ['RealESRGAN_x4plus', 'realesr-general-x4v3']
+
+
+class QueueBackend:
+    """Backend whose estimates are a fixed queue wait plus one second per unit of cost"""
+
+    def __init__(self, wait, ready=READY_MODELS):
+        self.wait = wait
+        self.ready = ready
+        self.calls = []
+
+    def estimate_latency(self, works):
+        self.calls.append(works)
+        if self.wait is None:
+            return None
+        return [self.wait + estimate_cost(work['width'], work['height'], work['model']) for work in works]
+
+    def readiness(self):
+        return True, {name: {'state': READY} for name in self.ready}
+
+
+def test_tiers_get_cheaper():
+    tiers = plan_tiers(PHOTO, 'RealESRGAN_x4plus', 4, READY_MODELS)
+    assert [tier.name for tier in tiers] == [FULL, COARSE_TILES, FAST_MODEL, REDUCED_SCALE]
+    assert tiers[2].model_name == 'realesr-general-x4v3'
+    costs = [tier.estimate(PHOTO)[0] for tier in tiers]
+    assert costs == sorted(costs, reverse=True)
+
+    reduced = tiers[-1]
+    assert (reduced.outscale, reduced.prescale, reduced.network_outscale) == (2, 0.5, 4)
+    assert reduced.estimate(PHOTO)[1] < tiers[0].estimate(PHOTO)[1]
+
+
+def test_small_images_skip_coarse_tiles():
+    tiers = plan_tiers(ImageInfo('png', 200, 100, 3), 'RealESRGAN_x4plus', 4, READY_MODELS)
+    assert COARSE_TILES not in [tier.name for tier in tiers]
+
+
+def test_only_ready_cheaper_models_substitute():
+    tiers = plan_tiers(PHOTO, 'RealESRGAN_x4plus', 4, ['RealESRGAN_x4plus'])
+    assert FAST_MODEL not in [tier.name for tier in tiers]
+    assert tiers[-1].model_name == 'RealESRGAN_x4plus'
+
+
+def test_full_quality_when_the_slo_is_met():
+    backend = QueueBackend(wait=1.0)
+    tier, estimated_ms = select_tier(backend, PHOTO, 'RealESRGAN_x4plus', 4, 30000, 'enhance')
+    assert tier.name == FULL
+    assert estimated_ms == round((1.0 + PHOTO.pixels / 1e6) * 1000, 1)
+    assert len(backend.calls) == 1
+
+
+def test_degrades_to_the_best_tier_that_meets_the_slo():
+    backend = QueueBackend(wait=5.0)
+    tier, estimated_ms = select_tier(backend, PHOTO, 'RealESRGAN_x4plus', 4, 5500, 'enhance')
+    assert (tier.name, tier.model_name) == (FAST_MODEL, 'realesr-general-x4v3')
+    assert estimated_ms <= 5500
+
+
+def test_cheapest_tier_when_nothing_meets_the_slo():
+    tier, _ = select_tier(QueueBackend(wait=60.0), PHOTO, 'RealESRGAN_x4plus', 4, 5000, 'enhance')
+    assert tier.name == REDUCED_SCALE
+
+
+def test_no_degradation_without_an_estimate_or_slo():
+    assert select_tier(QueueBackend(wait=None), PHOTO, 'RealESRGAN_x4plus', 4, 1, 'enhance')[0].name == FULL
+    backend = QueueBackend(wait=60.0)
+    tier, estimated_ms = select_tier(backend, PHOTO, 'RealESRGAN_x4plus', 4, 0, 'job')
+    # Still estimated, for the progress bar
+    assert (tier.name, estimated_ms) == (FULL, round((60.0 + PHOTO.pixels / 1e6) * 1000, 1))
+    assert backend.calls == [[tier.work(PHOTO)]]
+    assert backend.calls[0][0]['passes'] == 1
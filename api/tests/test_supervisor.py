@@ -0,0 +1,219 @@
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from shm_transport import RemoteInference
+from supervisor import Autoscaler, Supervisor, Worker, serve, DRAIN, DRAINING, RESUME, SERVING, SPAWN, STARTING, STOP
+
+MB = 1024 * 1024
+STUB_WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_worker_stub.py')
+IMAGE = np.arange(4 * 6 * 3, dtype=np.uint8).reshape(4, 6, 3)
+
+
+class Simulation:
+    """Model workers that run ``concurrency`` requests of ``service`` seconds each at once,
+    serving ``startup`` seconds after they are started, with one ``model_mb`` model loaded"""
+
+    def __init__(self, autoscaler, concurrency=2, service=10, startup=5, model_mb=100):
+        self.autoscaler = autoscaler
+        self.concurrency = concurrency
+        self.service = service
+        self.startup = startup
+        self.model_mb = model_mb
+        self.workers = []
+        self.jobs = {}  # worker id -> seconds left of its running requests
+        self.waiting = 0  # arrived while no worker was serving
+        self.ids = 0
+        self.log = []
+
+    def spawn(self, now):
+        self.ids += 1
+        worker = Worker(self.ids, f'sim-{self.ids}', started=now)
+        worker.concurrency = self.concurrency
+        self.workers.append(worker)
+        self.jobs[worker.id] = []
+
+    def route(self, arrivals):
+        serving = [worker for worker in self.workers if worker.state == SERVING]
+        if not serving:
+            self.waiting += arrivals
+            return
+        for _ in range(arrivals + self.waiting):
+            worker = min(serving, key=lambda worker: worker.leases)
+            worker.leases += 1
+            worker.queued += 1
+        self.waiting = 0
+
+    def advance(self, now):
+        for worker in self.workers:
+            if worker.state == STARTING and now - worker.started >= self.startup:
+                worker.state = SERVING
+                worker.memory, worker.models = self.model_mb * MB, ['realesr-general-x4v3']
+            jobs = [left - 1 for left in self.jobs[worker.id] if left > 1]
+            worker.leases -= len(self.jobs[worker.id]) - len(jobs)
+            while worker.queued and len(jobs) < worker.concurrency:
+                worker.queued -= 1
+                jobs.append(self.service)
+            self.jobs[worker.id] = jobs
+            worker.running = len(jobs)
+
+    def run(self, load, seconds):
+        for now in range(seconds):
+            self.route(load(now))
+            self.advance(now)
+            for decision, worker in self.autoscaler.step(self.workers, now=now):
+                if decision == SPAWN:
+                    self.spawn(now)
+                elif decision == STOP:
+                    # Drained: nothing is left running on it
+                    assert worker.leases == 0
+                    self.workers.remove(worker)
+                else:
+                    worker.state = DRAINING if decision == DRAIN else SERVING
+                    worker.drain_started = now
+                self.log.append((now, decision, worker.id if worker else None))
+            self.log.append((now, 'workers', len([w for w in self.workers if w.state != DRAINING])))
+
+    def workers_at(self, now):
+        return [count for when, event, count in self.log if when == now and event == 'workers'][0]
+
+
+def test_bursty_load_scales_up_within_the_memory_budget_and_back_down():
+    autoscaler = Autoscaler(min_workers=1, max_workers=4, memory_budget=300 * MB, target_queue=2, cooldown=5,
+                            idle_seconds=20, drain_timeout=60)
+    simulation = Simulation(autoscaler)
+
+    # A request every 10 seconds, then one a second for 40 seconds, and quiet again
+    def load(now):
+        return 1 if 60 <= now < 100 else int(now % 10 == 0)
+
+    simulation.run(load, 300)
+
+    assert {simulation.workers_at(now) for now in range(0, 60)} == {1}
+    # Workers are added one per cooldown while the burst queues up...
+    spawned = [when for when, event, _ in simulation.log if event == SPAWN and when > 0]
+    assert len(spawned) == 2 and 60 < spawned[0] < 70 and spawned[1] - spawned[0] >= 5
+    # ...but a fourth would not fit 300MB of models
+    assert max(simulation.workers_at(now) for now in range(300)) == 3
+    assert autoscaler.stats['memory_limited'] > 0
+    # Back to one worker once the backlog is gone, one drain at a time after the idle period
+    drained = [when for when, event, _ in simulation.log if event == DRAIN]
+    assert len(drained) == 2 and drained[0] > 100 + 20 and drained[1] - drained[0] >= 20
+    assert simulation.workers_at(299) == 1 and len(simulation.workers) == 1
+    assert autoscaler.stats[STOP] == 2
+
+
+def test_draining_warm_workers_are_resumed_before_starting_new_ones():
+    autoscaler = Autoscaler(min_workers=1, max_workers=3, memory_budget=1000 * MB, target_queue=2, cooldown=0)
+    busy, warm, cold = (Worker(index, f'sim-{index}', started=index) for index in range(3))
+    busy.state, busy.queued, busy.leases = SERVING, 8, 10
+    busy.memory, busy.models = 100 * MB, ['realesr-general-x4v3']
+    warm.memory, warm.models = 200 * MB, ['RealESRGAN_x4plus', 'realesr-general-x4v3']
+    cold.memory, cold.models = 100 * MB, ['realesr-general-x4v3']
+    for worker in (warm, cold):
+        worker.state, worker.drain_started, worker.leases = DRAINING, 0, 1
+
+    assert autoscaler.step([busy, warm, cold], now=1) == [(RESUME, warm)]
+
+    # With the load gone, the worker with the fewest models goes first
+    busy.queued = 0
+    warm.state, cold.state = SERVING, SERVING
+    autoscaler.idle_seconds = 0
+    assert autoscaler.step([busy, warm, cold], now=2) == [(DRAIN, cold)]
+
+
+def wait_for(condition, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def supervisor(tmp_path):
+    # Never scales on its own: the tests start workers and tick it themselves
+    supervisor = Supervisor(Autoscaler(min_workers=1, max_workers=2, cooldown=0, idle_seconds=3600),
+                            command=[sys.executable, STUB_WORKER], model_budget_mb=1000, admission_budget_mb=600)
+    address = str(tmp_path / 'supervisor.sock')
+    threading.Thread(target=serve, args=(address, supervisor), daemon=True).start()
+    wait_for(lambda: os.path.exists(address))
+    yield supervisor, address
+    for worker in list(supervisor.workers):
+        supervisor.stop(worker)
+
+
+def start_workers(supervisor, count):
+    workers = [supervisor.spawn() for _ in range(count)]
+
+    def serving():
+        for worker in workers:
+            supervisor.poll(worker)
+        return all(worker.state == SERVING for worker in workers)
+
+    wait_for(serving)
+    # As the next tick would, for workers that were not listening yet when another started
+    supervisor.share_budgets()
+    return workers
+
+
+def test_leases_go_back_to_zero_after_admit_enhance_and_close(supervisor):
+    supervisor, address = supervisor
+    worker, = start_workers(supervisor, 1)
+    remote = RemoteInference(address)
+
+    ticket = remote.admit(0.1, 1000)
+    assert worker.leases == 1
+    with remote.enhance(IMAGE, 'realesr-general-x4v3') as result:
+        assert np.array_equal(result.image[::2, ::2], IMAGE)
+        # The admission ticket and the output block
+        assert worker.leases == 2
+    wait_for(lambda: worker.leases == 1)
+    remote.release_admission(ticket)
+    wait_for(lambda: worker.leases == 0)
+
+    # A client that goes away lets go of everything it held
+    gone = RemoteInference(address)
+    gone.admit(0.1, 1000)
+    gone.enhance(IMAGE, 'realesr-general-x4v3')
+    assert worker.leases == 2
+    gone._drop_connection()
+    wait_for(lambda: worker.leases == 0)
+    assert remote.snapshot()['tickets'] == 0
+
+
+def test_a_draining_worker_finishes_its_requests_and_is_stopped(supervisor):
+    supervisor, address = supervisor
+    workers = start_workers(supervisor, 2)
+    assert [worker.budgets for worker in workers] == [{'model_mb': 500, 'admission_mb': 300}] * 2
+
+    held = RemoteInference(address)
+    ticket = held.admit(0.1, 1000)
+    draining, = [worker for worker in workers if worker.leases]
+    other, = [worker for worker in workers if worker is not draining]
+    with supervisor._cond:
+        draining.state, draining.drain_started = DRAINING, time.monotonic()
+
+    # New work goes elsewhere...
+    remote = RemoteInference(address)
+    for _ in range(3):
+        with remote.enhance(IMAGE, 'realesr-general-x4v3'):
+            pass
+    assert supervisor.pick() is other
+    # ...while the admitted request still runs where its ticket is
+    with held.enhance(IMAGE, 'realesr-general-x4v3'):
+        pass
+    assert RemoteInference(draining.address).snapshot()['enhanced'] == 1
+    assert RemoteInference(other.address).snapshot()['enhanced'] == 3
+    assert STOP not in [decision for decision, _ in supervisor.tick()]
+
+    held.release_admission(ticket)
+    wait_for(lambda: draining.leases == 0)
+    assert supervisor.tick() == [(STOP, draining)]
+    assert supervisor.workers == [other] and draining.process.poll() is not None
+    # The remaining worker takes over the whole memory budgets
+    assert other.budgets == {'model_mb': 1000, 'admission_mb': 600}
+    assert RemoteInference(other.address).snapshot()['budgets'] == other.budgets
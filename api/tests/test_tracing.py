@@ -0,0 +1,162 @@
+import json
+import logging
+import time
+import threading
+
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+import tracing
+from image_io import StageTimer
+
+
+class ListExporter:
+    def __init__(self):
+        self.traces = []
+
+    def export(self, trace):
+        self.traces.append(trace)
+
+
+@pytest.fixture
+def exported(monkeypatch):
+    exporter = ListExporter()
+    monkeypatch.setattr(tracing, 'exporter', exporter)
+    return exporter.traces
+
+
+def by_name(trace):
+    return {span.name: span for span in trace.spans}
+
+
+def test_spans_nest_and_export_with_their_root(exported):
+    with tracing.span('orphan') as span:
+        # Outside a traced request spans cost nothing and go nowhere
+        assert span is tracing.NOOP_SPAN
+
+    timer = StageTimer()
+    with tracing.trace('POST /api/enhance', kind=tracing.SERVER) as root:
+        with timer.stage('read'):
+            with timer.stage('decode', width=640) as decode:
+                decode.set(height=480)
+        started = time.perf_counter()
+        timer.record('queue', started, tenant='ip:1')
+        assert tracing.current_span() is root
+    assert tracing.current_span() is None
+    assert set(timer.stages) == {'read', 'decode', 'queue'}
+
+    trace, = exported
+    spans = by_name(trace)
+    assert spans['decode'].parent_id == spans['read'].span_id
+    assert spans['read'].parent_id == spans['queue'].parent_id == root.span_id
+    assert spans['decode'].attributes == {'width': 640, 'height': 480}
+    assert spans['read'].start_ns <= spans['decode'].start_ns <= spans['decode'].end_ns <= spans['read'].end_ns
+    assert 'decode' in tracing.render_tree(trace.spans).splitlines()[2]
+
+
+def test_errors_and_unsampled_traces(exported, monkeypatch):
+    with pytest.raises(ValueError):
+        with tracing.trace('job'):
+            with tracing.span('inference'):
+                raise ValueError('out of memory')
+    assert by_name(exported[0])['inference'].error == 'out of memory'
+    assert by_name(exported[0])['job'].error == 'out of memory'
+
+    monkeypatch.setattr(tracing, 'TRACE_SAMPLE_RATE', 0.0)
+    with tracing.trace('fast'):
+        pass
+    assert len(exported) == 1
+    # Slow requests are exported anyway, and logged as a span tree
+    monkeypatch.setattr(tracing, 'TRACE_SLOW_MS', 0.0)
+    with tracing.trace('slow'):
+        with tracing.span('tile', index=1):
+            pass
+    assert [trace.root.name for trace in exported] == ['job', 'slow']
+
+
+def test_slow_requests_are_logged(exported, monkeypatch, caplog):
+    monkeypatch.setattr(tracing, 'TRACE_SLOW_MS', 0.0)
+    with caplog.at_level(logging.WARNING, logger='tracing'):
+        with tracing.trace('POST /api/jobs'):
+            with tracing.span('inference', tiles=4):
+                pass
+    assert 'Slow request POST /api/jobs' in caplog.text
+    assert '  inference ' in caplog.text and 'tiles=4' in caplog.text
+
+
+def test_traces_continue_across_threads_and_processes(exported):
+    header = '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'
+    parent = tracing.parse_traceparent(header)
+    assert parent == {'trace_id': '4bf92f3577b34da6a3ce929d0e0e4736', 'span_id': '00f067aa0ba902b7', 'sampled': True}
+    for malformed in (None, '', '00-xyz-00f067aa0ba902b7-01', '00-' + '0' * 32 + '-00f067aa0ba902b7-01'):
+        assert tracing.parse_traceparent(malformed) is None
+
+    with tracing.trace('GET /api/deepzoom', parent) as root:
+        assert tracing.traceparent().startswith('00-4bf92f3577b34da6a3ce929d0e0e4736-')
+        context = tracing.context()
+        # What the model server does with the context it is sent
+        replies = []
+
+        def serve():
+            with tracing.remote_trace('model_server.enhance', context) as spans:
+                with tracing.span('inference'):
+                    pass
+            replies.append(spans)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        thread.join()
+        tracing.adopt(replies[0])
+    assert root.parent_id == '00f067aa0ba902b7'
+
+    # Only the request's own trace was exported, with the server's spans in it
+    trace, = exported
+    spans = by_name(trace)
+    assert spans['model_server.enhance'].parent_id == root.span_id
+    assert spans['inference'].parent_id == spans['model_server.enhance'].span_id
+    assert {span.trace.trace_id for span in trace.spans} == {'4bf92f3577b34da6a3ce929d0e0e4736'}
+
+    with tracing.remote_trace('model_server.enhance', None) as spans:
+        pass
+    assert spans == []
+
+
+def test_upsampler_traces_every_tile(tmp_path, exported):
+    from realesrgan import RealESRGANer
+
+    model = nn.Sequential(nn.Conv2d(3, 12, 1), nn.PixelShuffle(2))
+    path = tmp_path / 'tiny.pth'
+    torch.save({'params': model.state_dict()}, path)
+    esrgan = RealESRGANer(2, str(path), model=model, tile=16, tile_pad=2, pre_pad=0, device=torch.device('cpu'))
+    img = np.random.randint(0, 256, (32, 48, 4), np.uint8)
+
+    with tracing.trace('enhance'):
+        output, _ = esrgan.enhance(img, trace=tracing.span)
+    assert output.shape == (64, 96, 4)
+    spans = exported[0].spans
+    passes = [span for span in spans if span.name == 'pass']
+    assert [span.attributes['channels'] for span in passes] == ['rgb', 'alpha']
+    tiles = [span for span in spans if span.name == 'tile']
+    # 3x2 tiles in each pass
+    assert len(tiles) == 12 and {span.parent_id for span in tiles} == {span.span_id for span in passes}
+    assert tiles[0].attributes == {'index': 1, 'x': 0, 'y': 0, 'width': 18, 'height': 18}
+
+
+def test_file_export_is_otlp_json(tmp_path, exported):
+    exporter = tracing.Exporter('file', path=str(tmp_path / 'traces.jsonl'))
+    with tracing.trace('job', job_id='abc') as root:
+        with tracing.span('tile', index=3, scale=0.5, alpha=False):
+            pass
+    exporter.export(root.trace)
+    exporter.flush()
+    with open(tmp_path / 'traces.jsonl') as f:
+        request, = [json.loads(line) for line in f]
+    spans = request['resourceSpans'][0]['scopeSpans'][0]['spans']
+    tile = next(span for span in spans if span['name'] == 'tile')
+    assert tile['parentSpanId'] == root.span_id and len(tile['traceId']) == 32
+    assert tile['attributes'] == [{'key': 'index', 'value': {'intValue': '3'}},
+                                  {'key': 'scale', 'value': {'doubleValue': 0.5}},
+                                  {'key': 'alpha', 'value': {'boolValue': False}}]
+    assert int(tile['endTimeUnixNano']) >= int(tile['startTimeUnixNano'])
@@ -0,0 +1,133 @@
+import hashlib
+import io
+import os
+import struct
+import zlib
+
+import cv2
+import numpy as np
+import pytest
+from flask import Flask, jsonify, request
+
+from uploads import PROBE_WINDOW, IngestRequest, IngestStream, ResumableUploads, UploadConflict, UploadRejected
+
+
+def png(width, height):
+    # Noise does not compress, so the file is large enough to cross the probe window
+    return cv2.imencode('.png', np.random.randint(0, 256, (height, width, 3), np.uint8))[1].tobytes()
+
+
+def bomb():
+    """Valid PNG header claiming 400 megapixels, followed by plenty of data"""
+    ihdr = struct.pack('>IIBBBBB', 20000, 20000, 8, 2, 0, 0, 0)
+    chunk = lambda kind, data: struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IDAT', os.urandom(4 * PROBE_WINDOW))
+
+
+def feed(stream, data, chunk=16 * 1024):
+    for start in range(0, len(data), chunk):
+        stream.write(data[start:start + chunk])
+    stream.seek(0)
+    return stream
+
+
+@pytest.mark.parametrize('spill_threshold', [10 ** 9, 1000])
+def test_ingest_hashes_probes_and_spools(spill_threshold, tmp_path):
+    data = png(300, 200)
+    stream = feed(IngestStream('a.png', probe=True, spill_threshold=spill_threshold, spill_dir=tmp_path), data)
+    assert stream.rejection is None
+    assert (stream.info.width, stream.info.height) == (300, 200)
+    assert stream.sha256 == hashlib.sha256(data).hexdigest()
+    assert stream.on_disk == (spill_threshold < len(data))
+    assert stream.read() == data
+    assert stream.as_array().tobytes() == data
+    stream.close()
+
+
+@pytest.mark.parametrize('data, message, status', [
+    (os.urandom(4 * PROBE_WINDOW), 'Could not read image file', 400),
+    (bomb(), 'Image too large. Maximum is 25 megapixels', 413),
+    (b'', 'Empty file', 400),
+])
+def test_ingest_rejects_while_streaming(data, message, status):
+    stream = IngestStream('a.png', probe=True)
+    for start in range(0, len(data), 16 * 1024):
+        stream.write(data[start:start + 16 * 1024])
+        if start >= PROBE_WINDOW:
+            # Rejected once the header window is in; nothing after it is kept
+            assert stream.rejection == (message, status)
+            assert stream.tell() == 0
+    stream.seek(0)
+    assert stream.rejection == (message, status)
+    assert stream.read() == b''
+    assert stream.size == len(data)
+
+
+def test_ingest_drops_oversized_upload():
+    stream = feed(IngestStream('a.png', max_size=1024 * 1024, probe=True), png(800, 800))
+    assert stream.rejection == ('File too large. Maximum size is 1MB', 400)
+    assert stream.read() == b''
+
+
+def test_request_files_are_ingested():
+    app = Flask(__name__)
+    app.request_class = IngestRequest
+
+    @app.route('/', methods=['POST'])
+    def upload():
+        image, archive = request.files['image'].stream, request.files['archive'].stream
+        return jsonify(width=image.info.width, sha256=image.sha256, rejection=image.rejection,
+                       archive_probed=archive.probe, archive=archive.read().decode())
+
+    data = png(64, 32)
+    response = app.test_client().post('/', data={'image': (io.BytesIO(data), 'a.png'),
+                                                 'archive': (io.BytesIO(b'zip bytes'), 'a.zip')})
+    assert response.get_json() == {'width': 64, 'sha256': hashlib.sha256(data).hexdigest(), 'rejection': None,
+                                   'archive_probed': False, 'archive': 'zip bytes'}
+
+
+def test_resumable_upload_resumes_from_offset(tmp_path):
+    uploads = ResumableUploads(str(tmp_path))
+    data = png(500, 400)
+    upload = uploads.create('a.png', len(data))
+    upload_id = upload['upload_id']
+    assert upload['offset'] == 0
+
+    # A chunk cut off by a dropped connection keeps what arrived
+    half = len(data) // 2
+    assert uploads.append(upload_id, 0, io.BytesIO(data[:half - 10]))['offset'] == half - 10
+    with pytest.raises(UploadConflict) as conflict:
+        uploads.append(upload_id, half, io.BytesIO(data[half:]))
+    assert conflict.value.offset == half - 10
+    assert uploads.open(upload_id) is None
+
+    upload = uploads.append(upload_id, half - 10, io.BytesIO(data[half - 10:]))
+    assert upload['complete'] and upload['offset'] == len(data)
+    assert upload['sha256'] == hashlib.sha256(data).hexdigest()
+    assert (upload['info']['width'], upload['info']['height']) == (500, 400)
+
+    with uploads.open(upload_id) as stream:
+        assert stream.sha256 == upload['sha256']
+        assert stream.info.width == 500
+        assert stream.as_array().tobytes() == data
+    assert uploads.delete(upload_id)
+    assert uploads.status(upload_id) is None
+
+
+def test_resumable_upload_rejects_early(tmp_path):
+    uploads = ResumableUploads(str(tmp_path), max_size=10 * 1024 * 1024)
+    with pytest.raises(UploadRejected) as rejected:
+        uploads.create('a.png', 11 * 1024 * 1024)
+    assert rejected.value.status == 413
+
+    data = bomb()
+    upload_id = uploads.create('a.png', len(data) * 2)['upload_id']
+    with pytest.raises(UploadRejected) as rejected:
+        uploads.append(upload_id, 0, io.BytesIO(data))
+    assert rejected.value.status == 413
+    assert uploads.status(upload_id) is None
+
+    upload_id = uploads.create('a.png', 10)['upload_id']
+    with pytest.raises(UploadRejected):
+        uploads.append(upload_id, 0, io.BytesIO(b'x' * 11))
+    assert uploads.status('../../etc/passwd') is None
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+Request tracing for the Real-ESRGAN API
+Every request is a tree of timed spans (upload, admission, decode, model switch, queue,
+inference down to each tile, encode, base64) with attributes such as the image size,
+model and tile count. Finished traces are exported as OTLP/JSON, appended to a local
+file or posted to an OTLP/HTTP collector, and slow requests are logged as a span tree.
+Spans cost a few microseconds, and nothing at all outside a traced request.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+import urllib.request
+from queue import Queue, Full
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Where finished traces go: 'file', 'otlp' (an OTLP/HTTP collector) or 'none'
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', 'file')
+TRACE_FILE = os.getenv('TRACE_FILE', os.path.join('outputs', 'traces.jsonl'))
+# The trace file is rotated to TRACE_FILE.1 at this size
+TRACE_FILE_MAX_BYTES = int(os.getenv('TRACE_FILE_MAX_MB', 100)) * 1024 * 1024
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+# Fraction of traces exported; slow traces are exported regardless
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 1.0))
+# Requests slower than this are slow: always exported, and logged with their span tree
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', 10000))
+# Fraction of slow requests whose span tree is logged
+TRACE_SLOW_LOG_RATE = float(os.getenv('TRACE_SLOW_LOG_RATE', 1.0))
+# Spans kept per trace; a huge image is thousands of tiles
+TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', 2000))
+# Traces waiting for the exporter before new ones are dropped
+TRACE_QUEUE_SIZE = 1000
+SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'hdess-api')
+
+# OTLP span kinds and status codes
+INTERNAL, SERVER = 1, 2
+STATUS_ERROR = 2
+
+_current = contextvars.ContextVar('span', default=None)
+
+
+def _id(bits):
+    return f'{random.getrandbits(bits):0{bits // 4}x}'
+
+
+class _Trace:
+    """The spans of one local root span, exported together when it ends"""
+
+    def __init__(self, trace_id, sampled, remote=False):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        # Traces continued from another process hand their spans back instead of exporting them
+        self.remote = remote
+        self.root = None
+        self.spans = []
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            if len(self.spans) < TRACE_MAX_SPANS:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+
+class Span:
+    """A timed operation within a trace. Use ``set`` to add attributes while it runs"""
+
+    def __init__(self, trace, name, parent_id=None, kind=INTERNAL, attributes=None, start_ns=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = _id(64)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns() if start_ns is None else start_ns
+        self.end_ns = None
+        self.error = None
+        self._previous = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+    def fail(self, error):
+        self.error = str(error) or type(error).__name__
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def end(self, end_ns=None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns() if end_ns is None else end_ns
+        self.trace.add(self)
+        if _current.get() is self:
+            _current.set(self._previous)
+        if self is self.trace.root:
+            _finish(self.trace, self)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'kind': self.kind,
+            'attributes': self.attributes,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'error': self.error
+        }
+
+
+class _NoopSpan:
+    """Stands in for a span outside a traced request"""
+
+    def set(self, **attributes):
+        return self
+
+    def fail(self, error):
+        pass
+
+    def end(self, end_ns=None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def current_span():
+    """The span running in this context, or None outside a traced request"""
+    return _current.get()
+
+
+def start_trace(name, parent=None, kind=INTERNAL, remote=False, **attributes):
+    """Start the local root span of a request, job or server operation and make it current.
+
+    ``parent`` continues a trace from elsewhere (a ``context()`` dict or the result of
+    ``parse_traceparent``). Call ``end()`` on the span, or use ``trace``.
+    """
+    if parent:
+        trace = _Trace(parent['trace_id'], parent.get('sampled', True), remote)
+        parent_id = parent.get('span_id')
+    else:
+        trace = _Trace(_id(128), random.random() < TRACE_SAMPLE_RATE, remote)
+        parent_id = None
+    span = Span(trace, name, parent_id, kind, attributes)
+    trace.root = span
+    span._previous = _current.get()
+    _current.set(span)
+    return span
+
+
+@contextmanager
+def trace(name, parent=None, **attributes):
+    """Run the enclosed block as the local root span of a trace"""
+    span = start_trace(name, parent, **attributes)
+    try:
+        yield span
+    except BaseException as e:
+        span.fail(e)
+        raise
+    finally:
+        span.end()
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time the enclosed block as a child of the current span (a no-op outside a trace)"""
+    parent = _current.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+    child = Span(parent.trace, name, parent.span_id, attributes=attributes)
+    child._previous = parent
+    _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.fail(e)
+        raise
+    finally:
+        child.end()
+
+
+def record(name, since, **attributes):
+    """Add a child span of the current span that started at ``since`` (a perf_counter value) and ends now"""
+    parent = _current.get()
+    if parent is None:
+        return
+    now_ns = time.time_ns()
+    start_ns = now_ns - int((time.perf_counter() - since) * 1e9)
+    Span(parent.trace, name, parent.span_id, attributes=attributes, start_ns=start_ns).end(now_ns)
+
+
+def context():
+    """Identify the current span to continue its trace in another thread or process (None outside a trace)"""
+    current = _current.get()
+    if current is None:
+        return None
+    return {'trace_id': current.trace.trace_id, 'span_id': current.span_id, 'sampled': current.trace.sampled}
+
+
+def traceparent():
+    """W3C traceparent header of the current span"""
+    current = _current.get()
+    if current is None:
+        return None
+    return f"00-{current.trace.trace_id}-{current.span_id}-{'01' if current.trace.sampled else '00'}"
+
+
+def parse_traceparent(header):
+    """Parent context from a W3C traceparent header; None if it is missing or malformed"""
+    parts = (header or '').strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        trace_id, span_id, flags = int(parts[1], 16), int(parts[2], 16), int(parts[3], 16)
+    except ValueError:
+        return None
+    if not trace_id or not span_id:
+        return None
+    return {'trace_id': parts[1].lower(), 'span_id': parts[2].lower(), 'sampled': bool(flags & 1)}
+
+
+@contextmanager
+def remote_trace(name, parent, **attributes):
+    """Trace an operation on behalf of another process.
+
+    Yields a list that holds the spans (as dicts) once the block is done, to send back
+    with the reply and ``adopt`` there. Nothing is traced without a ``parent``.
+    """
+    spans = []
+    if not parent:
+        yield spans
+        return
+    root = start_trace(name, parent, remote=True, **attributes)
+    try:
+        yield spans
+    except BaseException as e:
+        root.fail(e)
+        raise
+    finally:
+        root.end()
+        spans.extend(span.to_dict() for span in root.trace.spans)
+
+
+def adopt(spans):
+    """Add spans traced by another process (see ``remote_trace``) to the current trace"""
+    current = _current.get()
+    if current is None or not spans:
+        return
+    for data in spans:
+        span = Span(current.trace, data['name'], data['parent_id'], data['kind'], data['attributes'],
+                    data['start_ns'])
+        span.span_id = data['span_id']
+        span.error = data['error']
+        span.end_ns = data['end_ns']
+        current.trace.add(span)
+
+
+def _finish(trace, root):
+    if trace.remote:
+        return
+    slow = root.duration_ms >= TRACE_SLOW_MS
+    if slow and random.random() < TRACE_SLOW_LOG_RATE:
+        logger.warning(f"🐢 Slow request {root.name} took {root.duration_ms:.0f}ms (trace {trace.trace_id}):\n"
+                       f"{render_tree(trace.spans)}")
+    if trace.sampled or slow:
+        exporter.export(trace)
+
+
+def render_tree(spans):
+    """Indented span tree with durations and attributes, for logs"""
+    children = {}
+    ids = {span.span_id for span in spans}
+    for span in sorted(spans, key=lambda span: span.start_ns):
+        parent = span.parent_id if span.parent_id in ids else None
+        children.setdefault(parent, []).append(span)
+    lines = []
+
+    def walk(parent, depth):
+        for span in children.get(parent, []):
+            attributes = ' '.join(f'{key}={value}' for key, value in span.attributes.items())
+            error = f' ERROR {span.error}' if span.error else ''
+            lines.append(f"{'  ' * depth}{span.name} {span.duration_ms:.1f}ms {attributes}{error}".rstrip())
+            walk(span.span_id, depth + 1)
+
+    walk(None, 0)
+    return '\n'.join(lines)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def to_otlp(trace):
+    """A trace as an OTLP/JSON ExportTraceServiceRequest"""
+    spans = []
+    for span in trace.spans:
+        otlp = {
+            'traceId': trace.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': span.kind,
+            'startTimeUnixNano': str(span.start_ns),
+            'endTimeUnixNano': str(span.end_ns),
+            'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in span.attributes.items()]
+        }
+        if span.parent_id:
+            otlp['parentSpanId'] = span.parent_id
+        if span.error:
+            otlp['status'] = {'code': STATUS_ERROR, 'message': span.error}
+        spans.append(otlp)
+    resource = [{'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]
+    if trace.dropped:
+        resource.append({'key': 'hdess.dropped_spans', 'value': {'intValue': str(trace.dropped)}})
+    return {'resourceSpans': [{
+        'resource': {'attributes': resource},
+        'scopeSpans': [{'scope': {'name': 'hdess.tracing'}, 'spans': spans}]
+    }]}
+
+
+class Exporter:
+    """Export finished traces from a background thread so requests never wait on it.
+
+    Args:
+        mode (str): 'file' appends one OTLP/JSON request per line to ``path`` (readable by
+            an OpenTelemetry collector's otlpjsonfile receiver); 'otlp' posts them to
+            ``endpoint``; 'none' drops them. Default: TRACE_EXPORT.
+        path (str): Default: TRACE_FILE.
+        endpoint (str): OTLP/HTTP traces URL. Default: TRACE_OTLP_ENDPOINT.
+    """
+
+    def __init__(self, mode=TRACE_EXPORT, path=TRACE_FILE, endpoint=TRACE_OTLP_ENDPOINT):
+        self.mode = mode
+        self.path = path
+        self.endpoint = endpoint
+        self._queue = Queue(TRACE_QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._failing = False
+
+    def export(self, trace):
+        if self.mode == 'none':
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='trace-export', daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except Full:
+            pass
+
+    def flush(self, timeout=5.0):
+        """Wait until the traces queued so far are exported"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            try:
+                self._write(json.dumps(to_otlp(trace)))
+                if self._failing:
+                    logger.info(f"Trace export to {self.path if self.mode == 'file' else self.endpoint} recovered")
+                self._failing = False
+            except (OSError, ValueError) as e:
+                # Logged once per outage rather than per trace
+                if not self._failing:
+                    logger.warning(f"⚠️ Could not export traces: {e}")
+                self._failing = True
+            finally:
+                self._queue.task_done()
+
+    def _write(self, body):
+        if self.mode == 'otlp':
+            request = urllib.request.Request(self.endpoint, data=body.encode(),
+                                             headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request, timeout=5):
+                pass
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= TRACE_FILE_MAX_BYTES:
+            os.replace(self.path, f'{self.path}.1')
+        with open(self.path, 'a') as f:
+            f.write(body + '\n')
+
+
+exporter = Exporter()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Streaming ingestion and resumable uploads
+Multipart file parts are hashed, header-probed and spooled in one pass while the
+request body is parsed, and a file that is too large or not an image is discarded
+as soon as that is known instead of after it was buffered. Large files can also be
+sent in chunks to a resumable upload and referenced by its id afterwards.
+"""
+
+import os
+import io
+import re
+import json
+import time
+import uuid
+import hashlib
+import tempfile
+
+import numpy as np
+from flask import Request
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends to one upload are not serialized across processes
+    fcntl = None
+
+import tracing
+from image_io import SPILL_THRESHOLD, COPY_CHUNK_SIZE
+from image_probe import ImageInfo, check_image_info, probe_image, sniff_format
+
+# Largest single image upload; above the spill threshold uploads are spooled to disk
+MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_MB', 10)) * 1024 * 1024
+# Largest resumable upload, sent in chunks of any size up to the declared total
+MAX_RESUMABLE_SIZE = int(os.getenv('MAX_RESUMABLE_UPLOAD_MB', 200)) * 1024 * 1024
+RESUMABLE_CHUNK_SIZE = int(os.getenv('RESUMABLE_CHUNK_MB', 8)) * 1024 * 1024
+# Unfinished or unused resumable uploads are removed after this long without activity
+UPLOAD_SESSION_TTL = int(os.getenv('UPLOAD_SESSION_TTL', 3600))
+# Bytes after which a header must have been recognized; every supported format has
+# its dimensions well within this, only the frame count may come later
+PROBE_WINDOW = 64 * 1024
+
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _too_large(max_size):
+    return f'File too large. Maximum size is {max_size // (1024 * 1024)}MB'
+
+
+def check_header(stream, complete):
+    """Probe a partly or fully received image; returns its ImageInfo and a rejection.
+
+    The rejection is None or an (error message, HTTP status) pair. Before the
+    upload is complete a header that cannot be read yet is not an error, unless
+    the file does not even start like an image.
+    """
+    position = stream.tell()
+    stream.seek(0)
+    signature = stream.read(12)
+    stream.seek(0)
+    info = probe_image(stream)
+    stream.seek(position)
+    if info is None and not complete and (len(signature) < 12 or sniff_format(signature) is not None):
+        return None, None
+    return info, check_image_info(info)
+
+
+class IngestStream:
+    """Writable and then readable spool of one uploaded file.
+
+    Bytes are hashed as they arrive and kept in memory up to ``spill_threshold``,
+    then in a temporary file. With ``probe`` set, the image header is checked once
+    ``PROBE_WINDOW`` bytes are in and again at the end; a file that is rejected, or
+    grows past ``max_size``, has its bytes dropped instead of spooled and carries
+    the reason in ``rejection``. Writing ends with the first seek or read.
+    """
+
+    def __init__(self, filename=None, max_size=None, probe=False, spill_threshold=SPILL_THRESHOLD,
+                 spill_dir=None):
+        self.filename = filename
+        self.max_size = max_size
+        self.probe = probe
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.size = 0
+        self.info = None
+        self.rejection = None
+        self._sha256 = hashlib.sha256()
+        self._digest = None
+        self._file = io.BytesIO()
+        self._on_disk = False
+        self._finished = False
+        self._probed = False
+
+    @classmethod
+    def open(cls, path, filename=None, sha256=None, info=None):
+        """Read-only stream over a file already received, e.g. a finished resumable upload"""
+        stream = cls(filename)
+        stream._file = open(path, 'rb')
+        stream._on_disk = True
+        stream._finished = True
+        stream._digest = sha256
+        stream.size = os.path.getsize(path)
+        stream.info = info
+        return stream
+
+    @property
+    def on_disk(self):
+        return self._on_disk
+
+    @property
+    def sha256(self):
+        """Hex digest of everything received, including bytes dropped after a rejection"""
+        self.finish()
+        if self._digest is None:
+            self._digest = self._sha256.hexdigest()
+        return self._digest
+
+    def _reject(self, message, status):
+        self.rejection = (message, status)
+        self._file.close()
+        self._file = io.BytesIO()
+        self._on_disk = False
+
+    def write(self, data):
+        if self._finished:
+            raise ValueError('Upload is already complete')
+        self._sha256.update(data)
+        self.size += len(data)
+        if self.rejection is not None:
+            return len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self._reject(_too_large(self.max_size), 400)
+            return len(data)
+
+        if not self._on_disk and self.size > self.spill_threshold:
+            spill = tempfile.TemporaryFile(suffix='.upload', dir=self.spill_dir)
+            spill.write(self._file.getbuffer())
+            self._file = spill
+            self._on_disk = True
+        self._file.write(data)
+
+        if self.probe and not self._probed and self.size >= PROBE_WINDOW:
+            self._probed = True
+            self.info, rejection = check_header(self._file, complete=False)
+            if rejection is not None:
+                self._reject(*rejection)
+        return len(data)
+
+    def finish(self):
+        """End writing: the final header check runs and the stream is rewound"""
+        if self._finished:
+            return
+        self._finished = True
+        if self.probe and self.rejection is None:
+            if self.size == 0:
+                self._reject('Empty file', 400)
+            else:
+                self.info, rejection = check_header(self._file, complete=True)
+                if rejection is not None:
+                    self._reject(*rejection)
+        self._file.flush()
+        self._file.seek(0)
+
+    def as_array(self):
+        """The spooled bytes as a uint8 array, memory-mapped instead of read when on disk"""
+        self.finish()
+        if self._on_disk:
+            self._file.flush()
+            if self.size == 0:
+                return np.empty(0, dtype=np.uint8)
+            return np.memmap(self._file, dtype=np.uint8, mode='r')
+        # getvalue() shares the buffer when it is not over-allocated; getbuffer() would stop close()
+        return np.frombuffer(self._file.getvalue(), dtype=np.uint8)
+
+    # File interface for werkzeug, zipfile and cv2 readers
+
+    def read(self, size=-1):
+        self.finish()
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        self.finish()
+        return self._file.readline(size)
+
+    def readinto(self, buffer):
+        self.finish()
+        return self._file.readinto(buffer)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # werkzeug rewinds a file part once all of it was received
+        self.finish()
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return not self._finished
+
+    def flush(self):
+        self._file.flush()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class IngestRequest(Request):
+    """Flask request whose uploaded files are parsed into IngestStreams.
+
+    Files with an image extension are probed and limited to ``max_file_size``;
+    other files (archives) are only hashed and spooled.
+    """
+
+    image_extensions = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+    max_file_size = MAX_UPLOAD_SIZE
+    spill_dir = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        extension = filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else ''
+        if extension in self.image_extensions:
+            return IngestStream(filename, max_size=self.max_file_size, probe=True, spill_dir=self.spill_dir)
+        return IngestStream(filename, spill_dir=self.spill_dir)
+
+    def _load_form_data(self):
+        # The body is read, hashed, probed and spooled here, as the request's 'upload' span
+        with tracing.span('upload', bytes=self.content_length or 0):
+            super()._load_form_data()
+
+
+class UploadRejected(Exception):
+    """A resumable upload was refused and removed; ``status`` is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class UploadConflict(Exception):
+    """A chunk did not start at the upload's current offset"""
+
+    def __init__(self, offset):
+        super().__init__(f'Upload is at offset {offset}')
+        self.offset = offset
+
+
+class ResumableUploads:
+    """Chunked uploads kept on disk, so any worker process can take the next chunk.
+
+    Each upload is a data file plus a JSON metadata file in ``directory``. The
+    offset is the size of the data file: a chunk cut off by a dropped connection
+    keeps what arrived, and the client resumes from the offset it reads back. The
+    header is checked as soon as enough of it arrived, and the content hash once
+    the last chunk is in.
+    """
+
+    def __init__(self, directory, max_size=MAX_RESUMABLE_SIZE, ttl=UPLOAD_SESSION_TTL):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, upload_id):
+        if not _UPLOAD_ID.match(upload_id or ''):
+            return None, None
+        base = os.path.join(self.directory, upload_id)
+        return f'{base}.data', f'{base}.json'
+
+    def _save(self, meta_path, meta):
+        partial_path = f'{meta_path}.part'
+        with open(partial_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(partial_path, meta_path)
+
+    def cleanup(self):
+        """Remove uploads idle for longer than the TTL"""
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def create(self, filename, size):
+        """Start an upload of ``size`` bytes; raises UploadRejected if it is too large"""
+        if size <= 0:
+            raise UploadRejected('Empty file')
+        if size > self.max_size:
+            raise UploadRejected(_too_large(self.max_size), 413)
+        self.cleanup()
+        upload_id = uuid.uuid4().hex
+        data_path, meta_path = self._paths(upload_id)
+        open(data_path, 'wb').close()
+        meta = {'upload_id': upload_id, 'filename': filename, 'size': size, 'created': time.time(),
+                'complete': False, 'sha256': None, 'info': None}
+        self._save(meta_path, meta)
+        return self.status(upload_id)
+
+    def status(self, upload_id):
+        """Metadata and current offset of an upload, or None if it does not exist"""
+        data_path, meta_path = self._paths(upload_id)
+        if meta_path is None:
+            return None
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            meta['offset'] = os.path.getsize(data_path)
+        except (OSError, ValueError):
+            return None
+        return meta
+
+    def append(self, upload_id, offset, stream):
+        """Write a chunk read from ``stream`` at ``offset``; returns the upload's status.
+
+        Returns None for an unknown upload. Raises UploadConflict when ``offset`` is
+        not the current offset, and UploadRejected (after removing the upload) when
+        the data runs past the declared size or is not an acceptable image.
+        """
+        data_path, meta_path = self._paths(upload_id)
+        meta = self.status(upload_id)
+        if meta is None:
+            return None
+        del meta['offset']
+        with open(data_path, 'r+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            current = f.seek(0, os.SEEK_END)
+            if offset != current or meta['complete']:
+                raise UploadConflict(current)
+            remaining = meta['size'] - current
+            try:
+                while True:
+                    chunk = stream.read(min(COPY_CHUNK_SIZE, remaining + 1))
+                    if not chunk:
+                        break
+                    if len(chunk) > remaining:
+                        self.delete(upload_id)
+                        raise UploadRejected('Chunk runs past the declared upload size', 413)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+                    if meta['info'] is None and f.tell() >= PROBE_WINDOW:
+                        self._check_header(upload_id, f, meta, complete=False)
+            finally:
+                f.flush()
+            offset = f.tell()
+
+            if offset == meta['size']:
+                # Checked again for the frame count, which may come after the header window
+                self._check_header(upload_id, f, meta, complete=True)
+                f.seek(0)
+                digest = hashlib.sha256()
+                for block in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                    digest.update(block)
+                meta['complete'] = True
+                meta['sha256'] = digest.hexdigest()
+            self._save(meta_path, meta)
+        meta['offset'] = offset
+        return meta
+
+    def _check_header(self, upload_id, f, meta, complete):
+        f.flush()
+        info, rejection = check_header(f, complete)
+        if rejection is not None:
+            self.delete(upload_id)
+            raise UploadRejected(*rejection)
+        if info is not None:
+            meta['info'] = info.to_dict()
+
+    def open(self, upload_id):
+        """IngestStream over a finished upload, or None if it does not exist or is unfinished"""
+        meta = self.status(upload_id)
+        if meta is None or not meta['complete']:
+            return None
+        data_path, _ = self._paths(upload_id)
+        info = ImageInfo(**meta['info']) if meta['info'] is not None else None
+        return IngestStream.open(data_path, meta['filename'], meta['sha256'], info)
+
+    def delete(self, upload_id):
+        """Remove an upload; returns whether it existed"""
+        existed = False
+        for path in self._paths(upload_id):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+                existed = True
+        return existed
@@ -5,14 +5,11 @@ Simple backend starter without problematic dependencies
 
 import os
 import sys
-import cv2
-import base64
 import numpy as np
 import torch
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import tempfile
-import uuid
 from datetime import datetime
 
 # Add Real-ESRGAN path
@@ -22,6 +19,11 @@ from basicsr.archs.rrdbnet_arch import RRDBNet
 from realesrgan import RealESRGANer
 from realesrgan.archs.srvgg_arch import SRVGGNetCompact
 
+# Shared in-memory image I/O helpers
+sys.path.append(os.path.join(os.path.dirname(__file__), 'api'))
+from image_io import StageTimer, UploadBuffer, decode_image, encode_image, bytes_to_base64
+from image_probe import check_image_info, probe_image
+
 app = Flask(__name__)
 CORS(app)
 
@@ -123,11 +125,6 @@ def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def image_to_base64(image_path):
-    """Convert image to base64 string"""
-    with open(image_path, "rb") as img_file:
-        return base64.b64encode(img_file.read()).decode('utf-8')
-
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -172,39 +169,36 @@ def enhance_image():
         if file_size == 0:
             return jsonify({'error': 'Empty file'}), 400
         
-        # Generate unique filename
-        unique_id = str(uuid.uuid4())
-        input_filename = f"{unique_id}_input.png"
-        output_filename = f"{unique_id}_output.png"
+        # Check the dimensions from the header before decoding
+        error = check_image_info(probe_image(file.stream))
+        if error is not None:
+            message, status = error
+            return jsonify({'error': message}), status
         
-        input_path = os.path.join(UPLOAD_FOLDER, input_filename)
-        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+        timer = StageTimer()
         
-        # Save uploaded file
-        file.save(input_path)
+        # Read the upload into memory (spilled to disk only above the threshold)
+        with timer.stage('read'), UploadBuffer(file, spill_dir=UPLOAD_FOLDER) as upload:
+            original_size = upload.size
+            spilled = upload.spilled
+            with timer.stage('decode'):
+                img = decode_image(upload.data)
         
-        # Read and process image
-        img = cv2.imread(input_path, cv2.IMREAD_UNCHANGED)
         if img is None:
             return jsonify({'error': 'Could not read image file'}), 400
         
         # Enhance image
-        print(f"Enhancing image: {input_filename}")
-        enhanced_img, _ = upsampler.enhance(img, outscale=4)
+        print(f"Enhancing image: {file.filename} ({img.shape[1]}x{img.shape[0]})")
+        with timer.stage('inference'):
+            enhanced_img, _ = upsampler.enhance(img, outscale=4)
         
-        # Save enhanced image
-        cv2.imwrite(output_path, enhanced_img)
+        # Encode enhanced image in memory
+        with timer.stage('encode'):
+            enhanced_bytes = encode_image(enhanced_img, '.png')
         
         # Convert to base64 for response
-        enhanced_base64 = image_to_base64(output_path)
-        
-        # Get file sizes
-        original_size = os.path.getsize(input_path)
-        enhanced_size = os.path.getsize(output_path)
-        
-        # Clean up files
-        os.remove(input_path)
-        os.remove(output_path)
+        with timer.stage('base64'):
+            enhanced_base64 = bytes_to_base64(enhanced_bytes)
         
         return jsonify({
             'success': True,
@@ -212,8 +206,10 @@ def enhance_image():
             'model_used': current_model,
             'scale': 4,
             'original_size': original_size,
-            'enhanced_size': enhanced_size,
-            'device': 'GPU' if torch.cuda.is_available() else 'CPU'
+            'enhanced_size': len(enhanced_bytes),
+            'device': 'GPU' if torch.cuda.is_available() else 'CPU',
+            'timings': timer.breakdown(),
+            'disk_io': {'spilled': spilled, 'round_trips': 2 if spilled else 0}
         })
         
     except Exception as e: